@@ -5,6 +5,8 @@ import signal
 import sys
 
 from .main import WorkerMain
+from .main import export_manifest_main
+from .main import prewarm_main
 
 
 MAX_MESSAGE_LENGTH = 16 * 1024 * 1024
@@ -18,9 +20,28 @@ def _handle_exception(exc_type, exc_value, exc_traceback):
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
-    parser.add_argument("config_file")
+    if len(sys.argv) > 1 and sys.argv[1] == "prewarm":
+        parser.prog += " prewarm"
+        parser.add_argument("config_file")
+        parser.add_argument("manifest")
+        args_list = sys.argv[2:]
+        command = "prewarm"
+    elif len(sys.argv) > 1 and sys.argv[1] == "export-manifest":
+        parser.prog += " export-manifest"
+        parser.add_argument("config_file")
+        parser.add_argument(
+            "output", nargs="?", default="-", help="default stdout"
+        )
+        args_list = sys.argv[2:]
+        command = "export-manifest"
+    else:
+        parser.add_argument("config_file")
+        args_list = sys.argv[1:]
+        command = "run"
     parser.add_argument("--log-file", default=None)
-    return parser.parse_args()
+    args = parser.parse_args(args_list)
+    args.command = command
+    return args
 
 
 def main() -> None:
@@ -36,6 +57,12 @@ def main() -> None:
     else:
         logging.basicConfig(level=logging.INFO, format=log_foramt)
 
+    if args.command == "prewarm":
+        prewarm_main(args.config_file, args.manifest)
+        return
+    if args.command == "export-manifest":
+        export_manifest_main(args.config_file, args.output)
+        return
     worker_main = WorkerMain(args.config_file)
     signal.signal(signal.SIGINT, lambda s, f: worker_main.graceful_shutdown())
     signal.signal(signal.SIGTERM, lambda s, f: worker_main.graceful_shutdown())
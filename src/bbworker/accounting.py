@@ -0,0 +1,106 @@
+import os
+import threading
+import typing
+
+
+class InodeAccounting(object):
+    """Space accounting of file cache inodes shared with cached directories.
+
+    When the directory builder hardlinks from the file cache, a cached
+    directory and the file cache hold the same inode. Removing the file from
+    the file cache frees nothing while a directory still links it, and the
+    file cache would download it again into a new inode. The builder holds
+    the files of every cached directory here, and the file cache skips held
+    files when it evicts.
+
+    Other links, e.g. from the build directories of running actions, are
+    seen through st_nlink.
+
+    The file cache reports the files it counts in its size with add_cached
+    and discard_cached, so held_cached_bytes tells how much of its size the
+    cached directories account for already.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        # name in cache -> (links held by cached directories, size)
+        self._refs: typing.Dict[str, typing.Tuple[int, int]] = {}
+        self._held_bytes = 0
+        # names counted by the file cache.
+        self._cached: typing.Set[str] = set()
+        self._held_cached_bytes = 0
+
+    @property
+    def held_bytes(self) -> int:
+        """Bytes of distinct files held by cached directories."""
+        return self._held_bytes
+
+    @property
+    def held_cached_bytes(self) -> int:
+        """Bytes of held files which the file cache counts too."""
+        return self._held_cached_bytes
+
+    def hold(self, files: typing.Iterable[typing.Tuple[str, int]]) -> None:
+        """Hold (name_in_cache, size_bytes) of files linked by a cached
+        directory. Files linked more than once are held more than once.
+        """
+        with self._lock:
+            for name, size_bytes in files:
+                count, _ = self._refs.get(name, (0, size_bytes))
+                if count == 0:
+                    self._held_bytes += size_bytes
+                    if name in self._cached:
+                        self._held_cached_bytes += size_bytes
+                self._refs[name] = (count + 1, size_bytes)
+
+    def release(self, files: typing.Iterable[typing.Tuple[str, int]]) -> None:
+        """Release what hold took."""
+        with self._lock:
+            for name, _ in files:
+                count, size_bytes = self._refs[name]
+                if count == 1:
+                    del self._refs[name]
+                    self._held_bytes -= size_bytes
+                    if name in self._cached:
+                        self._held_cached_bytes -= size_bytes
+                else:
+                    self._refs[name] = (count - 1, size_bytes)
+
+    def is_held(self, name_in_cache: str) -> bool:
+        return name_in_cache in self._refs
+
+    def add_cached(self, name_in_cache: str) -> None:
+        """The file cache counts the file in its size from now on."""
+        with self._lock:
+            if name_in_cache in self._cached:
+                return
+            self._cached.add(name_in_cache)
+            ref = self._refs.get(name_in_cache)
+            if ref is not None:
+                self._held_cached_bytes += ref[1]
+
+    def discard_cached(self, name_in_cache: str) -> None:
+        """The file cache doesn't count the file anymore."""
+        with self._lock:
+            if name_in_cache not in self._cached:
+                return
+            self._cached.discard(name_in_cache)
+            ref = self._refs.get(name_in_cache)
+            if ref is not None:
+                self._held_cached_bytes -= ref[1]
+
+    def clear_cached(self) -> None:
+        """The file cache counts nothing, e.g. before it loads its files."""
+        with self._lock:
+            self._cached.clear()
+            self._held_cached_bytes = 0
+
+    @staticmethod
+    def link_count(path: str) -> int:
+        """Links to the inode of path, 0 if it doesn't exist. Unlinking
+        path frees its space only if this is 1.
+        """
+        try:
+            return os.stat(path).st_nlink
+        except FileNotFoundError:
+            return 0
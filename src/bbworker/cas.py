@@ -17,6 +17,10 @@ from build.bazel.remote.execution.v2.remote_execution_pb2 import (
     BatchUpdateBlobsRequest,
 )
 from build.bazel.remote.execution.v2.remote_execution_pb2 import Digest
+from build.bazel.remote.execution.v2.remote_execution_pb2 import Directory
+from build.bazel.remote.execution.v2.remote_execution_pb2 import (
+    GetTreeRequest,
+)
 from build.bazel.remote.execution.v2.remote_execution_pb2_grpc import (
     ContentAddressableStorageStub,
 )
@@ -277,6 +281,27 @@ class CASHelper(object):
                 failed_digests,
             )
 
+    def get_tree(
+        self, root_digest: Digest, page_size: int = 10000
+    ) -> typing.Iterator[Directory]:
+        """Yield every Directory of the tree under root_digest, root
+        included, with the GetTree RPC. Continue with the page token when
+        the server ends the stream early.
+        """
+        page_token = ""
+        while True:
+            request = GetTreeRequest(
+                root_digest=root_digest,
+                page_size=page_size,
+                page_token=page_token,
+            )
+            page_token = ""
+            for response in self._cas_stub.GetTree(request):
+                yield from response.directories
+                page_token = response.next_page_token
+            if not page_token:
+                break
+
     def _read_bytes_from_stream(self, digest: Digest):
         resource_name = "blobs/{hash_}/{size}".format(
             hash_=digest.hash, size=digest.size_bytes
@@ -5,6 +5,8 @@ from pydantic import BaseModel
 from pydantic import BaseSettings
 from pydantic import validator
 
+from .verify import parse_verify_level
+
 
 _KB = 1024
 _MB = 1024 * 1024
@@ -44,11 +46,36 @@ class FileSystemConfig(BaseModel):
     max_cache_size_bytes: int = 0
     concurrency: int = 10
     download_batch_size_bytes: int = 3 * 1024 * 1024
+    hash_concurrency: int = 2
+    download_queue_size: int = 64
+    # share cache_root with other bbworker processes on the same host.
+    shared: bool = False
+    # threads linking files of a large directory. more helps on SSD.
+    link_concurrency: int = 4
+    # watch cached files with inotify instead of stat them before linking.
+    watch_cache: bool = False
+    # none, metadata, sampled or full, see verify.py. fingerprints of
+    # verified files are kept in fingerprint_path, defaults to cache_root
+    # with a ".fingerprints" suffix.
+    verify_level: str = "full"
+    verify_sample_ratio: float = 0.1
+    fingerprint_path: str | None = None
+    # hash scrub_bytes_per_interval of cached files in background every
+    # interval, unless verify_level is full. 0 disables it.
+    scrub_interval_seconds: float = 0
+    scrub_bytes_per_interval: int = 64 * 1024 * 1024
 
     _max_cache_size_bytes_validator = validator(
-        "max_cache_size_bytes", pre=True, allow_reuse=True
+        "max_cache_size_bytes",
+        "scrub_bytes_per_interval",
+        pre=True,
+        allow_reuse=True,
     )(parse_size_bytes)
 
+    _verify_level_validator = validator("verify_level", allow_reuse=True)(
+        parse_verify_level
+    )
+
     _download_batch_size_bytes_validator = validator(
         "download_batch_size_bytes", pre=True, allow_reuse=True
     )(parse_size_bytes)
@@ -58,11 +85,92 @@ class BuildDirectoryBuilderConfig(BaseModel):
     cache_root: str
     max_cache_size_bytes: int = 0
     concurrency: int = 10
+    # the file cache doesn't evict files cached directories hardlink, and
+    # evicts files linked nowhere else first. keep max_cache_size_bytes
+    # below the one of the file cache.
+    inode_accounting: bool = False
+    # resolve input trees with the GetTree RPC first.
+    use_get_tree: bool = False
+    # start building subdirectories as soon as they are resolved, instead
+    # of resolving the whole input tree first.
+    streaming: bool = False
+    # estimated memory of resolved input trees kept in memory.
+    max_directory_data_bytes: int = 256 * 1024 * 1024
+    # keep Directory messages and their checksums on disk across restarts.
+    directory_store_root: str | None = None
+    directory_store_size_bytes: int = 1024 * 1024 * 1024
+    # update build directories from the inputs of their last action instead
+    # of building them from scratch.
+    incremental: bool = False
+    # manifests of cached directories, which let a restart verify them
+    # from metadata instead of hashing every file. defaults to cache_root
+    # with a ".manifests" suffix.
+    manifest_root: str | None = None
+    # like the ones of the file cache. the weaker levels rely on the
+    # manifests.
+    verify_level: str = "metadata"
+    verify_sample_ratio: float = 0.1
+    scrub_interval_seconds: float = 0
+    scrub_bytes_per_interval: int = 64 * 1024 * 1024
+    # subdirectories of input roots built as real directories whose own
+    # subdirectories are laid out on their own, and ones never cached
+    # because actions write there.
+    large_directories: typing.List[str] = ["engine", "external"]
+    skip_cache: typing.List[str] = ["bazel-out"]
+    # cache other subtrees at any depth when they hold min_unit_bytes or
+    # min_unit_files, or were used min_unit_seen times, and build the rest
+    # in place. subtrees over max_unit_bytes are split. 0 disables a limit.
+    adaptive_granularity: bool = False
+    min_unit_bytes: int = 1024 * 1024
+    min_unit_files: int = 64
+    min_unit_seen: int = 3
+    max_unit_bytes: int = 0
+    # evicted cached directories and removed build trees are moved here and
+    # removed in background at best effort I/O priority trash_io_nice (0 to
+    # 7, None keeps it). defaults to cache_root with a ".trash" suffix. it
+    # must be on the filesystem of cache_root, build trees on another one
+    # are removed at once.
+    trash_root: str | None = None
+    trash_io_nice: int | None = 7
 
     _max_cache_size_bytes_validator = validator(
-        "max_cache_size_bytes", pre=True, allow_reuse=True
+        "max_cache_size_bytes",
+        "max_directory_data_bytes",
+        "directory_store_size_bytes",
+        "scrub_bytes_per_interval",
+        "min_unit_bytes",
+        "max_unit_bytes",
+        pre=True,
+        allow_reuse=True,
     )(parse_size_bytes)
 
+    _verify_level_validator = validator("verify_level", allow_reuse=True)(
+        parse_verify_level
+    )
+
+
+class PrefetchConfig(BaseModel):
+    # prefetch inputs needed by at least this share of recent actions.
+    min_probability: float = 0.5
+    max_bytes_per_round: int = 256 * 1024 * 1024
+    # decay of input frequencies per recorded action.
+    decay: float = 0.9
+    unused_ttl_seconds: float = 600
+    # share of download bandwidth compared to a runner slot.
+    weight: float = 0.1
+
+    _max_bytes_per_round_validator = validator(
+        "max_bytes_per_round", pre=True, allow_reuse=True
+    )(parse_size_bytes)
+
+
+class DoubleBufferConfig(BaseModel):
+    # keep linked the top-level cached directories used by at least this
+    # share of the recent actions of a slot.
+    min_probability: float = 0.5
+    # decay of their frequencies per action.
+    decay: float = 0.9
+
 
 class Property(BaseModel):
     name: str
@@ -91,5 +199,9 @@ class Config(BaseSettings):
     build_directory_builder: BuildDirectoryBuilderConfig
     build_root: str
     concurrency: int = 1
+    prefetch: PrefetchConfig | None
+    # every slot alternates between build_root/<slot> and
+    # build_root/<slot>.b, cleaned and prepared in background.
+    double_buffer: DoubleBufferConfig | None
     sentry: Sentry | None
     open_telemetry: OpenTelemetry | None
@@ -0,0 +1,180 @@
+"""Small dependent tasks run by a work-stealing thread pool.
+
+A task runs once the futures it depends on are done, so no thread ever
+blocks waiting for another task or for I/O done elsewhere, e.g. downloads.
+Ready tasks go to the deque of the worker which made them ready, which runs
+its newest task first and keeps working on what it just touched. Idle
+workers steal the oldest tasks of the others, which are the closest to the
+root of a tree and so expand into the most work.
+
+A task may return a future instead of a value to finish later: its own
+future then completes with that one, without holding a thread meanwhile.
+"""
+
+import collections
+import concurrent.futures
+import logging
+import threading
+import typing
+
+
+class _Task:
+    __slots__ = ("future", "_fn", "_args", "_deps", "_waiting", "_lock")
+
+    def __init__(
+        self,
+        fn: typing.Callable[..., typing.Any],
+        args: typing.Tuple[typing.Any, ...],
+        deps: typing.List[concurrent.futures.Future],
+    ):
+        self.future: concurrent.futures.Future = concurrent.futures.Future()
+        self._fn = fn
+        self._args = args
+        self._deps = deps
+        self._waiting = len(deps)
+        self._lock = threading.Lock()
+
+    def dep_done(self) -> bool:
+        """Return whether it was the last dependency."""
+        with self._lock:
+            self._waiting -= 1
+            return self._waiting == 0
+
+    def run(self) -> None:
+        if not self.future.set_running_or_notify_cancel():
+            return
+        for dep in self._deps:
+            e = dep.exception()
+            if e is not None:
+                self.future.set_exception(e)
+                return
+        try:
+            result = self._fn(*self._args)
+        except BaseException as e:
+            self.future.set_exception(e)
+            return
+        if isinstance(result, concurrent.futures.Future):
+            chain(result, self.future)
+        else:
+            self.future.set_result(result)
+
+
+def chain(
+    source: concurrent.futures.Future, target: concurrent.futures.Future
+) -> None:
+    """Complete target like source once source is done."""
+
+    def _copy(_: concurrent.futures.Future) -> None:
+        e = source.exception()
+        if e is not None:
+            target.set_exception(e)
+        else:
+            target.set_result(source.result())
+
+    source.add_done_callback(_copy)
+
+
+class TaskScheduler:
+    """Run tasks with dependencies on concurrency threads. Tasks must not
+    block, they return futures for what they wait on.
+    """
+
+    def __init__(self, concurrency: int, thread_name_prefix: str = "dag"):
+        self._deques: typing.List[typing.Deque[_Task]] = [
+            collections.deque() for _ in range(concurrency)
+        ]
+        # tasks made ready by other threads.
+        self._injected: typing.Deque[_Task] = collections.deque()
+        # one permit per queued task.
+        self._queued = threading.Semaphore(0)
+        self._local = threading.local()
+        self._stopped = False
+        self._threads = [
+            threading.Thread(
+                target=self._work,
+                args=(i,),
+                name=f"{thread_name_prefix}_{i}",
+                daemon=True,
+            )
+            for i in range(concurrency)
+        ]
+        for t in self._threads:
+            t.start()
+
+    @property
+    def stopped(self) -> bool:
+        return self._stopped
+
+    def submit(
+        self,
+        fn: typing.Callable[..., typing.Any],
+        *args: typing.Any,
+        deps: typing.Iterable[concurrent.futures.Future] = (),
+    ) -> concurrent.futures.Future:
+        """Run fn(*args) after every future of deps is done. If one of them
+        failed, fn isn't run and the returned future fails the same way.
+        """
+        task = _Task(fn, args, list(deps))
+        if not task._deps:
+            self._push(task)
+            return task.future
+
+        def _dep_done(_: concurrent.futures.Future) -> None:
+            if task.dep_done():
+                self._push(task)
+
+        for dep in task._deps:
+            dep.add_done_callback(_dep_done)
+        return task.future
+
+    def shutdown(self) -> None:
+        """Stop the threads once they are idle. Tasks still queued or
+        waiting are never run.
+        """
+        self._stopped = True
+        for _ in self._threads:
+            self._queued.release()
+        for t in self._threads:
+            if t is not threading.current_thread():
+                t.join()
+
+    def _push(self, task: _Task) -> None:
+        index = getattr(self._local, "index", None)
+        if index is None:
+            self._injected.append(task)
+        else:
+            self._deques[index].append(task)
+        self._queued.release()
+
+    def _take(self, index: int) -> typing.Optional[_Task]:
+        try:
+            return self._deques[index].pop()
+        except IndexError:
+            pass
+        try:
+            return self._injected.popleft()
+        except IndexError:
+            pass
+        count = len(self._deques)
+        for i in range(1, count):
+            try:
+                return self._deques[(index + i) % count].popleft()
+            except IndexError:
+                pass
+        return None
+
+    def _work(self, index: int) -> None:
+        self._local.index = index
+        while True:
+            self._queued.acquire()
+            if self._stopped:
+                return
+            # the permit guarantees a task is queued somewhere, though
+            # another worker may take it first and leave one elsewhere.
+            task = self._take(index)
+            while task is None:
+                task = self._take(index)
+            try:
+                task.run()
+            except Exception:
+                logging.exception("task failed")
@@ -7,28 +7,46 @@ import logging
 import os
 import os.path
 import hashlib
-import shutil
+import random
 import stat
 import sys
 import typing
 import threading
 
+import grpc
 from build.bazel.remote.execution.v2.remote_execution_pb2 import Digest
 from build.bazel.remote.execution.v2.remote_execution_pb2 import Directory
 from build.bazel.remote.execution.v2.remote_execution_pb2 import DirectoryNode
-from build.bazel.remote.execution.v2.remote_execution_pb2 import FileNode
 
+from .accounting import InodeAccounting
 from .cas import CASHelper
+from .dag import TaskScheduler
+from .dirmanifest import check_manifest
+from .dirmanifest import remove_manifest
+from .dirmanifest import write_manifest
+from .directorydata import DirectoryData
+from .directorydata import FileData
+from .dirstore import DirectoryStore
 from .filesystem import LocalHardlinkFilesystem
 from .lock import VariableRLock
 from .metrics import MeterBase
-from .util import unlink_file
+from .trash import Trash
+from .trash import remove_tree
+from .refcount import FileSummary
+from .refcount import RefcountTable
+from .refcount import Reservation
+from .refcount import summarize
 from .util import unlink_readonly_file
-from .util import rmtree
-from .util import rmtree_with_readonly_files
 from .util import set_dir_readonly_recursive
 from .util import create_dir_link
+from .util import is_dir_link
 from .util import remove_dir_link
+from .verify import VERIFY_FULL
+from .verify import VERIFY_METADATA
+from .verify import VERIFY_NONE
+from .verify import VERIFY_SAMPLED
+from .verify import Scrubber
+from .verify import hash_file
 
 
 DigestKey = typing.Tuple[str, int]
@@ -41,6 +59,147 @@ def digest_to_key(digest: Digest):
     return f"{digest.hash}_{digest.size_bytes}"
 
 
+def source_file_name(name_in_cache: str, source_digest: Digest) -> str:
+    """Name of the empty file recording the CAS digest of the Directory a
+    cached directory is built from.
+    """
+    return f".{name_in_cache}.{digest_to_key(source_digest)}"
+
+
+def parse_source_file_name(
+    name: str,
+) -> typing.Optional[typing.Tuple[str, Digest]]:
+    """Return (name_in_cache, source_digest) of a file named by
+    source_file_name, or None.
+    """
+    parts = name.split(".")
+    if len(parts) != 3 or parts[0]:
+        return None
+    try:
+        hash_, size_bytes_str = parts[2].split("_")
+        source_digest = Digest(hash=hash_, size_bytes=int(size_bytes_str))
+    except ValueError:
+        return None
+    return parts[1], source_digest
+
+
+InodeKey = typing.Tuple[int, int]
+
+
+class _ScannedDir(typing.NamedTuple):
+    # name, path, size, executable bit and (st_dev, st_ino) of the files.
+    files: typing.List[typing.Tuple[str, str, int, bool, InodeKey]]
+    directories: typing.List[typing.Tuple[str, _ScannedDir]]
+    atime: float
+
+
+def _scan_cached_dir(dir_path: str) -> typing.Optional[_ScannedDir]:
+    """Collect the metadata of a cached directory, None if it isn't one."""
+    if os.stat(dir_path).st_mode & stat.S_IWUSR:
+        return None
+    files = []
+    directories = []
+    atime = 0.0
+    for name in sorted(os.listdir(dir_path)):
+        p = os.path.join(dir_path, name)
+        stat_result = os.stat(p)
+        if stat_result.st_mode & stat.S_IWUSR:
+            return None
+        if stat.S_ISREG(stat_result.st_mode):
+            is_executable = bool(stat_result.st_mode & stat.S_IXUSR)
+            inode = (stat_result.st_dev, stat_result.st_ino)
+            files.append((name, p, stat_result.st_size, is_executable, inode))
+            atime = max(atime, stat_result.st_atime)
+        elif stat.S_ISDIR(stat_result.st_mode):
+            subdir = _scan_cached_dir(p)
+            if subdir is None:
+                return None
+            directories.append((name, subdir))
+            atime = max(atime, subdir.atime)
+        else:
+            return None
+    return _ScannedDir(files, directories, atime)
+
+
+def _iter_scanned_files(
+    scanned: _ScannedDir,
+) -> typing.Iterator[typing.Tuple[str, int, InodeKey]]:
+    for _, p, size_bytes, _, inode in scanned.files:
+        yield p, size_bytes, inode
+    for _, subdir in scanned.directories:
+        yield from _iter_scanned_files(subdir)
+
+
+def _hash_files(
+    files: typing.List[typing.Tuple[str, int]]
+) -> typing.Dict[str, typing.Optional[str]]:
+    hashes: typing.Dict[str, typing.Optional[str]] = {}
+    for p, size_bytes in files:
+        try:
+            hashes[p] = hash_file(p, size_bytes)
+        except OSError:
+            hashes[p] = None
+    return hashes
+
+
+def _iter_file_paths(
+    dir_data: DirectoryData, dir_path: str
+) -> typing.Iterator[typing.Tuple[str, FileData]]:
+    for name, fd in dir_data.files():
+        yield os.path.join(dir_path, name), fd
+    for name, subdir in dir_data.directories():
+        yield from _iter_file_paths(subdir, os.path.join(dir_path, name))
+
+
+def _files_match(
+    dir_data: DirectoryData, dir_path: str, ratio: float = 1.0
+) -> bool:
+    """Hash a random share of the files of a cached directory, all by
+    default, and check they match dir_data.
+    """
+    for p, fd in _iter_file_paths(dir_data, dir_path):
+        if ratio < 1.0 and random.random() >= ratio:
+            continue
+        if hash_file(p, fd.size_bytes) != fd.digest.hash:
+            return False
+    return True
+
+
+def _scanned_directory_data(
+    scanned: _ScannedDir, hashes: typing.Dict[str, typing.Optional[str]]
+) -> typing.Optional[DirectoryData]:
+    checksum_message = Directory()
+    files: typing.Dict[str, FileData] = {}
+    subdirs: typing.Dict[str, DirectoryData] = {}
+    for name, p, size_bytes, is_executable, _ in scanned.files:
+        hash_ = hashes.get(p)
+        if hash_ is None:
+            return None
+        fd = FileData(Digest(hash=hash_, size_bytes=size_bytes), is_executable)
+        files[name] = fd
+        checksum_message.files.append(fd.to_file_node(name))
+    for name, subdir in scanned.directories:
+        subdir_data = _scanned_directory_data(subdir, hashes)
+        if subdir_data is None:
+            return None
+        subdirs[name] = subdir_data
+        checksum_message.directories.append(
+            DirectoryNode(name=name, digest=subdir_data.checksum_digest)
+        )
+    checksum_data = checksum_message.SerializeToString(deterministic=True)
+    checksum_digest = Digest(
+        hash=hashlib.sha256(checksum_data).hexdigest(),
+        size_bytes=len(checksum_data),
+    )
+    return DirectoryData(checksum_digest, files, subdirs)
+
+
+# files are hashed in batches of about this size when verifying cached
+# directories.
+_VERIFY_BATCH_BYTES = 64 * 1024 * 1024
+_VERIFY_BATCH_FILES = 1024
+
+
 class DirectoryBuilderError(Exception):
     pass
 
@@ -51,9 +210,24 @@ class MaxSizeReached(DirectoryBuilderError):
     pass
 
 
+class _TrashNotEmpty(Exception):
+    """The space needed is held by trees in the trash, size_bytes of them
+    should be removed before admitting again.
+    """
+
+    def __init__(self, size_bytes: int):
+        super().__init__(size_bytes)
+        self.size_bytes = size_bytes
+
+
 class IDirectoryBuilder(object):
     def build(
-        self, input_root_digest: Digest, input_root: Directory, local_root: str
+        self,
+        input_root_digest: Digest,
+        input_root: Directory,
+        local_root: str,
+        *,
+        caller: typing.Hashable = None,
     ) -> None:
         raise NotImplementedError(
             "This method should be implmented in subclass {0}.".format(
@@ -61,164 +235,434 @@ class IDirectoryBuilder(object):
             )
         )
 
+    def release(self, *, caller: typing.Hashable = None) -> None:
+        """Release what the last build of caller keeps for its action,
+        once the action is done. The next build of caller releases it too.
+        """
 
-class FileData:
-    def __init__(self, digest: Digest, is_executable: bool):
-        self._digest = digest
-        self._is_executable = is_executable
-        self._name_in_cache = f"{self._digest.hash}_{self._digest.size_bytes}"
-
-    @property
-    def name_in_cache(self):
-        return self._name_in_cache
-
-    @property
-    def digest(self):
-        return self._digest
-
-    @property
-    def is_executable(self):
-        return self._is_executable
-
-    def to_file_node(self, name: str):
-        return FileNode(
-            name=name, digest=self._digest, is_executable=self._is_executable
+    def prepare(
+        self, local_root: str, dirs: typing.Dict[str, DirectoryData]
+    ) -> None:
+        raise NotImplementedError(
+            "This method should be implmented in subclass {0}.".format(
+                self.__class__.__name__
+            )
         )
 
-
-class DirectoryData:
-    def __init__(
-        self,
-        checksum_digest: Digest,
-        files: typing.Dict[str, FileData],
-        directories: typing.Dict[str, DirectoryData],
-    ):
-        self._checksum_digest = checksum_digest
-        self._name_in_cache = (
-            f"{self._checksum_digest.hash}_{self._checksum_digest.size_bytes}"
+    def toplevel_cached(
+        self, input_root_digest: Digest, input_root: Directory
+    ) -> typing.Dict[str, DirectoryData]:
+        raise NotImplementedError(
+            "This method should be implmented in subclass {0}.".format(
+                self.__class__.__name__
+            )
         )
-        self._files: typing.Dict[str, FileData] = {}
-        self._files.update(files)
-        self._directories: typing.Dict[str, DirectoryData] = {}
-        self._directories.update(directories)
-        self._copy_size_bytes = 0
-        for fd in self._files.values():
-            self._copy_size_bytes += fd.digest.size_bytes
-        for dir_data in self._directories.values():
-            self._copy_size_bytes += dir_data.copy_size_bytes
-
-    @property
-    def checksum_digest(self):
-        return self._checksum_digest
-
-    @property
-    def name_in_cache(self):
-        return self._name_in_cache
 
-    @property
-    def file_count(self):
-        return len(self._files)
-
-    def files(self) -> typing.Iterator[typing.Tuple[str, FileData]]:
-        for name, fd in self._files.items():
-            yield name, fd
-
-    def directories(self) -> typing.Iterator[typing.Tuple[str, DirectoryData]]:
-        for name, data in self._directories.items():
-            yield name, data
 
-    @property
-    def copy_size_bytes(self):
-        return self._copy_size_bytes
+def _file_data(directory: Directory) -> typing.Dict[str, FileData]:
+    """Files of a Directory message by name, sorted by name."""
+    files = {}
+    for f in sorted(directory.files, key=lambda fn: fn.name):
+        if sys.platform == "win32":
+            is_executable = False
+        else:
+            is_executable = f.is_executable
+        files[f.name] = FileData(f.digest, is_executable)
+    return files
+
+
+def _is_normalized(
+    directory: Directory,
+    digest: Digest,
+    subdirs: typing.Dict[str, DirectoryData],
+) -> bool:
+    """Whether the checksum message of directory would be directory itself,
+    so its checksum digest is digest. Children must be sorted and unique,
+    without symlinks, node properties or executable files on Windows, and
+    every subdirectory must be its own checksum too.
+    """
+    if directory.symlinks or directory.HasField("node_properties"):
+        return False
+    previous = ""
+    for f in directory.files:
+        if f.name <= previous or f.HasField("node_properties"):
+            return False
+        if sys.platform == "win32" and f.is_executable:
+            return False
+        previous = f.name
+    previous = ""
+    for dn in directory.directories:
+        if dn.name <= previous:
+            return False
+        if subdirs[dn.name].name_in_cache != digest_to_key(dn.digest):
+            return False
+        previous = dn.name
+    # serialized canonically, as the remote execution API requires.
+    return directory.ByteSize() == digest.size_bytes
 
 
 class DirectoryDataCache:
+    """Resolve Directory trees to DirectoryData and cache them by digest.
+
+    Trees are resolved breadth first. All directories at the same depth are
+    fetched with one batched request, so a tree costs about one round trip
+    per level instead of one per directory. Subtrees already cached are not
+    fetched again. With use_get_tree, the whole tree is first requested with
+    the GetTree RPC and only directories missing from its result are
+    fetched by level.
+
+    The cache is bounded by the estimated memory of the cached DirectoryData
+    and evicts least recently used first. Every subtree is cached too, but
+    a subtree is only evicted once no cached directory references it, since
+    evicting it earlier frees nothing. Concurrent requests of the same
+    digest wait for one resolution.
+
+    With a DirectoryStore, directories are looked up in the store before
+    they are fetched, and resolved directories are saved there with their
+    checksum digests, so the cache is warm again after a restart.
+    """
+
     def __init__(
-        self, cas_helper: CASHelper, meter: MeterBase, max_cached: int = 5000
+        self,
+        cas_helper: CASHelper,
+        meter: MeterBase,
+        max_cached_bytes: int = 256 * 1024 * 1024,
+        *,
+        use_get_tree: bool = False,
+        store: typing.Optional[DirectoryStore] = None,
     ):
         self._cas_helper = cas_helper
         self._meter = meter
-        self._max_cached = max_cached
+        self._max_cached_bytes = max_cached_bytes
+        self._use_get_tree = use_get_tree
+        self._store = store
         self._global_lock = threading.Lock()
-        self._cache: typing.Dict[
-            str, DirectoryData
-        ] = collections.OrderedDict()
+        # key -> (DirectoryData, estimated memory)
+        self._cache: typing.Dict[str, typing.Tuple[DirectoryData, int]] = {}
+        # cached directories referenced by other cached directories, by
+        # count of references.
+        self._refs: typing.Counter[str] = collections.Counter()
+        # keys of the other cached directories, least recently used first.
+        self._lru: typing.OrderedDict[str, None] = collections.OrderedDict()
+        self._cached_bytes = 0
+        self._pending: typing.Dict[
+            str, concurrent.futures.Future[DirectoryData]
+        ] = {}
+
+    @property
+    def cached_bytes(self) -> int:
+        return self._cached_bytes
 
     def fetch_directory_data(
         self, digest: Digest, directory: Directory
     ) -> DirectoryData:
-        result = None
-        key = f"{digest.hash}_{digest.size_bytes}"
+        key = digest_to_key(digest)
         self._meter.count("fetch_directory_data_access")
         with self._global_lock:
-            if key in self._cache:
+            result = self._get_cached_locked(key)
+            if result is not None:
                 self._meter.count("fetch_directory_data_cache_hit")
-                result = self._cache.pop(key)
-                self._cache[key] = result
-        if result is None:
-            result = self._fetch_directory_data(digest, directory)
+                return result
+            future = self._pending.get(key)
+            if future is None:
+                future = concurrent.futures.Future()
+                self._pending[key] = future
+                resolving = True
+            else:
+                resolving = False
+        if not resolving:
+            self._meter.count("fetch_directory_data_wait")
+            with self._meter.record_duration(
+                "fetch_directory_data_wait_seconds"
+            ):
+                return future.result()
+        self._meter.count("fetch_directory_data_cache_miss")
+        try:
+            result = self._resolve_tree(digest, directory)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
             with self._global_lock:
-                self._cache[key] = result
-                while len(self._cache) > self._max_cached:
-                    for key_to_evict in self._cache:
-                        self._cache.pop(key_to_evict)
-                        break
+                del self._pending[key]
+
+    def get(self, digest: Digest) -> typing.Optional[DirectoryData]:
+        """Return the cached DirectoryData of digest without fetching."""
+        return self._get_cached(digest_to_key(digest))
+
+    def _get_cached(self, key: str) -> typing.Optional[DirectoryData]:
+        with self._global_lock:
+            return self._get_cached_locked(key)
+
+    def _get_cached_locked(self, key: str) -> typing.Optional[DirectoryData]:
+        """This method MUST be called with _global_lock."""
+        item = self._cache.get(key)
+        if item is None:
+            return None
+        if key in self._lru:
+            self._lru.move_to_end(key)
+        return item[0]
+
+    def _add_cached(self, key: str, dir_data: DirectoryData) -> DirectoryData:
+        """Cache dir_data, whose subtrees are cached already. Return the
+        cached one if another resolution cached key first.
+        """
+        with self._global_lock:
+            cached = self._get_cached_locked(key)
+            if cached is not None:
+                return cached
+            self._add_cached_locked(key, dir_data)
+            # always keep the newest one.
+            evicted = 0
+            while (
+                self._cached_bytes > self._max_cached_bytes
+                and len(self._lru) > 1
+            ):
+                key_to_evict, _ = self._lru.popitem(last=False)
+                evicted_data, evicted_bytes = self._cache.pop(key_to_evict)
+                self._cached_bytes -= evicted_bytes
+                evicted += 1
+                for subdir_key in self._subdir_keys(evicted_data):
+                    self._refs[subdir_key] -= 1
+                    if self._refs[subdir_key] == 0:
+                        del self._refs[subdir_key]
+                        # only referenced by the evicted one, evict next.
+                        self._lru[subdir_key] = None
+                        self._lru.move_to_end(subdir_key, last=False)
+        if evicted:
+            self._meter.count("fetch_directory_data_evict", evicted)
+        return dir_data
+
+    def _add_cached_locked(self, key: str, dir_data: DirectoryData) -> None:
+        """This method MUST be called with _global_lock."""
+        size_bytes = dir_data.estimated_memory_bytes()
+        self._cache[key] = (dir_data, size_bytes)
+        self._cached_bytes += size_bytes
+        self._lru[key] = None
+        for subdir_key, subdir in self._subdir_keys(dir_data).items():
+            if subdir_key not in self._cache:
+                # evicted while its parent was resolved.
+                self._add_cached_locked(subdir_key, subdir)
+            self._refs[subdir_key] += 1
+            self._lru.pop(subdir_key, None)
+
+    @staticmethod
+    def _subdir_keys(
+        dir_data: DirectoryData,
+    ) -> typing.Dict[str, DirectoryData]:
+        """Distinct subdirectories of dir_data by key."""
+        result: typing.Dict[str, DirectoryData] = {}
+        for _, subdir in dir_data.directories():
+            source_digest = subdir.source_digest
+            if source_digest is not None:
+                result[digest_to_key(source_digest)] = subdir
         return result
 
-    def _fetch_directory_data(
+    def _resolve_tree(
         self, digest: Digest, directory: Directory
     ) -> DirectoryData:
-        checksum_message = Directory()
-        files = {}
-        for f in sorted(directory.files, key=lambda fn: fn.name):
-            if sys.platform == "win32":
-                is_executable = False
+        root_key = (digest.hash, digest.size_bytes)
+        messages: typing.Dict[DigestKey, Directory] = {root_key: directory}
+        # checksum digests known from the store.
+        checksums: typing.Dict[DigestKey, Digest] = {}
+        self._load_stored(digest, messages, checksums)
+        if (
+            self._use_get_tree
+            and directory.directories
+            and root_key not in checksums
+        ):
+            messages.update(self._get_tree(digest))
+        resolved: typing.Dict[DigestKey, DirectoryData] = {}
+        seen: typing.Set[DigestKey] = {root_key}
+        level = [root_key]
+        while level:
+            next_level: typing.List[DigestKey] = []
+            to_fetch: typing.Dict[DigestKey, Digest] = {}
+            for key in level:
+                dn: DirectoryNode
+                for dn in messages[key].directories:
+                    subdir_key = (dn.digest.hash, dn.digest.size_bytes)
+                    if subdir_key in seen:
+                        continue
+                    seen.add(subdir_key)
+                    cached = self._get_cached(digest_to_key(dn.digest))
+                    if cached is not None:
+                        resolved[subdir_key] = cached
+                    elif subdir_key in messages or self._load_stored(
+                        dn.digest, messages, checksums
+                    ):
+                        next_level.append(subdir_key)
+                    else:
+                        to_fetch[subdir_key] = dn.digest
+            if to_fetch:
+                self._meter.count("fetch_directory_level")
+                for subdir_digest, data in self._cas_helper.fetch_all(
+                    list(to_fetch.values())
+                ):
+                    subdir_key = (subdir_digest.hash, subdir_digest.size_bytes)
+                    if subdir_key in to_fetch and subdir_key not in messages:
+                        subdirectory = Directory()
+                        subdirectory.ParseFromString(data)
+                        messages[subdir_key] = subdirectory
+                        next_level.append(subdir_key)
+                for subdir_key, subdir_digest in to_fetch.items():
+                    if subdir_key not in messages:
+                        raise DirectoryBuilderError(
+                            f"directory {digest_to_key(subdir_digest)} "
+                            "not found"
+                        )
+            level = next_level
+        return self._build_directory_data(
+            digest, messages, checksums, resolved
+        )
+
+    def _load_stored(
+        self,
+        digest: Digest,
+        messages: typing.Dict[DigestKey, Directory],
+        checksums: typing.Dict[DigestKey, Digest],
+    ) -> bool:
+        """Load digest from the store into messages and checksums. Return
+        whether it's found.
+        """
+        if self._store is None:
+            return False
+        stored = self._store.get(digest)
+        if stored is None:
+            self._meter.count("directory_store_miss")
+            return False
+        self._meter.count("directory_store_hit")
+        key = (digest.hash, digest.size_bytes)
+        if key not in messages:
+            directory = Directory()
+            directory.ParseFromString(stored.data)
+            messages[key] = directory
+        if stored.checksum_digest is not None:
+            checksums[key] = stored.checksum_digest
+        return True
+
+    def _get_tree(self, digest: Digest) -> typing.Dict[DigestKey, Directory]:
+        """Fetch the tree with GetTree. Return directories by digest, empty
+        if the server doesn't support it.
+        """
+        messages: typing.Dict[DigestKey, Directory] = {}
+        try:
+            for directory in self._cas_helper.get_tree(digest):
+                data = directory.SerializeToString(deterministic=True)
+                key = (hashlib.sha256(data).hexdigest(), len(data))
+                messages[key] = directory
+        except grpc.RpcError as e:
+            if e.code() == grpc.StatusCode.UNIMPLEMENTED:
+                logging.warning("GetTree is not supported, fetch by level")
+                self._use_get_tree = False
             else:
-                is_executable = f.is_executable
-            fd = FileData(f.digest, is_executable)
-            files[f.name] = fd
-            checksum_message.files.append(fd.to_file_node(f.name))
+                logging.exception("GetTree failed, fetch by level")
+        self._meter.count("fetch_directory_get_tree")
+        return messages
 
+    def _build_directory_data(
+        self,
+        digest: Digest,
+        messages: typing.Dict[DigestKey, Directory],
+        checksums: typing.Dict[DigestKey, Digest],
+        resolved: typing.Dict[DigestKey, DirectoryData],
+    ) -> DirectoryData:
+        """Build DirectoryData bottom up, add every subtree to the cache."""
+        key = (digest.hash, digest.size_bytes)
+        result = resolved.get(key)
+        if result is not None:
+            return result
+        directory = messages[key]
+        files = _file_data(directory)
         subdirs: typing.Dict[str, DirectoryData] = {}
-
-        dir_digest_to_fetch: typing.Dict[DigestKey, Digest] = {}
-        dir_digest_to_names: typing.Dict[
-            DigestKey, typing.List[str]
-        ] = collections.defaultdict(list)
-        dn: DirectoryNode
         for dn in directory.directories:
-            subdir_digest = dn.digest
-            key = (subdir_digest.hash, subdir_digest.size_bytes)
-            dir_digest_to_fetch[key] = subdir_digest
-            dir_digest_to_names[key].append(dn.name)
+            subdirs[dn.name] = self._build_directory_data(
+                dn.digest, messages, checksums, resolved
+            )
+        checksum_digest = checksums.get(key)
+        if checksum_digest is None:
+            checksum_digest = self._checksum_digest(
+                digest, directory, files, subdirs
+            )
+            if self._store is not None:
+                self._store.put(
+                    digest,
+                    directory.SerializeToString(deterministic=True),
+                    checksum_digest,
+                )
+        result = self._add_cached(
+            digest_to_key(digest),
+            DirectoryData(checksum_digest, files, subdirs, digest),
+        )
+        resolved[key] = result
+        return result
 
-        for subdir_digest, data in self._cas_helper.fetch_all(
-            dir_digest_to_fetch.values()
-        ):
-            key = (subdir_digest.hash, subdir_digest.size_bytes)
-            if key in dir_digest_to_names:
-                subdirectory = Directory()
-                subdirectory.ParseFromString(data)
-                for name in dir_digest_to_names[key]:
-                    subdirs[name] = self.fetch_directory_data(
-                        subdir_digest, subdirectory
-                    )
+    def _checksum_digest(
+        self,
+        digest: Digest,
+        directory: Directory,
+        files: typing.Dict[str, FileData],
+        subdirs: typing.Dict[str, DirectoryData],
+    ) -> Digest:
+        if _is_normalized(directory, digest, subdirs):
+            self._meter.count("fetch_directory_checksum_reused")
+            return digest
+        checksum_message = Directory()
+        for name, fd in files.items():
+            checksum_message.files.append(fd.to_file_node(name))
         for n in sorted(subdirs):
             d = subdirs[n]
             checksum_message.directories.append(
                 DirectoryNode(name=n, digest=d.checksum_digest)
             )
         checksum_data = checksum_message.SerializeToString(deterministic=True)
-        return DirectoryData(
-            Digest(
-                hash=hashlib.sha256(checksum_data).hexdigest(),
-                size_bytes=len(checksum_data),
-            ),
-            files,
-            subdirs,
+        return Digest(
+            hash=hashlib.sha256(checksum_data).hexdigest(),
+            size_bytes=len(checksum_data),
         )
 
 
+def _iter_file_data(dir_data: DirectoryData) -> typing.Iterator[FileData]:
+    for _, fd in dir_data.files():
+        yield fd
+    for _, subdir in dir_data.directories():
+        yield from _iter_file_data(subdir)
+
+
+def _iter_subtrees(dir_data: DirectoryData) -> typing.Iterator[DirectoryData]:
+    """Yield every subdirectory of the tree, not dir_data itself."""
+    for _, subdir in dir_data.directories():
+        yield subdir
+        yield from _iter_subtrees(subdir)
+
+
+def _iter_file_sizes(
+    dir_data: DirectoryData,
+) -> typing.Iterator[typing.Tuple[str, int]]:
+    """Yield (name_in_cache, size_bytes) of every file in the tree."""
+    for _, fd in dir_data.files():
+        yield fd.name_in_cache, fd.size_bytes
+    for _, subdir in dir_data.directories():
+        yield from _iter_file_sizes(subdir)
+
+
+# how a subdirectory of a build directory is built. cached ones are built
+# in the cache and linked. expanded ones are real directories, whose files
+# are fetched and subdirectories laid out on their own. skipped and inlined
+# ones are built in place without the cache, skipped ones because actions
+# write there.
+_CACHED = "cached"
+_EXPANDED = "expanded"
+_SKIPPED = "skipped"
+_INLINED = "inlined"
+
+# subtrees whose uses are counted for adaptive granularity.
+_MAX_SEEN_SUBTREES = 64 * 1024
+
+
 class SharedTopLevelCachedDirectoryBuilder(IDirectoryBuilder):
     def __init__(
         self,
@@ -231,29 +675,110 @@ class SharedTopLevelCachedDirectoryBuilder(IDirectoryBuilder):
         max_cache_size_bytes: int = 0,
         concurrency: int = 10,
         copy_file: bool = False,
+        accounting: typing.Optional[InodeAccounting] = None,
+        use_get_tree: bool = False,
+        streaming: bool = False,
+        max_directory_data_bytes: int = 256 * 1024 * 1024,
+        directory_store: typing.Optional[DirectoryStore] = None,
+        incremental: bool = False,
+        manifest_root: typing.Optional[str] = None,
+        verify_level: str = VERIFY_METADATA,
+        verify_sample_ratio: float = 0.1,
+        scrub_interval_seconds: float = 0,
+        scrub_bytes_per_interval: int = 64 * 1024 * 1024,
+        large_directory: typing.Optional[typing.Iterable[str]] = None,
+        adaptive: bool = False,
+        min_unit_bytes: int = 1024 * 1024,
+        min_unit_files: int = 64,
+        min_unit_seen: int = 3,
+        max_unit_bytes: int = 0,
+        trash_root: typing.Optional[str] = None,
+        trash_io_nice: typing.Optional[int] = 7,
     ):
         self._cache_dir_root = cache_root
+        # evicted cached directories and build trees are moved here and
+        # removed in background. it must be on the filesystem of cache_root,
+        # and of the build directories to help them. the size of evicted
+        # directories counts against max_cache_size_bytes until they are
+        # removed. None removes everything at once.
+        self._trash: typing.Optional[Trash] = None
+        if trash_root is not None:
+            self._trash = Trash(trash_root, trash_io_nice)
+        # manifests of cached directories, to verify them from metadata at
+        # restart. kept out of cache_root, which holds cached directories
+        # only.
+        self._manifest_root = manifest_root
+        # what is hashed at startup, see verify.py. the weaker levels need
+        # manifests, directories without one are always hashed.
+        self._verify_level = verify_level
+        self._verify_sample_ratio = verify_sample_ratio
+        self._scrubber: typing.Optional[Scrubber] = None
+        if verify_level != VERIFY_FULL and scrub_interval_seconds > 0:
+            self._scrubber = Scrubber(
+                "directory_scrubber",
+                self._scrub,
+                scrub_interval_seconds,
+                scrub_bytes_per_interval,
+            )
+        self._scrub_queue: typing.Deque[str] = collections.deque()
         self._cas_helper = cas_helper
         self._directory_data_cache = DirectoryDataCache(
-            self._cas_helper, meter, 5000
+            self._cas_helper,
+            meter,
+            max_directory_data_bytes,
+            use_get_tree=use_get_tree,
+            store=directory_store,
         )
         self._filesystem = filesystem
-        self._large_directory = set(["engine", "external"])
+        if large_directory is None:
+            # split one level deeper, their subdirectories are cached.
+            self._large_directory = set(["engine", "external"])
+        else:
+            self._large_directory = set(large_directory)
         if skip_cache is None:
             # by default we do not cache bazel-out, because output files
             # need to be created in it.
             self._skip_cache = set(["bazel-out"])
         else:
             self._skip_cache = set(skip_cache)
+        # with adaptive granularity, the other subdirectories are cached at
+        # any depth when they are large or used often enough, and inlined
+        # otherwise. min_* criteria of 0 are disabled. subtrees larger than
+        # max_unit_bytes are expanded instead.
+        self._adaptive = adaptive
+        self._min_unit_bytes = min_unit_bytes
+        self._min_unit_files = min_unit_files
+        self._min_unit_seen = min_unit_seen
+        self._max_unit_bytes = max_unit_bytes
+        self._seen_count: typing.Dict[str, int] = collections.OrderedDict()
+        self._seen_lock = threading.Lock()
         self._dir_lock = VariableRLock()
         self._download_lock = threading.RLock()
         self._executor = concurrent.futures.ThreadPoolExecutor(
             max_workers=concurrency, thread_name_prefix="directory_builder_"
         )
+        # directories are built by small tasks which never wait, see
+        # _build_natives_in_thread.
+        self._dag_concurrency = concurrency
+        self._dag = TaskScheduler(concurrency, "directory_build")
+        # in streaming mode, subtrees are resolved in this pool and built as
+        # soon as they are resolved.
+        self._streaming = streaming
+        self._resolve_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="directory_resolve_"
+        )
+        # inputs of the last build of every target directory in incremental
+        # mode, or the links prepare() left there, which the next build is
+        # diffed against.
+        self._incremental = incremental
+        self._previous_inputs: typing.Dict[str, DirectoryData] = {}
+        self._previous_inputs_lock = threading.Lock()
         self._pending_cached_dir: typing.Dict[str, FutureDigest] = {}
         self._cached_dir: typing.Dict[
             str, DirectoryData
         ] = collections.OrderedDict()
+        # name in cache -> source file name.
+        self._source_files: typing.Dict[str, str] = {}
         self._max_cache_size_bytes = max_cache_size_bytes
         self._current_size_bytes = 0
         # on Windows platform, we cannot unlink a readonly hardlink. so we
@@ -263,11 +788,23 @@ class SharedTopLevelCachedDirectoryBuilder(IDirectoryBuilder):
             self._copy_from_filesystem = True
         else:
             self._copy_from_filesystem = copy_file
-        self._file_count: typing.Dict[str, int] | None
-        if self._copy_from_filesystem:
-            self._file_count = None
-        else:
-            self._file_count = {}
+        # files linked by cached directories, counted once however many
+        # link them. copies take their whole size.
+        self._refcounts: typing.Optional[RefcountTable] = None
+        if not self._copy_from_filesystem:
+            self._refcounts = RefcountTable()
+        # distinct files of the cached and pending directories.
+        self._file_summaries: typing.Dict[str, FileSummary] = {}
+        # cached directories linked by in-flight actions, which are never
+        # evicted, and the names every caller pinned. a caller builds one
+        # directory at a time.
+        self._pins: typing.Counter[str] = collections.Counter()
+        self._caller_pins: typing.Dict[typing.Hashable, typing.List[str]] = {}
+        # cached directories hold the file cache inodes they link here, so
+        # the file cache doesn't evict them. copies hold nothing.
+        self._accounting: typing.Optional[InodeAccounting] = None
+        if not self._copy_from_filesystem:
+            self._accounting = accounting
         self._meter = meter
 
     @property
@@ -281,23 +818,289 @@ class SharedTopLevelCachedDirectoryBuilder(IDirectoryBuilder):
     def init(self):
         if not os.path.exists(self._cache_dir_root):
             os.makedirs(self._cache_dir_root)
+        if self._manifest_root is not None:
+            os.makedirs(self._manifest_root, exist_ok=True)
+        for dir_data in self._cached_dir.values():
+            self._release_files(dir_data)
         self._cached_dir.clear()
         self._pending_cached_dir.clear()
+        self._pins.clear()
+        self._caller_pins.clear()
         self._current_size_bytes = 0
+        if self._refcounts is not None:
+            self._refcounts = RefcountTable()
+        self._file_summaries.clear()
+        if self._dag.stopped:
+            # closed before, its threads are gone.
+            self._dag = TaskScheduler(self._dag_concurrency, "directory_build")
+        if self._trash is not None and not self._trash.is_alive():
+            self._trash.start()
         self._verify_existing_dirs()
+        if self._scrubber is not None and not self._scrubber.is_alive():
+            self._scrubber.start()
+
+    def close(self):
+        if self._scrubber is not None:
+            self._scrubber.stop()
+        if self._trash is not None:
+            self._trash.stop()
+        self._dag.shutdown()
 
     def build(
-        self, input_root_digest: Digest, input_root: Directory, target_dir: str
+        self,
+        input_root_digest: Digest,
+        input_root: Directory,
+        target_dir: str,
+        *,
+        caller: typing.Hashable = None,
     ) -> None:
+        # the previous build of caller is about to be replaced.
+        self.release(caller=caller)
+        # dropped until this build succeeds.
+        with self._previous_inputs_lock:
+            previous = self._previous_inputs.pop(target_dir, None)
+        if self._streaming:
+            dir_data = self._directory_data_cache.get(input_root_digest)
+            if dir_data is None:
+                self._build_streaming(
+                    input_root,
+                    target_dir,
+                    self._large_directory,
+                    self._skip_cache,
+                    caller,
+                )
+                return
+        else:
+            dir_data = self._directory_data_cache.fetch_directory_data(
+                input_root_digest, input_root
+            )
+        if previous is not None:
+            self._meter.count("build_incremental")
+            self._update_toplevel(
+                previous,
+                dir_data,
+                target_dir,
+                self._large_directory,
+                self._skip_cache,
+                caller,
+            )
+        else:
+            self._build_toplevel(
+                dir_data,
+                target_dir,
+                self._large_directory,
+                self._skip_cache,
+                caller,
+            )
+        if self._incremental:
+            with self._previous_inputs_lock:
+                self._previous_inputs[target_dir] = dir_data
+
+    def prepare(
+        self, target_dir: str, dirs: typing.Dict[str, DirectoryData]
+    ) -> None:
+        """Empty target_dir ahead of its next build, but the links to the
+        cached directories of dirs, by name. The ones missing are linked if
+        they are cached, nothing is built. The next build keeps the links
+        it needs, like an incremental one.
+        """
+        with self._previous_inputs_lock:
+            self._previous_inputs.pop(target_dir, None)
+        os.makedirs(target_dir, exist_ok=True)
+        linked: typing.Dict[str, DirectoryData] = {}
+        for name in os.listdir(target_dir):
+            p = os.path.join(target_dir, name)
+            subdir = dirs.get(name)
+            if subdir is not None:
+                path_in_cache = os.path.join(
+                    self._cache_dir_root, subdir.name_in_cache
+                )
+                try:
+                    if is_dir_link(p) and os.path.samefile(p, path_in_cache):
+                        linked[name] = subdir
+                        continue
+                except FileNotFoundError:
+                    pass
+            self._remove_entry(
+                p, name, self._large_directory, self._skip_cache
+            )
+        kept_count = len(linked)
+        for name, subdir in dirs.items():
+            if name in linked:
+                continue
+            with self._download_lock:
+                if subdir.name_in_cache not in self._cached_dir:
+                    continue
+            path_in_cache = os.path.join(
+                self._cache_dir_root, subdir.name_in_cache
+            )
+            with self._dir_lock.lock(path_in_cache):
+                create_dir_link(path_in_cache, os.path.join(target_dir, name))
+            linked[name] = subdir
+        self._meter.count("prepare_kept_dir", kept_count)
+        self._meter.count("prepare_linked_dir", len(linked) - kept_count)
+        with self._previous_inputs_lock:
+            self._previous_inputs[target_dir] = DirectoryData(
+                Digest(), {}, linked
+            )
+
+    def toplevel_cached(
+        self, input_root_digest: Digest, input_root: Directory
+    ) -> typing.Dict[str, DirectoryData]:
+        """Return the subdirectories of the input root linked from the
+        cache, by name.
+        """
         dir_data = self._directory_data_cache.fetch_directory_data(
             input_root_digest, input_root
         )
-        self._build_toplevel(
-            dir_data,
-            target_dir,
-            self._large_directory,
-            self._skip_cache,
+        return {
+            name: subdir
+            for name, subdir in dir_data.directories()
+            if self._layout(
+                name,
+                subdir,
+                self._large_directory,
+                self._skip_cache,
+                count_seen=False,
+            )
+            == _CACHED
+        }
+
+    def release(self, *, caller: typing.Hashable = None) -> None:
+        with self._download_lock:
+            for name_in_cache in self._caller_pins.pop(caller, ()):
+                self._pins[name_in_cache] -= 1
+                if not self._pins[name_in_cache]:
+                    del self._pins[name_in_cache]
+
+    def directory_data(
+        self, digest: Digest, directory: Directory
+    ) -> DirectoryData:
+        return self._directory_data_cache.fetch_directory_data(
+            digest, directory
+        )
+
+    def inputs(
+        self, input_root_digest: Digest, input_root: Directory
+    ) -> typing.Tuple[
+        typing.Dict[str, FileData], typing.Dict[str, DirectoryData]
+    ]:
+        """Return the files fetched from the file cache and the directories
+        cached as a whole to build the input root, by name in cache.
+        """
+        dir_data = self._directory_data_cache.fetch_directory_data(
+            input_root_digest, input_root
+        )
+        files: typing.Dict[str, FileData] = {}
+        dirs: typing.Dict[str, DirectoryData] = {}
+        self._collect_inputs(
+            dir_data, self._large_directory, self._skip_cache, files, dirs
         )
+        return files, dirs
+
+    def _collect_inputs(
+        self,
+        dir_data: DirectoryData,
+        large_directory: typing.Set[str],
+        skip_cache: typing.Set[str],
+        files: typing.Dict[str, FileData],
+        dirs: typing.Dict[str, DirectoryData],
+    ) -> None:
+        # same layout as _build_toplevel.
+        for _, fd in dir_data.files():
+            files[fd.name_in_cache] = fd
+        for name, subdir in dir_data.directories():
+            layout = self._layout(
+                name, subdir, large_directory, skip_cache, count_seen=False
+            )
+            if layout == _EXPANDED:
+                self._collect_inputs(subdir, set(), set(), files, dirs)
+            elif layout == _CACHED:
+                dirs[subdir.name_in_cache] = subdir
+            elif layout == _INLINED:
+                for fd in _iter_file_data(subdir):
+                    files[fd.name_in_cache] = fd
+
+    def prefetch(
+        self,
+        dirs: typing.Iterable[DirectoryData],
+        *,
+        caller: typing.Hashable = None,
+    ) -> typing.Dict[str, FutureDigest]:
+        """Build directories into the cache without linking them anywhere.
+        Directories already cached or being built are skipped. Nothing is
+        built if they don't fit in the free space, so prefetching never
+        evicts.
+
+        Return futures of the directories started, by name in cache.
+        """
+        with self._download_lock:
+            new_dirs: typing.Dict[str, DirectoryData] = {}
+            for d in dirs:
+                if (
+                    d.name_in_cache not in self._cached_dir
+                    and d.name_in_cache not in self._pending_cached_dir
+                ):
+                    new_dirs[d.name_in_cache] = d
+            if not new_dirs:
+                return {}
+            admitted = self._admit_cached_dirs(
+                new_dirs.values(), caller, evict=False
+            )
+            if admitted is None:
+                self._meter.count("prefetch_skipped_dir", len(new_dirs))
+                return {}
+            return dict(zip(new_dirs, admitted[0]))
+
+    def _layout(
+        self,
+        name: str,
+        subdir: DirectoryData,
+        large_directory: typing.Set[str],
+        skip_cache: typing.Set[str],
+        *,
+        count_seen: bool = True,
+    ) -> str:
+        """How to build subdirectory name, one of _CACHED, _EXPANDED,
+        _SKIPPED and _INLINED. Uses of the subtree are counted unless
+        count_seen is False.
+        """
+        if name in skip_cache:
+            return _SKIPPED
+        if name in large_directory:
+            return _EXPANDED
+        if not self._adaptive:
+            return _CACHED
+        if subdir.copy_size_bytes > self._max_unit_bytes > 0:
+            return _EXPANDED
+        if self._is_unit(subdir, count_seen):
+            return _CACHED
+        # small and rarely used. its subtrees are small too, so checking
+        # them all is cheap, and counts their uses.
+        units = [self._is_unit(d, count_seen) for d in _iter_subtrees(subdir)]
+        return _EXPANDED if any(units) else _INLINED
+
+    def _is_unit(self, subdir: DirectoryData, count_seen: bool) -> bool:
+        """Whether a subtree is worth its own cached directory."""
+        if count_seen:
+            seen = self._count_seen(subdir)
+        else:
+            with self._seen_lock:
+                seen = self._seen_count.get(subdir.name_in_cache, 0)
+        return (
+            subdir.copy_size_bytes >= self._min_unit_bytes > 0
+            or subdir.total_file_count >= self._min_unit_files > 0
+            or seen >= self._min_unit_seen > 0
+        )
+
+    def _count_seen(self, subdir: DirectoryData) -> int:
+        name_in_cache = subdir.name_in_cache
+        with self._seen_lock:
+            count = self._seen_count.pop(name_in_cache, 0) + 1
+            self._seen_count[name_in_cache] = count
+            if len(self._seen_count) > _MAX_SEEN_SUBTREES:
+                del self._seen_count[next(iter(self._seen_count))]
+        return count
 
     def _build_toplevel(
         self,
@@ -305,131 +1108,437 @@ class SharedTopLevelCachedDirectoryBuilder(IDirectoryBuilder):
         directory_local: str,
         large_directory: typing.Set[str],
         skip_cache: typing.Set[str],
+        caller: typing.Hashable = None,
     ) -> None:
-        if not os.path.exists(directory_local):
-            os.makedirs(directory_local)
-        for name in os.listdir(directory_local):
-            p = os.path.join(directory_local, name)
-            if os.path.isfile(p):
-                unlink_readonly_file(p)
-            elif os.path.islink(p):
-                remove_dir_link(p)
-            elif os.path.isdir(p):
-                if name in large_directory:
-                    self._remove_large_directory(p)
-                elif name in skip_cache:
-                    rmtree_with_readonly_files(p)
-                else:
-                    remove_dir_link(p)
-            else:
-                remove_dir_link(p)
+        self._clear_directory(directory_local, large_directory, skip_cache)
         if dir_data.file_count:
             self._filesystem.fetch_to(
                 self._cas_helper,
-                [fd.to_file_node(name) for name, fd in dir_data.files()],
+                dir_data.file_nodes(),
                 directory_local,
                 copy_file=self._copy_from_filesystem,
+                caller=caller,
             )
         self._build_toplevel_dirs(
             dir_data.directories(),
             directory_local,
             large_directory,
             skip_cache,
+            caller,
+        )
+
+    def _update_toplevel(
+        self,
+        previous: DirectoryData,
+        dir_data: DirectoryData,
+        directory_local: str,
+        large_directory: typing.Set[str],
+        skip_cache: typing.Set[str],
+        caller: typing.Hashable = None,
+    ) -> None:
+        """Turn directory_local built from previous into dir_data like
+        _build_toplevel, keeping what is still valid.
+
+        Files and cached directory links are kept when they are unchanged in
+        both the inputs and on disk. Expanded directories are updated the
+        same way. Other directories not cached are always built again,
+        because actions write their outputs there. Everything else,
+        including what the action wrote, is removed.
+        """
+        if not os.path.isdir(directory_local):
+            self._build_toplevel(
+                dir_data, directory_local, large_directory, skip_cache, caller
+            )
+            return
+        previous_files = dict(previous.files())
+        previous_dirs = dict(previous.directories())
+        new_files = dict(dir_data.files())
+        new_dirs = dict(dir_data.directories())
+        layouts = {
+            name: self._layout(name, subdir, large_directory, skip_cache)
+            for name, subdir in new_dirs.items()
+        }
+        kept: typing.Set[str] = set()
+        large_dirs_to_update: typing.List[
+            typing.Tuple[str, DirectoryData, DirectoryData]
+        ] = []
+        for name in os.listdir(directory_local):
+            p = os.path.join(directory_local, name)
+            fd = new_files.get(name)
+            subdir = new_dirs.get(name)
+            previous_subdir = previous_dirs.get(name)
+            if fd is not None:
+                if self._is_unchanged_file(p, previous_files.get(name), fd):
+                    kept.add(name)
+                    continue
+            elif subdir is not None and previous_subdir is not None:
+                if layouts[name] == _EXPANDED:
+                    if os.path.isdir(p) and not is_dir_link(p):
+                        large_dirs_to_update.append(
+                            (name, previous_subdir, subdir)
+                        )
+                        kept.add(name)
+                        continue
+                elif (
+                    layouts[name] == _CACHED
+                    and previous_subdir.name_in_cache == subdir.name_in_cache
+                    and self._is_cached_dir_link(p, subdir, caller)
+                ):
+                    kept.add(name)
+                    continue
+            self._remove_entry(p, name, large_directory, skip_cache)
+
+        file_nodes = [
+            fn for fn in dir_data.file_nodes() if fn.name not in kept
+        ]
+        self._meter.count(
+            "build_incremental_kept_files", len(new_files) - len(file_nodes)
+        )
+        if file_nodes:
+            self._filesystem.fetch_to(
+                self._cas_helper,
+                file_nodes,
+                directory_local,
+                copy_file=self._copy_from_filesystem,
+                caller=caller,
+            )
+        for name, previous_subdir, subdir in large_dirs_to_update:
+            self._update_toplevel(
+                previous_subdir,
+                subdir,
+                os.path.join(directory_local, name),
+                set(),
+                set(),
+                caller,
+            )
+        self._build_toplevel_dirs(
+            [(n, d) for n, d in new_dirs.items() if n not in kept],
+            directory_local,
+            large_directory,
+            skip_cache,
+            caller,
+            layouts=layouts,
         )
 
+    def _is_unchanged_file(
+        self,
+        path: str,
+        previous: typing.Optional[FileData],
+        fd: FileData,
+    ) -> bool:
+        if (
+            previous is None
+            or previous.name_in_cache != fd.name_in_cache
+            or previous.is_executable != fd.is_executable
+        ):
+            return False
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            return False
+        # a file the action replaced or made writable is not ours anymore.
+        if (
+            not stat.S_ISREG(st.st_mode)
+            or st.st_mode & stat.S_IWUSR
+            or st.st_size != fd.size_bytes
+        ):
+            return False
+        if self._copy_from_filesystem:
+            return True
+        # still a hardlink of the file cache.
+        return self._filesystem.is_cached_file(fd.name_in_cache, st)
+
+    def _is_cached_dir_link(
+        self, path: str, subdir: DirectoryData, caller: typing.Hashable
+    ) -> bool:
+        name_in_cache = subdir.name_in_cache
+        with self._download_lock:
+            if name_in_cache not in self._cached_dir:
+                return False
+            # used again, by an action of caller if kept.
+            self._cached_dir[name_in_cache] = self._cached_dir.pop(
+                name_in_cache
+            )
+            self._pin([name_in_cache], caller)
+        path_in_cache = os.path.join(self._cache_dir_root, name_in_cache)
+        try:
+            return is_dir_link(path) and os.path.samefile(path, path_in_cache)
+        except FileNotFoundError:
+            return False
+
+    def _build_streaming(
+        self,
+        directory: Directory,
+        directory_local: str,
+        large_directory: typing.Set[str],
+        skip_cache: typing.Set[str],
+        caller: typing.Hashable = None,
+    ) -> None:
+        """Build like _build_toplevel from the Directory message, without
+        resolving the whole tree first. Files of this directory start
+        downloading right away, and every subdirectory starts building as
+        soon as its own subtree is resolved. Large directories are streamed
+        the same way.
+        """
+        self._clear_directory(directory_local, large_directory, skip_cache)
+        files = [fd.to_file_node(n) for n, fd in _file_data(directory).items()]
+        fetch_files_future = None
+        if files:
+            fetch_files_future = self._resolve_executor.submit(
+                self._filesystem.fetch_to,
+                self._cas_helper,
+                files,
+                directory_local,
+                copy_file=self._copy_from_filesystem,
+                caller=caller,
+            )
+        resolved: typing.Dict[str, DirectoryData] = {}
+        to_fetch: typing.Dict[DigestKey, Digest] = {}
+        for dn in directory.directories:
+            subdir = self._directory_data_cache.get(dn.digest)
+            if subdir is not None:
+                resolved[dn.name] = subdir
+            else:
+                to_fetch[(dn.digest.hash, dn.digest.size_bytes)] = dn.digest
+        messages: typing.Dict[DigestKey, Directory] = {}
+        if to_fetch:
+            for subdir_digest, data in self._cas_helper.fetch_all(
+                list(to_fetch.values())
+            ):
+                subdirectory = Directory()
+                subdirectory.ParseFromString(data)
+                messages[
+                    (subdir_digest.hash, subdir_digest.size_bytes)
+                ] = subdirectory
+            for key, subdir_digest in to_fetch.items():
+                if key not in messages:
+                    raise DirectoryBuilderError(
+                        f"directory {digest_to_key(subdir_digest)} not found"
+                    )
+
+        started: typing.Dict[
+            str,
+            concurrent.futures.Future[
+                typing.Tuple[DirectoryData, str, typing.List[FutureDigest]]
+            ],
+        ] = {}
+        build_futures: typing.List[FutureDigest] = []
+        cached_subdirs: typing.Dict[str, DirectoryData] = {}
+        large_dirs: typing.List[DirectoryNode] = []
+        for dn in directory.directories:
+            if dn.name in large_directory:
+                large_dirs.append(dn)
+            elif dn.name in resolved:
+                subdir = resolved[dn.name]
+                layout, subdir_futures = self._start_subdir(
+                    dn.name,
+                    subdir,
+                    directory_local,
+                    large_directory,
+                    skip_cache,
+                    caller,
+                )
+                build_futures.extend(subdir_futures)
+                if layout == _CACHED:
+                    cached_subdirs[dn.name] = subdir
+            else:
+                started[dn.name] = self._resolve_executor.submit(
+                    self._resolve_and_start,
+                    dn.name,
+                    dn.digest,
+                    messages[(dn.digest.hash, dn.digest.size_bytes)],
+                    directory_local,
+                    large_directory,
+                    skip_cache,
+                    caller,
+                )
+        for dn in large_dirs:
+            dir_local_path = os.path.join(directory_local, dn.name)
+            if dn.name in resolved:
+                self._build_toplevel(
+                    resolved[dn.name], dir_local_path, set(), set(), caller
+                )
+            else:
+                self._build_streaming(
+                    messages[(dn.digest.hash, dn.digest.size_bytes)],
+                    dir_local_path,
+                    set(),
+                    set(),
+                    caller,
+                )
+        for name, f in started.items():
+            subdir, layout, subdir_futures = f.result()
+            build_futures.extend(subdir_futures)
+            if layout == _CACHED:
+                cached_subdirs[name] = subdir
+        for build_future in concurrent.futures.as_completed(build_futures):
+            build_future.result()
+        for name, subdir in cached_subdirs.items():
+            path_in_cache = os.path.join(
+                self._cache_dir_root, subdir.name_in_cache
+            )
+            with self._dir_lock.lock(path_in_cache):
+                create_dir_link(
+                    path_in_cache, os.path.join(directory_local, name)
+                )
+        if fetch_files_future is not None:
+            fetch_files_future.result()
+        for dn in directory.directories:
+            p = os.path.join(directory_local, dn.name)
+            if not os.path.isdir(p):
+                raise RuntimeError(f"missing directory {p}")
+
+    def _resolve_and_start(
+        self,
+        name: str,
+        digest: Digest,
+        directory: Directory,
+        directory_local: str,
+        large_directory: typing.Set[str],
+        skip_cache: typing.Set[str],
+        caller: typing.Hashable,
+    ) -> typing.Tuple[DirectoryData, str, typing.List[FutureDigest]]:
+        subdir = self._directory_data_cache.fetch_directory_data(
+            digest, directory
+        )
+        return subdir, *self._start_subdir(
+            name, subdir, directory_local, large_directory, skip_cache, caller
+        )
+
+    def _start_subdir(
+        self,
+        name: str,
+        subdir: DirectoryData,
+        directory_local: str,
+        large_directory: typing.Set[str],
+        skip_cache: typing.Set[str],
+        caller: typing.Hashable,
+    ) -> typing.Tuple[str, typing.List[FutureDigest]]:
+        """Start building a resolved subdirectory as laid out by _layout.
+        Return the layout, and futures to wait for before linking. Expanded
+        subdirectories are built before returning.
+        """
+        layout = self._layout(name, subdir, large_directory, skip_cache)
+        subdir_local = os.path.join(directory_local, name)
+        if layout == _EXPANDED:
+            self._build_toplevel(subdir, subdir_local, set(), set(), caller)
+            return layout, []
+        if layout != _CACHED:
+            return layout, self._build_natives_in_thread(
+                [(subdir, subdir_local)],
+                copy_file=self._copy_from_filesystem,
+                caller=caller,
+            )
+        futures, dir_need_to_evict, uncached = self._admit_evicting(
+            [subdir], caller
+        )
+        for name_to_evict, size_bytes in dir_need_to_evict:
+            self._meter.count("evict_cached_dir")
+            self._remove_cached_dir(name_to_evict, size_bytes)
+        if uncached:
+            # the cache is saturated, built in place.
+            return _INLINED, self._build_natives_in_thread(
+                [(subdir, subdir_local)],
+                copy_file=self._copy_from_filesystem,
+                caller=caller,
+            )
+        return layout, futures
+
+    def _clear_directory(
+        self,
+        directory_local: str,
+        large_directory: typing.Set[str],
+        skip_cache: typing.Set[str],
+    ) -> None:
+        if not os.path.exists(directory_local):
+            os.makedirs(directory_local)
+        for name in os.listdir(directory_local):
+            p = os.path.join(directory_local, name)
+            self._remove_entry(p, name, large_directory, skip_cache)
+
+    def _remove_entry(
+        self,
+        p: str,
+        name: str,
+        large_directory: typing.Set[str],
+        skip_cache: typing.Set[str],
+    ) -> None:
+        if os.path.isfile(p):
+            unlink_readonly_file(p)
+        elif is_dir_link(p):
+            remove_dir_link(p)
+        elif os.path.isdir(p):
+            # expanded directories may hold links to cached directories at
+            # any depth, which are removed without following them.
+            self._discard(p)
+        else:
+            remove_dir_link(p)
+
     def _build_toplevel_dirs(
         self,
         missing_dirs: typing.Iterable[typing.Tuple[str, DirectoryData]],
         directory_local: str,
         large_directory: typing.Set[str],
         skip_cache: typing.Set[str],
+        caller: typing.Hashable = None,
+        *,
+        layouts: typing.Optional[typing.Dict[str, str]] = None,
     ):
+        """Build the subdirectories of a build directory. layouts are the
+        ones already decided, by name.
+        """
         large_dir_to_build: typing.Dict[str, DirectoryData] = {}
-        skip_cache_dir_to_build: typing.Dict[str, DirectoryData] = {}
+        native_dir_to_build: typing.List[typing.Tuple[DirectoryData, str]] = []
         cached_dir_to_build: typing.Dict[str, DirectoryData] = {}
         for name, each_dir in missing_dirs:
-            if name in large_directory:
-                large_dir_to_build[name] = each_dir
-            elif name in skip_cache:
-                skip_cache_dir_to_build[name] = each_dir
+            if layouts is not None and name in layouts:
+                layout = layouts[name]
             else:
+                layout = self._layout(
+                    name, each_dir, large_directory, skip_cache
+                )
+            if layout == _EXPANDED:
+                large_dir_to_build[name] = each_dir
+            elif layout == _CACHED:
                 cached_dir_to_build[name] = each_dir
+            else:
+                native_dir_to_build.append(
+                    (each_dir, os.path.join(directory_local, name))
+                )
 
         build_native_futures: typing.List[FutureDigest] = []
         delayed_link: typing.Dict[
             str, typing.List[str]
         ] = collections.defaultdict(list)
-        dir_need_to_evict = []
-        with self._download_lock:
-            required_size_bytes = 0
-            cached_names: typing.Set[str] = set()
-            dirs_to_download: typing.Dict[str, DirectoryData] = {}
-            file_count = self._file_count
-            for name, subdir in cached_dir_to_build.items():
-                name_in_cache = subdir.name_in_cache
-                dir_local_path = os.path.join(directory_local, name)
-                if name_in_cache in self._cached_dir:
-                    # other thread may downloaded the same directory at the
-                    # same time.
-                    cached_names.add(name_in_cache)
-                elif name_in_cache in self._pending_cached_dir:
-                    # other thread is downloading the same directory.
-                    f = self._pending_cached_dir[name_in_cache]
-                    build_native_futures.append(f)
-                else:
-                    size_bytes, file_count = self._calculate_required_size(
-                        subdir, file_count
-                    )
-                    required_size_bytes += size_bytes
-                    dirs_to_download[name] = subdir
-                delayed_link[name_in_cache].append(dir_local_path)
-            available_size_bytes = (
-                self._max_cache_size_bytes
-                - self._current_size_bytes
-                - required_size_bytes
-            )
-            if self._max_cache_size_bytes > 0 > available_size_bytes:
-                released_size = 0
-                for name_in_cache in self._cached_dir:
-                    if name_in_cache in cached_names:
-                        continue
-                    dir_need_to_evict.append(name_in_cache)
-                    size_bytes, file_count = self._calculate_released_size(
-                        self._cached_dir[name_in_cache], file_count
-                    )
-                    released_size += size_bytes
-                    if available_size_bytes + released_size >= 0:
-                        break
-                if available_size_bytes + released_size < 0:
-                    raise MaxSizeReached
-                self._current_size_bytes -= released_size
-                for name in dir_need_to_evict:
-                    del self._cached_dir[name]
-            for name in cached_names:
-                self._cached_dir[name] = self._cached_dir.pop(name)
-            self._current_size_bytes += required_size_bytes
-            self._file_count = file_count
-            for name, subdirectory in dirs_to_download.items():
-                f = self._build_cached_directory_in_thread(
-                    subdirectory, self._copy_from_filesystem
-                )
-                build_native_futures.append(f)
-        for name, subdirectory in large_dir_to_build.items():
+        dir_need_to_evict: typing.List[typing.Tuple[str, int]] = []
+        for name, subdir in cached_dir_to_build.items():
             dir_local_path = os.path.join(directory_local, name)
-            self._build_toplevel(subdirectory, dir_local_path, set(), set())
-        for name, subdirectory in skip_cache_dir_to_build.items():
+            delayed_link[subdir.name_in_cache].append(dir_local_path)
+        futures, dir_need_to_evict, uncached = self._admit_evicting(
+            cached_dir_to_build.values(), caller
+        )
+        build_native_futures.extend(futures)
+        for subdir in uncached:
+            # the cache is saturated, built in place instead of linked.
+            for dir_local_path in delayed_link.pop(subdir.name_in_cache):
+                native_dir_to_build.append((subdir, dir_local_path))
+        for name, subdirectory in large_dir_to_build.items():
             dir_local_path = os.path.join(directory_local, name)
-            f = self._build_native_in_thread(
-                subdirectory,
-                dir_local_path,
-                copy_file=self._copy_from_filesystem,
+            self._build_toplevel(
+                subdirectory, dir_local_path, set(), set(), caller
+            )
+        if native_dir_to_build:
+            build_native_futures.extend(
+                self._build_natives_in_thread(
+                    native_dir_to_build,
+                    copy_file=self._copy_from_filesystem,
+                    caller=caller,
+                )
             )
-            build_native_futures.append(f)
 
-        # TODO: do in thread.
-        for name in dir_need_to_evict:
+        for name, size_bytes in dir_need_to_evict:
             self._meter.count("evict_cached_dir")
-            self._remove_cached_dir(name)
+            self._remove_cached_dir(name, size_bytes)
 
         for f in concurrent.futures.as_completed(build_native_futures):
             f.result()
@@ -444,180 +1553,317 @@ class SharedTopLevelCachedDirectoryBuilder(IDirectoryBuilder):
             if not os.path.isdir(p):
                 raise RuntimeError(f"missing directory {p}")
 
-    def _build_cached_directory_in_thread(
+    def _admit_evicting(
         self,
-        directory: DirectoryData,
-        copy_file: bool = False,
-    ) -> FutureDigest:
-        """Build a cached directory in thread. This method MUST be called with
-        _download_lock.
+        dirs: typing.Iterable[DirectoryData],
+        caller: typing.Hashable,
+    ) -> typing.Tuple[
+        typing.List[FutureDigest],
+        typing.List[typing.Tuple[str, int]],
+        typing.List[DirectoryData],
+    ]:
+        """_admit_cached_dirs with evict. When the trash holds the space
+        needed, it is removed without _download_lock first, removing trees
+        takes long.
         """
-        name_in_cache = directory.name_in_cache
-
-        future: FutureDigest
-        if name_in_cache in self._pending_cached_dir:
-            future = self._pending_cached_dir[name_in_cache]
-        else:
-            future = concurrent.futures.Future()
-            path_in_cache = os.path.join(self._cache_dir_root, name_in_cache)
-
-            inner_future = self._build_native_in_thread(
-                directory, path_in_cache, copy_file=copy_file
+        dirs = list(dirs)
+        try:
+            with self._download_lock:
+                admitted = self._admit_cached_dirs(
+                    dirs, caller, wait_for_trash=True
+                )
+        except _TrashNotEmpty as e:
+            assert self._trash is not None
+            self._meter.count("trash_reclaim")
+            self._trash.reclaim(e.size_bytes)
+            # what is still in the trash is counted, evict for the rest.
+            with self._download_lock:
+                admitted = self._admit_cached_dirs(dirs, caller)
+        assert admitted is not None
+        return admitted
+
+    def _admit_cached_dirs(
+        self,
+        dirs: typing.Iterable[DirectoryData],
+        caller: typing.Hashable = None,
+        *,
+        evict: bool = True,
+        wait_for_trash: bool = False,
+    ) -> typing.Optional[
+        typing.Tuple[
+            typing.List[FutureDigest],
+            typing.List[typing.Tuple[str, int]],
+            typing.List[DirectoryData],
+        ]
+    ]:
+        """Make space for the directories not cached yet and start building
+        them. This method MUST be called with _download_lock.
+
+        Return futures of the directories being built, the names and
+        released sizes of the directories evicted from _cached_dir, which the
+        caller must remove from disk, and the directories not cached because
+        the others are pinned, which the caller must build in place. The
+        directories used are pinned for caller. If evict is False, return
+        None and change nothing when there is not enough free space. If
+        wait_for_trash, raise _TrashNotEmpty and change nothing when
+        removing the trash would make space, see _admit_evicting.
+        """
+        dirs = list(dirs)
+        build_futures: typing.List[FutureDigest] = []
+        dir_need_to_evict: typing.List[typing.Tuple[str, int]] = []
+        uncached: typing.List[DirectoryData] = []
+        required_size_bytes = 0
+        cached_names: typing.Set[str] = set()
+        dirs_to_download: typing.Dict[str, DirectoryData] = {}
+        reservation = self._reserve()
+        for subdir in dirs:
+            name_in_cache = subdir.name_in_cache
+            if name_in_cache in self._cached_dir:
+                # other thread may downloaded the same directory at the
+                # same time.
+                cached_names.add(name_in_cache)
+            elif name_in_cache in self._pending_cached_dir:
+                # other thread is downloading the same directory.
+                build_futures.append(self._pending_cached_dir[name_in_cache])
+            elif name_in_cache not in dirs_to_download:
+                required_size_bytes += self._calculate_required_size(
+                    subdir, reservation
+                )
+                dirs_to_download[name_in_cache] = subdir
+        available_size_bytes = (
+            self._max_cache_size_bytes
+            - self._current_size_bytes
+            - self._trash_size_bytes()
+            - required_size_bytes
+        )
+        if self._max_cache_size_bytes > 0 > available_size_bytes:
+            if not evict:
+                self._rollback(reservation, dirs_to_download)
+                return None
+            if wait_for_trash and self._trash_size_bytes() > 0:
+                # remove evicted directories before evicting more.
+                self._rollback(reservation, dirs_to_download)
+                raise _TrashNotEmpty(-available_size_bytes)
+            released_size = 0
+            pinned_count = 0
+            for name_in_cache in self._cached_dir:
+                if available_size_bytes + released_size >= 0:
+                    break
+                if name_in_cache in cached_names:
+                    continue
+                if name_in_cache in self._pins:
+                    pinned_count += 1
+                    continue
+                size_bytes = self._calculate_released_size(
+                    self._cached_dir[name_in_cache], reservation
+                )
+                dir_need_to_evict.append((name_in_cache, size_bytes))
+                released_size += size_bytes
+            if pinned_count:
+                self._meter.count("evict_skipped_pinned_dir", pinned_count)
+            if available_size_bytes + released_size < 0:
+                # saturated by directories in use. the new ones are built
+                # without the cache rather than fail the action.
+                self._rollback(reservation, dirs_to_download)
+                self._meter.count("dir_cache_saturated")
+                self._meter.count("build_uncached_dir", len(dirs_to_download))
+                uncached = list(dirs_to_download.values())
+                dirs_to_download = {}
+                dir_need_to_evict = []
+                required_size_bytes = 0
+            else:
+                self._current_size_bytes -= released_size
+                for name, _ in dir_need_to_evict:
+                    self._release_files(self._cached_dir.pop(name))
+        if evict:
+            uncached_names = {d.name_in_cache for d in uncached}
+            self._pin(
+                (
+                    d.name_in_cache
+                    for d in dirs
+                    if d.name_in_cache not in uncached_names
+                ),
+                caller,
+            )
+        for name in cached_names:
+            self._cached_dir[name] = self._cached_dir.pop(name)
+        self._current_size_bytes += required_size_bytes
+        if reservation is not None:
+            reservation.commit()
+        for subdirectory in dirs_to_download.values():
+            self._hold_files(subdirectory)
+        build_futures.extend(
+            self._build_cached_directories_in_thread(
+                list(dirs_to_download.values()),
+                self._copy_from_filesystem,
+                caller,
+                evict,
             )
+        )
+        return build_futures, dir_need_to_evict, uncached
 
-            def _inner_finish(inner_future):
-                try:
-                    checksum = inner_future.result()
-                    with self._download_lock:
-                        assert (
-                            self._pending_cached_dir.get(name_in_cache, None)
-                            is future
-                        )
-                        with self._dir_lock.lock(path_in_cache):
-                            set_dir_readonly_recursive(path_in_cache)
-                        self._cached_dir[name_in_cache] = directory
-                        del self._pending_cached_dir[name_in_cache]
-                except Exception as e:
-                    if os.path.exists(path_in_cache):
-                        self._remove_cached_dir(name_in_cache)
-                    with self._download_lock:
-                        size_bytes, file_count = self._calculate_released_size(
-                            directory, self._file_count
-                        )
-                        self._current_size_bytes -= size_bytes
-                        self._file_count = file_count
-                    future.set_exception(e)
-                else:
-                    future.set_result(checksum)
-
-            self._pending_cached_dir[name_in_cache] = future
-            inner_future.add_done_callback(_inner_finish)
-        return future
+    def _pin(
+        self, names: typing.Iterable[str], caller: typing.Hashable
+    ) -> None:
+        """Keep cached directories until caller releases them. This method
+        MUST be called with _download_lock.
+        """
+        pinned = self._caller_pins.setdefault(caller, [])
+        for name_in_cache in names:
+            self._pins[name_in_cache] += 1
+            pinned.append(name_in_cache)
 
-    def _build_native_in_thread(
+    def _build_cached_directories_in_thread(
         self,
-        directory: DirectoryData,
-        directory_local: str,
+        directories: typing.List[DirectoryData],
         copy_file: bool = False,
+        caller: typing.Hashable = None,
+        evict: bool = True,
+    ) -> typing.List[FutureDigest]:
+        """Build cached directories in thread, their files fetched together.
+        Unless evict, the file cache evicts nothing for them.
+        This method MUST be called with _download_lock.
+        """
+        futures: typing.Dict[str, FutureDigest] = {}
+        to_build: typing.List[DirectoryData] = []
+        for directory in directories:
+            name_in_cache = directory.name_in_cache
+            if name_in_cache in self._pending_cached_dir:
+                futures[name_in_cache] = self._pending_cached_dir[
+                    name_in_cache
+                ]
+            else:
+                to_build.append(directory)
+        inner_futures = self._build_natives_in_thread(
+            [
+                (
+                    directory,
+                    os.path.join(
+                        self._cache_dir_root, directory.name_in_cache
+                    ),
+                )
+                for directory in to_build
+            ],
+            copy_file=copy_file,
+            caller=caller,
+            evict=evict,
+        )
+        for directory, inner_future in zip(to_build, inner_futures):
+            futures[directory.name_in_cache] = self._finish_cached_directory(
+                directory, inner_future
+            )
+        return [futures[directory.name_in_cache] for directory in directories]
+
+    def _finish_cached_directory(
+        self, directory: DirectoryData, inner_future: FutureDigest
     ) -> FutureDigest:
+        """Cache directory once inner_future built it. This method MUST be
+        called with _download_lock.
+        """
+        name_in_cache = directory.name_in_cache
         future: FutureDigest = concurrent.futures.Future()
+        path_in_cache = os.path.join(self._cache_dir_root, name_in_cache)
 
-        def _chain_exception(inner_future):
+        def _inner_finish(inner_future):
             try:
-                inner_future.result()
+                checksum = inner_future.result()
+                # a pending directory is never evicted, so it is finished
+                # without blocking admissions. only registering it needs
+                # _download_lock.
+                with self._dir_lock.lock(path_in_cache):
+                    set_dir_readonly_recursive(path_in_cache)
+                    self._write_source(directory)
+                    self._write_manifest(directory, path_in_cache)
+                with self._download_lock:
+                    assert (
+                        self._pending_cached_dir.get(name_in_cache, None)
+                        is future
+                    )
+                    self._cached_dir[name_in_cache] = directory
+                    del self._pending_cached_dir[name_in_cache]
             except Exception as e:
+                if os.path.exists(path_in_cache):
+                    self._remove_cached_dir(name_in_cache)
+                with self._download_lock:
+                    self._current_size_bytes -= self._commit_released_size(
+                        directory
+                    )
+                    self._release_files(directory)
                 future.set_exception(e)
+            else:
+                future.set_result(checksum)
 
-        inner_future = self._executor.submit(
-            self._build_native,
-            future,
-            directory,
-            directory_local,
-            copy_file=copy_file,
-        )
-        inner_future.add_done_callback(_chain_exception)
+        self._pending_cached_dir[name_in_cache] = future
+        inner_future.add_done_callback(_inner_finish)
         return future
 
-    def _build_native(
+    def _build_natives_in_thread(
         self,
-        future: FutureDigest,
-        directory: DirectoryData,
-        directory_local: str,
+        trees: typing.List[typing.Tuple[DirectoryData, str]],
         copy_file: bool = False,
-    ):
-        dir_message = Directory()
-        if not os.path.exists(directory_local):
-            os.makedirs(directory_local)
-        # files.
-        if directory.file_count:
-            sorted_files = sorted(
-                [fd.to_file_node(n) for n, fd in directory.files()],
-                key=lambda fn: fn.name,
-            )
-            self._filesystem.fetch_to(
+        caller: typing.Hashable = None,
+        evict: bool = True,
+    ) -> typing.List[FutureDigest]:
+        """Build directories at their paths with tasks of _dag. One fetches
+        the files of all the trees at once with fetch_tree, which links every
+        directory in a task once its files are downloaded. A tree is built
+        once all of its directories are linked: fetch_tree creates them and
+        fetches again the files link_to reports missing.
+        """
+        if not trees:
+            return []
+        results: typing.List[FutureDigest] = [
+            concurrent.futures.Future() for _ in trees
+        ]
+
+        def _tree_done(
+            directory: DirectoryData,
+            result: FutureDigest,
+            fetched: concurrent.futures.Future,
+        ) -> None:
+            e = fetched.exception()
+            if e is not None:
+                result.set_exception(e)
+            else:
+                # the checksum of what is built is known already.
+                result.set_result(directory.checksum_digest)
+
+        def _start():
+            fetched = self._filesystem.fetch_tree(
                 self._cas_helper,
-                sorted_files,
-                directory_local,
+                trees,
                 copy_file=copy_file,
+                caller=caller,
+                executor=self._dag,
+                evict=evict,
             )
-            for fnode in sorted_files:
-                dir_message.files.append(fnode)
-            # TODO: better exception and set_exception.
-            for n, fd in directory.files():
-                p = os.path.join(directory_local, n)
-                if not os.path.exists(p):
-                    raise RuntimeError(f"missing file {n}")
-        # directories.
-        subdir_check: typing.Dict[str, None | DirectoryNode] = {}
-        subdir_check_lock = threading.Lock()
-
-        def _set_result():
-            dir_data = dir_message.SerializeToString(deterministic=True)
-            future.set_result(
-                Digest(
-                    hash=hashlib.sha256(dir_data).hexdigest(),
-                    size_bytes=len(dir_data),
+            for (directory, _), f, result in zip(trees, fetched, results):
+                f.add_done_callback(
+                    functools.partial(_tree_done, directory, result)
                 )
-            )
 
-        def _subdir_build_callback(name: str, fut: FutureDigest):
-            try:
-                digest = fut.result()
-            except Exception as e:
-                if not future.done():
-                    future.set_exception(e)
-            else:
-                with subdir_check_lock:
-                    subdir_check[name] = DirectoryNode(
-                        name=name, digest=digest
-                    )
+        def _start_failed(started: concurrent.futures.Future) -> None:
+            e = started.exception()
+            if e is not None:
+                for result in results:
+                    result.set_exception(e)
 
-                    if all(subdir_check.values()):
-                        for name in sorted(subdir_check):
-                            n = subdir_check[name]
-                            assert n
-                            dir_message.directories.append(n)
-                        # TODO: better exception and set_exception.
-                        for d in directory.directories():
-                            if not os.path.exists(
-                                os.path.join(directory_local, name)
-                            ):
-                                raise RuntimeError(f"missing directory {name}")
-                        _set_result()
-
-        for each_name, subdirectory in directory.directories():
-            subdir_check[each_name] = None
-        for each_name, subdirectory in directory.directories():
-            sub_future = self._build_native_in_thread(
-                subdirectory,
-                os.path.join(directory_local, each_name),
-                copy_file=copy_file,
-            )
-            sub_future.add_done_callback(
-                functools.partial(_subdir_build_callback, each_name)
-            )
-        with subdir_check_lock:
-            if not subdir_check:
-                _set_result()
-
-    def _remove_large_directory(self, target: str):
-        for name in os.listdir(target):
-            p = os.path.join(target, name)
-            # remove links first so we can quick remove a large directory.
-            if os.path.isdir(p):
-                # XXX: directory in large directory should always be a link.
-                remove_dir_link(p)
-            elif os.path.isfile(p):
-                unlink_readonly_file(p)
-        rmtree(target)
+        self._dag.submit(_start).add_done_callback(_start_failed)
+        return results
 
     def _verify_existing_dirs(self) -> None:
         logging.info("validate directory start.")
-        dir_to_verify: typing.List[typing.Tuple[str, Digest]] = []
+        dir_to_verify: typing.List[str] = []
+        self._source_files.clear()
         for name in os.listdir(self._cache_dir_root):
+            if name.startswith("."):
+                source = parse_source_file_name(name)
+                if source is not None:
+                    self._source_files[source[0]] = name
+                continue
             try:
-                hash_, size_bytes_str = name.split("_")
-                size_bytes = int(size_bytes_str)
+                _, size_bytes_str = name.split("_")
+                int(size_bytes_str)
             except Exception:
                 p = os.path.join(self._cache_dir_root, name)
                 if os.path.isfile(p):
@@ -625,183 +1871,274 @@ class SharedTopLevelCachedDirectoryBuilder(IDirectoryBuilder):
                 elif os.path.isdir(p):
                     self._remove_cached_dir(name)
             else:
-                dir_to_verify.append(
-                    (name, Digest(hash=hash_, size_bytes=size_bytes))
-                )
-        dir_atime = {}
-        if dir_to_verify:
-            verify_thread_count = 10
-            mapped_digests = [
-                dir_to_verify[i::verify_thread_count]
-                for i in range(verify_thread_count)
-            ]
-            future_list = []
-            for part in mapped_digests:
-                future_list.append(
-                    self._executor.submit(self._verify_thread, part)
-                )
-            for future in future_list:
-                dir_atime.update(future.result())
+                dir_to_verify.append(name)
+        dir_atime = self._verify_dirs(dir_to_verify)
         dirs_to_evict = []
         for name in sorted(
             dir_atime, key=lambda k: dir_atime[k], reverse=True
         ):
             dir_data = self._cached_dir[name]
-            size_bytes, file_count = self._calculate_required_size(
-                dir_data, self._file_count
-            )
+            reservation = self._reserve()
+            size_bytes = self._calculate_required_size(dir_data, reservation)
             if (
                 size_bytes + self._current_size_bytes
                 > self._max_cache_size_bytes
                 > 0
             ):
+                self._rollback(reservation, [name])
                 dirs_to_evict.append(name)
             else:
                 self._current_size_bytes += size_bytes
-                self._file_count = file_count
+                if reservation is not None:
+                    reservation.commit()
+                self._hold_files(dir_data)
         for name in dirs_to_evict:
+            del self._cached_dir[name]
             self._remove_cached_dir(name)
+        for name_in_cache, name in list(self._source_files.items()):
+            if name_in_cache not in self._cached_dir:
+                del self._source_files[name_in_cache]
+                os.unlink(os.path.join(self._cache_dir_root, name))
+        if self._manifest_root is not None:
+            for name in os.listdir(self._manifest_root):
+                name_in_cache, _ = os.path.splitext(name)
+                if name_in_cache not in self._cached_dir:
+                    os.unlink(os.path.join(self._manifest_root, name))
         logging.info("validate directory end.")
 
-    def _verify_thread(
-        self, directory_to_verify: typing.Iterable[typing.Tuple[str, Digest]]
-    ):
-        dir_atime = {}
-        for name, check_digest in directory_to_verify:
-            p = os.path.join(self._cache_dir_root, name)
-            try:
-                dir_data, atime = self._calculate_dir_digest(p)
-                if dir_data is None:
-                    self._remove_cached_dir(name)
-                elif dir_data.checksum_digest != check_digest:
-                    self._remove_cached_dir(name)
-                else:
-                    self._cached_dir[name] = dir_data
-                    dir_atime[name] = atime
-            except Exception:
+    def _verify_dirs(self, names: typing.List[str]) -> typing.Dict[str, float]:
+        """Verify cached directories, and return the last access time of the
+        valid ones. A directory matching its manifest is verified from
+        metadata. The files of the others are hashed in batches spread over
+        the executor, so a few large directories don't serialize the work.
+        """
+        dir_atime: typing.Dict[str, float] = {}
+        scanned: typing.Dict[str, _ScannedDir] = {}
+        for name, result in zip(
+            names, self._executor.map(self._check_or_scan_dir, names)
+        ):
+            if result is None:
+                self._remove_cached_dir(name)
+            elif isinstance(result, _ScannedDir):
+                scanned[name] = result
+            else:
+                self._cached_dir[name], dir_atime[name] = result
+                self._meter.count("verify_cached_dir_manifest")
+        if not scanned:
+            return dir_atime
+        # files linked from the file cache were just verified by it.
+        verified_inodes = self._filesystem.take_verified_inodes()
+        hashes: typing.Dict[str, typing.Optional[str]] = {}
+        batches: typing.List[typing.List[typing.Tuple[str, int]]] = [[]]
+        batch_bytes = 0
+        for p, size_bytes, inode in (
+            f for s in scanned.values() for f in _iter_scanned_files(s)
+        ):
+            hash_ = verified_inodes.get(inode)
+            if hash_ is not None:
+                hashes[p] = hash_
+                continue
+            if batch_bytes >= _VERIFY_BATCH_BYTES or (
+                len(batches[-1]) >= _VERIFY_BATCH_FILES
+            ):
+                batches.append([])
+                batch_bytes = 0
+            batches[-1].append((p, size_bytes))
+            batch_bytes += size_bytes
+        self._meter.count("verify_cached_dir_reused_files", len(hashes))
+        hashed_count = 0
+        for batch_hashes in self._executor.map(_hash_files, batches):
+            hashes.update(batch_hashes)
+            hashed_count += len(batch_hashes)
+        self._meter.count("verify_cached_dir_hashed_files", hashed_count)
+        for name, s in scanned.items():
+            dir_data = _scanned_directory_data(s, hashes)
+            if dir_data is None or dir_data.name_in_cache != name:
                 self._remove_cached_dir(name)
+                continue
+            self._cached_dir[name] = dir_data
+            dir_atime[name] = s.atime
+            self._write_manifest(
+                dir_data, os.path.join(self._cache_dir_root, name)
+            )
         return dir_atime
 
-    def _calculate_dir_digest(
-        self, dir_path: str
-    ) -> typing.Tuple[typing.Optional[DirectoryData], float]:
-        atime = 0.0
-        if os.stat(dir_path).st_mode & stat.S_IWUSR:
-            return None, atime
-        checksum_message = Directory()
-        files: typing.Dict[str, FileData] = {}
-        subdirs: typing.Dict[str, DirectoryData] = {}
-        for name in sorted(os.listdir(dir_path)):
-            p = os.path.join(dir_path, name)
-            if os.stat(p).st_mode & stat.S_IWUSR:
-                return None, atime
-            if os.path.isfile(p):
-                size_bytes = os.path.getsize(p)
-                sha256 = hashlib.sha256()
-                with open(p, "rb") as f:
-                    while True:
-                        sha256.update(f.read(1024 * 1024))
-                        if f.tell() == size_bytes:
-                            break
-                d = Digest(hash=sha256.hexdigest(), size_bytes=size_bytes)
-                stat_result = os.stat(p)
-                is_executable = bool(stat_result.st_mode & stat.S_IXUSR)
-                fd = FileData(d, is_executable)
-                files[name] = fd
-                checksum_message.files.append(fd.to_file_node(name))
-                if stat_result.st_atime > atime:
-                    atime = stat_result.st_atime
-            elif os.path.isdir(p):
-                subdir_data, subdir_atime = self._calculate_dir_digest(p)
-                if subdir_data is None:
-                    return None, atime
-                if subdir_atime > atime:
-                    atime = subdir_atime
-                subdirs[name] = subdir_data
-                checksum_message.directories.append(
-                    DirectoryNode(
-                        name=name, digest=subdir_data.checksum_digest
-                    )
+    def _check_or_scan_dir(
+        self, name: str
+    ) -> typing.Union[None, _ScannedDir, typing.Tuple[DirectoryData, float]]:
+        """(DirectoryData, atime) of a cached directory matching its
+        manifest, else its metadata to hash it, or None if it's invalid.
+        """
+        p = os.path.join(self._cache_dir_root, name)
+        try:
+            if (
+                self._manifest_root is not None
+                and self._verify_level != VERIFY_FULL
+            ):
+                result = check_manifest(
+                    self._manifest_root,
+                    name,
+                    p,
+                    check_metadata=self._verify_level != VERIFY_NONE,
                 )
-            else:
-                return None, atime
-        checksum_data = checksum_message.SerializeToString(deterministic=True)
-        checksum_digest = Digest(
-            hash=hashlib.sha256(checksum_data).hexdigest(),
-            size_bytes=len(checksum_data),
+                if result is not None and (
+                    self._verify_level != VERIFY_SAMPLED
+                    or _files_match(result[0], p, self._verify_sample_ratio)
+                ):
+                    return result
+            return _scan_cached_dir(p)
+        except Exception:
+            return None
+
+    def _scrub(self, budget_bytes: int) -> None:
+        """Hash cached directories until budget_bytes are hashed or every
+        directory was hashed once since the last round. Corrupted ones are
+        removed.
+        """
+        if not self._scrub_queue:
+            with self._download_lock:
+                self._scrub_queue.extend(self._cached_dir)
+        while budget_bytes > 0 and self._scrub_queue:
+            name_in_cache = self._scrub_queue.popleft()
+            with self._download_lock:
+                dir_data = self._cached_dir.get(name_in_cache)
+            if dir_data is None:
+                continue
+            budget_bytes -= dir_data.copy_size_bytes
+            path_in_cache = os.path.join(self._cache_dir_root, name_in_cache)
+            try:
+                valid = _files_match(dir_data, path_in_cache)
+            except OSError:
+                valid = False
+            self._meter.count("scrub_dir_bytes", dir_data.copy_size_bytes)
+            if valid:
+                continue
+            with self._download_lock:
+                if self._cached_dir.get(name_in_cache) is not dir_data:
+                    # evicted meanwhile.
+                    continue
+                logging.warning(f"scrubber found corrupted {path_in_cache}")
+                self._meter.count("scrub_corrupted_dir")
+                del self._cached_dir[name_in_cache]
+                size_bytes = self._commit_released_size(dir_data)
+                self._current_size_bytes -= size_bytes
+                self._release_files(dir_data)
+            self._remove_cached_dir(name_in_cache, size_bytes)
+
+    def _write_manifest(self, directory: DirectoryData, path: str) -> None:
+        if self._manifest_root is None:
+            return
+        try:
+            write_manifest(self._manifest_root, directory, path)
+        except OSError as e:
+            logging.warning(
+                f"failed to write manifest of {directory.name_in_cache}: {e}"
+            )
+
+    def _write_source(self, directory: DirectoryData) -> None:
+        """Remember the CAS digest a cached directory is built from, so it can
+        be exported in a warm-up manifest. The file is empty, so it doesn't
+        count in the cache size.
+        """
+        if directory.source_digest is None:
+            return
+        name = source_file_name(
+            directory.name_in_cache, directory.source_digest
         )
-        return DirectoryData(checksum_digest, files, subdirs), atime
+        open(os.path.join(self._cache_dir_root, name), "w").close()
+        self._source_files[directory.name_in_cache] = name
 
-    def _remove_cached_dir(self, name_in_cache: str):
+    def _remove_cached_dir(self, name_in_cache: str, size_bytes: int = 0):
         path_in_cache = os.path.join(self._cache_dir_root, name_in_cache)
         logging.info("remove cached directory:", path_in_cache)
         self._meter.count("remove_cached_dir")
         with self._dir_lock.lock(path_in_cache):
+            if self._manifest_root is not None:
+                remove_manifest(self._manifest_root, name_in_cache)
+            source_name = self._source_files.pop(name_in_cache, None)
+            if source_name is not None:
+                try:
+                    os.unlink(os.path.join(self._cache_dir_root, source_name))
+                except FileNotFoundError:
+                    pass
             if os.path.exists(path_in_cache):
-                if self._copy_from_filesystem:
-                    dir_mode = stat.S_IWUSR | stat.S_IRUSR | stat.S_IXUSR
-                    file_mode = stat.S_IWUSR | stat.S_IRUSR
-                    for dir_, dirnames, filenames in os.walk(path_in_cache):
-                        for n in filenames:
-                            os.chmod(os.path.join(dir_, n), file_mode)
-                        for n in dirnames:
-                            os.chmod(os.path.join(dir_, n), dir_mode)
-                    os.chmod(path_in_cache, dir_mode)
-                else:
-                    dir_mode = stat.S_IWUSR | stat.S_IRUSR | stat.S_IXUSR
-                    for dir_, dirnames, filenames in os.walk(path_in_cache):
-                        os.chmod(dir_, dir_mode)
-                        for n in filenames:
-                            unlink_file(os.path.join(dir_, n))
-                shutil.rmtree(path_in_cache)
+                self._discard(path_in_cache, size_bytes)
+
+    def _trash_size_bytes(self) -> int:
+        if self._trash is None:
+            return 0
+        return self._trash.size_bytes
+
+    def _discard(self, path: str, size_bytes: int = 0) -> None:
+        """Remove the directory tree at path, in background if possible.
+        size_bytes counts against the cache until it is removed.
+        """
+        if self._trash is None:
+            remove_tree(path)
+        else:
+            self._trash.move(path, size_bytes)
+
+    def _hold_files(self, dir_data: DirectoryData) -> None:
+        if self._accounting is not None:
+            self._accounting.hold(_iter_file_sizes(dir_data))
+
+    def _release_files(self, dir_data: DirectoryData) -> None:
+        """Release what a directory leaving the cache held."""
+        self._file_summaries.pop(dir_data.name_in_cache, None)
+        if self._accounting is not None:
+            self._accounting.release(_iter_file_sizes(dir_data))
+
+    def _file_summary(self, dir_data: DirectoryData) -> FileSummary:
+        name_in_cache = dir_data.name_in_cache
+        summary = self._file_summaries.get(name_in_cache)
+        if summary is None:
+            summary = summarize(
+                (fd.interned_digest, fd.size_bytes)
+                for fd in _iter_file_data(dir_data)
+            )
+            self._file_summaries[name_in_cache] = summary
+        return summary
+
+    def _reserve(self) -> typing.Optional[Reservation]:
+        """Start admitting or evicting directories, None for copies, whose
+        size doesn't depend on other directories.
+        """
+        if self._refcounts is None:
+            return None
+        return self._refcounts.reserve()
+
+    def _rollback(
+        self,
+        reservation: typing.Optional[Reservation],
+        names: typing.Iterable[str],
+    ) -> None:
+        """Undo a reservation which didn't admit the directories names."""
+        if reservation is not None:
+            reservation.rollback()
+        for name in names:
+            self._file_summaries.pop(name, None)
 
     def _calculate_required_size(
         self,
         dir_data: DirectoryData,
-        file_count: typing.Dict[str, int] | None = None,
-    ) -> typing.Tuple[int, typing.Dict[str, int] | None]:
-        new_file_count: typing.Dict[str, int] | None
-        if file_count is None:
-            new_file_count = None
-            result = dir_data.copy_size_bytes
-        else:
-            result = 0
-            new_file_count = {}
-            new_file_count.update(file_count)
-            for n, fd in dir_data.files():
-                if fd.name_in_cache not in new_file_count:
-                    new_file_count[fd.name_in_cache] = 1
-                    result += fd.digest.size_bytes
-                else:
-                    new_file_count[fd.name_in_cache] += 1
-            for n, subdir_data in dir_data.directories():
-                subdir_result, new_file_count = self._calculate_required_size(
-                    subdir_data, new_file_count
-                )
-                result += subdir_result
-        return result, new_file_count
+        reservation: typing.Optional[Reservation],
+    ) -> int:
+        if reservation is None:
+            return dir_data.copy_size_bytes
+        return reservation.acquire(self._file_summary(dir_data))
 
     def _calculate_released_size(
         self,
         dir_data: DirectoryData,
-        file_count: typing.Dict[str, int] | None = None,
-    ) -> typing.Tuple[int, typing.Dict[str, int] | None]:
-        new_file_count: typing.Dict[str, int] | None
-        if file_count is None:
-            new_file_count = None
-            result = dir_data.copy_size_bytes
-        else:
-            result = 0
-            new_file_count = {}
-            new_file_count.update(file_count)
-            for n, fd in dir_data.files():
-                new_file_count[fd.name_in_cache] -= 1
-                if new_file_count[fd.name_in_cache] == 0:
-                    result += fd.digest.size_bytes
-                    del new_file_count[fd.name_in_cache]
-            for n, subdir_data in dir_data.directories():
-                subdir_result, new_file_count = self._calculate_released_size(
-                    subdir_data, new_file_count
-                )
-                result += subdir_result
-        return result, new_file_count
+        reservation: typing.Optional[Reservation],
+    ) -> int:
+        if reservation is None:
+            return dir_data.copy_size_bytes
+        return reservation.release(self._file_summary(dir_data))
+
+    def _commit_released_size(self, dir_data: DirectoryData) -> int:
+        reservation = self._reserve()
+        size_bytes = self._calculate_released_size(dir_data, reservation)
+        if reservation is not None:
+            reservation.commit()
+        return size_bytes
@@ -0,0 +1,224 @@
+from __future__ import annotations
+
+import sys
+import threading
+import typing
+import weakref
+
+from build.bazel.remote.execution.v2.remote_execution_pb2 import Digest
+from build.bazel.remote.execution.v2.remote_execution_pb2 import FileNode
+
+
+# memory of a FileNode with its Digest, measured with the upb backend, and
+# its pointer in the tuple of file_nodes.
+_FILE_NODE_SIZE_BYTES = 120
+
+
+class InternedDigest:
+    """Immutable digest shared by every user of the same hash and size.
+
+    SHA-256 hashes are kept as 32 raw bytes instead of a 64 characters
+    string. Other hashes are kept as they are.
+    """
+
+    __slots__ = ("_hash", "_size_bytes", "__weakref__")
+
+    def __init__(self, hash_: typing.Union[bytes, str], size_bytes: int):
+        self._hash = hash_
+        self._size_bytes = size_bytes
+
+    @property
+    def hash(self) -> str:
+        if isinstance(self._hash, bytes):
+            return self._hash.hex()
+        return self._hash
+
+    @property
+    def size_bytes(self) -> int:
+        return self._size_bytes
+
+    @property
+    def key(self) -> str:
+        return f"{self.hash}_{self._size_bytes}"
+
+    def to_digest(self) -> Digest:
+        return Digest(hash=self.hash, size_bytes=self._size_bytes)
+
+
+_intern_lock = threading.Lock()
+_interned: weakref.WeakValueDictionary[
+    typing.Tuple[typing.Union[bytes, str], int], InternedDigest
+] = weakref.WeakValueDictionary()
+
+
+def _pack_hash(hash_: str) -> typing.Union[bytes, str]:
+    if len(hash_) == 64:
+        try:
+            raw = bytes.fromhex(hash_)
+        except ValueError:
+            return hash_
+        # only lowercase hex survives the round trip.
+        if raw.hex() == hash_:
+            return raw
+    return hash_
+
+
+def intern_digest(digest: Digest) -> InternedDigest:
+    """Return the InternedDigest of digest. It lives as long as someone
+    holds it.
+    """
+    key = (_pack_hash(digest.hash), digest.size_bytes)
+    with _intern_lock:
+        result = _interned.get(key)
+        if result is None:
+            result = InternedDigest(*key)
+            _interned[key] = result
+        return result
+
+
+def interned_count() -> int:
+    """Count of distinct digests alive in the intern table."""
+    return len(_interned)
+
+
+class FileData:
+    __slots__ = ("_digest", "_is_executable")
+
+    def __init__(self, digest: Digest, is_executable: bool):
+        self._digest = intern_digest(digest)
+        self._is_executable = is_executable
+
+    @property
+    def name_in_cache(self) -> str:
+        return self._digest.key
+
+    @property
+    def digest(self) -> Digest:
+        return self._digest.to_digest()
+
+    @property
+    def interned_digest(self) -> InternedDigest:
+        return self._digest
+
+    @property
+    def size_bytes(self) -> int:
+        return self._digest.size_bytes
+
+    @property
+    def is_executable(self) -> bool:
+        return self._is_executable
+
+    def to_file_node(self, name: str) -> FileNode:
+        return FileNode(
+            name=name,
+            digest=self._digest.to_digest(),
+            is_executable=self._is_executable,
+        )
+
+
+class DirectoryData:
+    """A resolved Directory tree.
+
+    Children are kept in two flat tuples, names and data, files first. File
+    and directory names are interned with sys.intern, digests with
+    intern_digest, so trees cached at the same time share both.
+    """
+
+    __slots__ = (
+        "_checksum_digest",
+        "_source_digest",
+        "_names",
+        "_children",
+        "_file_count",
+        "_total_file_count",
+        "_copy_size_bytes",
+        "_file_nodes",
+    )
+
+    def __init__(
+        self,
+        checksum_digest: Digest,
+        files: typing.Dict[str, FileData],
+        directories: typing.Dict[str, DirectoryData],
+        source_digest: typing.Optional[Digest] = None,
+    ):
+        self._checksum_digest = intern_digest(checksum_digest)
+        # digest of the Directory message in CAS this data is built from.
+        self._source_digest = (
+            None if source_digest is None else intern_digest(source_digest)
+        )
+        self._names: typing.Tuple[str, ...] = tuple(
+            sys.intern(n) for n in (*files, *directories)
+        )
+        self._children: typing.Tuple[
+            typing.Union[FileData, DirectoryData], ...
+        ] = (*files.values(), *directories.values())
+        self._file_count = len(files)
+        self._total_file_count = len(files) + sum(
+            d.total_file_count for d in directories.values()
+        )
+        self._copy_size_bytes = sum(
+            fd.size_bytes for fd in files.values()
+        ) + sum(d.copy_size_bytes for d in directories.values())
+        self._file_nodes: typing.Optional[typing.Tuple[FileNode, ...]] = None
+
+    @property
+    def checksum_digest(self) -> Digest:
+        return self._checksum_digest.to_digest()
+
+    @property
+    def source_digest(self) -> typing.Optional[Digest]:
+        if self._source_digest is None:
+            return None
+        return self._source_digest.to_digest()
+
+    @property
+    def name_in_cache(self) -> str:
+        return self._checksum_digest.key
+
+    @property
+    def file_count(self) -> int:
+        return self._file_count
+
+    @property
+    def total_file_count(self) -> int:
+        """Count of files in the whole tree."""
+        return self._total_file_count
+
+    def files(self) -> typing.Iterator[typing.Tuple[str, FileData]]:
+        for i in range(self._file_count):
+            yield self._names[i], typing.cast(FileData, self._children[i])
+
+    def directories(self) -> typing.Iterator[typing.Tuple[str, DirectoryData]]:
+        for i in range(self._file_count, len(self._names)):
+            yield self._names[i], typing.cast(DirectoryData, self._children[i])
+
+    def file_nodes(self) -> typing.List[FileNode]:
+        """FileNodes of the files, built once on first use. The FileNodes
+        are shared, don't modify them.
+        """
+        if self._file_nodes is None:
+            self._file_nodes = tuple(
+                fd.to_file_node(name) for name, fd in self.files()
+            )
+        return list(self._file_nodes)
+
+    @property
+    def copy_size_bytes(self) -> int:
+        return self._copy_size_bytes
+
+    def estimated_memory_bytes(self) -> int:
+        """Estimated memory of this node, without its subdirectories and
+        the digests and names it shares with other nodes. FileNodes are
+        counted as if file_nodes had been called.
+        """
+        size_bytes = (
+            sys.getsizeof(self)
+            + sys.getsizeof(self._names)
+            + sys.getsizeof(self._children)
+        )
+        if self._file_count:
+            size_bytes += self._file_count * (
+                sys.getsizeof(self._children[0]) + _FILE_NODE_SIZE_BYTES
+            )
+        return size_bytes
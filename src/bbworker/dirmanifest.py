@@ -0,0 +1,143 @@
+"""Manifests of cached directories.
+
+A manifest records the DirectoryData a cached directory is built from, and
+the inode, mtime, size and mode of every file in it, when it's finished. At
+restart, a directory which still matches its manifest is known valid from
+metadata alone, without hashing its files again.
+"""
+
+import json
+import logging
+import os
+import os.path
+import stat
+import typing
+
+from build.bazel.remote.execution.v2.remote_execution_pb2 import Digest
+
+from .directorydata import DirectoryData
+from .directorydata import FileData
+from .verify import fingerprint
+
+
+_VERSION = 1
+
+
+def manifest_path(manifest_root: str, name_in_cache: str) -> str:
+    return os.path.join(manifest_root, f"{name_in_cache}.json")
+
+
+def _encode(dir_data: DirectoryData, dir_path: str) -> dict:
+    files = []
+    for name, fd in dir_data.files():
+        st = os.lstat(os.path.join(dir_path, name))
+        digest = fd.digest
+        files.append(
+            [name, digest.hash, digest.size_bytes, fd.is_executable]
+            + fingerprint(st)
+        )
+    return {
+        "checksum": dir_data.name_in_cache,
+        "files": files,
+        "dirs": [
+            [name, _encode(subdir, os.path.join(dir_path, name))]
+            for name, subdir in dir_data.directories()
+        ],
+    }
+
+
+def write_manifest(
+    manifest_root: str, dir_data: DirectoryData, dir_path: str
+) -> None:
+    """Write the manifest of a finished cached directory."""
+    data = {"version": _VERSION, "tree": _encode(dir_data, dir_path)}
+    path = manifest_path(manifest_root, dir_data.name_in_cache)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, separators=(",", ":"))
+    os.replace(tmp_path, path)
+
+
+def remove_manifest(manifest_root: str, name_in_cache: str) -> None:
+    try:
+        os.unlink(manifest_path(manifest_root, name_in_cache))
+    except FileNotFoundError:
+        pass
+
+
+def _parse_key(key: str) -> Digest:
+    hash_, size_bytes_str = key.split("_")
+    return Digest(hash=hash_, size_bytes=int(size_bytes_str))
+
+
+def _check(
+    node: dict, dir_path: str, check_metadata: bool
+) -> typing.Optional[typing.Tuple[DirectoryData, float]]:
+    files: typing.Dict[str, FileData] = {}
+    subdirs: typing.Dict[str, DirectoryData] = {}
+    expected_names = set()
+    atime = 0.0
+    for name, hash_, size_bytes, is_executable, *recorded in node["files"]:
+        if check_metadata:
+            st = os.lstat(os.path.join(dir_path, name))
+            if fingerprint(st) != recorded:
+                return None
+            atime = max(atime, st.st_atime)
+        files[name] = FileData(
+            Digest(hash=hash_, size_bytes=size_bytes), is_executable
+        )
+        expected_names.add(name)
+    for name, subnode in node["dirs"]:
+        subdir_path = os.path.join(dir_path, name)
+        if check_metadata:
+            st = os.lstat(subdir_path)
+            if not stat.S_ISDIR(st.st_mode) or st.st_mode & stat.S_IWUSR:
+                return None
+        result = _check(subnode, subdir_path, check_metadata)
+        if result is None:
+            return None
+        subdirs[name], subdir_atime = result
+        atime = max(atime, subdir_atime)
+        expected_names.add(name)
+    # nothing added.
+    if check_metadata and len(os.listdir(dir_path)) != len(expected_names):
+        return None
+    return (
+        DirectoryData(_parse_key(node["checksum"]), files, subdirs),
+        atime,
+    )
+
+
+def check_manifest(
+    manifest_root: str,
+    name_in_cache: str,
+    dir_path: str,
+    check_metadata: bool = True,
+) -> typing.Optional[typing.Tuple[DirectoryData, float]]:
+    """Return the DirectoryData and the last access time of the cached
+    directory if it matches its manifest, checking metadata only. None if
+    there is no valid manifest or anything changed.
+
+    Without check_metadata, only the top directory is checked, and its
+    access time is returned.
+    """
+    try:
+        with open(manifest_path(manifest_root, name_in_cache), "r") as f:
+            data = json.load(f)
+        if data.get("version") != _VERSION:
+            return None
+        tree = data["tree"]
+        if tree["checksum"] != name_in_cache:
+            return None
+        st = os.lstat(dir_path)
+        if not stat.S_ISDIR(st.st_mode) or st.st_mode & stat.S_IWUSR:
+            return None
+        result = _check(tree, dir_path, check_metadata)
+        if result is None or check_metadata:
+            return result
+        return result[0], st.st_atime
+    except FileNotFoundError:
+        return None
+    except (ValueError, KeyError, TypeError):
+        logging.warning(f"invalid manifest of {name_in_cache}")
+        return None
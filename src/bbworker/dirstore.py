@@ -0,0 +1,269 @@
+import hashlib
+import mmap
+import os
+import os.path
+import struct
+import threading
+import typing
+import zlib
+
+from build.bazel.remote.execution.v2.remote_execution_pb2 import Digest
+
+from .lock import InterProcessLock
+
+
+_MAGIC = b"BBDSTORE"
+_VERSION = 1
+# magic, version, slot count, data size, head.
+_HEADER = struct.Struct("<8sIIQQ")
+# key, logical offset of the record, record size. Size 0 is an empty slot.
+_SLOT = struct.Struct("<32sQI4x")
+# key, crc32 of the body, body size.
+_RECORD = struct.Struct("<32sII")
+# size of the serialized checksum digest, which is followed by the digest
+# and the Directory.
+_BODY = struct.Struct("<H")
+# slots probed for a key.
+_PROBES = 8
+# expected average record size, to size the index.
+_AVERAGE_RECORD_BYTES = 512
+
+
+class DirectoryStoreError(Exception):
+    pass
+
+
+class StoredDirectory(typing.NamedTuple):
+    # serialized Directory message.
+    data: bytes
+    # checksum digest of the DirectoryData built from it, if known.
+    checksum_digest: typing.Optional[Digest]
+
+
+def _key(digest: Digest) -> bytes:
+    return hashlib.sha256(
+        f"{digest.hash}_{digest.size_bytes}".encode()
+    ).digest()
+
+
+class DirectoryStore(object):
+    """Persistent store of Directory messages and their checksum digests.
+
+    Records are appended to a fixed size data file used as a ring buffer,
+    so the oldest records are overwritten when it's full. A fixed size hash
+    index maps digests to records. Both files are memory mapped and sized
+    when created, opening the store doesn't read either of them. Records
+    are checked against their key and crc32 when read, a record which
+    doesn't match is treated as missing.
+
+    A store is used by one process at a time.
+    """
+
+    def __init__(self, root_dir: str, max_size_bytes: int) -> None:
+        self._root_dir = root_dir
+        self._data_size = max_size_bytes
+        self._slot_count = max(1024, max_size_bytes // _AVERAGE_RECORD_BYTES)
+        self._lock = threading.Lock()
+        self._process_lock = InterProcessLock(os.path.join(root_dir, ".lock"))
+        self._index_file: typing.Optional[typing.BinaryIO] = None
+        self._data_file: typing.Optional[typing.BinaryIO] = None
+        self._index: typing.Optional[mmap.mmap] = None
+        self._data: typing.Optional[mmap.mmap] = None
+        self._head = 0
+
+    def open(self) -> None:
+        os.makedirs(self._root_dir, exist_ok=True)
+        if not self._process_lock.acquire(blocking=False):
+            raise DirectoryStoreError(
+                f"directory store {self._root_dir} is used by another process"
+            )
+        try:
+            self._open_files()
+        except BaseException:
+            self._process_lock.release()
+            raise
+
+    def _open_files(self) -> None:
+        index_path = os.path.join(self._root_dir, "index")
+        data_path = os.path.join(self._root_dir, "data")
+        index_size = _HEADER.size + self._slot_count * _SLOT.size
+        header = None
+        if os.path.exists(index_path) and os.path.exists(data_path):
+            with open(index_path, "rb") as f:
+                header_data = f.read(_HEADER.size)
+            if len(header_data) == _HEADER.size:
+                header = _HEADER.unpack(header_data)
+        if header is None or header[:4] != (
+            _MAGIC,
+            _VERSION,
+            self._slot_count,
+            self._data_size,
+        ):
+            # new store, or created with another size: start over.
+            for path, size in [
+                (index_path, index_size),
+                (data_path, self._data_size),
+            ]:
+                with open(path, "wb") as f:
+                    f.truncate(size)
+            head = 0
+        else:
+            head = header[4]
+        self._index_file = open(index_path, "r+b")
+        self._data_file = open(data_path, "r+b")
+        self._index = mmap.mmap(self._index_file.fileno(), index_size)
+        self._data = mmap.mmap(self._data_file.fileno(), self._data_size)
+        self._head = head
+        self._write_header()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._index is None:
+                return
+            for m in [self._index, self._data]:
+                assert m is not None
+                m.flush()
+                m.close()
+            for f in [self._index_file, self._data_file]:
+                assert f is not None
+                f.close()
+            self._index = self._data = None
+            self._index_file = self._data_file = None
+        self._process_lock.release()
+
+    def get(self, digest: Digest) -> typing.Optional[StoredDirectory]:
+        key = _key(digest)
+        with self._lock:
+            if self._index is None:
+                return None
+            slot = self._find_slot(key)
+            if slot is None:
+                return None
+            _, offset, size = self._read_slot(slot)
+            body = self._read_record(key, offset, size)
+        if body is None:
+            return None
+        (checksum_size,) = _BODY.unpack_from(body)
+        start = _BODY.size
+        end = start + checksum_size
+        checksum_digest = None
+        if checksum_size:
+            checksum_digest = Digest()
+            checksum_digest.ParseFromString(body[start:end])
+        return StoredDirectory(body[end:], checksum_digest)
+
+    def put(
+        self,
+        digest: Digest,
+        data: bytes,
+        checksum_digest: typing.Optional[Digest] = None,
+    ) -> bool:
+        """Store the serialized Directory of digest. Return False when it's
+        too large for this store.
+        """
+        key = _key(digest)
+        checksum_data = b""
+        if checksum_digest is not None:
+            checksum_data = checksum_digest.SerializeToString()
+        body = _BODY.pack(len(checksum_data)) + checksum_data + data
+        record = _RECORD.pack(key, zlib.crc32(body), len(body)) + body
+        # a record never takes more than a quarter of the ring.
+        if len(record) > self._data_size // 4:
+            return False
+        with self._lock:
+            if self._data is None:
+                return False
+            offset = self._head
+            position = offset % self._data_size
+            if position + len(record) > self._data_size:
+                # records don't wrap.
+                offset += self._data_size - position
+                position = 0
+            end = position + len(record)
+            self._data[position:end] = record
+            self._write_slot(self._slot_to_replace(key), key, offset, record)
+            self._head = offset + len(record)
+            self._write_header()
+        return True
+
+    def _is_live(self, offset: int, size: int) -> bool:
+        """This method MUST be called with _lock."""
+        return size > 0 and offset >= self._head - self._data_size
+
+    def _slots(self, key: bytes) -> typing.Iterator[int]:
+        first = int.from_bytes(key[:8], "little") % self._slot_count
+        for i in range(_PROBES):
+            yield (first + i) % self._slot_count
+
+    def _read_slot(self, slot: int) -> typing.Tuple[bytes, int, int]:
+        assert self._index is not None
+        return typing.cast(
+            typing.Tuple[bytes, int, int],
+            _SLOT.unpack_from(self._index, _HEADER.size + slot * _SLOT.size),
+        )
+
+    def _write_slot(
+        self, slot: int, key: bytes, offset: int, record: bytes
+    ) -> None:
+        assert self._index is not None
+        _SLOT.pack_into(
+            self._index,
+            _HEADER.size + slot * _SLOT.size,
+            key,
+            offset,
+            len(record),
+        )
+
+    def _write_header(self) -> None:
+        assert self._index is not None
+        _HEADER.pack_into(
+            self._index,
+            0,
+            _MAGIC,
+            _VERSION,
+            self._slot_count,
+            self._data_size,
+            self._head,
+        )
+
+    def _find_slot(self, key: bytes) -> typing.Optional[int]:
+        """This method MUST be called with _lock."""
+        for slot in self._slots(key):
+            slot_key, offset, size = self._read_slot(slot)
+            if slot_key == key and self._is_live(offset, size):
+                return slot
+        return None
+
+    def _slot_to_replace(self, key: bytes) -> int:
+        """The slot of key, else a free one, else the oldest one. This
+        method MUST be called with _lock.
+        """
+        oldest = None
+        oldest_offset = 0
+        for slot in self._slots(key):
+            slot_key, offset, size = self._read_slot(slot)
+            if slot_key == key or not self._is_live(offset, size):
+                return slot
+            if oldest is None or offset < oldest_offset:
+                oldest = slot
+                oldest_offset = offset
+        assert oldest is not None
+        return oldest
+
+    def _read_record(
+        self, key: bytes, offset: int, size: int
+    ) -> typing.Optional[bytes]:
+        """This method MUST be called with _lock."""
+        assert self._data is not None
+        position = offset % self._data_size
+        if position + size > self._data_size:
+            return None
+        record_key, crc, body_size = _RECORD.unpack_from(self._data, position)
+        if record_key != key or _RECORD.size + body_size != size:
+            return None
+        start = position + _RECORD.size
+        end = start + body_size
+        body = self._data[start:end]
+        if zlib.crc32(body) != crc:
+            return None
+        return body
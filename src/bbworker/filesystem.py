@@ -1,29 +1,72 @@
 import collections
 import concurrent.futures
+import functools
 import hashlib
 import io
 import logging
 import os
 import os.path
+import random
 import typing
 import shutil
 import stat
 import threading
+import time
 
 from build.bazel.remote.execution.v2.remote_execution_pb2 import Digest
 from build.bazel.remote.execution.v2.remote_execution_pb2 import FileNode
 
+from .accounting import InodeAccounting
 from .cacheinfo import FileCacheInfo
+from .directorydata import DirectoryData
+from .linker import LINKED
+from .linker import NOT_FOUND
+from .linker import VANISHED
+from .linker import LinkEngine
+from .linker import LinkJob
 from .lock import VariableLock
 from .metrics import MeterBase
+from .scheduler import FairShareScheduler
+from .sharedcache import SharedFileEntry
+from .sharedcache import SharedFileIndex
 from .util import set_read_only
+from .watcher import CacheWatcher
 from .util import set_read_exec_only
-from .util import link_file
 from .util import unlink_readonly_file
+from .verify import VERIFY_FULL
+from .verify import VERIFY_NONE
+from .verify import VERIFY_SAMPLED
+from .verify import Scrubber
+from .verify import fingerprint
+from .verify import hash_file
+from .verify import load_fingerprints
+from .verify import save_fingerprints
 
 
 DownloadFuture = concurrent.futures.Future[None]
 
+# a block received from the backend: digest, offset and data.
+_Block = typing.Tuple[Digest, int, bytes]
+
+# fixed cost of a download request when scheduling, so many small batches
+# are not treated as free.
+_REQUEST_COST_BYTES = 64 * 1024
+
+
+class LinkExecutor(typing.Protocol):
+    def submit(
+        self, fn: typing.Callable[..., typing.Any], /, *args: typing.Any
+    ) -> concurrent.futures.Future:
+        ...
+
+
+def _iter_tree_dirs(
+    dir_data: DirectoryData, path: str
+) -> typing.Iterator[typing.Tuple[str, DirectoryData]]:
+    yield path, dir_data
+    for name, subdir in dir_data.directories():
+        yield from _iter_tree_dirs(subdir, os.path.join(path, name))
+
 
 def digest_to_cache_name(digest: Digest):
     """Convert digest to "{hash}_{size}"."""
@@ -92,6 +135,144 @@ class DownloadBatch(object):
         self._total_size_bytes += digest_and_file_nodes.digest.size_bytes
 
 
+class _BlockWriter(object):
+    """Writes and hashes the blocks of a download batch into temp files.
+
+    Blocks are queued by the download thread and written in order by a task
+    of the hash pool, which only runs while blocks are queued. A batch
+    waiting for the network holds no hash thread, so the number of
+    concurrent downloads is not bounded by the pool and blocks of different
+    batches are hashed concurrently.
+    """
+
+    def __init__(
+        self,
+        cache_root_dir: str,
+        executor: concurrent.futures.Executor,
+        max_queued: int,
+    ):
+        self._cache_root_dir = cache_root_dir
+        self._executor = executor
+        self._max_queued = max(1, max_queued)
+        self._cond = threading.Condition()
+        self._blocks: typing.Deque[_Block] = collections.deque()
+        self._draining = False
+        self._aborted = False
+        self._error: typing.Optional[BaseException] = None
+        # path in temp -> (file, sha256) of the files being received.
+        self._files: typing.Dict[
+            str, typing.Tuple[io.BufferedWriter, "hashlib._Hash"]
+        ] = {}
+        self.busy_seconds = 0.0
+
+    def put(self, block: _Block):
+        """Queue a block, waiting while the queue is full. Raise the error
+        of the writer if it failed.
+        """
+        with self._cond:
+            while (
+                len(self._blocks) >= self._max_queued and self._error is None
+            ):
+                self._cond.wait()
+            if self._error is not None:
+                raise self._error
+            self._blocks.append(block)
+            if self._draining:
+                return
+            self._draining = True
+        try:
+            self._executor.submit(self._drain)
+        except BaseException:
+            with self._cond:
+                self._draining = False
+                self._cond.notify_all()
+            raise
+
+    def finish(self):
+        """Wait until all queued blocks are written. Every file must be
+        fully received.
+        """
+        with self._cond:
+            while self._draining:
+                self._cond.wait()
+            error = self._error
+        if error is not None:
+            self._drop_files()
+            raise error
+        if self._files:
+            count = len(self._files)
+            self._drop_files()
+            raise RuntimeError(f"{count} files not fully received")
+
+    def abort(self):
+        """Receiving failed. Drop the queued blocks and unfinished files."""
+        with self._cond:
+            self._aborted = True
+            while self._draining:
+                self._cond.wait()
+        self._drop_files()
+
+    def _drain(self):
+        while True:
+            with self._cond:
+                if self._aborted or not self._blocks:
+                    self._blocks.clear()
+                    self._draining = False
+                    self._cond.notify_all()
+                    return
+                block = self._blocks.popleft()
+                self._cond.notify_all()
+            start_at = time.time()
+            try:
+                self._write(block)
+            except BaseException as e:
+                with self._cond:
+                    self._error = e
+                    self._blocks.clear()
+                    self._draining = False
+                    self._cond.notify_all()
+                return
+            finally:
+                self.busy_seconds += time.time() - start_at
+
+    def _write(self, block: _Block):
+        digest, offset, data = block
+        name_in_cache = digest_to_cache_name(digest)
+        # We need to download into a temp path. Only the file is
+        # downloaded and verify then we can move it to cache root.
+        path_in_temp = os.path.join(
+            self._cache_root_dir, name_in_cache + ".tmp"
+        )
+        if path_in_temp in self._files:
+            f, sha256 = self._files[path_in_temp]
+        else:
+            if os.path.exists(path_in_temp):
+                raise RuntimeError(f"{path_in_temp} shouldn't exist")
+            f = open(path_in_temp, "wb")
+            sha256 = hashlib.sha256()
+            self._files[path_in_temp] = (f, sha256)
+        f.write(data)
+        sha256.update(data)
+        if offset + len(data) >= digest.size_bytes:
+            assert offset + len(data) == digest.size_bytes
+            f.close()
+            del self._files[path_in_temp]
+            if (
+                os.path.getsize(path_in_temp) != digest.size_bytes
+                or sha256.hexdigest() != digest.hash
+            ):
+                os.unlink(path_in_temp)
+                # TODO: better exception.
+                raise Exception("???:{0}".format(path_in_temp))
+
+    def _drop_files(self):
+        for path_in_temp, (f, _) in self._files.items():
+            f.close()
+            # partially received file. nobody will resume it.
+            os.unlink(path_in_temp)
+        self._files.clear()
+
+
 class LocalHardlinkFilesystem(object):
     """基于hardlink的本地缓存文件系统."""
 
@@ -103,6 +284,17 @@ class LocalHardlinkFilesystem(object):
         max_cache_size_bytes: int = 0,
         concurrency: int = 10,
         download_batch_size_bytes: int = 3 * 1024 * 1024,
+        hash_concurrency: int = 2,
+        download_queue_size: int = 64,
+        shared: bool = False,
+        link_concurrency: int = 4,
+        watch: bool = False,
+        accounting: typing.Optional[InodeAccounting] = None,
+        verify_level: str = VERIFY_FULL,
+        verify_sample_ratio: float = 0.1,
+        fingerprint_path: typing.Optional[str] = None,
+        scrub_interval_seconds: float = 0,
+        scrub_bytes_per_interval: int = 64 * 1024 * 1024,
     ):
         self._cache_root_dir = cache_root_dir
         self._file_lock = VariableLock()
@@ -113,27 +305,154 @@ class LocalHardlinkFilesystem(object):
             str, FileCacheInfo
         ] = collections.OrderedDict()
         self._pending_files: typing.Dict[str, DownloadFuture] = {}
+        # files being fetched into build directories, which are never
+        # evicted before they are linked.
+        self._pins: typing.Counter[str] = collections.Counter()
         self._global_lock = threading.Lock()
         self._executor = concurrent.futures.ThreadPoolExecutor(
             concurrency, thread_name_prefix="filesystem_"
         )
+        # writing and sha256 of downloaded blocks run in this pool so the
+        # download threads can keep reading from network. a batch only uses
+        # a thread while it has received blocks to write, see _BlockWriter.
+        self._hash_executor = concurrent.futures.ThreadPoolExecutor(
+            hash_concurrency, thread_name_prefix="filesystem_hash_"
+        )
+        self._download_queue_size = download_queue_size
+        # downloads of different callers (usually runner slots) share the
+        # download threads fairly.
+        self._scheduler = FairShareScheduler(
+            meter,
+            concurrency,
+            age_boost=download_batch_size_bytes,
+            thread_name_prefix="filesystem_download_",
+        )
+        # when the cache root is shared by multiple processes, the index
+        # decides what is cached and what to evict.
+        self._shared_index: typing.Optional[SharedFileIndex]
+        if shared:
+            self._shared_index = SharedFileIndex(cache_root_dir)
+        else:
+            self._shared_index = None
+        self._link_engine = LinkEngine(
+            cache_root_dir, concurrency=link_concurrency
+        )
+        # when watched, files nobody touched are linked without stat.
+        self._watcher: typing.Optional[CacheWatcher] = None
+        if watch:
+            if CacheWatcher.available():
+                self._watcher = CacheWatcher(cache_root_dir, meter)
+            else:
+                logging.warning("inotify is not available, cache not watched")
+        # files held by cached directories, shared with the directory
+        # builder.
+        self._accounting = accounting
+        # what is hashed at startup, see verify.py. fingerprints of
+        # verified files are saved to fingerprint_path, the weaker levels
+        # trust files which still match them.
+        self._verify_level = verify_level
+        self._verify_sample_ratio = verify_sample_ratio
+        self._fingerprint_path = fingerprint_path
+        self._scrubber: typing.Optional[Scrubber] = None
+        if verify_level != VERIFY_FULL and scrub_interval_seconds > 0:
+            self._scrubber = Scrubber(
+                "filesystem_scrubber",
+                self._scrub,
+                scrub_interval_seconds,
+                scrub_bytes_per_interval,
+            )
+        self._scrub_queue: typing.Deque[str] = collections.deque()
+        # (st_dev, st_ino) -> hash of the files hashed at init, for the
+        # directory builder, whose cached directories link the same inodes.
+        self._verified_inodes: typing.Dict[typing.Tuple[int, int], str] = {}
         self._meter = meter
 
     @property
     def current_size_bytes(self):
+        if self._shared_index is not None:
+            return self._shared_index.total_bytes()
         return self._current_size_bytes
 
     def init(self):
         if not os.path.exists(self._cache_root_dir):
             os.makedirs(self._cache_root_dir)
-        self._verify_existing_files()
+        if self._shared_index is None:
+            self._verify_existing_files()
+        else:
+            with self._shared_index.init_lock():
+                if self._shared_index.open():
+                    # no other process is using the cache root.
+                    self._verify_existing_files()
+                    entries = {}
+                    for name, cache_info in self._cached_files.items():
+                        entries[name] = (
+                            self._stat_shared_entry(name),
+                            cache_info.st_atime,
+                        )
+                    self._shared_index.reset(entries)
+                else:
+                    self._load_shared_index()
+        if self._watcher is not None:
+            self._watcher.start()
+        if self._scrubber is not None and not self._scrubber.is_alive():
+            self._scrubber.start()
+
+    def close(self):
+        if self._scrubber is not None:
+            self._scrubber.stop()
+        if self._watcher is not None:
+            self._watcher.stop()
+        self._save_fingerprints()
+        if self._shared_index is not None:
+            self._shared_index.close()
+
+    def _stat_shared_entry(self, name_in_cache: str) -> SharedFileEntry:
+        st = os.stat(os.path.join(self._cache_root_dir, name_in_cache))
+        return SharedFileEntry(st.st_size, st.st_ino, st.st_mtime_ns)
+
+    def _load_shared_index(self) -> None:
+        """Trust the files other running processes have verified."""
+        assert self._shared_index is not None
+        self._cached_files.clear()
+        self._current_size_bytes = 0
+        if self._accounting is not None:
+            self._accounting.clear_cached()
+        for name, entry in self._shared_index.entries().items():
+            p = os.path.join(self._cache_root_dir, name)
+            try:
+                st = os.stat(p)
+            except FileNotFoundError:
+                self._shared_index.remove(name)
+                continue
+            if (st.st_ino, st.st_mtime_ns) == (entry.ino, entry.mtime_ns):
+                self._cached_files[name] = FileCacheInfo(st)
+                self._count_size(name, entry.size)
+
+    def _is_shared_file(
+        self, name_in_cache: str, file_stat: os.stat_result
+    ) -> bool:
+        """Check if a file we don't know was added by another process."""
+        assert self._shared_index is not None
+        entry = self._shared_index.lookup([name_in_cache]).get(name_in_cache)
+        return entry is not None and (entry.ino, entry.mtime_ns) == (
+            file_stat.st_ino,
+            file_stat.st_mtime_ns,
+        )
 
     def _verify_existing_files(self) -> None:
         logging.info("validate cached files start.")
         self._cached_files.clear()
         self._current_size_bytes = 0
+        if self._accounting is not None:
+            self._accounting.clear_cached()
         file_to_verify: typing.List[str] = []
+        fingerprints: typing.Dict[str, typing.List[int]] = {}
+        if self._fingerprint_path is not None:
+            fingerprints = load_fingerprints(self._fingerprint_path)
         for name in os.listdir(self._cache_root_dir):
+            if name.startswith("."):
+                # bookkeeping of a shared cache root.
+                continue
             p = os.path.join(self._cache_root_dir, name)
             if os.path.isfile(p):
                 file_to_verify.append(name)
@@ -145,14 +464,18 @@ class LocalHardlinkFilesystem(object):
                 file_to_verify[i::verify_thread_count]
                 for i in range(verify_thread_count)
             ]
-            cached_files = {}
+            cached_files: typing.Dict[str, FileCacheInfo] = {}
             future_list = []
             for part in mapped_digests:
                 future_list.append(
-                    self._executor.submit(self._verify_thread, part)
+                    self._executor.submit(
+                        self._verify_thread, part, fingerprints
+                    )
                 )
             for f in future_list:
-                cached_files.update(f.result())
+                file_cache_info, verified_inodes = f.result()
+                cached_files.update(file_cache_info)
+                self._verified_inodes.update(verified_inodes)
             files_to_evict: typing.List[str] = []
             for name_in_cache in sorted(
                 cached_files,
@@ -165,46 +488,159 @@ class LocalHardlinkFilesystem(object):
                     files_to_evict.append(name_in_cache)
                 else:
                     self._cached_files[name_in_cache] = cache_info
-                    self._current_size_bytes = new_size_bytes
+                    self._count_size(name_in_cache, cache_info.st_size)
             for name_in_cache in files_to_evict:
                 path_in_cache = os.path.join(
                     self._cache_root_dir, name_in_cache
                 )
                 unlink_readonly_file(path_in_cache)
+        self._save_fingerprints()
         logging.info("validate cached files end.")
 
-    def _verify_thread(self, file_to_verify: typing.Iterable[str]):
+    def _verify_thread(
+        self,
+        file_to_verify: typing.Iterable[str],
+        fingerprints: typing.Dict[str, typing.List[int]],
+    ):
         file_cache_info: typing.Dict[str, FileCacheInfo] = {}
+        verified_inodes: typing.Dict[typing.Tuple[int, int], str] = {}
+        hashed_count = 0
         for name in file_to_verify:
             p = os.path.join(self._cache_root_dir, name)
             try:
                 hash_, size_bytes_str = name.split("_")
                 # we need get cache info first so we don't change the atime.
-                cache_info = FileCacheInfo(os.stat(p))
-                if os.stat(p).st_mode & stat.S_IWUSR:
+                file_stat = os.stat(p)
+                cache_info = FileCacheInfo(file_stat)
+                size_bytes = int(size_bytes_str)
+                if file_stat.st_mode & stat.S_IWUSR:
+                    unlink_readonly_file(p)
+                elif file_stat.st_size != size_bytes:
                     unlink_readonly_file(p)
                 else:
-                    size_bytes = int(size_bytes_str)
-                    if os.path.getsize(p) == size_bytes:
-                        sha256 = hashlib.sha256()
-                        corrupted = False
-                        with open(p, "rb") as f:
-                            while True:
-                                sha256.update(f.read(1024 * 1024))
-                                if f.tell() == size_bytes:
-                                    test_hash = sha256.hexdigest()
-                                    if test_hash != hash_:
-                                        corrupted = True
-                                    break
-                        if corrupted:
-                            unlink_readonly_file(p)
-                        else:
-                            file_cache_info[name] = cache_info
+                    valid = True
+                    if self._need_hash(fingerprints.get(name), file_stat):
+                        hashed_count += 1
+                        valid = hash_file(p, size_bytes) == hash_
+                        if valid:
+                            inode = (file_stat.st_dev, file_stat.st_ino)
+                            verified_inodes[inode] = hash_
+                    if valid:
+                        file_cache_info[name] = cache_info
                     else:
                         unlink_readonly_file(p)
             except Exception:
                 unlink_readonly_file(p)
-        return file_cache_info
+        self._meter.count("verify_cached_file_hashed", hashed_count)
+        return file_cache_info, verified_inodes
+
+    def is_cached_file(
+        self, name_in_cache: str, file_stat: os.stat_result
+    ) -> bool:
+        """Whether file_stat is of the inode cached as name_in_cache, and it
+        still matches its cache info.
+        """
+        with self._global_lock:
+            cache_info = self._cached_files.get(name_in_cache)
+        if cache_info is None or not cache_info.match(file_stat):
+            return False
+        try:
+            cached_stat = os.stat(
+                os.path.join(self._cache_root_dir, name_in_cache)
+            )
+        except FileNotFoundError:
+            return False
+        return (cached_stat.st_dev, cached_stat.st_ino) == (
+            file_stat.st_dev,
+            file_stat.st_ino,
+        )
+
+    def take_verified_inodes(self) -> typing.Dict[typing.Tuple[int, int], str]:
+        """Hashes of the files hashed at init by (st_dev, st_ino). Files
+        trusted from their metadata are not in it. Handed over once, later
+        calls return an empty map.
+        """
+        verified_inodes = self._verified_inodes
+        self._verified_inodes = {}
+        return verified_inodes
+
+    def _need_hash(
+        self,
+        recorded: typing.Optional[typing.List[int]],
+        file_stat: os.stat_result,
+    ) -> bool:
+        if self._verify_level == VERIFY_NONE:
+            return False
+        if self._verify_level == VERIFY_FULL:
+            return True
+        if recorded != fingerprint(file_stat):
+            return True
+        return (
+            self._verify_level == VERIFY_SAMPLED
+            and random.random() < self._verify_sample_ratio
+        )
+
+    def _save_fingerprints(self) -> None:
+        """Save fingerprints of the cached files which still have the
+        metadata they had when verified or downloaded.
+        """
+        if self._fingerprint_path is None:
+            return
+        with self._global_lock:
+            cached_files = list(self._cached_files.items())
+        fingerprints = {}
+        for name_in_cache, cache_info in cached_files:
+            try:
+                file_stat = os.stat(
+                    os.path.join(self._cache_root_dir, name_in_cache)
+                )
+            except FileNotFoundError:
+                continue
+            if cache_info.match(file_stat):
+                fingerprints[name_in_cache] = fingerprint(file_stat)
+        save_fingerprints(self._fingerprint_path, fingerprints)
+
+    def _scrub(self, budget_bytes: int) -> None:
+        """Hash cached files until budget_bytes are hashed or every file was
+        hashed once since the last round. Corrupted files are removed.
+        """
+        if not self._scrub_queue:
+            with self._global_lock:
+                self._scrub_queue.extend(self._cached_files)
+        while budget_bytes > 0 and self._scrub_queue:
+            name_in_cache = self._scrub_queue.popleft()
+            with self._global_lock:
+                cache_info = self._cached_files.get(name_in_cache)
+            if cache_info is None:
+                continue
+            budget_bytes -= cache_info.st_size
+            hash_, _ = name_in_cache.split("_")
+            path_in_cache = os.path.join(self._cache_root_dir, name_in_cache)
+            try:
+                valid = hash_file(path_in_cache, cache_info.st_size) == hash_
+            except FileNotFoundError:
+                # evicted meanwhile.
+                continue
+            self._meter.count("scrub_file_bytes", cache_info.st_size)
+            if not valid:
+                logging.warning(f"scrubber found corrupted {path_in_cache}")
+                self._meter.count("scrub_corrupted_file")
+                with self._global_lock:
+                    if name_in_cache in self._cached_files:
+                        self._remove_corrupted_file(name_in_cache)
+
+    def _remove_corrupted_file(self, name_in_cache: str) -> None:
+        """This method MUST be called with _global_lock."""
+        path_in_cache = os.path.join(self._cache_root_dir, name_in_cache)
+        if os.path.exists(path_in_cache):
+            unlink_readonly_file(path_in_cache)
+        if self._shared_index is not None:
+            self._shared_index.remove(name_in_cache)
+        if self._watcher is not None:
+            self._watcher.unwatch(name_in_cache)
+        cache_info = self._cached_files.pop(name_in_cache, None)
+        if cache_info is not None:
+            self._uncount_size(name_in_cache, cache_info.st_size)
 
     def _link_existing_files(
         self,
@@ -216,6 +652,7 @@ class LocalHardlinkFilesystem(object):
         """Link existing files into target directory.
         Return files not exists.
         """
+        fnode_list = list(fnode_list)
         missing_files = []
         cached_files = {}
         with self._global_lock:
@@ -230,54 +667,123 @@ class LocalHardlinkFilesystem(object):
                 except KeyError:
                     pass
         corrupted_files: typing.List[FileNode] = []
+        adopted_files: typing.Dict[str, FileCacheInfo] = {}
+        # link first and sort out errors after. a file evicted or renamed
+        # into place concurrently only makes the link fail, so no per-file
+        # lock is needed.
+        watcher = self._watcher
+        since = 0
+        if watcher is not None:
+            since = watcher.sequence()
+        jobs: typing.List[LinkJob] = []
         for fnode in fnode_list:
             name_in_cache = digest_to_cache_name(fnode.digest)
-            path_in_cache = os.path.join(self._cache_root_dir, name_in_cache)
-            with self._file_lock.lock(path_in_cache):
-                if os.path.exists(path_in_cache):
-                    if name_in_cache not in cached_files:
-                        corrupted = True
-                    elif not cached_files[name_in_cache].match(
-                        os.stat(path_in_cache)
-                    ):
-                        del cached_files[name_in_cache]
-                        corrupted = True
-                    else:
-                        corrupted = False
-                    if not corrupted:
-                        target_path = os.path.join(target_dir, fnode.name)
-                        if os.path.exists(target_path):
-                            unlink_readonly_file(target_path)
-                        if not copy_file:
-                            link_file(path_in_cache, target_path)
-                        else:
-                            shutil.copy2(path_in_cache, target_path)
-                    else:
-                        corrupted_files.append(fnode)
+            expected = cached_files.get(name_in_cache)
+            jobs.append(
+                LinkJob(
+                    name_in_cache,
+                    fnode.name,
+                    expected,
+                    # nobody touched it since last checked.
+                    expected is not None
+                    and watcher is not None
+                    and watcher.is_clean(name_in_cache),
+                )
+            )
+        results = self._link_engine.link(jobs, target_dir, copy_file=copy_file)
+        retry_jobs: typing.List[LinkJob] = []
+        retry_fnodes: typing.List[FileNode] = []
+        for fnode, job, (result, file_stat) in zip(fnode_list, jobs, results):
+            name_in_cache = job.source_name
+            if result == LINKED:
+                if watcher is not None and not job.trusted:
+                    assert job.expected is not None
+                    watcher.mark_clean(name_in_cache, job.expected, since)
+                continue
+            elif result == VANISHED:
+                # evicted after checked.
+                missing_files.append(fnode)
+            elif result == NOT_FOUND:
+                # corrupted files are missing too once removed, below.
+                if name_in_cache in cached_files:
+                    corrupted_files.append(fnode)
+                else:
+                    missing_files.append(fnode)
+            else:
+                assert file_stat is not None
+                if self._shared_index is not None and (
+                    self._is_shared_file(name_in_cache, file_stat)
+                ):
+                    # downloaded again by another process.
+                    retry_jobs.append(
+                        job._replace(expected=FileCacheInfo(file_stat))
+                    )
+                    retry_fnodes.append(fnode)
+                else:
+                    corrupted_files.append(fnode)
+        if retry_jobs:
+            results = self._link_engine.link(
+                retry_jobs, target_dir, copy_file=copy_file
+            )
+            for fnode, job, (result, _) in zip(
+                retry_fnodes, retry_jobs, results
+            ):
+                if result == LINKED:
+                    assert job.expected is not None
+                    adopted_files[job.source_name] = job.expected
                 else:
-                    if name_in_cache in cached_files:
-                        corrupted_files.append(fnode)
                     missing_files.append(fnode)
         with self._global_lock:
+            for name_in_cache, cache_info in adopted_files.items():
+                if name_in_cache not in self._cached_files:
+                    self._count_size(name_in_cache, cache_info.st_size)
+                self._cached_files[name_in_cache] = cache_info
             for fn in corrupted_files:
-                name_in_cache = digest_to_cache_name(fn.digest)
-                path_in_cache = os.path.join(
-                    self._cache_root_dir, name_in_cache
-                )
-                if os.path.exists(path_in_cache):
-                    unlink_readonly_file(path_in_cache)
-                del self._cached_files[name_in_cache]
-                self._current_size_bytes -= fn.digest.size_bytes
+                self._remove_corrupted_file(digest_to_cache_name(fn.digest))
                 missing_files.append(fn)
         return missing_files
 
+    def _adopt_shared_files(self, names: typing.Iterable[str]) -> None:
+        """Add files downloaded by other processes into _cached_files."""
+        assert self._shared_index is not None
+        with self._global_lock:
+            unknown_names = [
+                n
+                for n in names
+                if n not in self._cached_files and n not in self._pending_files
+            ]
+        if not unknown_names:
+            return
+        shared_files: typing.Dict[str, FileCacheInfo] = {}
+        for name, entry in self._shared_index.lookup(unknown_names).items():
+            try:
+                st = os.stat(os.path.join(self._cache_root_dir, name))
+            except FileNotFoundError:
+                continue
+            if (st.st_ino, st.st_mtime_ns) == (entry.ino, entry.mtime_ns):
+                shared_files[name] = FileCacheInfo(st)
+        with self._global_lock:
+            for name, cache_info in shared_files.items():
+                if name not in self._cached_files:
+                    self._cached_files[name] = cache_info
+                    self._count_size(name, cache_info.st_size)
+
     def _download_missing_files(
-        self, backend, files: typing.Iterable[FileNode]
+        self,
+        backend,
+        files: typing.Iterable[FileNode],
+        caller: typing.Hashable = None,
+        *,
+        evict: bool = True,
     ) -> typing.Iterable[DownloadFuture]:
+        """Start downloading the files not cached yet. Raise MaxSizeReached
+        if they don't fit, or don't fit in the free space when not evict.
+        """
         batch_size = self._download_batch_size_bytes
         size_limited = self._max_cache_size_bytes > 0
         max_cache_size_bytes = self._max_cache_size_bytes
         download_futures: typing.Set[concurrent.futures.Future] = set()
+        shared_evicted: typing.List[str] = []
         # merge the files that have the same content.
         merged_files: typing.Dict[str, DigestAndFileNodes] = {}
         for fn in files:
@@ -288,13 +794,21 @@ class LocalHardlinkFilesystem(object):
                 merged_files[name_in_cache] = DigestAndFileNodes(
                     fn.digest, [fn]
                 )
+        if self._shared_index is not None:
+            self._adopt_shared_files(merged_files)
+        link_counts: typing.Dict[str, int] = {}
+        if (
+            self._accounting is not None
+            and self._shared_index is None
+            and size_limited
+            and evict
+        ):
+            link_counts = self._stat_eviction_candidates(merged_files)
         with self._global_lock:
             # calculate which files we need to download. which files we need
             # to remove to make space.
             required_size = 0
-            available_cache_size_bytes = (
-                self._max_cache_size_bytes - self._current_size_bytes
-            )
+            available_cache_size_bytes = self._available_size_bytes()
             missing_files: typing.List[DigestAndFileNodes] = []
             names_need_to_evict: typing.List[str] = []
             cached_names: typing.List[str] = []
@@ -311,20 +825,34 @@ class LocalHardlinkFilesystem(object):
                     if size_bytes > max_cache_size_bytes > 0:
                         raise MaxSizeReached
                     required_size += size_bytes
-            if size_limited and required_size > available_cache_size_bytes:
-                for name_in_cache in self._cached_files:
-                    names_need_to_evict.append(name_in_cache)
-                    cache_info = self._cached_files[name_in_cache]
-                    required_size -= cache_info.st_size
-                    if required_size <= available_cache_size_bytes:
-                        break
-                if required_size > available_cache_size_bytes:
+            if self._shared_index is not None:
+                keep: typing.Container[str] = merged_files
+                if self._pins:
+                    keep = self._pins.keys() | merged_files.keys()
+                evicted = self._shared_index.reserve(
+                    required_size, max_cache_size_bytes, keep, evict=evict
+                )
+                if evicted is None:
+                    raise MaxSizeReached
+                for name in evicted:
+                    cache_info = self._cached_files.pop(name, None)
+                    if cache_info is not None:
+                        self._uncount_size(name, cache_info.st_size)
+                shared_evicted = evicted
+            elif size_limited and required_size > available_cache_size_bytes:
+                if not evict:
                     raise MaxSizeReached
+                selected = self._select_files_to_evict(
+                    required_size - available_cache_size_bytes, link_counts
+                )
+                if selected is None:
+                    raise MaxSizeReached
+                names_need_to_evict = selected
             for name in cached_names:
                 self._cached_files[name] = self._cached_files.pop(name)
             for name in names_need_to_evict:
                 cache_info = self._cached_files.pop(name)
-                self._current_size_bytes -= cache_info.st_size
+                self._uncount_size(name, cache_info.st_size)
             # split missing files to batches to download.
             batch = DownloadBatch()
             batch_list: typing.List[DownloadBatch] = [batch]
@@ -346,25 +874,91 @@ class LocalHardlinkFilesystem(object):
                 future = batch_for_digest.future
                 self._pending_files[name_in_cache] = future
                 download_futures.add(future)
-                self._current_size_bytes += (
-                    digest_and_file_nodes.digest.size_bytes
+                self._count_size(
+                    name_in_cache, digest_and_file_nodes.digest.size_bytes
                 )
         # remove evicted files first so we have enough space to download new
         # files.
+        for name_in_cache in names_need_to_evict + shared_evicted:
+            if self._watcher is not None:
+                self._watcher.unwatch(name_in_cache)
         for name_in_cache in names_need_to_evict:
             self._meter.count("evict_cached_file")
             path_in_cache = os.path.join(self._cache_root_dir, name_in_cache)
             with self._file_lock.lock(path_in_cache):
                 if os.path.exists(path_in_cache):
                     unlink_readonly_file(path_in_cache)
+        if shared_evicted:
+            assert self._shared_index is not None
+            self._meter.count("evict_cached_file", len(shared_evicted))
+            self._shared_index.remove_evicted(shared_evicted)
+        if self._shared_index is not None and cached_names:
+            self._shared_index.touch(cached_names)
         for batch in batch_list:
             if batch.digests:
-                self._executor.submit(self._download_thread, backend, batch)
+                self._scheduler.submit(
+                    caller,
+                    batch.total_size_bytes + _REQUEST_COST_BYTES,
+                    self._download_thread,
+                    backend,
+                    batch,
+                )
         return download_futures
 
     def _download_thread(self, backend, batch: DownloadBatch):
+        locks = []
+        if self._shared_index is not None:
+            locks = self._shared_index.fetch_locks(
+                digest_to_cache_name(d) for d in batch.digests
+            )
+        for lock in locks:
+            lock.acquire()
         try:
-            self._download_thread_inner(backend, batch)
+            self._download_thread_locked(backend, batch)
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def _prepare_shared_download(
+        self, batch: DownloadBatch
+    ) -> typing.Set[str]:
+        """Return the names another process has downloaded since we checked.
+        Leftovers of the other names are removed. This method MUST be called
+        with the fetch locks of the batch.
+        """
+        assert self._shared_index is not None
+        names = [digest_to_cache_name(d) for d in batch.digests]
+        downloaded: typing.Set[str] = set()
+        present = self._shared_index.lookup(names)
+        for name_in_cache in names:
+            path_in_cache = os.path.join(self._cache_root_dir, name_in_cache)
+            try:
+                file_stat = os.stat(path_in_cache)
+            except FileNotFoundError:
+                file_stat = None
+            entry = present.get(name_in_cache)
+            if file_stat is not None and entry is not None:
+                if (entry.ino, entry.mtime_ns) == (
+                    file_stat.st_ino,
+                    file_stat.st_mtime_ns,
+                ):
+                    downloaded.add(name_in_cache)
+                    continue
+            # left by a process that exited in the middle of downloading.
+            if entry is not None:
+                self._shared_index.remove(name_in_cache)
+            if file_stat is not None:
+                unlink_readonly_file(path_in_cache)
+            if os.path.exists(path_in_cache + ".tmp"):
+                os.unlink(path_in_cache + ".tmp")
+        return downloaded
+
+    def _download_thread_locked(self, backend, batch: DownloadBatch):
+        downloaded_by_others: typing.Set[str] = set()
+        try:
+            if self._shared_index is not None:
+                downloaded_by_others = self._prepare_shared_download(batch)
+            self._download_thread_inner(backend, batch, downloaded_by_others)
         except Exception as e:
             with self._global_lock:
                 for digest_and_file_nodes in batch:
@@ -373,9 +967,16 @@ class LocalHardlinkFilesystem(object):
                     path_in_cache = os.path.join(
                         self._cache_root_dir, name_in_cache
                     )
-                    if os.path.exists(path_in_cache):
-                        unlink_readonly_file(path_in_cache)
-                    self._current_size_bytes -= digest.size_bytes
+                    if self._shared_index is not None:
+                        self._shared_index.release(digest.size_bytes)
+                    # files downloaded by others are still valid for them.
+                    if name_in_cache not in downloaded_by_others:
+                        if os.path.exists(path_in_cache):
+                            unlink_readonly_file(path_in_cache)
+                        # verified but not renamed yet.
+                        if os.path.exists(path_in_cache + ".tmp"):
+                            os.unlink(path_in_cache + ".tmp")
+                    self._uncount_size(name_in_cache, digest.size_bytes)
                     del self._pending_files[name_in_cache]
             batch.future.set_exception(e)
         else:
@@ -395,58 +996,93 @@ class LocalHardlinkFilesystem(object):
                             self._cached_files[name_in_cache] = FileCacheInfo(
                                 file_stat
                             )
+                            if self._shared_index is not None:
+                                self._add_shared_file(
+                                    name_in_cache,
+                                    file_stat,
+                                    name_in_cache in downloaded_by_others,
+                                )
                         else:
                             # download failed. return the reserved size bytes.
-                            self._current_size_bytes -= digest.size_bytes
+                            self._uncount_size(
+                                name_in_cache, digest.size_bytes
+                            )
+                            if self._shared_index is not None:
+                                self._shared_index.release(digest.size_bytes)
                         del self._pending_files[name_in_cache]
                 batch.future.set_result(None)
             except Exception as e:
                 batch.future.set_exception(e)
 
-    def _download_thread_inner(self, backend, batch: DownloadBatch):
-        file_opened: typing.Dict[str, io.BufferedWriter] = {}
-        file_sha256: typing.Dict[str, hashlib._Hash] = {}
+    def _add_shared_file(
+        self,
+        name_in_cache: str,
+        file_stat: os.stat_result,
+        downloaded_by_others: bool,
+    ) -> None:
+        assert self._shared_index is not None
+        if downloaded_by_others:
+            # already counted in the index, only return our reservation.
+            self._shared_index.release(file_stat.st_size)
+        else:
+            self._shared_index.add(
+                name_in_cache,
+                SharedFileEntry(
+                    file_stat.st_size, file_stat.st_ino, file_stat.st_mtime_ns
+                ),
+            )
+
+    def _download_thread_inner(
+        self,
+        backend,
+        batch: DownloadBatch,
+        skip: typing.AbstractSet[str] = frozenset(),
+    ):
+        # receiving and writing/hashing are pipelined. this thread only pulls
+        # blocks from the backend and queues them to the writer of the batch.
+        digests = [
+            d for d in batch.digests if digest_to_cache_name(d) not in skip
+        ]
+        if not digests:
+            return
+        writer = _BlockWriter(
+            self._cache_root_dir,
+            self._hash_executor,
+            self._download_queue_size,
+        )
+        receive_seconds = 0.0
+        queue_wait_seconds = 0.0
         try:
-            for digest, offset, data in backend.fetch_all_block(batch.digests):
-                name_in_cache = digest_to_cache_name(digest)
-                # We need to download into a temp path. Only the file is
-                # downloaded and verify then we can move it to cache root.
-                # TODO: create test for it.
-                path_in_temp = os.path.join(
-                    self._cache_root_dir, name_in_cache + ".tmp"
-                )
-                if path_in_temp in file_opened:
-                    f = file_opened[path_in_temp]
-                    sha256 = file_sha256[path_in_temp]
-                else:
-                    if os.path.exists(path_in_temp):
-                        raise RuntimeError(f"{path_in_temp} shouldn't exist")
-                    f = open(path_in_temp, "wb")
-                    sha256 = hashlib.sha256()
-                    file_opened[path_in_temp] = f
-                    file_sha256[path_in_temp] = sha256
-                f.write(data)
-                sha256.update(data)
-                if offset + len(data) >= digest.size_bytes:
-                    assert offset + len(data) == digest.size_bytes
-                    f.close()
-                    del file_opened[path_in_temp]
-                    del file_sha256[path_in_temp]
-                    if (
-                        os.path.getsize(path_in_temp) != digest.size_bytes
-                        or sha256.hexdigest() != digest.hash
-                    ):
-                        os.unlink(path_in_temp)
-                        # TODO: better exception.
-                        raise Exception("???:{0}".format(path_in_temp))
+            blocks = iter(backend.fetch_all_block(digests))
+            while True:
+                start_at = time.time()
+                try:
+                    block = next(blocks)
+                except StopIteration:
+                    break
+                finally:
+                    receive_seconds += time.time() - start_at
+                start_at = time.time()
+                writer.put(block)
+                queue_wait_seconds += time.time() - start_at
+        except BaseException:
+            writer.abort()
+            raise
+        else:
+            writer.finish()
         finally:
-            file_sha256.clear()
-            for file in file_opened.values():
-                file.close()
-            file_opened.clear()
+            self._meter.record("download_receive_seconds", receive_seconds)
+            self._meter.record(
+                "download_queue_wait_seconds", queue_wait_seconds
+            )
+            self._meter.record(
+                "download_write_hash_seconds", writer.busy_seconds
+            )
         # set mode.
         for digest_and_file_nodes in batch:
             name_in_cache = digest_to_cache_name(digest_and_file_nodes.digest)
+            if name_in_cache in skip:
+                continue
             executable = False
             for fn in digest_and_file_nodes.file_nodes:
                 if fn.is_executable:
@@ -464,6 +1100,170 @@ class LocalHardlinkFilesystem(object):
                 else:
                     set_read_only(path_in_cache)
 
+    def _available_size_bytes(self) -> int:
+        """Free space of the file cache. This method MUST be called with
+        _global_lock.
+        """
+        available = self._max_cache_size_bytes - self._current_size_bytes
+        if self._accounting is not None:
+            # files held by cached directories are counted by the directory
+            # cache.
+            available += self._accounting.held_cached_bytes
+        return available
+
+    def _count_size(self, name_in_cache: str, size_bytes: int) -> None:
+        """Count a file in _current_size_bytes. This method MUST be called
+        with _global_lock, or before the filesystem is shared.
+        """
+        self._current_size_bytes += size_bytes
+        if self._accounting is not None:
+            self._accounting.add_cached(name_in_cache)
+
+    def _uncount_size(self, name_in_cache: str, size_bytes: int) -> None:
+        """Undo _count_size. This method MUST be called with _global_lock."""
+        self._current_size_bytes -= size_bytes
+        if self._accounting is not None:
+            self._accounting.discard_cached(name_in_cache)
+
+    def _stat_eviction_candidates(
+        self, merged_files: typing.Dict[str, DigestAndFileNodes]
+    ) -> typing.Dict[str, int]:
+        """Return the link counts of the least recently used files which may
+        be evicted to make room for merged_files. Files are stat'ed without
+        _global_lock, which MUST NOT be held.
+        """
+        assert self._accounting is not None
+        with self._global_lock:
+            needed_bytes = -self._available_size_bytes()
+            for name_in_cache, digest_and_file_nodes in merged_files.items():
+                if (
+                    name_in_cache not in self._cached_files
+                    and name_in_cache not in self._pending_files
+                ):
+                    needed_bytes += digest_and_file_nodes.digest.size_bytes
+            if needed_bytes <= 0:
+                return {}
+            candidates = [
+                (name_in_cache, cache_info.st_size)
+                for name_in_cache, cache_info in self._cached_files.items()
+                if name_in_cache not in self._pins
+                and name_in_cache not in merged_files
+                and not self._accounting.is_held(name_in_cache)
+            ]
+        link_counts: typing.Dict[str, int] = {}
+        for name_in_cache, size_bytes in candidates:
+            path_in_cache = os.path.join(self._cache_root_dir, name_in_cache)
+            link_count = InodeAccounting.link_count(path_in_cache)
+            link_counts[name_in_cache] = link_count
+            if link_count <= 1:
+                needed_bytes -= size_bytes
+                if needed_bytes <= 0:
+                    break
+        return link_counts
+
+    def _select_files_to_evict(
+        self, needed_bytes: int, link_counts: typing.Dict[str, int]
+    ) -> typing.Optional[typing.List[str]]:
+        """Select least recently used files to free needed_bytes. Return None
+        if not possible. This method MUST be called with _global_lock.
+
+        With accounting, files held by cached directories are skipped, they
+        free nothing. So are files also linked by build directories (see
+        link_counts from _stat_eviction_candidates), their blocks stay on
+        disk until those are removed, and files not stat'ed.
+        """
+        selected: typing.List[str] = []
+        pinned_count = 0
+        if self._accounting is None:
+            for name_in_cache, cache_info in self._cached_files.items():
+                if name_in_cache in self._pins:
+                    pinned_count += 1
+                    continue
+                selected.append(name_in_cache)
+                needed_bytes -= cache_info.st_size
+                if needed_bytes <= 0:
+                    break
+            if pinned_count:
+                self._meter.count("evict_skipped_pinned_file", pinned_count)
+            if needed_bytes > 0:
+                return None
+            return selected
+        linked_count = 0
+        held_count = 0
+        for name_in_cache, cache_info in self._cached_files.items():
+            if name_in_cache in self._pins:
+                pinned_count += 1
+                continue
+            if self._accounting.is_held(name_in_cache):
+                held_count += 1
+                continue
+            if link_counts.get(name_in_cache, 2) > 1:
+                linked_count += 1
+                continue
+            selected.append(name_in_cache)
+            needed_bytes -= cache_info.st_size
+            if needed_bytes <= 0:
+                break
+        if held_count:
+            self._meter.count("evict_skipped_held_file", held_count)
+        if linked_count:
+            self._meter.count("evict_skipped_linked_file", linked_count)
+        if pinned_count:
+            self._meter.count("evict_skipped_pinned_file", pinned_count)
+        if needed_bytes > 0:
+            return None
+        return selected
+
+    def set_caller_weight(self, caller: typing.Hashable, weight: float):
+        """Set the share of download bandwidth of a caller. Default is 1."""
+        self._scheduler.set_weight(caller, weight)
+
+    def prefetch(
+        self,
+        backend,
+        files: typing.Iterable[FileNode],
+        *,
+        caller: typing.Hashable = None,
+    ) -> typing.Dict[str, concurrent.futures.Future]:
+        """Download files into the cache without linking them anywhere.
+        Files already cached or being downloaded are skipped. Nothing is
+        downloaded if they don't fit in the free space, so prefetching never
+        evicts.
+
+        Return futures of the downloads started, by name in cache.
+        """
+        new_files: typing.Dict[str, FileNode] = {}
+        with self._global_lock:
+            for fn in files:
+                name_in_cache = digest_to_cache_name(fn.digest)
+                if (
+                    name_in_cache not in self._cached_files
+                    and name_in_cache not in self._pending_files
+                ):
+                    new_files[name_in_cache] = fn
+        if not new_files:
+            return {}
+        try:
+            # the free space is checked in the same critical section the
+            # downloads are admitted.
+            self._download_missing_files(
+                backend, new_files.values(), caller, evict=False
+            )
+        except MaxSizeReached:
+            self._meter.count("prefetch_skipped_file", len(new_files))
+            return {}
+        result: typing.Dict[str, concurrent.futures.Future] = {}
+        with self._global_lock:
+            for name in new_files:
+                future = self._pending_files.get(name)
+                if future is None and name in self._cached_files:
+                    # finished already.
+                    future = concurrent.futures.Future()
+                    future.set_result(None)
+                if future is not None:
+                    result[name] = future
+        return result
+
     def fetch_to(
         self,
         backend,
@@ -471,15 +1271,361 @@ class LocalHardlinkFilesystem(object):
         target_dir: str,
         *,
         copy_file: bool = False,
+        caller: typing.Hashable = None,
     ):
-        """Fetch files into the target directory."""
+        """Fetch files into the target directory.
+
+        caller identifies who is fetching (e.g. a runner slot). downloads of
+        different callers are scheduled fairly. When the cache has no room
+        for them, files are downloaded straight into the target directory.
+        """
         # TODO: add generator test.
         # convert to list. we will iterate multiple times.
         files = list(files)
-        while files:
-            download_futures = self._download_missing_files(backend, files)
-            for f in concurrent.futures.as_completed(download_futures):
-                f.result()
-            files = self._link_existing_files(
-                files, target_dir, copy_file=copy_file
+        names = self._pin(files)
+        try:
+            while files:
+                try:
+                    download_futures = self.start_fetch(
+                        backend, files, caller=caller
+                    )
+                except MaxSizeReached:
+                    self._meter.count("file_cache_saturated")
+                    self._fetch_uncached_dir(
+                        backend, files, target_dir, copy_file
+                    )
+                    return
+                for f in concurrent.futures.as_completed(download_futures):
+                    f.result()
+                files = self.link_to(files, target_dir, copy_file=copy_file)
+        finally:
+            self._unpin(names)
+
+    def fetch_tree(
+        self,
+        backend,
+        trees: typing.Sequence[typing.Tuple[DirectoryData, str]],
+        *,
+        copy_file: bool = False,
+        caller: typing.Hashable = None,
+        executor: typing.Optional[LinkExecutor] = None,
+        on_directory: typing.Optional[typing.Callable[[str], None]] = None,
+        evict: bool = True,
+    ) -> typing.List[concurrent.futures.Future]:
+        """Fetch the files of whole trees into their target directories,
+        creating the directories first.
+
+        Unlike fetch_to for every directory, the files missing from the
+        cache are planned once for all the trees, and packed into download
+        batches together. Each directory is linked by executor, the pool of
+        the filesystem by default, as soon as its own files are cached, and
+        on_directory is called with its path. Nothing waits in between.
+        When the cache has no room for them, the files are downloaded
+        straight into the directories instead, by the pool of the
+        filesystem. Unless evict, no cached file is evicted to make room,
+        the files which don't fit are skipped by the cache instead.
+
+        Return a future per tree, done when all its files are linked.
+        """
+        link_executor: LinkExecutor = executor or self._executor
+        dirs: typing.List[typing.Tuple[int, str, typing.List[FileNode]]] = []
+        for index, (tree, target_dir) in enumerate(trees):
+            for path, dir_data in _iter_tree_dirs(tree, target_dir):
+                os.makedirs(path, exist_ok=True)
+                dirs.append((index, path, list(dir_data.file_nodes())))
+        # every directory unpins its files once linked.
+        pinned = [self._pin(files) for _, _, files in dirs]
+        saturated = False
+        try:
+            self._download_missing_files(
+                backend,
+                (fn for _, _, files in dirs for fn in files),
+                caller,
+                evict=evict,
+            )
+        except MaxSizeReached:
+            self._meter.count("file_cache_saturated")
+            if not evict:
+                self._meter.count(
+                    "prefetch_skipped_file",
+                    sum(len(files) for _, _, files in dirs),
+                )
+            saturated = True
+        with self._global_lock:
+            # only the downloads not finished yet, the others are cached.
+            pending = {
+                name: self._pending_files[name]
+                for name in (
+                    digest_to_cache_name(fn.digest)
+                    for _, _, files in dirs
+                    for fn in files
+                )
+                if name in self._pending_files
+            }
+        tree_futures: typing.List[concurrent.futures.Future] = [
+            concurrent.futures.Future() for _ in trees
+        ]
+        remaining = [0] * len(trees)
+        for index, _, _ in dirs:
+            remaining[index] += 1
+        lock = threading.Lock()
+
+        def _directory_done(
+            index: int,
+            path: str,
+            names: typing.List[str],
+            error: typing.Optional[BaseException],
+        ) -> None:
+            self._unpin(names)
+            with lock:
+                remaining[index] -= 1
+                future = tree_futures[index]
+                if future.done():
+                    return
+                if error is not None:
+                    future.set_exception(error)
+                    return
+                if on_directory is not None:
+                    on_directory(path)
+                if remaining[index] == 0:
+                    future.set_result(None)
+
+        for (index, path, files), names in zip(dirs, pinned):
+            done = functools.partial(_directory_done, index, path, names)
+            if not files:
+                done(None)
+                continue
+            if saturated:
+                self._executor.submit(
+                    self._fetch_uncached_dir,
+                    backend,
+                    files,
+                    path,
+                    copy_file,
+                    done,
+                )
+                continue
+            self._link_when_cached(
+                backend,
+                link_executor,
+                {
+                    pending[name]
+                    for name in (
+                        digest_to_cache_name(fn.digest) for fn in files
+                    )
+                    if name in pending
+                },
+                files,
+                path,
+                copy_file,
+                caller,
+                evict,
+                done,
             )
+        return tree_futures
+
+    def _link_when_cached(
+        self,
+        backend,
+        executor: LinkExecutor,
+        downloads: typing.Set[concurrent.futures.Future],
+        files: typing.List[FileNode],
+        target_dir: str,
+        copy_file: bool,
+        caller: typing.Hashable,
+        evict: bool,
+        done: typing.Callable[[typing.Optional[BaseException]], None],
+    ) -> None:
+        """Link files with executor once downloads are done."""
+        args = (backend, executor, downloads, files, target_dir, copy_file)
+        if not downloads:
+            executor.submit(self._link_tree_dir, *args, caller, evict, done)
+            return
+        waiting = [len(downloads)]
+        lock = threading.Lock()
+
+        def _download_done(_: concurrent.futures.Future) -> None:
+            with lock:
+                waiting[0] -= 1
+                if waiting[0]:
+                    return
+            executor.submit(self._link_tree_dir, *args, caller, evict, done)
+
+        for f in downloads:
+            f.add_done_callback(_download_done)
+
+    def _link_tree_dir(
+        self,
+        backend,
+        executor: LinkExecutor,
+        downloads: typing.Set[concurrent.futures.Future],
+        files: typing.List[FileNode],
+        target_dir: str,
+        copy_file: bool,
+        caller: typing.Hashable,
+        evict: bool,
+        done: typing.Callable[[typing.Optional[BaseException]], None],
+    ) -> None:
+        try:
+            for f in downloads:
+                f.result()
+            missing = self.link_to(files, target_dir, copy_file=copy_file)
+            if missing:
+                # evicted meanwhile.
+                try:
+                    retry = list(
+                        self._download_missing_files(
+                            backend, missing, caller, evict=evict
+                        )
+                    )
+                except MaxSizeReached:
+                    self._meter.count("file_cache_saturated")
+                    self._executor.submit(
+                        self._fetch_uncached_dir,
+                        backend,
+                        missing,
+                        target_dir,
+                        copy_file,
+                        done,
+                    )
+                    return
+                self._link_when_cached(
+                    backend,
+                    executor,
+                    set(retry),
+                    missing,
+                    target_dir,
+                    copy_file,
+                    caller,
+                    evict,
+                    done,
+                )
+                return
+        except Exception as e:
+            done(e)
+            return
+        done(None)
+
+    def _fetch_uncached_dir(
+        self,
+        backend,
+        files: typing.List[FileNode],
+        target_dir: str,
+        copy_file: bool,
+        done: typing.Optional[
+            typing.Callable[[typing.Optional[BaseException]], None]
+        ] = None,
+    ) -> None:
+        """Link the files which are cached, and download the others into
+        target_dir without caching them. done is called with the error, if
+        any, instead of raising it.
+        """
+        try:
+            missing = self.link_to(files, target_dir, copy_file=copy_file)
+            self._fetch_uncached(backend, missing, target_dir)
+        except Exception as e:
+            if done is None:
+                raise
+            done(e)
+            return
+        if done is not None:
+            done(None)
+
+    def _fetch_uncached(
+        self, backend, files: typing.List[FileNode], target_dir: str
+    ) -> None:
+        merged_files: typing.Dict[str, DigestAndFileNodes] = {}
+        for fn in files:
+            name_in_cache = digest_to_cache_name(fn.digest)
+            if name_in_cache in merged_files:
+                merged_files[name_in_cache].append_file_node(fn)
+            else:
+                merged_files[name_in_cache] = DigestAndFileNodes(
+                    fn.digest, [fn]
+                )
+        if not merged_files:
+            return
+        self._meter.count("fetch_uncached_file", len(merged_files))
+        # the first file of every content, the others are copies of it.
+        file_opened: typing.Dict[str, io.BufferedWriter] = {}
+        file_sha256: typing.Dict[str, hashlib._Hash] = {}
+        try:
+            for digest, _, data in backend.fetch_all_block(
+                [d.digest for d in merged_files.values()]
+            ):
+                name_in_cache = digest_to_cache_name(digest)
+                f = file_opened.get(name_in_cache)
+                if f is None:
+                    fn = merged_files[name_in_cache].file_nodes[0]
+                    f = open(os.path.join(target_dir, fn.name), "wb")
+                    file_opened[name_in_cache] = f
+                    file_sha256[name_in_cache] = hashlib.sha256()
+                f.write(data)
+                file_sha256[name_in_cache].update(data)
+        finally:
+            for f in file_opened.values():
+                f.close()
+        for name_in_cache, digest_and_file_nodes in merged_files.items():
+            digest = digest_and_file_nodes.digest
+            file_nodes = digest_and_file_nodes.file_nodes
+            path = os.path.join(target_dir, file_nodes[0].name)
+            sha256 = file_sha256.get(name_in_cache)
+            if sha256 is None:
+                if digest.size_bytes:
+                    raise InvalidDigest(f"{name_in_cache} not received")
+                open(path, "wb").close()
+            elif (
+                os.path.getsize(path) != digest.size_bytes
+                or sha256.hexdigest() != digest.hash
+            ):
+                raise InvalidDigest(f"{name_in_cache} received corrupted")
+            for fn in file_nodes[1:]:
+                shutil.copyfile(path, os.path.join(target_dir, fn.name))
+            for fn in file_nodes:
+                p = os.path.join(target_dir, fn.name)
+                if fn.is_executable:
+                    set_read_exec_only(p)
+                else:
+                    set_read_only(p)
+
+    def _pin(self, files: typing.Iterable[FileNode]) -> typing.List[str]:
+        """Keep the cached files until unpinned, return their names."""
+        names = [digest_to_cache_name(fn.digest) for fn in files]
+        with self._global_lock:
+            for name_in_cache in names:
+                self._pins[name_in_cache] += 1
+        return names
+
+    def _unpin(self, names: typing.Iterable[str]) -> None:
+        with self._global_lock:
+            for name_in_cache in names:
+                self._pins[name_in_cache] -= 1
+                if not self._pins[name_in_cache]:
+                    del self._pins[name_in_cache]
+
+    def start_fetch(
+        self,
+        backend,
+        files: typing.Iterable[FileNode],
+        *,
+        caller: typing.Hashable = None,
+    ) -> typing.List[DownloadFuture]:
+        """Start downloading the files missing from the cache, evicting
+        others if needed, without waiting. Return futures of the downloads
+        they wait for, link_to them once these are done.
+        """
+        return list(self._download_missing_files(backend, files, caller))
+
+    def link_to(
+        self,
+        files: typing.Iterable[FileNode],
+        target_dir: str,
+        *,
+        copy_file: bool = False,
+    ) -> typing.List[FileNode]:
+        """Link cached files into the target directory. Return the files
+        which are not cached, or not anymore, to fetch again.
+        """
+        return self._link_existing_files(
+            files, target_dir, copy_file=copy_file
+        )
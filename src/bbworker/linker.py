@@ -0,0 +1,191 @@
+import concurrent.futures
+import os
+import os.path
+import shutil
+import sys
+import typing
+
+from .cacheinfo import FileCacheInfo
+from .util import link_file
+from .util import unlink_readonly_file
+
+
+# results of linking one file.
+LINKED = 0
+# source doesn't exist.
+NOT_FOUND = 1
+# source doesn't match the expected cache info.
+MISMATCH = 2
+# source removed after it was checked, e.g. evicted.
+VANISHED = 3
+
+_HAS_DIR_FD = (
+    sys.platform != "win32"
+    and hasattr(os, "O_DIRECTORY")
+    and os.stat in os.supports_dir_fd
+    and os.link in os.supports_dir_fd
+    and os.unlink in os.supports_dir_fd
+)
+
+
+class LinkJob(typing.NamedTuple):
+    source_name: str
+    target_name: str
+    # None means the source is not known to be valid.
+    expected: typing.Optional[FileCacheInfo]
+    # skip the stat check, the source is known unchanged.
+    trusted: bool = False
+
+
+LinkResult = typing.Tuple[int, typing.Optional[os.stat_result]]
+
+
+class LinkEngine(object):
+    """Link cached files into a target directory with as few syscalls as
+    possible.
+
+    Links are tried first and errors handled after (EAFP) instead of
+    checking existence before every step. On POSIX the source and target
+    directories are opened once and every operation is relative to them
+    (fstatat, linkat, unlinkat), so one file usually costs one stat and one
+    link. Large lists are split into chunks linked in parallel, size the
+    pool to what the storage can take.
+    """
+
+    def __init__(
+        self,
+        source_dir: str,
+        *,
+        concurrency: int = 4,
+        chunk_size: int = 1024,
+    ):
+        self._source_dir = source_dir
+        self._chunk_size = chunk_size
+        self._executor: typing.Optional[concurrent.futures.ThreadPoolExecutor]
+        if concurrency > 1:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                concurrency - 1, thread_name_prefix="filesystem_link_"
+            )
+        else:
+            self._executor = None
+
+    def link(
+        self,
+        jobs: typing.Sequence[LinkJob],
+        target_dir: str,
+        *,
+        copy_file: bool = False,
+    ) -> typing.List[LinkResult]:
+        """Link jobs into target_dir. Return result of each job, with the
+        stat of its source when the source was checked.
+        """
+        results: typing.List[LinkResult] = [(NOT_FOUND, None)] * len(jobs)
+        if not jobs:
+            return results
+        if _HAS_DIR_FD and not copy_file:
+            source_fd = os.open(self._source_dir, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                target_fd = os.open(target_dir, os.O_RDONLY | os.O_DIRECTORY)
+                try:
+                    self._run_chunks(
+                        jobs,
+                        results,
+                        lambda job: self._link_at(job, source_fd, target_fd),
+                    )
+                finally:
+                    os.close(target_fd)
+            finally:
+                os.close(source_fd)
+        else:
+            self._run_chunks(
+                jobs,
+                results,
+                lambda job: self._link_path(job, target_dir, copy_file),
+            )
+        return results
+
+    def _run_chunks(
+        self,
+        jobs: typing.Sequence[LinkJob],
+        results: typing.List[LinkResult],
+        link_one: typing.Callable[[LinkJob], LinkResult],
+    ) -> None:
+        def _run(start: int, end: int):
+            for i in range(start, end):
+                results[i] = link_one(jobs[i])
+
+        chunk_size = self._chunk_size
+        futures = []
+        if self._executor is not None:
+            # the calling thread links the first chunk itself.
+            for start in range(chunk_size, len(jobs), chunk_size):
+                end = min(start + chunk_size, len(jobs))
+                futures.append(self._executor.submit(_run, start, end))
+        try:
+            _run(0, min(chunk_size, len(jobs)) if futures else len(jobs))
+        finally:
+            for f in futures:
+                f.result()
+
+    @staticmethod
+    def _link_at(job: LinkJob, source_fd: int, target_fd: int) -> LinkResult:
+        source_stat = None
+        if not job.trusted:
+            try:
+                source_stat = os.stat(job.source_name, dir_fd=source_fd)
+            except FileNotFoundError:
+                return NOT_FOUND, None
+            if job.expected is None or not job.expected.match(source_stat):
+                return MISMATCH, source_stat
+        for retry in range(2):
+            try:
+                os.link(
+                    job.source_name,
+                    job.target_name,
+                    src_dir_fd=source_fd,
+                    dst_dir_fd=target_fd,
+                )
+            except FileExistsError:
+                if retry:
+                    raise
+                os.unlink(job.target_name, dir_fd=target_fd)
+            except FileNotFoundError:
+                if job.trusted:
+                    return NOT_FOUND, None
+                return VANISHED, source_stat
+            else:
+                break
+        return LINKED, source_stat
+
+    def _link_path(
+        self, job: LinkJob, target_dir: str, copy_file: bool
+    ) -> LinkResult:
+        source_path = os.path.join(self._source_dir, job.source_name)
+        target_path = os.path.join(target_dir, job.target_name)
+        source_stat = None
+        if not job.trusted:
+            try:
+                source_stat = os.stat(source_path)
+            except FileNotFoundError:
+                return NOT_FOUND, None
+            if job.expected is None or not job.expected.match(source_stat):
+                return MISMATCH, source_stat
+        for retry in range(2):
+            try:
+                if copy_file:
+                    if os.path.lexists(target_path):
+                        raise FileExistsError(target_path)
+                    shutil.copy2(source_path, target_path)
+                else:
+                    link_file(source_path, target_path)
+            except FileExistsError:
+                if retry:
+                    raise
+                unlink_readonly_file(target_path)
+            except FileNotFoundError:
+                if job.trusted:
+                    return NOT_FOUND, None
+                return VANISHED, source_stat
+            else:
+                break
+        return LINKED, source_stat
@@ -1,5 +1,8 @@
 import contextlib
+import os
+import sys
 import threading
+import time
 import typing
 
 
@@ -65,3 +68,85 @@ class VariableLock(_VariableLock):
 class VariableRLock(_VariableLock):
     def __init__(self) -> None:
         super().__init__(threading.RLock)
+
+
+if sys.platform == "win32":
+    import msvcrt
+
+    def _lock_file(fd: int, blocking: bool) -> bool:
+        os.lseek(fd, 0, os.SEEK_SET)
+        while True:
+            try:
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            except OSError:
+                if not blocking:
+                    return False
+                time.sleep(0.05)
+            else:
+                return True
+
+    def _unlock_file(fd: int) -> None:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+else:
+    import fcntl
+
+    def _lock_file(fd: int, blocking: bool) -> bool:
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(fd, flags)
+        except BlockingIOError:
+            return False
+        return True
+
+    def _unlock_file(fd: int) -> None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+class InterProcessLock(object):
+    """An exclusive lock backed by a lock file, shared between processes.
+
+    Two InterProcessLock instances of the same path exclude each other even
+    inside one process. A lock instance itself is not reentrant and should
+    only be held by one thread at a time.
+    """
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._fd: typing.Optional[int] = None
+
+    @property
+    def path(self):
+        return self._path
+
+    def acquire(self, blocking: bool = True) -> bool:
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            locked = _lock_file(fd, blocking)
+        except BaseException:
+            os.close(fd)
+            raise
+        if locked:
+            self._fd = fd
+        else:
+            os.close(fd)
+        return locked
+
+    def release(self) -> None:
+        fd = self._fd
+        assert fd is not None, "release an unlocked lock"
+        self._fd = None
+        try:
+            _unlock_file(fd)
+        finally:
+            os.close(fd)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
@@ -10,17 +10,192 @@ from build.bazel.remote.execution.v2.remote_execution_pb2_grpc import (
 import pydantic
 import yaml
 
+from .accounting import InodeAccounting
 from .cas import CASHelper
 from .config import Config
 from .directorybuilder import SharedTopLevelCachedDirectoryBuilder
+from .dirstore import DirectoryStore
 from .metrics import MeterBase
 from .filesystem import LocalHardlinkFilesystem
+from .prefetch import InputHistory
+from .prefetch import Prefetcher
+from .prewarm import export_manifest
+from .prewarm import prewarm
+from .prewarm import read_manifest
+from .prewarm import write_manifest
 from .thread import WorkerThreadMain
 
 
 MAX_MESSAGE_LENGTH = 16 * 1024 * 1024
 
 
+def load_config(config_path: str) -> Config:
+    with open(config_path, "r") as f:
+        data = yaml.load(f.read(), Loader=yaml.Loader)
+    try:
+        return Config.parse_obj(data)
+    except pydantic.error_wrappers.ValidationError as e:
+        sys.stderr.write(f"{e}\n")
+        sys.exit(1)
+
+
+def create_channel(address: str) -> grpc.Channel:
+    return grpc.insecure_channel(
+        address,
+        options=[
+            ("grpc.max_send_message_length", MAX_MESSAGE_LENGTH),
+            ("grpc.max_receive_message_length", MAX_MESSAGE_LENGTH),
+        ],
+    )
+
+
+def create_filesystem(
+    config: Config,
+    meter: MeterBase,
+    accounting: typing.Optional[InodeAccounting] = None,
+) -> LocalHardlinkFilesystem:
+    fsconfig = config.filesystem
+    return LocalHardlinkFilesystem(
+        fsconfig.cache_root,
+        meter,
+        max_cache_size_bytes=fsconfig.max_cache_size_bytes,
+        concurrency=fsconfig.concurrency,
+        download_batch_size_bytes=fsconfig.download_batch_size_bytes,
+        hash_concurrency=fsconfig.hash_concurrency,
+        download_queue_size=fsconfig.download_queue_size,
+        shared=fsconfig.shared,
+        link_concurrency=fsconfig.link_concurrency,
+        watch=fsconfig.watch_cache,
+        accounting=accounting,
+        verify_level=fsconfig.verify_level,
+        verify_sample_ratio=fsconfig.verify_sample_ratio,
+        fingerprint_path=fsconfig.fingerprint_path
+        or fsconfig.cache_root.rstrip("/\\") + ".fingerprints",
+        scrub_interval_seconds=fsconfig.scrub_interval_seconds,
+        scrub_bytes_per_interval=fsconfig.scrub_bytes_per_interval,
+    )
+
+
+def create_directory_builder(
+    config: Config,
+    cas_helper: CASHelper,
+    filesystem: LocalHardlinkFilesystem,
+    meter: MeterBase,
+    accounting: typing.Optional[InodeAccounting] = None,
+    directory_store: typing.Optional[DirectoryStore] = None,
+) -> SharedTopLevelCachedDirectoryBuilder:
+    builder_config = config.build_directory_builder
+    return SharedTopLevelCachedDirectoryBuilder(
+        builder_config.cache_root,
+        cas_helper,
+        filesystem,
+        meter,
+        max_cache_size_bytes=builder_config.max_cache_size_bytes,
+        concurrency=builder_config.concurrency,
+        accounting=accounting,
+        use_get_tree=builder_config.use_get_tree,
+        streaming=builder_config.streaming,
+        max_directory_data_bytes=builder_config.max_directory_data_bytes,
+        directory_store=directory_store,
+        incremental=builder_config.incremental,
+        manifest_root=builder_config.manifest_root
+        or builder_config.cache_root.rstrip("/\\") + ".manifests",
+        verify_level=builder_config.verify_level,
+        verify_sample_ratio=builder_config.verify_sample_ratio,
+        scrub_interval_seconds=builder_config.scrub_interval_seconds,
+        scrub_bytes_per_interval=builder_config.scrub_bytes_per_interval,
+        large_directory=builder_config.large_directories,
+        skip_cache=builder_config.skip_cache,
+        adaptive=builder_config.adaptive_granularity,
+        min_unit_bytes=builder_config.min_unit_bytes,
+        min_unit_files=builder_config.min_unit_files,
+        min_unit_seen=builder_config.min_unit_seen,
+        max_unit_bytes=builder_config.max_unit_bytes,
+        trash_root=builder_config.trash_root
+        or builder_config.cache_root.rstrip("/\\") + ".trash",
+        trash_io_nice=builder_config.trash_io_nice,
+    )
+
+
+def create_directory_store(config: Config) -> typing.Optional[DirectoryStore]:
+    builder_config = config.build_directory_builder
+    if builder_config.directory_store_root is None:
+        return None
+    store = DirectoryStore(
+        builder_config.directory_store_root,
+        builder_config.directory_store_size_bytes,
+    )
+    store.open()
+    return store
+
+
+def create_accounting(config: Config) -> typing.Optional[InodeAccounting]:
+    if config.build_directory_builder.inode_accounting:
+        return InodeAccounting()
+    return None
+
+
+def prewarm_main(config_path: str, manifest_path: str) -> None:
+    """Fill the caches of a stopped worker from a manifest."""
+    from .metrics import create_dummy_meter
+
+    config = load_config(config_path)
+    with open(manifest_path, "r") as f:
+        entries = read_manifest(f)
+    meter = create_dummy_meter()
+    with create_channel(config.buildbarn.cas_address) as cas_channel:
+        cas_helper = CASHelper(
+            ContentAddressableStorageStub(cas_channel),
+            ByteStreamStub(cas_channel),
+        )
+        accounting = create_accounting(config)
+        directory_store = create_directory_store(config)
+        filesystem = create_filesystem(config, meter, accounting)
+        filesystem.init()
+        try:
+            directory_builder = create_directory_builder(
+                config,
+                cas_helper,
+                filesystem,
+                meter,
+                accounting,
+                directory_store,
+            )
+            directory_builder.init()
+            try:
+                result = prewarm(
+                    cas_helper,
+                    filesystem,
+                    directory_builder,
+                    entries,
+                    concurrency=config.filesystem.concurrency,
+                )
+            finally:
+                directory_builder.close()
+        finally:
+            filesystem.close()
+            if directory_store is not None:
+                directory_store.close()
+    logging.info(f"prewarm fetched {result.fetched}, failed {result.failed}")
+    if result.failed:
+        sys.exit(1)
+
+
+def export_manifest_main(config_path: str, output_path: str) -> None:
+    """Write a manifest of what the caches of a worker hold."""
+    config = load_config(config_path)
+    entries = export_manifest(
+        config.filesystem.cache_root,
+        config.build_directory_builder.cache_root,
+    )
+    if output_path == "-":
+        write_manifest(sys.stdout, entries)
+    else:
+        with open(output_path, "w") as f:
+            write_manifest(f, entries)
+    logging.info(f"exported {len(entries)} entries")
+
+
 class WorkerMain:
     def __init__(self, config_path: str):
         self._config_path = config_path
@@ -29,13 +204,7 @@ class WorkerMain:
     def run(self) -> None:
         self._worker_threads = []
 
-        with open(self._config_path, "r") as f:
-            data = yaml.load(f.read(), Loader=yaml.Loader)
-        try:
-            config = Config.parse_obj(data)
-        except pydantic.error_wrappers.ValidationError as e:
-            sys.stderr.write(f"{e}\n")
-            sys.exit(1)
+        config = load_config(self._config_path)
 
         if config.sentry:
             import importlib.metadata
@@ -68,45 +237,43 @@ class WorkerMain:
 
             meter = create_dummy_meter()
         with (
-            grpc.insecure_channel(
-                config.buildbarn.scheduler_address,
-                options=[
-                    ("grpc.max_send_message_length", MAX_MESSAGE_LENGTH),
-                    ("grpc.max_receive_message_length", MAX_MESSAGE_LENGTH),
-                ],
-            ) as channel,
-            grpc.insecure_channel(
-                config.buildbarn.cas_address,
-                options=[
-                    ("grpc.max_send_message_length", MAX_MESSAGE_LENGTH),
-                    ("grpc.max_receive_message_length", MAX_MESSAGE_LENGTH),
-                ],
-            ) as cas_channel,
+            create_channel(config.buildbarn.scheduler_address) as channel,
+            create_channel(config.buildbarn.cas_address) as cas_channel,
         ):
-            fsconfig = config.filesystem
-            filesystem = LocalHardlinkFilesystem(
-                fsconfig.cache_root,
-                meter,
-                max_cache_size_bytes=fsconfig.max_cache_size_bytes,
-                concurrency=fsconfig.concurrency,
-                download_batch_size_bytes=fsconfig.download_batch_size_bytes,
-            )
+            accounting = create_accounting(config)
+            directory_store = create_directory_store(config)
+            filesystem = create_filesystem(config, meter, accounting)
             filesystem.init()
 
             cas_stub = ContentAddressableStorageStub(cas_channel)
             cas_byte_stream_stub = ByteStreamStub(cas_channel)
             cas_helper = CASHelper(cas_stub, cas_byte_stream_stub)
 
-            builder_config = config.build_directory_builder
-            directory_builder = SharedTopLevelCachedDirectoryBuilder(
-                builder_config.cache_root,
+            directory_builder = create_directory_builder(
+                config,
                 cas_helper,
                 filesystem,
                 meter,
-                max_cache_size_bytes=builder_config.max_cache_size_bytes,
-                concurrency=builder_config.concurrency,
+                accounting,
+                directory_store,
             )
             directory_builder.init()
+            prefetcher = None
+            if config.prefetch:
+                prefetch_config = config.prefetch
+                prefetcher = Prefetcher(
+                    cas_helper,
+                    filesystem,
+                    directory_builder,
+                    meter,
+                    config.concurrency,
+                    history=InputHistory(decay=prefetch_config.decay),
+                    min_probability=prefetch_config.min_probability,
+                    max_bytes_per_round=prefetch_config.max_bytes_per_round,
+                    unused_ttl=prefetch_config.unused_ttl_seconds,
+                    weight=prefetch_config.weight,
+                )
+                prefetcher.start()
             for i in range(config.concurrency):
                 thread_main = WorkerThreadMain(
                     channel,
@@ -118,6 +285,8 @@ class WorkerMain:
                     config.build_root,
                     i,
                     meter,
+                    prefetcher,
+                    config.double_buffer,
                 )
                 thread_main.start()
                 self._worker_threads.append(thread_main)
@@ -133,6 +302,12 @@ class WorkerMain:
                         break
                 if not any_alived:
                     break
+            if prefetcher is not None:
+                prefetcher.stop()
+            directory_builder.close()
+            filesystem.close()
+            if directory_store is not None:
+                directory_store.close()
         logging.info("Shutdown")
 
     def graceful_shutdown(self):
@@ -1,5 +1,6 @@
 import contextlib
 import time
+import typing
 
 
 class MeterBase(object):
@@ -7,10 +8,12 @@ class MeterBase(object):
     def record_duration(self, name: str, **kargs):
         start_at = time.time()
         yield
-        duration = time.time() - start_at
+        self.record(name, time.time() - start_at, **kargs)
+
+    def record(self, name: str, value: typing.Union[int, float], **kargs):
         histogram = self._get_histogram(name)
         if histogram:
-            histogram.record(duration, **kargs)
+            histogram.record(value, **kargs)
 
     def count(self, name: str, count: int = 1, **kargs):
         counter = self._get_counter(name)
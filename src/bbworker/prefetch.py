@@ -0,0 +1,320 @@
+from __future__ import annotations
+
+import collections
+import concurrent.futures
+import logging
+import os.path
+import queue
+import threading
+import time
+import typing
+
+from build.bazel.remote.execution.v2.remote_execution_pb2 import Command
+from build.bazel.remote.execution.v2.remote_execution_pb2 import Digest
+from build.bazel.remote.execution.v2.remote_execution_pb2 import Directory
+from build.bazel.remote.execution.v2.remote_execution_pb2 import (
+    RequestMetadata,
+)
+from remoteworker.remoteworker_pb2 import DesiredState
+
+from .cas import CASHelper
+from .directorybuilder import DirectoryData
+from .directorybuilder import FileData
+from .directorybuilder import SharedTopLevelCachedDirectoryBuilder
+from .filesystem import LocalHardlinkFilesystem
+from .metrics import MeterBase
+
+
+# downloads of the prefetcher are scheduled with this caller.
+PREFETCH_CALLER = "prefetch"
+
+InputItem = typing.Union[FileData, DirectoryData]
+
+
+def action_key(executing: DesiredState.Executing, command: Command) -> str:
+    """Group actions which likely need the same inputs. Use the mnemonic
+    bazel sends in RequestMetadata, fallback to the platform and the program.
+    """
+    for each in executing.auxiliary_metadata:
+        if each.Is(RequestMetadata.DESCRIPTOR):
+            metadata = RequestMetadata()
+            each.Unpack(metadata)
+            if metadata.action_mnemonic:
+                return f"mnemonic:{metadata.action_mnemonic}"
+    properties = ",".join(
+        f"{p.name}={p.value}" for p in command.platform.properties
+    )
+    program = ""
+    if command.arguments:
+        program = os.path.basename(command.arguments[0])
+    return f"command:{properties}:{program}"
+
+
+def _item_size_bytes(item: InputItem) -> int:
+    if isinstance(item, FileData):
+        return item.size_bytes
+    return item.copy_size_bytes
+
+
+class _KeyHistory(object):
+    def __init__(self) -> None:
+        self.score = 0.0
+        self.items: typing.Dict[str, typing.Tuple[float, InputItem]] = {}
+
+
+class InputHistory(object):
+    """Recent frequencies of the inputs needed by each action key.
+
+    Scores decay exponentially with every recorded action, so inputs of an
+    old toolchain fade out. With decay d, an input needed by every action
+    of a key converges to the score 1 / (1 - d), so score * (1 - d)
+    estimates the probability the next action of the key needs it.
+    """
+
+    def __init__(
+        self,
+        decay: float = 0.9,
+        max_keys: int = 64,
+        max_items_per_key: int = 4096,
+    ):
+        if not 0 < decay < 1:
+            raise ValueError("decay must be in (0, 1)")
+        self._decay = decay
+        self._max_keys = max_keys
+        self._max_items_per_key = max_items_per_key
+        self._lock = threading.Lock()
+        self._keys: typing.Dict[str, _KeyHistory] = collections.OrderedDict()
+
+    def record(self, key: str, inputs: typing.Dict[str, InputItem]) -> None:
+        decay = self._decay
+        with self._lock:
+            for other in self._keys.values():
+                other.score *= decay
+            history = self._keys.pop(key, None)
+            if history is None:
+                history = _KeyHistory()
+            self._keys[key] = history
+            history.score += 1
+            while len(self._keys) > self._max_keys:
+                for key_to_evict in self._keys:
+                    del self._keys[key_to_evict]
+                    break
+            items: typing.Dict[str, typing.Tuple[float, InputItem]] = {}
+            min_score = 1 - decay
+            for name, (score, item) in history.items.items():
+                score *= decay
+                if score >= min_score:
+                    items[name] = (score, item)
+            for name, item in inputs.items():
+                score, _ = items.get(name, (0.0, item))
+                items[name] = (score + 1, item)
+            if len(items) > self._max_items_per_key:
+                ranked = sorted(
+                    items.items(), key=lambda i: i[1][0], reverse=True
+                )
+                items = dict(ranked[: self._max_items_per_key])
+            history.items = items
+
+    def predict(
+        self, min_probability: float
+    ) -> typing.List[typing.Tuple[float, str, InputItem]]:
+        """Return inputs the next action likely needs, most likely first.
+
+        A key's share of recent actions is its weight, so inputs of the
+        actions running most often come first.
+        """
+        normalize = 1 - self._decay
+        probabilities: typing.Dict[str, float] = collections.defaultdict(float)
+        all_items: typing.Dict[str, InputItem] = {}
+        with self._lock:
+            total = sum(h.score for h in self._keys.values())
+            if total <= 0:
+                return []
+            for history in self._keys.values():
+                share = history.score / total
+                for name, (score, item) in history.items.items():
+                    probabilities[name] += share * min(1.0, score * normalize)
+                    all_items[name] = item
+        result = [
+            (p, name, all_items[name])
+            for name, p in probabilities.items()
+            if p >= min_probability
+        ]
+        result.sort(key=lambda i: i[0], reverse=True)
+        return result
+
+
+class Prefetcher(threading.Thread):
+    """Prefetch likely inputs into the caches while runner slots are idle.
+
+    Runners report busy/idle and the inputs of every action. Downloads use
+    PREFETCH_CALLER with a low weight so actions waiting for inputs always
+    go first, and prefetching never evicts cached data.
+
+    A prefetched input is a hit when an action needs it before unused_ttl
+    seconds, otherwise its bytes are counted as wasted.
+    """
+
+    def __init__(
+        self,
+        cas_helper: CASHelper,
+        filesystem: LocalHardlinkFilesystem,
+        directory_builder: SharedTopLevelCachedDirectoryBuilder,
+        meter: MeterBase,
+        slots: int,
+        *,
+        history: typing.Optional[InputHistory] = None,
+        min_probability: float = 0.5,
+        max_bytes_per_round: int = 256 * 1024 * 1024,
+        unused_ttl: float = 600,
+        weight: float = 0.1,
+    ):
+        super().__init__(name="prefetcher", daemon=True)
+        self._cas_helper = cas_helper
+        self._filesystem = filesystem
+        self._directory_builder = directory_builder
+        self._meter = meter
+        self._slots = slots
+        if history is None:
+            history = InputHistory()
+        self._history = history
+        self._min_probability = min_probability
+        self._max_bytes_per_round = max_bytes_per_round
+        self._unused_ttl = unused_ttl
+        self._condition = threading.Condition()
+        self._busy_slots = 0
+        self._history_changed = False
+        self._stopped = False
+        self._records: "queue.Queue[typing.Tuple[str, Digest, Directory]]"
+        self._records = queue.Queue()
+        # prefetched but not used yet. name in cache -> (size, prefetched_at)
+        self._unused: typing.Dict[str, typing.Tuple[int, float]] = {}
+        filesystem.set_caller_weight(PREFETCH_CALLER, weight)
+
+    def slot_busy(self) -> None:
+        with self._condition:
+            self._busy_slots += 1
+
+    def slot_idle(self) -> None:
+        with self._condition:
+            self._busy_slots = max(0, self._busy_slots - 1)
+            self._condition.notify()
+
+    def record(
+        self, key: str, input_root_digest: Digest, input_root: Directory
+    ) -> None:
+        """Record the inputs of an action. Processed in background."""
+        self._records.put((key, input_root_digest, input_root))
+        with self._condition:
+            self._condition.notify()
+
+    def stop(self) -> None:
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+    def run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._stopped and not self._has_work():
+                    self._condition.wait(timeout=self._unused_ttl)
+                    self._expire_unused()
+                if self._stopped:
+                    break
+            try:
+                self._process_records()
+                if self._history_changed and self._has_idle_slot():
+                    self._history_changed = False
+                    self._prefetch_round()
+            except Exception:
+                logging.exception("prefetch failed")
+
+    def _has_idle_slot(self) -> bool:
+        with self._condition:
+            return self._busy_slots < self._slots
+
+    def _has_work(self) -> bool:
+        """This method MUST be called with _condition."""
+        if not self._records.empty():
+            return True
+        return self._history_changed and self._busy_slots < self._slots
+
+    def _process_records(self) -> None:
+        while True:
+            try:
+                key, digest, input_root = self._records.get_nowait()
+            except queue.Empty:
+                break
+            files, dirs = self._directory_builder.inputs(digest, input_root)
+            inputs: typing.Dict[str, InputItem] = {}
+            inputs.update(files)
+            inputs.update(dirs)
+            hit = 0
+            with self._condition:
+                for name in inputs:
+                    if self._unused.pop(name, None) is not None:
+                        hit += 1
+            if hit:
+                self._meter.count("prefetch_hit", hit)
+            self._history.record(key, inputs)
+            self._history_changed = True
+
+    def _expire_unused(self) -> None:
+        """This method MUST be called with _condition."""
+        expired_at = time.time() - self._unused_ttl
+        wasted_bytes = 0
+        for name, (size_bytes, prefetched_at) in list(self._unused.items()):
+            if prefetched_at < expired_at:
+                wasted_bytes += size_bytes
+                del self._unused[name]
+        if wasted_bytes:
+            self._meter.count("prefetch_wasted_bytes", wasted_bytes)
+
+    def _prefetch_round(self) -> None:
+        budget = self._max_bytes_per_round
+        files: typing.List[FileData] = []
+        dirs: typing.List[DirectoryData] = []
+        with self._condition:
+            self._expire_unused()
+            for _, name, item in self._history.predict(self._min_probability):
+                if name in self._unused:
+                    continue
+                size_bytes = _item_size_bytes(item)
+                if size_bytes > budget:
+                    continue
+                budget -= size_bytes
+                if isinstance(item, FileData):
+                    files.append(item)
+                else:
+                    dirs.append(item)
+        futures: typing.Dict[str, concurrent.futures.Future] = {}
+        if files:
+            futures.update(
+                self._filesystem.prefetch(
+                    self._cas_helper,
+                    [fd.to_file_node(fd.name_in_cache) for fd in files],
+                    caller=PREFETCH_CALLER,
+                )
+            )
+        if dirs:
+            futures.update(
+                self._directory_builder.prefetch(dirs, caller=PREFETCH_CALLER)
+            )
+        if not futures:
+            return
+        sizes = {i.name_in_cache: _item_size_bytes(i) for i in files + dirs}
+        now = time.time()
+        with self._condition:
+            for name in futures:
+                self._unused[name] = (sizes[name], now)
+        self._meter.count("prefetch_issued", len(futures))
+        self._meter.count(
+            "prefetch_bytes", sum(sizes[name] for name in futures)
+        )
+        for name, f in futures.items():
+            try:
+                f.result()
+            except Exception:
+                logging.exception(f"failed to prefetch {name}")
+                with self._condition:
+                    self._unused.pop(name, None)
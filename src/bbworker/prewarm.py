@@ -0,0 +1,262 @@
+import concurrent.futures
+import logging
+import os
+import os.path
+import stat
+import typing
+
+from build.bazel.remote.execution.v2.remote_execution_pb2 import Digest
+from build.bazel.remote.execution.v2.remote_execution_pb2 import Directory
+from build.bazel.remote.execution.v2.remote_execution_pb2 import FileNode
+
+from .cas import CASHelper
+from .directorybuilder import DirectoryData
+from .directorybuilder import SharedTopLevelCachedDirectoryBuilder
+from .directorybuilder import parse_source_file_name
+from .filesystem import LocalHardlinkFilesystem
+
+
+# downloads of prewarm are scheduled with this caller.
+PREWARM_CALLER = "prewarm"
+
+# a file of the file cache.
+FILE = "file"
+# a directory cached as a whole by the directory builder.
+DIRECTORY = "directory"
+# an input root, warms what building it would fetch.
+ROOT = "root"
+
+_KINDS = (FILE, DIRECTORY, ROOT)
+
+
+class ManifestError(Exception):
+    pass
+
+
+class ManifestEntry(typing.NamedTuple):
+    kind: str
+    digest: Digest
+    is_executable: bool = False
+
+
+class PrewarmResult(typing.NamedTuple):
+    # count of files and directories downloaded.
+    fetched: int
+    # count failed to download.
+    failed: int
+
+
+def read_manifest(lines: typing.Iterable[str]) -> typing.List[ManifestEntry]:
+    """Parse a manifest. Every line is "<kind> <hash> <size_bytes>", files
+    may end with "x" when executable. Blank lines and lines starting with
+    "#" are ignored. Earlier entries are warmed first.
+    """
+    entries: typing.List[ManifestEntry] = []
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        fields = line.split()
+        try:
+            kind, hash_, size_bytes_str = fields[:3]
+            size_bytes = int(size_bytes_str)
+        except ValueError:
+            raise ManifestError(f"line {lineno}: invalid entry: {line}")
+        flags = fields[3:]
+        if kind not in _KINDS or size_bytes < 0 or flags not in ([], ["x"]):
+            raise ManifestError(f"line {lineno}: invalid entry: {line}")
+        if flags and kind != FILE:
+            raise ManifestError(f"line {lineno}: only files are executable")
+        entries.append(
+            ManifestEntry(
+                kind,
+                Digest(hash=hash_, size_bytes=size_bytes),
+                bool(flags),
+            )
+        )
+    return entries
+
+
+def write_manifest(
+    f: typing.TextIO, entries: typing.Iterable[ManifestEntry]
+) -> None:
+    for entry in entries:
+        line = f"{entry.kind} {entry.digest.hash} {entry.digest.size_bytes}"
+        if entry.is_executable:
+            line += " x"
+        f.write(line + "\n")
+
+
+def _parse_name_in_cache(name: str) -> typing.Optional[Digest]:
+    try:
+        hash_, size_bytes_str = name.split("_")
+        return Digest(hash=hash_, size_bytes=int(size_bytes_str))
+    except ValueError:
+        return None
+
+
+def export_manifest(
+    file_cache_root: str, directory_cache_root: typing.Optional[str] = None
+) -> typing.List[ManifestEntry]:
+    """List what is cached on disk, most recently used first. Only reads the
+    cache roots, so it's safe while a worker is running.
+
+    Directories are exported by the digest of the Directory message they
+    are built from, which the builder records when it caches them.
+    """
+    found: typing.List[typing.Tuple[float, ManifestEntry]] = []
+    if directory_cache_root is not None and os.path.isdir(
+        directory_cache_root
+    ):
+        for name in os.listdir(directory_cache_root):
+            source = parse_source_file_name(name)
+            if source is None:
+                continue
+            name_in_cache, digest = source
+            try:
+                dir_stat = os.stat(
+                    os.path.join(directory_cache_root, name_in_cache)
+                )
+            except FileNotFoundError:
+                # removed meanwhile.
+                continue
+            found.append((dir_stat.st_atime, ManifestEntry(DIRECTORY, digest)))
+    for name in os.listdir(file_cache_root):
+        if name.startswith("."):
+            continue
+        file_digest = _parse_name_in_cache(name)
+        if file_digest is None:
+            continue
+        try:
+            file_stat = os.stat(os.path.join(file_cache_root, name))
+        except FileNotFoundError:
+            continue
+        if not stat.S_ISREG(file_stat.st_mode):
+            continue
+        is_executable = bool(file_stat.st_mode & stat.S_IXUSR)
+        found.append(
+            (
+                file_stat.st_atime,
+                ManifestEntry(FILE, file_digest, is_executable),
+            )
+        )
+    found.sort(key=lambda i: i[0], reverse=True)
+    return [entry for _, entry in found]
+
+
+def _collect(
+    cas_helper: CASHelper,
+    builder: SharedTopLevelCachedDirectoryBuilder,
+    entries: typing.List[ManifestEntry],
+    concurrency: int,
+) -> typing.Tuple[typing.Dict[str, FileNode], typing.Dict[str, DirectoryData]]:
+    """Resolve entries to the files and cached directories to fetch, by name
+    in cache, in manifest order.
+    """
+    messages: typing.Dict[typing.Tuple[str, int], Directory] = {}
+    to_fetch = {
+        (e.digest.hash, e.digest.size_bytes): e.digest
+        for e in entries
+        if e.kind != FILE
+    }
+    if to_fetch:
+        for digest, data in cas_helper.fetch_all(list(to_fetch.values())):
+            directory = Directory()
+            directory.ParseFromString(data)
+            messages[(digest.hash, digest.size_bytes)] = directory
+
+    def _resolve(entry: ManifestEntry):
+        directory = messages[(entry.digest.hash, entry.digest.size_bytes)]
+        if entry.kind == DIRECTORY:
+            dir_data = builder.directory_data(entry.digest, directory)
+            return {}, {dir_data.name_in_cache: dir_data}
+        return builder.inputs(entry.digest, directory)
+
+    with concurrent.futures.ThreadPoolExecutor(
+        concurrency, thread_name_prefix="prewarm_"
+    ) as executor:
+        resolved = [
+            executor.submit(_resolve, e) if e.kind != FILE else None
+            for e in entries
+        ]
+        files: typing.Dict[str, FileNode] = {}
+        dirs: typing.Dict[str, DirectoryData] = {}
+        for entry, future in zip(entries, resolved):
+            if future is None:
+                name_in_cache = (
+                    f"{entry.digest.hash}_{entry.digest.size_bytes}"
+                )
+                files.setdefault(
+                    name_in_cache,
+                    FileNode(
+                        name=name_in_cache,
+                        digest=entry.digest,
+                        is_executable=entry.is_executable,
+                    ),
+                )
+                continue
+            entry_files, entry_dirs = future.result()
+            for name_in_cache, fd in entry_files.items():
+                if name_in_cache not in files:
+                    files[name_in_cache] = fd.to_file_node(name_in_cache)
+            for name_in_cache, dir_data in entry_dirs.items():
+                dirs.setdefault(name_in_cache, dir_data)
+    return files, dirs
+
+
+def _chunks(
+    items: typing.List[typing.Tuple[int, typing.Any]], chunk_size_bytes: int
+) -> typing.Iterator[typing.List[typing.Any]]:
+    chunk: typing.List[typing.Any] = []
+    chunk_bytes = 0
+    for size_bytes, item in items:
+        if chunk and chunk_bytes + size_bytes > chunk_size_bytes:
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(item)
+        chunk_bytes += size_bytes
+    if chunk:
+        yield chunk
+
+
+def prewarm(
+    cas_helper: CASHelper,
+    filesystem: LocalHardlinkFilesystem,
+    builder: SharedTopLevelCachedDirectoryBuilder,
+    entries: typing.Iterable[ManifestEntry],
+    *,
+    concurrency: int = 16,
+    chunk_size_bytes: int = 64 * 1024 * 1024,
+) -> PrewarmResult:
+    """Fill the caches with the entries through the normal download paths.
+
+    Everything is submitted at once so downloads run at the configured
+    concurrency. Entries are admitted in manifest order in chunks of
+    chunk_size_bytes. Prewarming never evicts, chunks which don't fit in
+    the free space are skipped. The files of a directory which don't fit
+    in the file cache are downloaded into the directory only.
+    """
+    files, dirs = _collect(cas_helper, builder, list(entries), concurrency)
+    logging.info(f"prewarm {len(files)} files and {len(dirs)} directories")
+    futures: typing.Dict[str, concurrent.futures.Future] = {}
+    for file_chunk in _chunks(
+        [(fn.digest.size_bytes, fn) for fn in files.values()],
+        chunk_size_bytes,
+    ):
+        futures.update(
+            filesystem.prefetch(cas_helper, file_chunk, caller=PREWARM_CALLER)
+        )
+    for dir_chunk in _chunks(
+        [(d.copy_size_bytes, d) for d in dirs.values()], chunk_size_bytes
+    ):
+        futures.update(builder.prefetch(dir_chunk, caller=PREWARM_CALLER))
+
+    failed = 0
+    for name, future in futures.items():
+        try:
+            future.result()
+        except Exception:
+            logging.exception(f"failed to prewarm {name}")
+            failed += 1
+    return PrewarmResult(len(futures) - failed, failed)
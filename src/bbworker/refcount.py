@@ -0,0 +1,94 @@
+"""Reference counts of the files held by cached directories.
+
+A file linked by several cached directories takes space once, so admitting
+or evicting a directory changes the cache size by the files it references
+first or last. A Reservation tries such changes on top of the table without
+copying it: it records only the counts it changes, and applies them on
+commit or drops them on rollback.
+"""
+
+import collections
+import typing
+
+
+# (key, links in the directory, size_bytes) of every distinct file of a
+# directory tree.
+FileSummary = typing.Tuple[typing.Tuple[typing.Hashable, int, int], ...]
+
+
+def summarize(
+    files: typing.Iterable[typing.Tuple[typing.Hashable, int]],
+) -> FileSummary:
+    """FileSummary of (key, size_bytes) of every file of a tree."""
+    counts: typing.Counter[typing.Hashable] = collections.Counter()
+    sizes: typing.Dict[typing.Hashable, int] = {}
+    for key, size_bytes in files:
+        counts[key] += 1
+        sizes[key] = size_bytes
+    return tuple((key, count, sizes[key]) for key, count in counts.items())
+
+
+class RefcountTable:
+    """Counts of references to files. Not thread safe, the caller locks."""
+
+    def __init__(self) -> None:
+        self._counts: typing.Dict[typing.Hashable, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._counts)
+
+    def count(self, key: typing.Hashable) -> int:
+        return self._counts.get(key, 0)
+
+    def reserve(self) -> "Reservation":
+        """Start tentative changes. Nothing else may change the table until
+        they are committed or rolled back.
+        """
+        return Reservation(self._counts)
+
+
+class Reservation:
+    def __init__(self, counts: typing.Dict[typing.Hashable, int]) -> None:
+        self._counts = counts
+        self._delta: typing.Dict[typing.Hashable, int] = {}
+
+    def acquire(self, summary: FileSummary) -> int:
+        """Reference the files of summary. Return the bytes of the ones
+        nothing referenced before.
+        """
+        counts = self._counts
+        delta = self._delta
+        result = 0
+        for key, count, size_bytes in summary:
+            change = delta.get(key, 0)
+            if counts.get(key, 0) + change == 0:
+                result += size_bytes
+            delta[key] = change + count
+        return result
+
+    def release(self, summary: FileSummary) -> int:
+        """Drop references acquired before. Return the bytes of the files
+        nothing references anymore.
+        """
+        counts = self._counts
+        delta = self._delta
+        result = 0
+        for key, count, size_bytes in summary:
+            change = delta.get(key, 0) - count
+            if counts.get(key, 0) + change == 0:
+                result += size_bytes
+            delta[key] = change
+        return result
+
+    def commit(self) -> None:
+        counts = self._counts
+        for key, change in self._delta.items():
+            count = counts.get(key, 0) + change
+            if count:
+                counts[key] = count
+            else:
+                counts.pop(key, None)
+        self._delta = {}
+
+    def rollback(self) -> None:
+        self._delta = {}
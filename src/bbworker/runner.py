@@ -38,7 +38,12 @@ from .cas import FileProvider
 from .cas import BatchReadBlobsError
 
 from .directorybuilder import IDirectoryBuilder
+from .directorybuilder import MaxSizeReached as DirectoryMaxSizeReached
+from .filesystem import MaxSizeReached as FileMaxSizeReached
 from .metrics import MeterBase
+from .prefetch import Prefetcher
+from .prefetch import action_key
+from .slotdirs import SlotDirectories
 from .util import setup_xcode_env
 
 
@@ -96,6 +101,7 @@ def execute_command(
     command: Command,
     input_root_digest: Digest,
     input_root: Directory,
+    slot: typing.Hashable = None,
 ):
     state_queue.put(
         CurrentState(
@@ -108,7 +114,7 @@ def execute_command(
     try:
         with meter.record_duration("build_directory_seconds"):
             build_directory_builder.build(
-                input_root_digest, input_root, build_directory
+                input_root_digest, input_root, build_directory, caller=slot
             )
     except BatchReadBlobsError as e:
         meter.count("failed_precondition")
@@ -126,6 +132,16 @@ def execute_command(
             detail_any.Pack(PreconditionFailure(violations=violations))
             status.details.append(detail_any)
         response = ExecuteResponse(status=status)
+    except (DirectoryMaxSizeReached, FileMaxSizeReached):
+        # the builders fall back to inputs out of the cache when it is
+        # full, this is the last resort.
+        meter.count("resource_exhausted")
+        response = ExecuteResponse(
+            status=Status(
+                code=grpc.StatusCode.RESOURCE_EXHAUSTED.value[0],
+                message="input cache is full",
+            )
+        )
     else:
         prepare_output_dirs(command, build_directory)
         if command.working_directory:
@@ -255,6 +271,9 @@ class RunnerThread(threading.Thread):
         current_state_queue: "queue.Queue[CurrentState]",
         desired_state_queue: "queue.Queue[DesiredState]",
         meter: MeterBase,
+        slot: typing.Hashable = None,
+        prefetcher: typing.Optional[Prefetcher] = None,
+        slot_directories: typing.Optional[SlotDirectories] = None,
     ):
         super().__init__()
         self._cas_stub = cas_stub
@@ -265,6 +284,11 @@ class RunnerThread(threading.Thread):
         self._current_state_queue = current_state_queue
         self._desired_state_queue = desired_state_queue
         self._meter = meter
+        self._slot = slot
+        self._prefetcher = prefetcher
+        # when set, actions alternate between its directories instead of
+        # build_directory.
+        self._slot_directories = slot_directories
         self._stop_event = threading.Event()
 
     def notify_stop(self):
@@ -272,6 +296,13 @@ class RunnerThread(threading.Thread):
         self._desired_state_queue.put(DesiredState(idle={}))
 
     def run(self):
+        try:
+            self._run()
+        finally:
+            if self._slot_directories is not None:
+                self._slot_directories.close()
+
+    def _run(self):
         self._current_state_queue.put(CurrentState(idle={}))
         while True:
             if self._stop_event.is_set():
@@ -304,17 +335,49 @@ class RunnerThread(threading.Thread):
                     action.input_root_digest,
                 )
                 if command and input_root:
-                    response = execute_command(
-                        self._meter,
-                        self._current_state_queue,
-                        self._build_directory_builder,
-                        self._build_directory,
-                        self._cas_helper,
-                        action_digest,
-                        command,
-                        action.input_root_digest,
-                        input_root,
-                    )
+                    if self._prefetcher is not None:
+                        self._prefetcher.slot_busy()
+                    build_directory = self._build_directory
+                    if self._slot_directories is not None:
+                        build_directory = self._slot_directories.acquire()
+                    try:
+                        response = execute_command(
+                            self._meter,
+                            self._current_state_queue,
+                            self._build_directory_builder,
+                            build_directory,
+                            self._cas_helper,
+                            action_digest,
+                            command,
+                            action.input_root_digest,
+                            input_root,
+                            self._slot,
+                        )
+                    except Exception as e:
+                        # the slot must survive whatever the action did.
+                        logging.exception("failed to execute action")
+                        self._meter.count("action_error")
+                        response = ExecuteResponse(
+                            status=Status(
+                                code=grpc.StatusCode.INTERNAL.value[0],
+                                message=str(e),
+                            )
+                        )
+                    finally:
+                        self._build_directory_builder.release(
+                            caller=self._slot
+                        )
+                        if self._slot_directories is not None:
+                            self._slot_directories.release(
+                                action.input_root_digest, input_root
+                            )
+                        if self._prefetcher is not None:
+                            self._prefetcher.record(
+                                action_key(should_executing, command),
+                                action.input_root_digest,
+                                input_root,
+                            )
+                            self._prefetcher.slot_idle()
                     self._current_state_queue.put(
                         CurrentState(
                             executing={
@@ -332,3 +395,5 @@ class RunnerThread(threading.Thread):
                         )
             else:
                 self._current_state_queue.put(CurrentState(idle={}))
+                if self._slot_directories is not None:
+                    self._slot_directories.prepare()
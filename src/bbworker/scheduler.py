@@ -0,0 +1,152 @@
+import collections
+import concurrent.futures
+import threading
+import time
+import typing
+
+from .metrics import MeterBase
+
+
+class _Task(object):
+    def __init__(
+        self,
+        future: concurrent.futures.Future,
+        fn: typing.Callable,
+        args: typing.Tuple,
+        kwargs: typing.Dict[str, typing.Any],
+        start_tag: float,
+        finish_tag: float,
+    ):
+        self.future = future
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.start_tag = start_tag
+        self.finish_tag = finish_tag
+        self.submitted_at = time.time()
+
+
+class _CallerQueue(object):
+    def __init__(self) -> None:
+        self.tasks: typing.Deque[_Task] = collections.deque()
+        self.last_finish_tag = 0.0
+
+
+class FairShareScheduler(object):
+    """Run tasks of multiple callers with weighted fair queuing.
+
+    Every task has a cost (e.g. bytes to download). A caller with weight w
+    gets w/W of the workers when W is the total weight of callers which have
+    queued tasks, so one caller submitting thousands of tasks cannot starve
+    the others. Tasks waiting longer get a boost of age_boost cost units per
+    second so no task waits forever behind a caller with higher weight.
+    """
+
+    def __init__(
+        self,
+        meter: MeterBase,
+        concurrency: int = 10,
+        *,
+        age_boost: float = 3 * 1024 * 1024,
+        thread_name_prefix: str = "scheduler_",
+    ):
+        self._meter = meter
+        self._age_boost = age_boost
+        self._condition = threading.Condition()
+        self._queues: typing.Dict[typing.Hashable, _CallerQueue] = {}
+        self._weights: typing.Dict[typing.Hashable, float] = {}
+        self._virtual_time = 0.0
+        self._shutdown = False
+        self._threads: typing.List[threading.Thread] = []
+        for i in range(concurrency):
+            t = threading.Thread(
+                target=self._worker,
+                name=f"{thread_name_prefix}{i}",
+                daemon=True,
+            )
+            t.start()
+            self._threads.append(t)
+
+    def set_weight(self, caller: typing.Hashable, weight: float) -> None:
+        if weight <= 0:
+            raise ValueError("weight must be positive")
+        with self._condition:
+            self._weights[caller] = weight
+
+    def submit(
+        self,
+        caller: typing.Hashable,
+        cost: typing.Union[int, float],
+        fn: typing.Callable,
+        *args,
+        **kwargs,
+    ) -> concurrent.futures.Future:
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError("cannot submit after shutdown")
+            caller_queue = self._queues.get(caller)
+            if caller_queue is None:
+                caller_queue = _CallerQueue()
+                self._queues[caller] = caller_queue
+            weight = self._weights.get(caller, 1.0)
+            start_tag = max(self._virtual_time, caller_queue.last_finish_tag)
+            finish_tag = start_tag + max(cost, 1) / weight
+            caller_queue.last_finish_tag = finish_tag
+            caller_queue.tasks.append(
+                _Task(future, fn, args, kwargs, start_tag, finish_tag)
+            )
+            self._condition.notify()
+        return future
+
+    def shutdown(self, wait: bool = True) -> None:
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify_all()
+        if wait:
+            for t in self._threads:
+                t.join()
+
+    def _pop_task(self) -> typing.Tuple[typing.Hashable, _Task]:
+        """Pop the task with the smallest age boosted finish tag. This method
+        MUST be called with _condition.
+        """
+        now = time.time()
+        selected_caller: typing.Hashable = None
+        selected_tag = 0.0
+        selected_queue = None
+        for caller, caller_queue in self._queues.items():
+            head = caller_queue.tasks[0]
+            tag = head.finish_tag - (now - head.submitted_at) * self._age_boost
+            if selected_queue is None or tag < selected_tag:
+                selected_caller = caller
+                selected_tag = tag
+                selected_queue = caller_queue
+        assert selected_queue is not None
+        task = selected_queue.tasks.popleft()
+        if not selected_queue.tasks:
+            del self._queues[selected_caller]
+        self._virtual_time = max(self._virtual_time, task.start_tag)
+        return selected_caller, task
+
+    def _worker(self) -> None:
+        while True:
+            with self._condition:
+                while not self._queues and not self._shutdown:
+                    self._condition.wait()
+                if not self._queues:
+                    break
+                caller, task = self._pop_task()
+            self._meter.record(
+                "download_schedule_wait_seconds",
+                time.time() - task.submitted_at,
+                attributes={"caller": str(caller)},
+            )
+            if not task.future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = task.fn(*task.args, **task.kwargs)
+            except BaseException as e:
+                task.future.set_exception(e)
+            else:
+                task.future.set_result(result)
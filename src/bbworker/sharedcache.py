@@ -0,0 +1,411 @@
+import contextlib
+import os
+import os.path
+import sqlite3
+import threading
+import time
+import typing
+import uuid
+import zlib
+
+from .lock import InterProcessLock
+from .util import unlink_readonly_file
+
+
+# fetch locks are striped so the number of lock files stays bounded.
+FETCH_LOCK_STRIPES = 1024
+
+_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS files (
+        name TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        ino INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        atime REAL NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS files_atime ON files (atime)",
+    """
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS reservations (
+        owner TEXT PRIMARY KEY,
+        bytes INTEGER NOT NULL
+    )
+    """,
+    "INSERT OR IGNORE INTO meta VALUES ('total_bytes', 0)",
+    "INSERT OR IGNORE INTO meta VALUES ('reserved_bytes', 0)",
+]
+
+
+class SharedFileEntry(typing.NamedTuple):
+    size: int
+    ino: int
+    mtime_ns: int
+
+
+class SharedFileIndex(object):
+    """Index and space accounting of a file cache root shared by multiple
+    bbworker processes on one host.
+
+    The index is a SQLite database in WAL mode inside the cache root. Bytes of
+    downloads in flight are reserved in the index so all processes respect
+    the same max cache size, and eviction is decided inside one transaction
+    so two processes never evict for the same space twice. A digest is only
+    downloaded by the process holding its fetch lock.
+
+    Reservations are also recorded per process, by the name of its alive
+    lock, so the ones of a process which died while downloading are
+    reclaimed by the others.
+
+    All names starting with "." inside the cache root belong to the index.
+    """
+
+    def __init__(self, cache_root_dir: str) -> None:
+        self._cache_root_dir = cache_root_dir
+        self._db_path = os.path.join(cache_root_dir, ".index.sqlite")
+        self._lock_dir = os.path.join(cache_root_dir, ".locks")
+        self._alive_dir = os.path.join(cache_root_dir, ".alive")
+        self._init_lock = InterProcessLock(
+            os.path.join(cache_root_dir, ".init.lock")
+        )
+        self._alive_lock: typing.Optional[InterProcessLock] = None
+        # name of the alive lock of this process.
+        self._owner = ""
+        self._conn: typing.Optional[sqlite3.Connection] = None
+        self._conn_lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def init_lock(self):
+        """Serialize the initialization of processes sharing the root."""
+        with self._init_lock:
+            yield
+
+    def open(self) -> bool:
+        """Open the index and register this process as a user of the cache
+        root. Return True if no other process is using it, in which case the
+        caller should verify the files and reset the index.
+
+        Should be called with init_lock.
+        """
+        for p in [self._lock_dir, self._alive_dir]:
+            if not os.path.exists(p):
+                os.makedirs(p)
+        alone = True
+        for name in os.listdir(self._alive_dir):
+            lock = InterProcessLock(os.path.join(self._alive_dir, name))
+            if lock.acquire(blocking=False):
+                # a process exited without cleaning up.
+                lock.release()
+                try:
+                    os.unlink(lock.path)
+                except OSError:
+                    pass
+            else:
+                alone = False
+        self._owner = uuid.uuid4().hex
+        self._alive_lock = InterProcessLock(
+            os.path.join(self._alive_dir, self._owner)
+        )
+        self._alive_lock.acquire()
+        conn = sqlite3.connect(
+            self._db_path,
+            timeout=60,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in _SCHEMA:
+            conn.execute(statement)
+        self._conn = conn
+        if not alone:
+            with self._transaction() as conn:
+                self._reclaim_dead_reservations(conn)
+        return alone
+
+    def close(self) -> None:
+        with self._conn_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        if self._alive_lock is not None:
+            path = self._alive_lock.path
+            self._alive_lock.release()
+            self._alive_lock = None
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._conn_lock:
+            conn = self._conn
+            assert conn is not None, "index is not opened"
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            else:
+                conn.execute("COMMIT")
+
+    def fetch_locks(
+        self, names: typing.Iterable[str]
+    ) -> typing.List[InterProcessLock]:
+        """Return the locks need to be held to download these names. Locks
+        are sorted, acquire them in order to avoid deadlock.
+        """
+        stripes = set()
+        for name in names:
+            stripes.add(zlib.crc32(name.encode()) % FETCH_LOCK_STRIPES)
+        return [
+            InterProcessLock(os.path.join(self._lock_dir, str(i)))
+            for i in sorted(stripes)
+        ]
+
+    def reset(
+        self, entries: typing.Dict[str, typing.Tuple[SharedFileEntry, float]]
+    ) -> None:
+        """Replace the whole index. Only used by the single process
+        initializing the cache root.
+        """
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM files")
+            conn.executemany(
+                "INSERT INTO files VALUES (?, ?, ?, ?, ?)",
+                [
+                    (name, e.size, e.ino, e.mtime_ns, atime)
+                    for name, (e, atime) in entries.items()
+                ],
+            )
+            total = sum(e.size for e, _ in entries.values())
+            conn.execute(
+                "UPDATE meta SET value = ? WHERE key = 'total_bytes'",
+                (total,),
+            )
+            conn.execute(
+                "UPDATE meta SET value = 0 WHERE key = 'reserved_bytes'"
+            )
+            conn.execute("DELETE FROM reservations")
+
+    def entries(self) -> typing.Dict[str, SharedFileEntry]:
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT name, size, ino, mtime_ns FROM files ORDER BY atime"
+            ).fetchall()
+        return {r[0]: SharedFileEntry(r[1], r[2], r[3]) for r in rows}
+
+    def lookup(
+        self, names: typing.Iterable[str]
+    ) -> typing.Dict[str, SharedFileEntry]:
+        result: typing.Dict[str, SharedFileEntry] = {}
+        names = list(names)
+        with self._transaction() as conn:
+            for start in range(0, len(names), 500):
+                end = start + 500
+                part = names[start:end]
+                rows = conn.execute(
+                    "SELECT name, size, ino, mtime_ns FROM files "
+                    "WHERE name IN ({0})".format(",".join("?" * len(part))),
+                    part,
+                ).fetchall()
+                for r in rows:
+                    result[r[0]] = SharedFileEntry(r[1], r[2], r[3])
+        return result
+
+    def touch(self, names: typing.Iterable[str]) -> None:
+        now = time.time()
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE files SET atime = ? WHERE name = ?",
+                [(now, name) for name in names],
+            )
+
+    def total_bytes(self) -> int:
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT SUM(value) FROM meta "
+                "WHERE key IN ('total_bytes', 'reserved_bytes')"
+            ).fetchone()
+        return row[0]
+
+    def reserve(
+        self,
+        required_bytes: int,
+        max_bytes: int,
+        keep: typing.Container[str],
+        *,
+        evict: bool = True,
+    ) -> typing.Optional[typing.List[str]]:
+        """Reserve space for files about to be downloaded, evicting the least
+        recently used files when needed and evict. Files in keep are never
+        evicted.
+
+        Return the evicted names. The caller must unlink them (see
+        remove_evicted). Return None and change nothing if there is not
+        enough space, except reclaiming the reservations of dead processes.
+        """
+        with self._transaction() as conn:
+            total, reserved = self._get_meta(conn)
+            evicted: typing.Optional[typing.List[typing.Tuple[str, int]]]
+            evicted = []
+            if max_bytes > 0:
+                evicted = self._select_evicted(
+                    conn,
+                    total + reserved + required_bytes - max_bytes,
+                    keep,
+                    evict,
+                )
+                if evicted is None:
+                    reserved = self._reclaim_dead_reservations(conn)
+                    evicted = self._select_evicted(
+                        conn,
+                        total + reserved + required_bytes - max_bytes,
+                        keep,
+                        evict,
+                    )
+                if evicted is None:
+                    return None
+            conn.executemany(
+                "DELETE FROM files WHERE name = ?",
+                [(name,) for name, _ in evicted],
+            )
+            total -= sum(size for _, size in evicted)
+            self._set_meta(conn, total, reserved + required_bytes)
+            self._add_reserved(conn, required_bytes)
+        return [name for name, _ in evicted]
+
+    def release(self, size_bytes: int) -> None:
+        """Return reserved bytes of a download which is not added."""
+        with self._transaction() as conn:
+            total, reserved = self._get_meta(conn)
+            self._set_meta(conn, total, max(0, reserved - size_bytes))
+            self._add_reserved(conn, -size_bytes)
+
+    def add(self, name: str, entry: SharedFileEntry) -> None:
+        """Add a downloaded file and turn its reservation into usage."""
+        with self._transaction() as conn:
+            total, reserved = self._get_meta(conn)
+            reserved = max(0, reserved - entry.size)
+            self._add_reserved(conn, -entry.size)
+            cursor = conn.execute(
+                "UPDATE files SET ino = ?, mtime_ns = ?, atime = ? "
+                "WHERE name = ?",
+                (entry.ino, entry.mtime_ns, time.time(), name),
+            )
+            if cursor.rowcount == 0:
+                conn.execute(
+                    "INSERT INTO files VALUES (?, ?, ?, ?, ?)",
+                    (name, entry.size, entry.ino, entry.mtime_ns, time.time()),
+                )
+                total += entry.size
+            self._set_meta(conn, total, reserved)
+
+    def remove(self, name: str) -> None:
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT size FROM files WHERE name = ?", (name,)
+            ).fetchone()
+            if row is not None:
+                conn.execute("DELETE FROM files WHERE name = ?", (name,))
+                total, reserved = self._get_meta(conn)
+                self._set_meta(conn, total - row[0], reserved)
+
+    def remove_evicted(self, names: typing.Iterable[str]) -> None:
+        """Unlink files evicted by reserve. A file downloaded again by another
+        process in the meantime is kept.
+        """
+        names = list(names)
+        locks = self.fetch_locks(names)
+        for lock in locks:
+            lock.acquire()
+        try:
+            present = self.lookup(names)
+            for name in names:
+                if name in present:
+                    continue
+                try:
+                    unlink_readonly_file(
+                        os.path.join(self._cache_root_dir, name)
+                    )
+                except FileNotFoundError:
+                    pass
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    @staticmethod
+    def _select_evicted(
+        conn: sqlite3.Connection,
+        need: int,
+        keep: typing.Container[str],
+        evict: bool,
+    ) -> typing.Optional[typing.List[typing.Tuple[str, int]]]:
+        """Select the least recently used files to free need bytes. Return
+        None if not possible.
+        """
+        evicted: typing.List[typing.Tuple[str, int]] = []
+        if need <= 0:
+            return evicted
+        if not evict:
+            return None
+        cursor = conn.execute("SELECT name, size FROM files ORDER BY atime")
+        for name, size in cursor:
+            if name in keep:
+                continue
+            evicted.append((name, size))
+            need -= size
+            if need <= 0:
+                break
+        cursor.close()
+        if need > 0:
+            return None
+        return evicted
+
+    def _add_reserved(self, conn: sqlite3.Connection, size_bytes: int):
+        conn.execute(
+            "INSERT INTO reservations VALUES (?, MAX(0, ?)) "
+            "ON CONFLICT (owner) DO UPDATE SET bytes = MAX(0, bytes + ?)",
+            (self._owner, size_bytes, size_bytes),
+        )
+
+    def _reclaim_dead_reservations(self, conn: sqlite3.Connection) -> int:
+        """Drop the reservations of processes which exited without
+        releasing them. Return the bytes still reserved.
+        """
+        total, reserved = self._get_meta(conn)
+        rows = conn.execute(
+            "SELECT owner, bytes FROM reservations WHERE owner != ?",
+            (self._owner,),
+        ).fetchall()
+        for owner, size in rows:
+            lock = InterProcessLock(os.path.join(self._alive_dir, owner))
+            if os.path.exists(lock.path):
+                if not lock.acquire(blocking=False):
+                    # still alive.
+                    continue
+                lock.release()
+            conn.execute("DELETE FROM reservations WHERE owner = ?", (owner,))
+            reserved = max(0, reserved - size)
+        self._set_meta(conn, total, reserved)
+        return reserved
+
+    @staticmethod
+    def _get_meta(conn: sqlite3.Connection) -> typing.Tuple[int, int]:
+        rows = dict(conn.execute("SELECT key, value FROM meta").fetchall())
+        return rows["total_bytes"], rows["reserved_bytes"]
+
+    @staticmethod
+    def _set_meta(conn: sqlite3.Connection, total: int, reserved: int):
+        conn.executemany(
+            "UPDATE meta SET value = ? WHERE key = ?",
+            [(total, "total_bytes"), (reserved, "reserved_bytes")],
+        )
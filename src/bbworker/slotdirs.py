@@ -0,0 +1,180 @@
+"""Double-buffered build directories of a runner slot.
+
+Tearing down the build directory of the last action is on the critical path
+of the next one. Instead, a slot alternates between two directories: the
+next action builds into the one which is ready while the other, used by the
+previous action, is cleaned in background.
+
+Cleaning keeps the links to the cached directories the actions of the slot
+use the most. When the slot is idle, the ones cached since are linked too,
+so the next build only has to fix the differences.
+"""
+
+import concurrent.futures
+import logging
+import threading
+import typing
+
+from build.bazel.remote.execution.v2.remote_execution_pb2 import Digest
+from build.bazel.remote.execution.v2.remote_execution_pb2 import Directory
+
+from .directorydata import DirectoryData
+from .directorybuilder import IDirectoryBuilder
+from .metrics import MeterBase
+
+
+class ToplevelHistory(object):
+    """Recent frequencies of the top-level cached directories of a slot.
+
+    Like InputHistory of prefetch.py with a single key: scores decay with
+    every recorded action, so score * (1 - decay) estimates the probability
+    the next action links the directory.
+    """
+
+    def __init__(self, decay: float = 0.9, max_items: int = 256):
+        if not 0 < decay < 1:
+            raise ValueError("decay must be in (0, 1)")
+        self._decay = decay
+        self._max_items = max_items
+        self._lock = threading.Lock()
+        # (name, name in cache) -> (score, directory)
+        self._items: typing.Dict[
+            typing.Tuple[str, str], typing.Tuple[float, DirectoryData]
+        ] = {}
+
+    def record(self, dirs: typing.Dict[str, DirectoryData]) -> None:
+        decay = self._decay
+        min_score = 1 - decay
+        with self._lock:
+            items: typing.Dict[
+                typing.Tuple[str, str], typing.Tuple[float, DirectoryData]
+            ] = {}
+            for key, (score, subdir) in self._items.items():
+                score *= decay
+                if score >= min_score:
+                    items[key] = (score, subdir)
+            for name, subdir in dirs.items():
+                key = (name, subdir.name_in_cache)
+                score, _ = items.get(key, (0.0, subdir))
+                items[key] = (score + 1, subdir)
+            if len(items) > self._max_items:
+                ranked = sorted(
+                    items.items(), key=lambda i: i[1][0], reverse=True
+                )
+                items = dict(ranked[: self._max_items])
+            self._items = items
+
+    def common(
+        self, min_probability: float
+    ) -> typing.Dict[str, DirectoryData]:
+        """Return the directory most likely linked at every name, if at
+        least min_probability.
+        """
+        normalize = 1 - self._decay
+        best: typing.Dict[str, typing.Tuple[float, DirectoryData]] = {}
+        with self._lock:
+            for (name, _), (score, subdir) in self._items.items():
+                probability = min(1.0, score * normalize)
+                if probability < min_probability:
+                    continue
+                if name not in best or best[name][0] < probability:
+                    best[name] = (probability, subdir)
+        return {name: subdir for name, (_, subdir) in best.items()}
+
+
+class SlotDirectories(object):
+    """The two build directories of a slot, path and path + ".b".
+
+    The runner builds into acquire(), then calls release() once the action
+    is done, and prepare() when it has nothing to run.
+    """
+
+    def __init__(
+        self,
+        builder: IDirectoryBuilder,
+        path: str,
+        meter: MeterBase,
+        *,
+        history: typing.Optional[ToplevelHistory] = None,
+        min_probability: float = 0.5,
+    ):
+        self._builder = builder
+        self._paths = (path, path + ".b")
+        self._meter = meter
+        if history is None:
+            history = ToplevelHistory()
+        self._history = history
+        self._min_probability = min_probability
+        # cleaning and preparing of a directory run in order, and never
+        # wait for the other one.
+        self._executors = [
+            concurrent.futures.ThreadPoolExecutor(
+                1, thread_name_prefix="slot_directory_"
+            )
+            for _ in self._paths
+        ]
+        self._next = 0
+        self._ready: typing.List[typing.Optional[concurrent.futures.Future]]
+        self._ready = [None, None]
+        # an action ran since the last prepare().
+        self._unprepared = False
+
+    def acquire(self) -> str:
+        """Return the directory to build the next action into, once its
+        cleaning is done.
+        """
+        index = self._next
+        ready = self._ready[index]
+        if ready is not None:
+            if not ready.done():
+                self._meter.count("slot_directory_wait")
+            try:
+                ready.result()
+            except Exception:
+                # the build removes whatever is left.
+                logging.exception(f"failed to clean {self._paths[index]}")
+        return self._paths[index]
+
+    def release(
+        self, input_root_digest: Digest, input_root: Directory
+    ) -> None:
+        """The action built into the last acquired directory is done. Clean
+        it in background, the next action uses the other one.
+        """
+        index = self._next
+        self._next = 1 - index
+        self._ready[index] = self._executors[index].submit(
+            self._clean, index, input_root_digest, input_root
+        )
+        self._unprepared = True
+
+    def prepare(self) -> None:
+        """The slot is idle. Link the cached directories its actions use
+        the most into the next directory, once per idle period.
+        """
+        if not self._unprepared:
+            return
+        self._unprepared = False
+        index = self._next
+        self._ready[index] = self._executors[index].submit(
+            self._prepare, index
+        )
+
+    def close(self) -> None:
+        for executor in self._executors:
+            executor.shutdown()
+
+    def _clean(
+        self, index: int, input_root_digest: Digest, input_root: Directory
+    ) -> None:
+        self._history.record(
+            self._builder.toplevel_cached(input_root_digest, input_root)
+        )
+        self._prepare(index)
+
+    def _prepare(self, index: int) -> None:
+        with self._meter.record_duration("slot_directory_prepare_seconds"):
+            self._builder.prepare(
+                self._paths[index],
+                self._history.common(self._min_probability),
+            )
@@ -19,10 +19,14 @@ from build.bazel.remote.execution.v2.remote_execution_pb2_grpc import (
 )
 
 from .cas import CASHelper
+from .config import DoubleBufferConfig
 from .config import Platform
 from .metrics import MeterBase
+from .prefetch import Prefetcher
 from .runner import RunnerThread
 from .directorybuilder import IDirectoryBuilder
+from .slotdirs import SlotDirectories
+from .slotdirs import ToplevelHistory
 
 
 class WorkerThreadMain(threading.Thread):
@@ -37,6 +41,8 @@ class WorkerThreadMain(threading.Thread):
         build_root: str,
         worker_iid: int,
         meter: MeterBase,
+        prefetcher: typing.Optional[Prefetcher] = None,
+        double_buffer: typing.Optional[DoubleBufferConfig] = None,
     ):
         super().__init__()
         self._operation_queue_channel = operation_queue_channel
@@ -54,15 +60,28 @@ class WorkerThreadMain(threading.Thread):
         action_cache_stub = ActionCacheStub(self._cas_channel)
         cas_byte_stream_stub = ByteStreamStub(self._cas_channel)
         cas_helper = CASHelper(cas_stub, cas_byte_stream_stub)
+        build_directory = f"{build_root}/{worker_iid}"
+        slot_directories = None
+        if double_buffer is not None:
+            slot_directories = SlotDirectories(
+                directory_builder,
+                build_directory,
+                meter,
+                history=ToplevelHistory(decay=double_buffer.decay),
+                min_probability=double_buffer.min_probability,
+            )
         self._runner_thread = RunnerThread(
             cas_stub,
             cas_helper,
             action_cache_stub,
             directory_builder,
-            f"{build_root}/{worker_iid}",
+            build_directory,
             self._current_state_queue,
             self._desired_state_queue,
             meter,
+            str(worker_iid),
+            prefetcher,
+            slot_directories,
         )
         self._platform = platform.dict()
         self._sync_future: typing.Optional[grpc.Future] = None
@@ -0,0 +1,186 @@
+"""Background deletion of directory trees.
+
+Removing a large tree takes as long as it has files. Instead, a tree is
+renamed into the trash root, which is atomic and quick when both are on the
+same filesystem, and a low I/O priority thread removes it later. Trees that
+can't be renamed there are removed at once.
+"""
+
+import collections
+import ctypes
+import logging
+import os
+import os.path
+import platform
+import stat
+import sys
+import threading
+import typing
+import uuid
+
+from .util import is_dir_link
+from .util import remove_dir_link
+from .util import unlink_readonly_file
+
+
+_DIR_MODE = stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR
+
+# ioprio_set(2) numbers, see include/uapi/linux/ioprio.h.
+_IOPRIO_SET_SYSCALLS = {"x86_64": 251, "aarch64": 30}
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_CLASS_BE = 2
+_IOPRIO_CLASS_SHIFT = 13
+
+
+def remove_tree(target: str) -> None:
+    """Remove a directory tree whose directories may be readonly. Links to
+    directories are removed, never followed.
+    """
+    os.chmod(target, _DIR_MODE)
+    for name in os.listdir(target):
+        p = os.path.join(target, name)
+        if is_dir_link(p):
+            remove_dir_link(p)
+        elif os.path.isdir(p):
+            remove_tree(p)
+        else:
+            unlink_readonly_file(p)
+    os.rmdir(target)
+
+
+def set_io_nice(level: int) -> None:
+    """Set the best effort I/O priority of the calling thread, 0 (highest)
+    to 7 (lowest), like ionice -c2 -n. Linux only, where it is per thread.
+    """
+    if not sys.platform.startswith("linux"):
+        return
+    syscall = _IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if syscall is None:
+        return
+    ioprio = (_IOPRIO_CLASS_BE << _IOPRIO_CLASS_SHIFT) | level
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.syscall(
+        syscall, _IOPRIO_WHO_PROCESS, threading.get_native_id(), ioprio
+    ):
+        logging.warning(
+            f"failed to set I/O priority: {os.strerror(ctypes.get_errno())}"
+        )
+
+
+class Trash(object):
+    """Trees moved into root, removed in background.
+
+    Every tree carries the size it took in a cache, which stays in size_bytes
+    until it is removed, so the cache can count it against its budget. It
+    can be started again after stop.
+    """
+
+    def __init__(self, root: str, io_nice: typing.Optional[int] = 7):
+        self._root = root
+        self._io_nice = io_nice
+        self._cond = threading.Condition()
+        self._queue: typing.Deque[typing.Tuple[str, int]] = collections.deque()
+        self._removing = 0
+        self._size_bytes = 0
+        self._stopped = False
+        self._thread: typing.Optional[threading.Thread] = None
+
+    @property
+    def size_bytes(self) -> int:
+        return self._size_bytes
+
+    def is_alive(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        """Start removing, trees left by a previous process first."""
+        assert not self.is_alive(), "trash is running already"
+        os.makedirs(self._root, exist_ok=True)
+        with self._cond:
+            queued = {p for p, _ in self._queue}
+            for name in os.listdir(self._root):
+                p = os.path.join(self._root, name)
+                if p not in queued:
+                    self._queue.append((p, 0))
+            self._stopped = False
+        self._thread = threading.Thread(
+            target=self._run, name="trash", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop removing. What is left is removed at the next start."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def move(self, path: str, size_bytes: int = 0) -> None:
+        """Move the tree at path to the trash, or remove it now if it can't
+        be moved there.
+        """
+        trash_path = os.path.join(self._root, uuid.uuid4().hex)
+        try:
+            if not is_dir_link(path):
+                # moving a directory to another parent updates its "..".
+                os.chmod(path, _DIR_MODE)
+            os.rename(path, trash_path)
+        except OSError:
+            # e.g. on another filesystem.
+            remove_tree(path)
+            return
+        with self._cond:
+            self._queue.append((trash_path, size_bytes))
+            self._size_bytes += size_bytes
+            self._cond.notify_all()
+
+    def reclaim(self, size_bytes: int) -> None:
+        """Wait until size_bytes of the trash are removed, or all of it,
+        helping the background thread.
+        """
+        with self._cond:
+            goal = self._size_bytes - size_bytes
+        while True:
+            with self._cond:
+                if self._size_bytes <= goal:
+                    return
+                if not self._queue:
+                    if not self._removing:
+                        return
+                    self._cond.wait()
+                    continue
+                entry = self._take()
+            self._remove(entry)
+
+    def _run(self) -> None:
+        if self._io_nice is not None:
+            set_io_nice(self._io_nice)
+        while True:
+            with self._cond:
+                while not self._queue and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                entry = self._take()
+            self._remove(entry)
+
+    def _take(self) -> typing.Tuple[str, int]:
+        """MUST be called with _cond."""
+        self._removing += 1
+        return self._queue.popleft()
+
+    def _remove(self, entry: typing.Tuple[str, int]) -> None:
+        path, size_bytes = entry
+        try:
+            if is_dir_link(path) or not os.path.isdir(path):
+                os.unlink(path)
+            else:
+                remove_tree(path)
+        except Exception:
+            logging.exception(f"failed to remove {path}")
+        with self._cond:
+            self._removing -= 1
+            self._size_bytes -= size_bytes
+            self._cond.notify_all()
@@ -95,6 +95,16 @@ if sys.platform == "win32":
     def remove_dir_link(target: str):
         os.remove(target)
 
+    def is_dir_link(target: str) -> bool:
+        try:
+            st = os.lstat(target)
+        except FileNotFoundError:
+            return False
+        return (
+            stat.S_ISLNK(st.st_mode)
+            or st.st_reparse_tag == stat.IO_REPARSE_TAG_MOUNT_POINT
+        )
+
 else:
 
     def link_file(source: str, target: str):
@@ -117,3 +127,6 @@ else:
 
     def remove_dir_link(target: str):
         os.unlink(target)
+
+    def is_dir_link(target: str) -> bool:
+        return os.path.islink(target)
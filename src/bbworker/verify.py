@@ -0,0 +1,139 @@
+"""Verification levels of the file cache and the directory cache.
+
+none      trust cached content, hash nothing.
+metadata  hash only what changed since it was verified: inode, mtime, size
+          or mode differ from the recorded ones, or nothing is recorded.
+sampled   like metadata, and also hash a random share of the rest.
+full      hash everything.
+
+The weaker levels can run a Scrubber, which hashes cached content slowly
+in background to find what they miss at startup.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import typing
+
+
+VERIFY_NONE = "none"
+VERIFY_METADATA = "metadata"
+VERIFY_SAMPLED = "sampled"
+VERIFY_FULL = "full"
+VERIFY_LEVELS = (VERIFY_NONE, VERIFY_METADATA, VERIFY_SAMPLED, VERIFY_FULL)
+
+
+def parse_verify_level(raw: str) -> str:
+    if raw not in VERIFY_LEVELS:
+        raise ValueError(
+            f"unknown verify level {raw}, expect one of "
+            + ", ".join(VERIFY_LEVELS)
+        )
+    return raw
+
+
+def fingerprint(st: os.stat_result) -> typing.List[int]:
+    """Metadata which changes when a file is replaced or written."""
+    return [st.st_ino, st.st_mtime_ns, st.st_size, st.st_mode]
+
+
+def hash_file(path: str, size_bytes: int) -> typing.Optional[str]:
+    """sha256 of a file, None if it isn't size_bytes long."""
+    sha256 = hashlib.sha256()
+    read_bytes = 0
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            sha256.update(data)
+            read_bytes += len(data)
+    if read_bytes != size_bytes:
+        return None
+    return sha256.hexdigest()
+
+
+def load_fingerprints(path: str) -> typing.Dict[str, typing.List[int]]:
+    """Fingerprints saved by save_fingerprints, empty if there are none."""
+    try:
+        with open(path, "r") as f:
+            fingerprints = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        logging.warning(f"invalid fingerprints {path}")
+        return {}
+    if not isinstance(fingerprints, dict):
+        return {}
+    return fingerprints
+
+
+def save_fingerprints(
+    path: str, fingerprints: typing.Dict[str, typing.List[int]]
+) -> None:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(fingerprints, f, separators=(",", ":"))
+    os.replace(tmp_path, path)
+
+
+def _lower_priority() -> None:
+    """Lower the CPU priority of the calling thread. Linux only, where
+    nice values are per thread.
+    """
+    if not sys.platform.startswith("linux"):
+        return
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+    except OSError:
+        pass
+
+
+class Scrubber(object):
+    """Call scrub with a budget of bytes to hash every interval_seconds, in
+    a low priority thread. scrub remembers where it stopped, so the whole
+    cache is checked over time without slowing down actions. It can be
+    started again after stop.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        scrub: typing.Callable[[int], None],
+        interval_seconds: float,
+        bytes_per_interval: int,
+    ):
+        self.name = name
+        self._scrub = scrub
+        self._interval_seconds = interval_seconds
+        self._bytes_per_interval = bytes_per_interval
+        self._stopped = threading.Event()
+        self._thread: typing.Optional[threading.Thread] = None
+
+    def is_alive(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        assert not self.is_alive(), f"{self.name} is running already"
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name=self.name, daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        _lower_priority()
+        while not self._stopped.wait(self._interval_seconds):
+            try:
+                self._scrub(self._bytes_per_interval)
+            except Exception:
+                logging.exception(f"{self.name} failed")
@@ -0,0 +1,290 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import os.path
+import select
+import struct
+import sys
+import threading
+import typing
+
+from .cacheinfo import FileCacheInfo
+from .metrics import MeterBase
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVE_SELF = 0x00000800
+IN_DELETE_SELF = 0x00000400
+IN_IGNORED = 0x00008000
+IN_Q_OVERFLOW = 0x00004000
+IN_CLOEXEC = 0o2000000
+
+# events which mean the content may have changed.
+_DIRTY_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVE_SELF | IN_DELETE_SELF
+_WATCH_MASK = _DIRTY_MASK | IN_ATTRIB
+
+_EVENT_HEADER = struct.Struct("iIII")
+# events of watched files carry no name, so a read drains more events than
+# the default fs.inotify.max_queued_events.
+_READ_SIZE = 1024 * 1024
+
+
+def _load_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.inotify_init1
+    except (OSError, AttributeError):
+        return None
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [
+        ctypes.c_int,
+        ctypes.c_char_p,
+        ctypes.c_uint32,
+    ]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return libc
+
+
+_libc = _load_libc()
+
+
+class CacheWatcher(object):
+    """Watch files of the file cache with inotify so linking can skip the
+    stat check of files nobody touched.
+
+    A file is clean after it was checked once and watched. Writes, moves
+    and deletes mark it dirty, and it stays dirty until the next stat check
+    in the link path. Attribute changes are also caused by our own links
+    (st_nlink), so they only queue a stat check in the watcher thread,
+    which marks the file dirty if it doesn't match anymore. The queue is
+    drained before these checks, and a file is checked once however many
+    events it got. When the event queue overflows, every file becomes
+    dirty.
+
+    Watches are on the inodes, so changes made through hardlinks in build
+    directories are seen too.
+    """
+
+    def __init__(self, cache_root_dir: str, meter: MeterBase):
+        self._cache_root_dir = cache_root_dir
+        self._meter = meter
+        self._lock = threading.Lock()
+        self._fd = -1
+        self._wake_r = -1
+        self._wake_w = -1
+        self._thread: typing.Optional[threading.Thread] = None
+        self._wd_to_name: typing.Dict[int, str] = {}
+        self._name_to_wd: typing.Dict[str, int] = {}
+        self._cache_info: typing.Dict[str, FileCacheInfo] = {}
+        self._clean: typing.Set[str] = set()
+        # increased by every event which may make files dirty.
+        self._sequence = 0
+        self._dirty_sequence: typing.Dict[str, int] = {}
+        self._overflow_sequence = 0
+        self._warned_no_space = False
+
+    @staticmethod
+    def available() -> bool:
+        return _libc is not None
+
+    def start(self) -> None:
+        assert _libc is not None, "inotify is not available"
+        fd = _libc.inotify_init1(IN_CLOEXEC)
+        if fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self._fd = fd
+        self._wake_r, self._wake_w = os.pipe()
+        self._thread = threading.Thread(
+            target=self._run, name="cache_watcher", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        os.write(self._wake_w, b"x")
+        self._thread.join()
+        self._thread = None
+        for fd in [self._fd, self._wake_r, self._wake_w]:
+            os.close(fd)
+        with self._lock:
+            self._wd_to_name.clear()
+            self._name_to_wd.clear()
+            self._cache_info.clear()
+            self._clean.clear()
+
+    def sequence(self) -> int:
+        """Take before checking files, then pass to mark_clean."""
+        with self._lock:
+            return self._sequence
+
+    def is_clean(self, name_in_cache: str) -> bool:
+        with self._lock:
+            return name_in_cache in self._clean
+
+    def mark_clean(
+        self, name_in_cache: str, cache_info: FileCacheInfo, since: int
+    ) -> None:
+        """Mark a file checked after sequence since as clean, unless it was
+        changed since then. Start watching it if not watched yet.
+        """
+        with self._lock:
+            if self._dirty_sequence.get(name_in_cache, -1) > since:
+                return
+            if self._overflow_sequence > since:
+                # events after the check were lost.
+                return
+            watched = name_in_cache in self._name_to_wd
+        if not watched:
+            if not self._add_watch(name_in_cache, cache_info):
+                return
+            # changes between the check and adding the watch were missed.
+            try:
+                file_stat = os.stat(
+                    os.path.join(self._cache_root_dir, name_in_cache)
+                )
+            except FileNotFoundError:
+                self.unwatch(name_in_cache)
+                return
+            if not cache_info.match(file_stat):
+                self.unwatch(name_in_cache)
+                return
+        with self._lock:
+            if name_in_cache not in self._name_to_wd:
+                return
+            if self._dirty_sequence.get(name_in_cache, -1) > since:
+                return
+            self._cache_info[name_in_cache] = cache_info
+            self._clean.add(name_in_cache)
+
+    def unwatch(self, name_in_cache: str) -> None:
+        """Stop watching a file, e.g. it's removed from the cache."""
+        assert _libc is not None
+        with self._lock:
+            self._clean.discard(name_in_cache)
+            self._cache_info.pop(name_in_cache, None)
+            self._dirty_sequence.pop(name_in_cache, None)
+            wd = self._name_to_wd.pop(name_in_cache, None)
+            if wd is not None:
+                del self._wd_to_name[wd]
+                _libc.inotify_rm_watch(self._fd, wd)
+
+    def _add_watch(
+        self, name_in_cache: str, cache_info: FileCacheInfo
+    ) -> bool:
+        assert _libc is not None
+        path = os.path.join(self._cache_root_dir, name_in_cache)
+        wd = _libc.inotify_add_watch(self._fd, os.fsencode(path), _WATCH_MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            if e == errno.ENOSPC and not self._warned_no_space:
+                self._warned_no_space = True
+                logging.warning(
+                    "inotify watches exhausted, raise "
+                    "fs.inotify.max_user_watches. unwatched files are "
+                    "checked by stat."
+                )
+            return False
+        with self._lock:
+            old_name = self._wd_to_name.get(wd)
+            if old_name is not None and old_name != name_in_cache:
+                # same inode under another name, should not happen.
+                self._name_to_wd.pop(old_name, None)
+                self._clean.discard(old_name)
+            self._wd_to_name[wd] = name_in_cache
+            self._name_to_wd[name_in_cache] = wd
+            self._cache_info[name_in_cache] = cache_info
+        return True
+
+    def _run(self) -> None:
+        poller = select.poll()
+        poller.register(self._fd, select.POLLIN)
+        poller.register(self._wake_r, select.POLLIN)
+        while True:
+            ready = [fd for fd, _ in poller.poll()]
+            if self._wake_r in ready:
+                break
+            # drain the queue before the stat checks, so the queue doesn't
+            # fill up meanwhile, and a file linked many times is checked
+            # once.
+            to_check: typing.Set[str] = set()
+            while True:
+                try:
+                    data = os.read(self._fd, _READ_SIZE)
+                except OSError:
+                    logging.exception("failed to read inotify events")
+                    break
+                self._handle_events(data, to_check)
+                if not select.select([self._fd], [], [], 0)[0]:
+                    break
+            if to_check:
+                self._check_attrib(to_check)
+
+    def _handle_events(
+        self, data: bytes, to_check: typing.Optional[typing.Set[str]] = None
+    ) -> typing.Set[str]:
+        """Apply events. Add names which need a stat check to to_check,
+        and return it.
+        """
+        if to_check is None:
+            to_check = set()
+        offset = 0
+        with self._lock:
+            while offset < len(data):
+                wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size + length
+                if mask & IN_Q_OVERFLOW:
+                    self._meter.count("cache_watcher_overflow")
+                    self._sequence += 1
+                    self._overflow_sequence = self._sequence
+                    self._clean.clear()
+                    to_check.clear()
+                    continue
+                name = self._wd_to_name.get(wd)
+                if name is None:
+                    continue
+                if mask & IN_IGNORED:
+                    # the inode is gone.
+                    del self._wd_to_name[wd]
+                    if self._name_to_wd.get(name) == wd:
+                        del self._name_to_wd[name]
+                    self._clean.discard(name)
+                    self._cache_info.pop(name, None)
+                    self._dirty_sequence.pop(name, None)
+                elif mask & _DIRTY_MASK:
+                    self._sequence += 1
+                    self._dirty_sequence[name] = self._sequence
+                    self._clean.discard(name)
+                    to_check.discard(name)
+                elif mask & IN_ATTRIB and name in self._clean:
+                    to_check.add(name)
+        return to_check
+
+    def _check_attrib(self, names: typing.Iterable[str]) -> None:
+        for name in names:
+            with self._lock:
+                cache_info = self._cache_info.get(name)
+                if name not in self._clean:
+                    # dirty already, or not watched anymore.
+                    continue
+            if cache_info is None:
+                continue
+            try:
+                file_stat: typing.Optional[os.stat_result] = os.stat(
+                    os.path.join(self._cache_root_dir, name)
+                )
+            except FileNotFoundError:
+                file_stat = None
+            if file_stat is None or not cache_info.match(file_stat):
+                self._meter.count("cache_watcher_dirty")
+                with self._lock:
+                    self._sequence += 1
+                    self._dirty_sequence[name] = self._sequence
+                    self._clean.discard(name)
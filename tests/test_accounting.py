@@ -0,0 +1,212 @@
+import os
+import os.path
+import tempfile
+
+from bbworker.accounting import InodeAccounting
+from bbworker.directorybuilder import SharedTopLevelCachedDirectoryBuilder
+from bbworker.filesystem import LocalHardlinkFilesystem
+from bbworker.metrics import create_dummy_meter
+
+
+def _name_in_cache(fnode):
+    return f"{fnode.digest.hash}_{fnode.digest.size_bytes}"
+
+
+def test_hold_and_release():
+    accounting = InodeAccounting()
+    accounting.hold([("a", 10), ("b", 5), ("a", 10)])
+    assert accounting.held_bytes == 15
+    accounting.release([("a", 10)])
+    assert accounting.is_held("a")
+    assert accounting.held_bytes == 15
+    accounting.release([("a", 10), ("b", 5)])
+    assert not accounting.is_held("a")
+    assert not accounting.is_held("b")
+    assert accounting.held_bytes == 0
+
+
+def test_link_count():
+    with tempfile.TemporaryDirectory() as root:
+        p = os.path.join(root, "a")
+        assert InodeAccounting.link_count(p) == 0
+        with open(p, "wb") as f:
+            f.write(b"a")
+        assert InodeAccounting.link_count(p) == 1
+        os.link(p, os.path.join(root, "b"))
+        assert InodeAccounting.link_count(p) == 2
+
+
+class TestEviction(object):
+    def test_held_files_not_evicted(self, mock_cas_helper):
+        with (
+            tempfile.TemporaryDirectory() as filesystem_root,
+            tempfile.TemporaryDirectory() as target,
+        ):
+            accounting = InodeAccounting()
+            filesystem = LocalHardlinkFilesystem(
+                filesystem_root,
+                create_dummy_meter(),
+                max_cache_size_bytes=20,
+                accounting=accounting,
+            )
+            filesystem.init()
+            a = mock_cas_helper.append_file("a", b"a" * 10)
+            b = mock_cas_helper.append_file("b", b"b" * 10)
+            c = mock_cas_helper.append_file("c", b"c" * 10)
+            filesystem.fetch_to(mock_cas_helper, [a, b], target)
+            for name in os.listdir(target):
+                os.unlink(os.path.join(target, name))
+            accounting.hold([(_name_in_cache(a), 10)])
+            d = mock_cas_helper.append_file("d", b"d" * 10)
+            filesystem.fetch_to(mock_cas_helper, [c], target)
+            os.unlink(os.path.join(target, "c"))
+            filesystem.fetch_to(mock_cas_helper, [d], target)
+            assert sorted(os.listdir(filesystem_root)) == sorted(
+                [_name_in_cache(a), _name_in_cache(c), _name_in_cache(d)]
+            )
+            assert filesystem.current_size_bytes == 30
+
+    def test_held_files_not_counted(self, mock_cas_helper):
+        with (
+            tempfile.TemporaryDirectory() as filesystem_root,
+            tempfile.TemporaryDirectory() as target,
+        ):
+            accounting = InodeAccounting()
+            filesystem = LocalHardlinkFilesystem(
+                filesystem_root,
+                create_dummy_meter(),
+                max_cache_size_bytes=20,
+                accounting=accounting,
+            )
+            filesystem.init()
+            a = mock_cas_helper.append_file("a", b"a" * 10)
+            b = mock_cas_helper.append_file("b", b"b" * 10)
+            c = mock_cas_helper.append_file("c", b"c" * 10)
+            filesystem.fetch_to(mock_cas_helper, [a, b], target)
+            for name in os.listdir(target):
+                os.unlink(os.path.join(target, name))
+            accounting.hold([(_name_in_cache(a), 10), (_name_in_cache(b), 10)])
+            # the cached directories account for a and b.
+            filesystem.fetch_to(mock_cas_helper, [c], target)
+            assert sorted(os.listdir(filesystem_root)) == sorted(
+                [_name_in_cache(a), _name_in_cache(b), _name_in_cache(c)]
+            )
+
+    def test_held_files_out_of_cache_not_counted(self, mock_cas_helper):
+        with (
+            tempfile.TemporaryDirectory() as filesystem_root,
+            tempfile.TemporaryDirectory() as target,
+        ):
+            accounting = InodeAccounting()
+            filesystem = LocalHardlinkFilesystem(
+                filesystem_root,
+                create_dummy_meter(),
+                max_cache_size_bytes=20,
+                accounting=accounting,
+            )
+            filesystem.init()
+            a = mock_cas_helper.append_file("a", b"a" * 10)
+            b = mock_cas_helper.append_file("b", b"b" * 10)
+            c = mock_cas_helper.append_file("c", b"c" * 10)
+            x = mock_cas_helper.append_file("x", b"x" * 20)
+            # held by a cached directory, but not in the file cache.
+            accounting.hold([(_name_in_cache(x), 20)])
+            filesystem.fetch_to(mock_cas_helper, [a], target)
+            os.unlink(os.path.join(target, "a"))
+            assert accounting.held_cached_bytes == 0
+            filesystem.fetch_to(mock_cas_helper, [b, c], target)
+            assert sorted(os.listdir(filesystem_root)) == sorted(
+                [_name_in_cache(b), _name_in_cache(c)]
+            )
+            accounting.hold([(_name_in_cache(b), 10)])
+            assert accounting.held_cached_bytes == 10
+            accounting.release([(_name_in_cache(b), 10)])
+            assert accounting.held_cached_bytes == 0
+
+    def test_files_linked_elsewhere_not_evicted(self, mock_cas_helper):
+        with (
+            tempfile.TemporaryDirectory() as filesystem_root,
+            tempfile.TemporaryDirectory() as target_a,
+            tempfile.TemporaryDirectory() as target_b,
+        ):
+            filesystem = LocalHardlinkFilesystem(
+                filesystem_root,
+                create_dummy_meter(),
+                max_cache_size_bytes=20,
+                accounting=InodeAccounting(),
+            )
+            filesystem.init()
+            a = mock_cas_helper.append_file("a", b"a" * 10)
+            b = mock_cas_helper.append_file("b", b"b" * 10)
+            c = mock_cas_helper.append_file("c", b"c" * 10)
+            # a is used least recently, but still linked in target_a.
+            filesystem.fetch_to(mock_cas_helper, [a], target_a)
+            filesystem.fetch_to(mock_cas_helper, [b], target_b)
+            os.unlink(os.path.join(target_b, "b"))
+            filesystem.fetch_to(mock_cas_helper, [c], target_b)
+            assert sorted(os.listdir(filesystem_root)) == sorted(
+                [_name_in_cache(a), _name_in_cache(c)]
+            )
+            # all linked elsewhere, evicting them frees nothing.
+            d = mock_cas_helper.append_file("d", b"d" * 10)
+            filesystem.fetch_to(mock_cas_helper, [d], target_b)
+            assert sorted(os.listdir(filesystem_root)) == sorted(
+                [_name_in_cache(a), _name_in_cache(c)]
+            )
+            with open(os.path.join(target_b, "d"), "rb") as f:
+                assert f.read() == b"d" * 10
+
+    def test_cached_directory_holds_files(self, mock_cas_helper):
+        with (
+            tempfile.TemporaryDirectory() as filesystem_root,
+            tempfile.TemporaryDirectory() as cache_root,
+            tempfile.TemporaryDirectory() as local_root,
+            tempfile.TemporaryDirectory() as target,
+        ):
+            meter = create_dummy_meter()
+            accounting = InodeAccounting()
+            filesystem = LocalHardlinkFilesystem(
+                filesystem_root,
+                meter,
+                max_cache_size_bytes=30,
+                accounting=accounting,
+            )
+            filesystem.init()
+            builder = SharedTopLevelCachedDirectoryBuilder(
+                cache_root,
+                mock_cas_helper,
+                filesystem,
+                meter,
+                max_cache_size_bytes=10,
+                accounting=accounting,
+            )
+            builder.init()
+            input_root_data = {"tool": {"bin": b"t" * 10}}
+            digest = mock_cas_helper.append_directory(input_root_data)
+            builder.build(
+                digest,
+                mock_cas_helper.get_directory_by_digest(digest),
+                local_root,
+            )
+            tool = mock_cas_helper.append_file("bin", b"t" * 10)
+            assert accounting.is_held(_name_in_cache(tool))
+            assert accounting.held_bytes == 10
+            others = [
+                mock_cas_helper.append_file(f"f{i}", str(i).encode() * 10)
+                for i in range(4)
+            ]
+            for fnode in others:
+                filesystem.fetch_to(mock_cas_helper, [fnode], target)
+                os.unlink(os.path.join(target, fnode.name))
+            assert _name_in_cache(tool) in os.listdir(filesystem_root)
+
+            # evicting the directory releases its files.
+            other_data = {"other": {"bin": b"o" * 10}}
+            other_digest = mock_cas_helper.append_directory(other_data)
+            builder.build(
+                other_digest,
+                mock_cas_helper.get_directory_by_digest(other_digest),
+                local_root,
+            )
+            assert not accounting.is_held(_name_in_cache(tool))
+            assert accounting.held_bytes == 10
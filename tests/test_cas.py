@@ -1,7 +1,15 @@
 import hashlib
 
+from build.bazel.remote.execution.v2.remote_execution_pb2 import Digest
+from build.bazel.remote.execution.v2.remote_execution_pb2 import Directory
+from build.bazel.remote.execution.v2.remote_execution_pb2 import FileNode
+from build.bazel.remote.execution.v2.remote_execution_pb2 import (
+    GetTreeResponse,
+)
+
 from bbworker.cas import BytesProvider
 from bbworker.cas import CASCache
+from bbworker.cas import CASHelper
 
 
 class TestBytesProvider:
@@ -247,3 +255,27 @@ class TestFetchAll:
         assert len(mock_cas_helper.call_history) == 0
         try_fetch(1)
         assert len(mock_cas_helper.call_history) == 1
+
+
+class TestGetTree:
+    def test_paging(self):
+        directories = [
+            Directory(files=[FileNode(name=f"file_{i}")]) for i in range(3)
+        ]
+        requests = []
+
+        class FakeStub:
+            def GetTree(self, request):
+                requests.append(request)
+                if not request.page_token:
+                    yield GetTreeResponse(
+                        directories=directories[:2], next_page_token="next"
+                    )
+                else:
+                    yield GetTreeResponse(directories=directories[2:])
+
+        cas_helper = CASHelper(FakeStub(), None)
+        root_digest = Digest(hash="root", size_bytes=1)
+        assert list(cas_helper.get_tree(root_digest, 2)) == directories
+        assert [r.page_token for r in requests] == ["", "next"]
+        assert all(r.root_digest == root_digest for r in requests)
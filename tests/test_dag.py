@@ -0,0 +1,75 @@
+import concurrent.futures
+import threading
+
+import pytest
+
+from bbworker.dag import TaskScheduler
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = TaskScheduler(4, "test_dag")
+    yield scheduler
+    scheduler.shutdown()
+
+
+def test_dependencies(scheduler):
+    order = []
+    lock = threading.Lock()
+
+    def _record(name):
+        with lock:
+            order.append(name)
+        return name
+
+    leaves = [scheduler.submit(_record, f"leaf_{i}") for i in range(10)]
+    root = scheduler.submit(_record, "root", deps=leaves)
+    assert root.result(timeout=10) == "root"
+    assert order[-1] == "root"
+    assert sorted(order[:-1]) == sorted(f"leaf_{i}" for i in range(10))
+
+
+def test_external_dependency(scheduler):
+    external: concurrent.futures.Future = concurrent.futures.Future()
+    task = scheduler.submit(lambda: "done", deps=[external])
+    assert not task.done()
+    external.set_result(None)
+    assert task.result(timeout=10) == "done"
+
+
+def test_failed_dependency(scheduler):
+    called = []
+
+    def _fail():
+        raise ValueError("failed")
+
+    failed = scheduler.submit(_fail)
+    task = scheduler.submit(called.append, 1, deps=[failed])
+    with pytest.raises(ValueError):
+        task.result(timeout=10)
+    assert called == []
+
+
+def test_continuation(scheduler):
+    external: concurrent.futures.Future = concurrent.futures.Future()
+    task = scheduler.submit(lambda: external)
+    # the task returned, its future waits for the one it returned.
+    task_done = scheduler.submit(lambda: None)
+    task_done.result(timeout=10)
+    assert not task.done()
+    external.set_result(42)
+    assert task.result(timeout=10) == 42
+
+
+def test_deep_tree_never_blocks():
+    # more levels than threads, every level waits for the next one.
+    scheduler = TaskScheduler(2, "test_dag")
+
+    def _node(depth):
+        if depth == 0:
+            return depth
+        child = scheduler.submit(_node, depth - 1)
+        return scheduler.submit(lambda: depth, deps=[child])
+
+    assert scheduler.submit(_node, 100).result(timeout=10) == 100
+    scheduler.shutdown()
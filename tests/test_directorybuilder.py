@@ -5,17 +5,27 @@ import random
 import stat
 import sys
 import tempfile
+import threading
+import time
 import typing
 import uuid
 
+import grpc
 import pytest
+from build.bazel.remote.execution.v2.remote_execution_pb2 import Directory
 
+from bbworker.directorybuilder import DirectoryBuilderError
+from bbworker.directorybuilder import DirectoryDataCache
 from bbworker.directorybuilder import SharedTopLevelCachedDirectoryBuilder
+from bbworker.dirstore import DirectoryStore
 from bbworker.filesystem import LocalHardlinkFilesystem
+from bbworker.metrics import MeterBase
 from bbworker.metrics import create_dummy_meter
 
+from bbworker.util import is_dir_link
 from bbworker.util import unlink_readonly_file
 from bbworker.util import set_read_exec_write
+from bbworker.util import set_read_only
 
 
 class FakeIOError(Exception):
@@ -524,6 +534,7 @@ class TestSharedTopLevelCachedDirectoryBuilder(object):
                 assert False, "fetch_to should not be called."
 
             filesystem.fetch_to = _no_fetch_to
+            filesystem.fetch_tree = _no_fetch_to
             # the first directory should still in the same.
             builder.build(
                 input_root_digest_list[0],
@@ -897,6 +908,7 @@ class TestSharedTopLevelCachedDirectoryBuilder(object):
                 ), "should not call filesystem.fetch_to when dir is cached."
 
             filesystem.fetch_to = should_not_call
+            filesystem.fetch_tree = should_not_call
             builder_1.build(
                 input_root_digest, input_root_directory, local_root_1
             )
@@ -2305,3 +2317,1141 @@ class TestCacheSizeLimitWithHardlink:
                     cache_root, "dir", f"{digest.hash}_{digest.size_bytes}"
                 )
                 assert not os.path.exists(p)
+
+
+class _UnimplementedError(grpc.RpcError):
+    def code(self):
+        return grpc.StatusCode.UNIMPLEMENTED
+
+
+def _wide_tree(depth: int, width: int, prefix: str = "") -> dict:
+    tree: dict = {"file": prefix.encode()}
+    if depth > 0:
+        for i in range(width):
+            tree[f"dir_{i}"] = _wide_tree(depth - 1, width, f"{prefix}{i}")
+    return tree
+
+
+def _fetch_calls(mock_cas_helper) -> typing.List[list]:
+    return [list(c) for c in mock_cas_helper.call_history if list(c)]
+
+
+class _CountingMeter(MeterBase):
+    def __init__(self):
+        self.counts: typing.Dict[str, int] = {}
+
+    def count(self, name, count=1, **kargs):
+        self.counts[name] = self.counts.get(name, 0) + count
+
+
+class TestDirectoryDataCache:
+    def test_fetch_by_level(self, mock_cas_helper):
+        digest = mock_cas_helper.append_directory(_wide_tree(3, 3))
+        directory = mock_cas_helper.get_directory_by_digest(digest)
+        cache = DirectoryDataCache(mock_cas_helper, create_dummy_meter())
+        dir_data = cache.fetch_directory_data(digest, directory)
+        # one request per level below the root.
+        assert [len(c) for c in _fetch_calls(mock_cas_helper)] == [3, 9, 27]
+        leaf = dict(
+            dict(dict(dir_data.directories())["dir_2"].directories())[
+                "dir_1"
+            ].directories()
+        )["dir_0"]
+        assert dict(leaf.files())["file"].digest.size_bytes == 3
+        assert leaf.source_digest is not None
+
+        # every subtree is cached.
+        mock_cas_helper.clear_call_history()
+        subdir_digest = directory.directories[1].digest
+        subdir = cache.fetch_directory_data(
+            subdir_digest,
+            mock_cas_helper.get_directory_by_digest(subdir_digest),
+        )
+        assert subdir is dict(dir_data.directories())["dir_1"]
+        assert _fetch_calls(mock_cas_helper) == []
+
+    def test_cached_subtree_not_fetched(self, mock_cas_helper):
+        shared = _wide_tree(2, 2, "shared")
+        shared_digest = mock_cas_helper.append_directory(shared)
+        cache = DirectoryDataCache(mock_cas_helper, create_dummy_meter())
+        cache.fetch_directory_data(
+            shared_digest,
+            mock_cas_helper.get_directory_by_digest(shared_digest),
+        )
+        mock_cas_helper.clear_call_history()
+        digest = mock_cas_helper.append_directory({"a": shared, "b": {}})
+        cache.fetch_directory_data(
+            digest, mock_cas_helper.get_directory_by_digest(digest)
+        )
+        assert [len(c) for c in _fetch_calls(mock_cas_helper)] == [1]
+
+    def test_get_tree(self, mock_cas_helper):
+        digest = mock_cas_helper.append_directory(_wide_tree(3, 2))
+        directory = mock_cas_helper.get_directory_by_digest(digest)
+
+        def _get_tree(root_digest):
+            assert root_digest == digest
+            pending = [directory]
+            while pending:
+                d = pending.pop()
+                yield d
+                for dn in d.directories:
+                    pending.append(
+                        mock_cas_helper.get_directory_by_digest(dn.digest)
+                    )
+
+        mock_cas_helper.get_tree = _get_tree
+        cache = DirectoryDataCache(
+            mock_cas_helper, create_dummy_meter(), use_get_tree=True
+        )
+        expected = DirectoryDataCache(
+            mock_cas_helper, create_dummy_meter()
+        ).fetch_directory_data(digest, directory)
+        mock_cas_helper.clear_call_history()
+        dir_data = cache.fetch_directory_data(digest, directory)
+        assert _fetch_calls(mock_cas_helper) == []
+        assert dir_data.checksum_digest == expected.checksum_digest
+
+    def test_get_tree_unimplemented(self, mock_cas_helper):
+        digest = mock_cas_helper.append_directory(_wide_tree(2, 2))
+        directory = mock_cas_helper.get_directory_by_digest(digest)
+
+        def _get_tree(root_digest):
+            raise _UnimplementedError()
+            yield
+
+        mock_cas_helper.get_tree = _get_tree
+        cache = DirectoryDataCache(
+            mock_cas_helper, create_dummy_meter(), use_get_tree=True
+        )
+        cache.fetch_directory_data(digest, directory)
+        assert [len(c) for c in _fetch_calls(mock_cas_helper)] == [2, 4]
+        assert not cache._use_get_tree
+
+    def test_bounded_by_memory(self, mock_cas_helper):
+        digests = [
+            mock_cas_helper.append_directory(_wide_tree(2, 4, str(i)))
+            for i in range(2)
+        ]
+        directories = [
+            mock_cas_helper.get_directory_by_digest(d) for d in digests
+        ]
+        meter = _CountingMeter()
+        cache = DirectoryDataCache(mock_cas_helper, meter)
+        cache.fetch_directory_data(digests[0], directories[0])
+        tree_bytes = cache.cached_bytes
+        assert tree_bytes > 0
+
+        # trees of the same shape take the same memory.
+        cache = DirectoryDataCache(mock_cas_helper, meter, tree_bytes)
+        for digest, directory in zip(digests, directories):
+            cache.fetch_directory_data(digest, directory)
+        assert cache.cached_bytes == tree_bytes
+        assert cache.get(digests[0]) is None
+        assert cache.get(digests[1]) is not None
+        assert meter.counts["fetch_directory_data_evict"] > 0
+        assert meter.counts["fetch_directory_data_cache_miss"] == 3
+
+    def test_subtrees_evicted_with_parent(self, mock_cas_helper):
+        digest = mock_cas_helper.append_directory(_wide_tree(2, 3, "a"))
+        directory = mock_cas_helper.get_directory_by_digest(digest)
+        small_digest = mock_cas_helper.append_directory({"b": {}})
+        cache = DirectoryDataCache(mock_cas_helper, create_dummy_meter())
+        dir_data = cache.fetch_directory_data(digest, directory)
+        tree_bytes = cache.cached_bytes
+
+        cache = DirectoryDataCache(
+            mock_cas_helper, create_dummy_meter(), tree_bytes
+        )
+        cache.fetch_directory_data(digest, directory)
+        subdir_digest = directory.directories[0].digest
+        # the root is used again, its subtrees are older.
+        assert cache.get(digest) is not None
+        cache.fetch_directory_data(
+            small_digest, mock_cas_helper.get_directory_by_digest(small_digest)
+        )
+        # subtrees are not evicted before the root referencing them.
+        assert cache.get(digest) is None
+        assert cache.cached_bytes <= tree_bytes
+        for cached, _ in cache._cache.values():
+            for _, subdir in cached.directories():
+                assert cache.get(subdir.source_digest) is subdir
+        # the subtree is resolved again as a whole.
+        subdir = cache.fetch_directory_data(
+            subdir_digest,
+            mock_cas_helper.get_directory_by_digest(subdir_digest),
+        )
+        assert subdir.checksum_digest == (
+            dict(dir_data.directories())["dir_0"].checksum_digest
+        )
+
+    def test_store(self, mock_cas_helper):
+        digest = mock_cas_helper.append_directory(_wide_tree(2, 3))
+        directory = mock_cas_helper.get_directory_by_digest(digest)
+        with tempfile.TemporaryDirectory() as store_root:
+            store = DirectoryStore(store_root, 1024 * 1024)
+            store.open()
+            try:
+                expected = DirectoryDataCache(
+                    mock_cas_helper, create_dummy_meter(), store=store
+                ).fetch_directory_data(digest, directory)
+                # a new cache, like after a restart.
+                mock_cas_helper.clear_call_history()
+                meter = _CountingMeter()
+                dir_data = DirectoryDataCache(
+                    mock_cas_helper, meter, store=store
+                ).fetch_directory_data(digest, directory)
+                assert _fetch_calls(mock_cas_helper) == []
+                assert meter.counts["directory_store_hit"] == 13
+                assert dir_data.checksum_digest == expected.checksum_digest
+                assert dir_data.copy_size_bytes == expected.copy_size_bytes
+            finally:
+                store.close()
+
+    def test_checksum_reuses_digest(self, mock_cas_helper):
+        digest = mock_cas_helper.append_directory(_wide_tree(2, 2))
+        directory = mock_cas_helper.get_directory_by_digest(digest)
+        meter = _CountingMeter()
+        dir_data = DirectoryDataCache(
+            mock_cas_helper, meter
+        ).fetch_directory_data(digest, directory)
+        assert dir_data.checksum_digest == digest
+        assert meter.counts["fetch_directory_checksum_reused"] == 7
+
+    def test_checksum_of_unsorted_directory(self, mock_cas_helper):
+        sorted_digest = mock_cas_helper.append_directory(
+            {"a": b"a", "b": b"b", "sub": {"c": b"c"}}
+        )
+        sorted_directory = mock_cas_helper.get_directory_by_digest(
+            sorted_digest
+        )
+        directory = Directory()
+        directory.files.extend(reversed(sorted_directory.files))
+        directory.directories.extend(sorted_directory.directories)
+        digest = mock_cas_helper.append_digest_data(
+            directory.SerializeToString()
+        )
+        meter = _CountingMeter()
+        dir_data = DirectoryDataCache(
+            mock_cas_helper, meter
+        ).fetch_directory_data(digest, directory)
+        assert dir_data.checksum_digest == sorted_digest
+        # only "sub" is normalized.
+        assert meter.counts["fetch_directory_checksum_reused"] == 1
+
+    @pytest.mark.only_in_full_test
+    def test_checksum_benchmark(self, mock_cas_helper, monkeypatch):
+        digest = mock_cas_helper.append_directory(_wide_tree(6, 4))
+        directory = mock_cas_helper.get_directory_by_digest(digest)
+        timing = {}
+        for name in ["recompute", "reuse"]:
+            if name == "recompute":
+                monkeypatch.setattr(
+                    "bbworker.directorybuilder._is_normalized",
+                    lambda *args: False,
+                )
+            else:
+                monkeypatch.undo()
+            cache = DirectoryDataCache(mock_cas_helper, create_dummy_meter())
+            # directories are fetched already, only building is measured.
+            messages = {}
+            pending = [(digest, directory)]
+            while pending:
+                d, message = pending.pop()
+                messages[(d.hash, d.size_bytes)] = message
+                for dn in message.directories:
+                    pending.append(
+                        (
+                            dn.digest,
+                            mock_cas_helper.get_directory_by_digest(dn.digest),
+                        )
+                    )
+            start_at = time.process_time()
+            cache._build_directory_data(digest, messages, {}, {})
+            timing[name] = time.process_time() - start_at
+        for name, seconds in timing.items():
+            print(
+                f"{name}: {seconds:.3f}s CPU for {len(messages)} directories"
+            )
+
+    @pytest.mark.parametrize("fail", [False, True])
+    def test_single_flight(self, mock_cas_helper, fail):
+        digest = mock_cas_helper.append_directory(_wide_tree(2, 2))
+        directory = mock_cas_helper.get_directory_by_digest(digest)
+        fetch_all = mock_cas_helper.fetch_all
+        fetching = threading.Event()
+        resume = threading.Event()
+
+        def _fetch_all(digests):
+            fetching.set()
+            assert resume.wait(5)
+            if fail:
+                raise DirectoryBuilderError("fetch failed")
+            return fetch_all(digests)
+
+        mock_cas_helper.fetch_all = _fetch_all
+        meter = _CountingMeter()
+        cache = DirectoryDataCache(mock_cas_helper, meter)
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            first = executor.submit(
+                cache.fetch_directory_data, digest, directory
+            )
+            assert fetching.wait(5)
+            second = executor.submit(
+                cache.fetch_directory_data, digest, directory
+            )
+            deadline = time.time() + 5
+            while "fetch_directory_data_wait" not in meter.counts:
+                assert time.time() < deadline
+                time.sleep(0.01)
+            resume.set()
+            if fail:
+                for future in [first, second]:
+                    with pytest.raises(DirectoryBuilderError):
+                        future.result()
+            else:
+                assert first.result() is second.result()
+        assert meter.counts["fetch_directory_data_cache_miss"] == 1
+        assert meter.counts["fetch_directory_data_wait"] == 1
+        assert not cache._pending
+
+
+class TestStreamingBuild:
+    def test_build(self, mock_cas_helper):
+        with (
+            tempfile.TemporaryDirectory() as filesystem_root,
+            tempfile.TemporaryDirectory() as local_root,
+            tempfile.TemporaryDirectory() as streaming_local_root,
+            tempfile.TemporaryDirectory() as cache_root,
+            tempfile.TemporaryDirectory() as streaming_cache_root,
+        ):
+            input_root_data = {
+                "file_1": b"a" * 100,
+                "dir_1": {"file_1_1": b"c" * 5, "dir_1_1": {"f": b"x"}},
+                "dir_2": {"file_1_1": b"c" * 5, "dir_1_1": {"f": b"x"}},
+                "external": {
+                    "repo_1": {"BUILD": b"repo_1", "lib": {"a": b"a"}},
+                    "file": b"external",
+                },
+                "bazel-out": {"k8": {"bin": {"out": b"out"}}},
+            }
+            input_root_digest = mock_cas_helper.append_directory(
+                input_root_data
+            )
+            input_root_directory = mock_cas_helper.get_directory_by_digest(
+                input_root_digest
+            )
+            meter = create_dummy_meter()
+            filesystem = LocalHardlinkFilesystem(filesystem_root, meter)
+            filesystem.init()
+            builder = SharedTopLevelCachedDirectoryBuilder(
+                cache_root, mock_cas_helper, filesystem, meter
+            )
+            builder.init()
+            streaming_builder = SharedTopLevelCachedDirectoryBuilder(
+                streaming_cache_root,
+                mock_cas_helper,
+                filesystem,
+                meter,
+                streaming=True,
+            )
+            streaming_builder.init()
+            builder.build(input_root_digest, input_root_directory, local_root)
+            for _ in range(2):
+                streaming_builder.build(
+                    input_root_digest,
+                    input_root_directory,
+                    streaming_local_root,
+                )
+                _assert_directory(
+                    input_root_data,
+                    streaming_local_root,
+                    skip_cache=["bazel-out", "external"],
+                )
+            # cached directories are the same.
+            assert sorted(os.listdir(streaming_cache_root)) == sorted(
+                os.listdir(cache_root)
+            )
+            assert (
+                streaming_builder.current_size_bytes
+                == builder.current_size_bytes
+            )
+
+    def test_files_fetched_while_resolving(self, mock_cas_helper):
+        with (
+            tempfile.TemporaryDirectory() as filesystem_root,
+            tempfile.TemporaryDirectory() as local_root,
+            tempfile.TemporaryDirectory() as cache_root,
+        ):
+            input_root_data = {
+                "file_1": b"a" * 100,
+                "dir_1": {"dir_1_1": {"dir_1_1_1": {"f": b"x"}}},
+            }
+            input_root_digest = mock_cas_helper.append_directory(
+                input_root_data
+            )
+            input_root_directory = mock_cas_helper.get_directory_by_digest(
+                input_root_digest
+            )
+            deep_digest = mock_cas_helper.append_directory({"f": b"x"})
+            file_name_in_cache = mock_cas_helper.append_file(
+                "file_1", b"a" * 100
+            ).digest.hash
+            overlapped = []
+            fetch_all = mock_cas_helper.fetch_all
+
+            def _slow_fetch_all(digests):
+                digests = list(digests)
+                if deep_digest in digests:
+                    # resolving the deepest level, root files are fetched.
+                    deadline = time.time() + 5
+                    while time.time() < deadline and not any(
+                        n.startswith(file_name_in_cache)
+                        for n in os.listdir(filesystem_root)
+                    ):
+                        time.sleep(0.01)
+                    overlapped.append(
+                        any(
+                            n.startswith(file_name_in_cache)
+                            for n in os.listdir(filesystem_root)
+                        )
+                    )
+                return fetch_all(digests)
+
+            mock_cas_helper.fetch_all = _slow_fetch_all
+            meter = create_dummy_meter()
+            filesystem = LocalHardlinkFilesystem(filesystem_root, meter)
+            filesystem.init()
+            builder = SharedTopLevelCachedDirectoryBuilder(
+                cache_root, mock_cas_helper, filesystem, meter, streaming=True
+            )
+            builder.init()
+            builder.build(input_root_digest, input_root_directory, local_root)
+            _assert_directory(input_root_data, local_root)
+            assert overlapped == [True]
+
+
+class TestIncrementalBuild:
+    def _create_builder(self, root: str, mock_cas_helper, meter):
+        filesystem = LocalHardlinkFilesystem(
+            os.path.join(root, "files"), meter
+        )
+        filesystem.init()
+        builder = SharedTopLevelCachedDirectoryBuilder(
+            os.path.join(root, "dirs"),
+            mock_cas_helper,
+            filesystem,
+            meter,
+            incremental=True,
+        )
+        builder.init()
+        return builder
+
+    def _build(self, builder, mock_cas_helper, data, local_root):
+        digest = mock_cas_helper.append_directory(data)
+        builder.build(
+            digest, mock_cas_helper.get_directory_by_digest(digest), local_root
+        )
+        _assert_directory(
+            data, local_root, skip_cache=["bazel-out", "external"]
+        )
+
+    def test_only_changes_applied(self, mock_cas_helper):
+        first = {
+            "same": b"same",
+            "changed": b"old",
+            "removed": b"removed",
+            "lib": {"a": b"a"},
+            "tool": {"t": b"t"},
+            "external": {"repo": {"BUILD": b"repo"}, "file": b"external"},
+            "bazel-out": {"k8": {"in": b"in"}},
+        }
+        second = {
+            "same": b"same",
+            "changed": b"new",
+            "added": b"added",
+            "lib": {"a": b"a"},
+            "tool": {"t": b"t2"},
+            "external": {"repo": {"BUILD": b"repo"}, "file2": b"external"},
+            "bazel-out": {"k8": {"in": b"in"}},
+        }
+        with (
+            tempfile.TemporaryDirectory() as root,
+            tempfile.TemporaryDirectory() as local_root,
+        ):
+            meter = _CountingMeter()
+            builder = self._create_builder(root, mock_cas_helper, meter)
+            self._build(builder, mock_cas_helper, first, local_root)
+            same_ino = os.stat(os.path.join(local_root, "same")).st_ino
+            lib_link = os.readlink(os.path.join(local_root, "lib"))
+            repo_link = os.readlink(
+                os.path.join(local_root, "external", "repo")
+            )
+            self._build(builder, mock_cas_helper, second, local_root)
+            assert meter.counts["build_incremental"] == 1
+            # "same" and "external/repo".
+            assert os.stat(os.path.join(local_root, "same")).st_ino == same_ino
+            assert os.readlink(os.path.join(local_root, "lib")) == lib_link
+            assert (
+                os.readlink(os.path.join(local_root, "external", "repo"))
+                == repo_link
+            )
+            assert meter.counts["build_incremental_kept_files"] == 1
+
+    def test_action_writes_cleaned(self, mock_cas_helper):
+        data = {
+            "src": b"src",
+            "lib": {"a": b"a"},
+            "external": {"repo": {"BUILD": b"repo"}},
+            "bazel-out": {"k8": {"in": b"in"}},
+        }
+        with (
+            tempfile.TemporaryDirectory() as root,
+            tempfile.TemporaryDirectory() as local_root,
+        ):
+            builder = self._create_builder(
+                root, mock_cas_helper, create_dummy_meter()
+            )
+            self._build(builder, mock_cas_helper, data, local_root)
+            # what an action may leave behind.
+            with open(os.path.join(local_root, "out.txt"), "wb") as f:
+                f.write(b"out")
+            os.makedirs(os.path.join(local_root, "outdir", "sub"))
+            with open(
+                os.path.join(local_root, "outdir", "sub", "o"), "wb"
+            ) as f:
+                f.write(b"o")
+            with open(
+                os.path.join(local_root, "bazel-out", "k8", "out"), "wb"
+            ) as f:
+                f.write(b"out")
+            with open(os.path.join(local_root, "external", "new"), "wb") as f:
+                f.write(b"new")
+            src = os.path.join(local_root, "src")
+            os.unlink(src)
+            with open(src, "wb") as f:
+                f.write(b"src")
+            os.unlink(os.path.join(local_root, "lib"))
+            os.makedirs(os.path.join(local_root, "lib"))
+            self._build(builder, mock_cas_helper, data, local_root)
+            assert os.stat(src).st_nlink > 1
+
+    def test_foreign_hardlink_replaced(self, mock_cas_helper):
+        data = {"src": b"src", "lib": {"a": b"a"}}
+        with (
+            tempfile.TemporaryDirectory() as root,
+            tempfile.TemporaryDirectory() as local_root,
+        ):
+            builder = self._create_builder(
+                root, mock_cas_helper, create_dummy_meter()
+            )
+            self._build(builder, mock_cas_helper, data, local_root)
+            # read-only, same size and linked twice, but not the cached one.
+            src = os.path.join(local_root, "src")
+            foreign = os.path.join(root, "foreign")
+            with open(foreign, "wb") as f:
+                f.write(b"bad")
+            set_read_only(foreign)
+            os.unlink(src)
+            os.link(foreign, src)
+            self._build(builder, mock_cas_helper, data, local_root)
+            assert not os.path.samefile(src, foreign)
+
+    def test_failed_build_starts_over(self, mock_cas_helper):
+        data = {"src": b"src", "lib": {"a": b"a"}}
+        with (
+            tempfile.TemporaryDirectory() as root,
+            tempfile.TemporaryDirectory() as local_root,
+        ):
+            meter = _CountingMeter()
+            builder = self._create_builder(root, mock_cas_helper, meter)
+            self._build(builder, mock_cas_helper, data, local_root)
+            missing = Directory()
+            missing.directories.add(
+                name="missing", digest={"hash": "0" * 64, "size_bytes": 3}
+            )
+            # the mock CAS raises KeyError for missing blobs.
+            with pytest.raises(KeyError):
+                builder.build(
+                    mock_cas_helper.append_digest_data(
+                        missing.SerializeToString()
+                    ),
+                    missing,
+                    local_root,
+                )
+            self._build(builder, mock_cas_helper, data, local_root)
+            assert "build_incremental" not in meter.counts
+
+
+class TestManifest:
+    _input_root_data = {
+        "file": b"file",
+        "dir_1": {"file_1": b"a" * 10, "dir_1_1": {"file_1_1": b"b"}},
+        "dir_2": {"file_2": b"c" * 20},
+    }
+
+    def _restart(self, root: str, mock_cas_helper, meter, **kwargs):
+        filesystem = LocalHardlinkFilesystem(
+            os.path.join(root, "files"), meter
+        )
+        filesystem.init()
+        builder = SharedTopLevelCachedDirectoryBuilder(
+            os.path.join(root, "dirs"),
+            mock_cas_helper,
+            filesystem,
+            meter,
+            manifest_root=os.path.join(root, "manifests"),
+            **kwargs,
+        )
+        builder.init()
+        return builder
+
+    def _build(self, builder, mock_cas_helper, local_root):
+        digest = mock_cas_helper.append_directory(self._input_root_data)
+        builder.build(
+            digest, mock_cas_helper.get_directory_by_digest(digest), local_root
+        )
+        _assert_directory(self._input_root_data, local_root)
+
+    def test_restart_from_manifest(self, mock_cas_helper):
+        with (
+            tempfile.TemporaryDirectory() as root,
+            tempfile.TemporaryDirectory() as local_root,
+        ):
+            builder = self._restart(root, mock_cas_helper, _CountingMeter())
+            self._build(builder, mock_cas_helper, local_root)
+            cached = sorted(builder._cached_dir)
+            size_bytes = builder.current_size_bytes
+            assert sorted(os.listdir(os.path.join(root, "manifests"))) == [
+                f"{name}.json" for name in cached
+            ]
+
+            meter = _CountingMeter()
+            builder = self._restart(root, mock_cas_helper, meter)
+            # verified from metadata, nothing hashed.
+            assert meter.counts["verify_cached_dir_manifest"] == 2
+            assert "verify_cached_dir_hashed_files" not in meter.counts
+            assert sorted(builder._cached_dir) == cached
+            assert builder.current_size_bytes == size_bytes
+            self._build(builder, mock_cas_helper, local_root)
+            assert "remove_cached_dir" not in meter.counts
+
+    def test_manifest_written_without_lock(self, mock_cas_helper):
+        with (
+            tempfile.TemporaryDirectory() as root,
+            tempfile.TemporaryDirectory() as local_root,
+        ):
+            builder = self._restart(root, mock_cas_helper, _CountingMeter())
+            write_manifest = builder._write_manifest
+            lock_free = []
+
+            def _write_manifest(directory, path):
+                # other threads can admit while the manifest is written.
+                def _try_lock():
+                    locked = builder._download_lock.acquire(timeout=5)
+                    if locked:
+                        builder._download_lock.release()
+                    lock_free.append(locked)
+
+                t = threading.Thread(target=_try_lock)
+                t.start()
+                t.join()
+                write_manifest(directory, path)
+
+            builder._write_manifest = _write_manifest
+            self._build(builder, mock_cas_helper, local_root)
+            assert lock_free == [True, True]
+            assert sorted(os.listdir(os.path.join(root, "manifests"))) == [
+                f"{name}.json" for name in sorted(builder._cached_dir)
+            ]
+
+    def test_missing_manifest(self, mock_cas_helper):
+        with (
+            tempfile.TemporaryDirectory() as root,
+            tempfile.TemporaryDirectory() as local_root,
+        ):
+            builder = self._restart(root, mock_cas_helper, _CountingMeter())
+            self._build(builder, mock_cas_helper, local_root)
+            manifest_root = os.path.join(root, "manifests")
+            for name in os.listdir(manifest_root):
+                os.unlink(os.path.join(manifest_root, name))
+            open(os.path.join(manifest_root, "orphan.json"), "w").close()
+
+            meter = _CountingMeter()
+            builder = self._restart(root, mock_cas_helper, meter)
+            # dir_1 and dir_2 verified again, and their manifests written.
+            assert meter.counts["verify_cached_dir_reused_files"] == 3
+            assert len(builder._cached_dir) == 2
+            assert sorted(os.listdir(manifest_root)) == [
+                f"{name}.json" for name in sorted(builder._cached_dir)
+            ]
+
+            meter = _CountingMeter()
+            self._restart(root, mock_cas_helper, meter)
+            assert meter.counts["verify_cached_dir_manifest"] == 2
+
+    def test_changed_file(self, mock_cas_helper):
+        with (
+            tempfile.TemporaryDirectory() as root,
+            tempfile.TemporaryDirectory() as local_root,
+        ):
+            builder = self._restart(root, mock_cas_helper, _CountingMeter())
+            self._build(builder, mock_cas_helper, local_root)
+            cache_dir_root = builder.cache_dir_root
+            # same size and mode, only the content and mtime change.
+            for dir_, _, filenames in os.walk(cache_dir_root):
+                if "file_2" in filenames:
+                    p = os.path.join(dir_, "file_2")
+                    origin_mode = os.stat(p).st_mode
+                    os.chmod(p, origin_mode | stat.S_IWUSR)
+                    with open(p, "wb") as f:
+                        f.write(b"d" * 20)
+                    os.chmod(p, origin_mode)
+
+            meter = _CountingMeter()
+            builder = self._restart(root, mock_cas_helper, meter)
+            assert meter.counts["verify_cached_dir_manifest"] == 1
+            assert meter.counts["verify_cached_dir_hashed_files"] == 1
+            assert meter.counts["remove_cached_dir"] == 1
+            assert len(builder._cached_dir) == 1
+            assert len(os.listdir(os.path.join(root, "manifests"))) == 1
+            self._build(builder, mock_cas_helper, local_root)
+
+    @pytest.mark.parametrize("copy_file", [False, True])
+    def test_reuse_file_cache_hashes(self, mock_cas_helper, copy_file):
+        with (
+            tempfile.TemporaryDirectory() as root,
+            tempfile.TemporaryDirectory() as local_root,
+        ):
+            builder = self._restart(
+                root, mock_cas_helper, _CountingMeter(), copy_file=copy_file
+            )
+            self._build(builder, mock_cas_helper, local_root)
+            meter = _CountingMeter()
+            builder = self._restart(
+                root,
+                mock_cas_helper,
+                meter,
+                copy_file=copy_file,
+                verify_level="full",
+            )
+            # copies are other inodes.
+            reused = 0 if copy_file else 3
+            assert meter.counts["verify_cached_dir_reused_files"] == reused
+            assert meter.counts["verify_cached_dir_hashed_files"] == 3 - reused
+            assert len(builder._cached_dir) == 2
+
+    def _overwrite_file_2(self, cache_dir_root: str) -> None:
+        """Change the content of file_2, keeping its size and metadata."""
+        for dir_, _, filenames in os.walk(cache_dir_root):
+            if "file_2" in filenames:
+                p = os.path.join(dir_, "file_2")
+                file_stat = os.stat(p)
+                os.chmod(p, file_stat.st_mode | stat.S_IWUSR)
+                with open(p, "wb") as f:
+                    f.write(b"d" * 20)
+                os.chmod(p, file_stat.st_mode)
+                os.utime(p, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns))
+
+    @pytest.mark.parametrize(
+        "level,hashed_files,detected",
+        [
+            ("none", 0, False),
+            ("metadata", 0, False),
+            ("sampled", 1, True),
+            ("full", 1, True),
+        ],
+    )
+    def test_verify_level(
+        self, mock_cas_helper, level, hashed_files, detected
+    ):
+        with (
+            tempfile.TemporaryDirectory() as root,
+            tempfile.TemporaryDirectory() as local_root,
+        ):
+            builder = self._restart(root, mock_cas_helper, _CountingMeter())
+            self._build(builder, mock_cas_helper, local_root)
+            self._overwrite_file_2(builder.cache_dir_root)
+
+            meter = _CountingMeter()
+            builder = self._restart(
+                root,
+                mock_cas_helper,
+                meter,
+                verify_level=level,
+                verify_sample_ratio=1.0,
+            )
+            # the file cache hashed the inodes of other files.
+            assert (
+                meter.counts.get("verify_cached_dir_hashed_files", 0)
+                == hashed_files
+            )
+            assert len(builder._cached_dir) == (1 if detected else 2)
+
+    def test_scrub(self, mock_cas_helper):
+        with (
+            tempfile.TemporaryDirectory() as root,
+            tempfile.TemporaryDirectory() as local_root,
+        ):
+            builder = self._restart(root, mock_cas_helper, _CountingMeter())
+            self._build(builder, mock_cas_helper, local_root)
+            size_bytes = builder.current_size_bytes
+            self._overwrite_file_2(builder.cache_dir_root)
+            meter = _CountingMeter()
+            builder = self._restart(root, mock_cas_helper, meter)
+            # one directory per round.
+            builder._scrub(1)
+            builder._scrub(1)
+            assert meter.counts["scrub_corrupted_dir"] == 1
+            assert len(builder._cached_dir) == 1
+            assert builder.current_size_bytes == size_bytes - 20
+            self._build(builder, mock_cas_helper, local_root)
+
+
+class TestAdaptiveGranularity:
+    def _create_builder(self, root: str, mock_cas_helper, **kwargs):
+        meter = create_dummy_meter()
+        filesystem = LocalHardlinkFilesystem(
+            os.path.join(root, "files"), meter
+        )
+        filesystem.init()
+        builder = SharedTopLevelCachedDirectoryBuilder(
+            os.path.join(root, "dirs"),
+            mock_cas_helper,
+            filesystem,
+            meter,
+            adaptive=True,
+            **kwargs,
+        )
+        builder.init()
+        return builder
+
+    def _build(self, builder, mock_cas_helper, data, local_root):
+        digest = mock_cas_helper.append_directory(data)
+        builder.build(
+            digest, mock_cas_helper.get_directory_by_digest(digest), local_root
+        )
+        _assert_directory(data, local_root, skip_cache=data.keys())
+
+    @pytest.mark.parametrize("streaming", [False, True])
+    def test_units_at_any_depth(self, mock_cas_helper, streaming):
+        data = {
+            "a": {
+                "b": {"big_1": b"1" * 300},
+                "c": {"d": {"big_2": b"2" * 300}},
+                "small": {"f": b"f"},
+            },
+            "tiny": {"x": b"x"},
+            "file": b"file",
+        }
+        with (
+            tempfile.TemporaryDirectory() as root,
+            tempfile.TemporaryDirectory() as local_root,
+        ):
+            builder = self._create_builder(
+                root,
+                mock_cas_helper,
+                streaming=streaming,
+                min_unit_bytes=250,
+                min_unit_files=0,
+                min_unit_seen=0,
+                max_unit_bytes=500,
+            )
+            self._build(builder, mock_cas_helper, data, local_root)
+            links = []
+            for dir_, dirnames, _ in os.walk(local_root):
+                for n in dirnames:
+                    p = os.path.join(dir_, n)
+                    if is_dir_link(p):
+                        links.append(os.path.relpath(p, local_root))
+            # "a" is too large, its large parts are cached, the rest is
+            # built in place.
+            assert sorted(links) == [
+                os.path.join("a", "b"),
+                os.path.join("a", "c"),
+            ]
+            assert len(builder._cached_dir) == 2
+
+            # rebuilt without walking into the cached directories. "a" is
+            # small enough to be cached as a whole now.
+            del data["a"]["b"]
+            self._build(builder, mock_cas_helper, data, local_root)
+            assert is_dir_link(os.path.join(local_root, "a"))
+            assert len(builder._cached_dir) == 3
+            for name_in_cache in builder._cached_dir:
+                assert os.listdir(
+                    os.path.join(builder.cache_dir_root, name_in_cache)
+                )
+
+    def test_cached_when_seen_often(self, mock_cas_helper):
+        data = {"lib": {"f": b"f"}, "src": {"g": b"g"}}
+        with (
+            tempfile.TemporaryDirectory() as root,
+            tempfile.TemporaryDirectory() as local_root,
+        ):
+            builder = self._create_builder(
+                root,
+                mock_cas_helper,
+                min_unit_bytes=0,
+                min_unit_files=0,
+                min_unit_seen=2,
+            )
+            digest = mock_cas_helper.append_directory(data)
+            directory = mock_cas_helper.get_directory_by_digest(digest)
+            # listing inputs doesn't count as a use.
+            builder.inputs(digest, directory)
+            for i in range(2):
+                target = os.path.join(local_root, str(i))
+                self._build(builder, mock_cas_helper, data, target)
+            assert not is_dir_link(os.path.join(local_root, "0", "lib"))
+            assert is_dir_link(os.path.join(local_root, "1", "lib"))
+            files, dirs = builder.inputs(digest, directory)
+            assert len(dirs) == 2
+            assert not files
+
+
+class TestTrash:
+    @pytest.mark.parametrize("background", [True, False])
+    def test_evict_into_trash(self, mock_cas_helper, background):
+        with (
+            tempfile.TemporaryDirectory() as filesystem_root,
+            tempfile.TemporaryDirectory() as local_root,
+            tempfile.TemporaryDirectory() as cache_root,
+            tempfile.TemporaryDirectory() as trash_root,
+        ):
+            input_list = []
+            for i in range(4):
+                digest = mock_cas_helper.append_directory(
+                    {f"dir_{i}": {"file": bytes([i]) * 20}}
+                )
+                dir_ = mock_cas_helper.get_directory_by_digest(digest)
+                input_list.append((digest, dir_))
+            meter = _CountingMeter()
+            filesystem = LocalHardlinkFilesystem(filesystem_root, meter)
+            filesystem.init()
+            builder = SharedTopLevelCachedDirectoryBuilder(
+                cache_root,
+                mock_cas_helper,
+                filesystem,
+                meter,
+                copy_file=True,
+                max_cache_size_bytes=40,
+                trash_root=trash_root,
+            )
+            builder.init()
+            if not background:
+                # evicted directories are only removed when space is needed.
+                builder._trash.stop()
+            reclaim = builder._trash.reclaim
+            lock_free = []
+
+            def _reclaim(size_bytes):
+                # other threads can admit while the trash is removed.
+                def _try_lock():
+                    locked = builder._download_lock.acquire(timeout=5)
+                    if locked:
+                        builder._download_lock.release()
+                    lock_free.append(locked)
+
+                t = threading.Thread(target=_try_lock)
+                t.start()
+                t.join()
+                reclaim(size_bytes)
+
+            builder._trash.reclaim = _reclaim
+            for i in [0, 1, 2, 3, 0, 2]:
+                digest, dir_ = input_list[i]
+                output_dir = os.path.join(local_root, "bazel-out")
+                os.makedirs(os.path.join(output_dir, "out"))
+                builder.build(digest, dir_, local_root)
+                # removed with the rest of the previous build tree.
+                assert not os.path.exists(output_dir)
+                total_size_bytes = 0
+                for dir_, dirnames, filenames in os.walk(cache_root):
+                    for n in filenames:
+                        p = os.path.join(dir_, n)
+                        total_size_bytes += os.path.getsize(p)
+                assert total_size_bytes == builder.current_size_bytes
+            assert meter.counts["evict_cached_dir"] == 4
+            if not background:
+                # the last evicted directory waits for the next admission.
+                assert meter.counts["trash_reclaim"] == 3
+                assert lock_free == [True] * 3
+                assert builder._trash.size_bytes == 20
+                assert len(os.listdir(trash_root)) == 1
+            builder._trash.reclaim(builder._trash.size_bytes)
+            builder.close()
+            assert os.listdir(trash_root) == []
+
+    def test_init_after_close(self, mock_cas_helper):
+        with (
+            tempfile.TemporaryDirectory() as filesystem_root,
+            tempfile.TemporaryDirectory() as local_root,
+            tempfile.TemporaryDirectory() as cache_root,
+            tempfile.TemporaryDirectory() as trash_root,
+        ):
+            data = {"dir_0": {"file": b"a" * 20}}
+            digest = mock_cas_helper.append_directory(data)
+            dir_ = mock_cas_helper.get_directory_by_digest(digest)
+            meter = _CountingMeter()
+            filesystem = LocalHardlinkFilesystem(filesystem_root, meter)
+            filesystem.init()
+            builder = SharedTopLevelCachedDirectoryBuilder(
+                cache_root,
+                mock_cas_helper,
+                filesystem,
+                meter,
+                trash_root=trash_root,
+                scrub_interval_seconds=60,
+            )
+            for _ in range(2):
+                builder.init()
+                assert builder._trash.is_alive()
+                assert builder._scrubber.is_alive()
+                builder.build(digest, dir_, local_root)
+                _assert_directory(data, local_root)
+                builder.close()
+                assert not builder._trash.is_alive()
+                assert not builder._scrubber.is_alive()
+            filesystem.close()
+
+
+class TestPins:
+    def test_pinned_not_evicted(self, mock_cas_helper):
+        with (
+            tempfile.TemporaryDirectory() as filesystem_root,
+            tempfile.TemporaryDirectory() as local_root,
+            tempfile.TemporaryDirectory() as cache_root,
+        ):
+            data_list = [
+                {f"dir_{i}": {"file": bytes([i]) * 20}} for i in range(4)
+            ]
+            input_list = []
+            for data in data_list:
+                digest = mock_cas_helper.append_directory(data)
+                dir_ = mock_cas_helper.get_directory_by_digest(digest)
+                input_list.append((digest, dir_))
+            meter = _CountingMeter()
+            filesystem = LocalHardlinkFilesystem(filesystem_root, meter)
+            filesystem.init()
+            builder = SharedTopLevelCachedDirectoryBuilder(
+                cache_root,
+                mock_cas_helper,
+                filesystem,
+                meter,
+                copy_file=True,
+                max_cache_size_bytes=40,
+            )
+            builder.init()
+            local_a = os.path.join(local_root, "a")
+            local_b = os.path.join(local_root, "b")
+            builder.build(*input_list[0], local_a, caller="a")
+            builder.build(*input_list[1], local_b, caller="b")
+            # dir_0 is in use by a, dir_1 not anymore.
+            builder.build(*input_list[2], local_b, caller="b")
+            assert meter.counts["evict_cached_dir"] == 1
+            assert meter.counts["evict_skipped_pinned_dir"] == 1
+            assert is_dir_link(os.path.join(local_a, "dir_0"))
+            # still linked to the cache.
+            _assert_directory(data_list[0], local_a)
+            _assert_directory(data_list[2], local_b)
+            builder.close()
+
+    def test_saturated(self, mock_cas_helper):
+        with (
+            tempfile.TemporaryDirectory() as filesystem_root,
+            tempfile.TemporaryDirectory() as local_root,
+            tempfile.TemporaryDirectory() as cache_root,
+        ):
+            data_a = {"dir_0": {"file": b"a" * 30}}
+            data_b = {"dir_1": {"file": b"b" * 20}}
+            digest_a = mock_cas_helper.append_directory(data_a)
+            dir_a = mock_cas_helper.get_directory_by_digest(digest_a)
+            digest_b = mock_cas_helper.append_directory(data_b)
+            dir_b = mock_cas_helper.get_directory_by_digest(digest_b)
+            meter = _CountingMeter()
+            filesystem = LocalHardlinkFilesystem(filesystem_root, meter)
+            filesystem.init()
+            builder = SharedTopLevelCachedDirectoryBuilder(
+                cache_root,
+                mock_cas_helper,
+                filesystem,
+                meter,
+                copy_file=True,
+                max_cache_size_bytes=40,
+            )
+            builder.init()
+            local_a = os.path.join(local_root, "a")
+            local_b = os.path.join(local_root, "b")
+            builder.build(digest_a, dir_a, local_a, caller="a")
+            # no room left but what a uses, built in place.
+            builder.build(digest_b, dir_b, local_b, caller="b")
+            assert meter.counts["dir_cache_saturated"] == 1
+            assert meter.counts["build_uncached_dir"] == 1
+            assert "evict_cached_dir" not in meter.counts
+            assert not is_dir_link(os.path.join(local_b, "dir_1"))
+            _assert_directory(data_b, local_b, skip_cache=["dir_1"])
+            _assert_directory(data_a, local_a)
+            assert builder.current_size_bytes == 30
+            # cached once a is done.
+            builder.release(caller="a")
+            builder.build(digest_b, dir_b, local_b, caller="b")
+            assert meter.counts["evict_cached_dir"] == 1
+            assert is_dir_link(os.path.join(local_b, "dir_1"))
+            _assert_directory(data_b, local_b)
+            assert builder.current_size_bytes == 20
+            builder.close()
+
+
+def _deep_tree(depth: int, prefix: str = "") -> dict:
+    tree: dict = {"file": f"{prefix}{depth}".encode()}
+    if depth > 0:
+        tree["dir"] = _deep_tree(depth - 1, prefix)
+    return tree
+
+
+class TestTaskGraphBuild:
+    def _build(self, mock_cas_helper, data, concurrency) -> float:
+        with (
+            tempfile.TemporaryDirectory() as filesystem_root,
+            tempfile.TemporaryDirectory() as local_root,
+            tempfile.TemporaryDirectory() as cache_root,
+        ):
+            digest = mock_cas_helper.append_directory(data)
+            directory = mock_cas_helper.get_directory_by_digest(digest)
+            meter = create_dummy_meter()
+            filesystem = LocalHardlinkFilesystem(filesystem_root, meter)
+            filesystem.init()
+            builder = SharedTopLevelCachedDirectoryBuilder(
+                cache_root,
+                mock_cas_helper,
+                filesystem,
+                meter,
+                concurrency=concurrency,
+            )
+            builder.init()
+            # resolved first, only building is measured.
+            builder._directory_data_cache.fetch_directory_data(
+                digest, directory
+            )
+            mock_cas_helper.clear_call_history()
+            start_at = time.perf_counter()
+            builder.build(digest, directory, local_root)
+            seconds = time.perf_counter() - start_at
+            _assert_directory(data, local_root)
+            builder.close()
+            return seconds
+
+    def test_deeper_than_threads(self, mock_cas_helper):
+        data = {f"dir_{i}": _deep_tree(40, f"{i}_") for i in range(3)}
+        self._build(mock_cas_helper, data, 2)
+
+    @pytest.mark.only_in_full_test
+    def test_build_benchmark(self, mock_cas_helper):
+        for name, data in [
+            ("deep", {f"dir_{i}": _deep_tree(200, f"{i}_") for i in range(8)}),
+            ("wide", {"dir": _wide_tree(5, 6)}),
+        ]:
+            seconds = self._build(mock_cas_helper, data, 4)
+            requests = len(_fetch_calls(mock_cas_helper))
+            print(f"{name}: {seconds:.2f}s, {requests} download requests")
@@ -0,0 +1,135 @@
+import gc
+import hashlib
+import tracemalloc
+
+import pytest
+from build.bazel.remote.execution.v2.remote_execution_pb2 import Digest
+from build.bazel.remote.execution.v2.remote_execution_pb2 import FileNode
+
+from bbworker.directorydata import DirectoryData
+from bbworker.directorydata import FileData
+from bbworker.directorydata import intern_digest
+
+
+def _digest(data: bytes) -> Digest:
+    return Digest(hash=hashlib.sha256(data).hexdigest(), size_bytes=len(data))
+
+
+def test_intern_digest():
+    digest = _digest(b"a")
+    interned = intern_digest(digest)
+    assert intern_digest(Digest(hash=digest.hash, size_bytes=1)) is interned
+    assert intern_digest(_digest(b"b")) is not interned
+    assert isinstance(interned._hash, bytes) and len(interned._hash) == 32
+    assert interned.to_digest() == digest
+    assert interned.key == f"{digest.hash}_1"
+
+
+@pytest.mark.parametrize(
+    "hash_", ["a", "A" * 64, "z" * 64, hashlib.sha256(b"").hexdigest()[:-1]]
+)
+def test_intern_other_hash(hash_):
+    interned = intern_digest(Digest(hash=hash_, size_bytes=3))
+    assert interned.hash == hash_
+    assert interned.to_digest() == Digest(hash=hash_, size_bytes=3)
+
+
+def test_file_data():
+    digest = _digest(b"data")
+    fd = FileData(digest, True)
+    assert fd.digest == digest
+    assert fd.size_bytes == 4
+    assert fd.name_in_cache == f"{digest.hash}_4"
+    assert fd.to_file_node("a") == FileNode(
+        name="a", digest=digest, is_executable=True
+    )
+    assert FileData(digest, False)._digest is fd._digest
+
+
+def test_directory_data():
+    a = FileData(_digest(b"a"), False)
+    b = FileData(_digest(b"bb"), True)
+    sub = DirectoryData(_digest(b"sub"), {"b": b}, {})
+    source = _digest(b"source")
+    dir_data = DirectoryData(
+        _digest(b"root"), {"a": a, "b": b}, {"sub": sub}, source
+    )
+    assert dir_data.checksum_digest == _digest(b"root")
+    assert dir_data.source_digest == source
+    assert sub.source_digest is None
+    assert dir_data.name_in_cache == f"{_digest(b'root').hash}_4"
+    assert dir_data.file_count == 2
+    assert dir_data.total_file_count == 3
+    assert list(dir_data.files()) == [("a", a), ("b", b)]
+    assert list(dir_data.directories()) == [("sub", sub)]
+    assert dir_data.copy_size_bytes == 5
+    file_nodes = dir_data.file_nodes()
+    assert file_nodes == [a.to_file_node("a"), b.to_file_node("b")]
+    file_nodes.clear()
+    # cached, and callers get their own list.
+    assert dir_data.file_nodes()[0] is dir_data.file_nodes()[0]
+    assert len(dir_data.file_nodes()) == 2
+
+
+class _LegacyFileData:
+    def __init__(self, digest: Digest, is_executable: bool):
+        self._digest = digest
+        self._is_executable = is_executable
+        self._name_in_cache = f"{self._digest.hash}_{self._digest.size_bytes}"
+
+
+class _LegacyDirectoryData:
+    def __init__(self, checksum_digest, files, directories):
+        self._checksum_digest = checksum_digest
+        self._name_in_cache = (
+            f"{self._checksum_digest.hash}_{self._checksum_digest.size_bytes}"
+        )
+        self._files = {}
+        self._files.update(files)
+        self._directories = {}
+        self._directories.update(directories)
+        self._copy_size_bytes = 0
+
+
+def _create_tree(file_data_class, directory_data_class, tree: int):
+    """A tree of 100 directories with 50 files each. Trees share all but
+    one file, like input roots of actions of the same target.
+    """
+    subdirs = {}
+    for d in range(100):
+        files = {}
+        for f in range(50):
+            data = f"{d}/{f}".encode()
+            if d == 0 and f == 0:
+                data += str(tree).encode()
+            files[f"file_{f}.cc"] = file_data_class(
+                Digest(
+                    hash=hashlib.sha256(data).hexdigest(),
+                    size_bytes=len(data),
+                ),
+                False,
+            )
+        subdirs[f"dir_{d}"] = directory_data_class(
+            _digest(f"{tree}/{d}".encode()), files, {}
+        )
+    return directory_data_class(_digest(str(tree).encode()), {}, subdirs)
+
+
+@pytest.mark.only_in_full_test
+def test_benchmark():
+    tree_count = 20
+    for name, file_data_class, directory_data_class in [
+        ("legacy", _LegacyFileData, _LegacyDirectoryData),
+        ("compact", FileData, DirectoryData),
+    ]:
+        gc.collect()
+        tracemalloc.start()
+        trees = [
+            _create_tree(file_data_class, directory_data_class, i)
+            for i in range(tree_count)
+        ]
+        gc.collect()
+        size_bytes, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{name}: {size_bytes // tree_count} bytes per cached tree")
+        del trees
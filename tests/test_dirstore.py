@@ -0,0 +1,97 @@
+import os.path
+import tempfile
+
+import pytest
+from build.bazel.remote.execution.v2.remote_execution_pb2 import Digest
+
+from bbworker.dirstore import DirectoryStore
+from bbworker.dirstore import DirectoryStoreError
+
+
+def _digest(i: int) -> Digest:
+    return Digest(hash=f"{i:064x}", size_bytes=i)
+
+
+def test_put_and_get():
+    with tempfile.TemporaryDirectory() as root:
+        store = DirectoryStore(root, 1024 * 1024)
+        store.open()
+        try:
+            assert store.get(_digest(1)) is None
+            assert store.put(_digest(1), b"one")
+            assert store.put(_digest(2), b"two", _digest(3))
+            assert store.get(_digest(1)) == (b"one", None)
+            assert store.get(_digest(2)) == (b"two", _digest(3))
+            # replaced.
+            assert store.put(_digest(1), b"one", _digest(4))
+            assert store.get(_digest(1)) == (b"one", _digest(4))
+        finally:
+            store.close()
+
+
+def test_reopen():
+    with tempfile.TemporaryDirectory() as root:
+        store = DirectoryStore(root, 1024 * 1024)
+        store.open()
+        store.put(_digest(1), b"one", _digest(2))
+        store.close()
+
+        store = DirectoryStore(root, 1024 * 1024)
+        store.open()
+        try:
+            assert store.get(_digest(1)) == (b"one", _digest(2))
+        finally:
+            store.close()
+
+        # another size starts over.
+        store = DirectoryStore(root, 2 * 1024 * 1024)
+        store.open()
+        try:
+            assert store.get(_digest(1)) is None
+        finally:
+            store.close()
+
+
+def test_used_by_one_process():
+    with tempfile.TemporaryDirectory() as root:
+        store = DirectoryStore(root, 1024 * 1024)
+        store.open()
+        try:
+            with pytest.raises(DirectoryStoreError):
+                DirectoryStore(root, 1024 * 1024).open()
+        finally:
+            store.close()
+
+
+def test_oldest_overwritten():
+    with tempfile.TemporaryDirectory() as root:
+        store = DirectoryStore(root, 4096)
+        store.open()
+        try:
+            assert not store.put(_digest(0), b"x" * 2048)
+            for i in range(100):
+                assert store.put(_digest(i), str(i).encode() * 20)
+            assert store.get(_digest(0)) is None
+            assert store.get(_digest(99)) == (b"99" * 20, None)
+            for i in range(100):
+                stored = store.get(_digest(i))
+                assert stored is None or stored.data == str(i).encode() * 20
+        finally:
+            store.close()
+
+
+def test_corrupted_record():
+    with tempfile.TemporaryDirectory() as root:
+        store = DirectoryStore(root, 1024 * 1024)
+        store.open()
+        store.put(_digest(1), b"one")
+        store.close()
+        with open(os.path.join(root, "data"), "r+b") as f:
+            data = f.read(64)
+            f.seek(data.index(b"one"))
+            f.write(b"two")
+        store.open()
+        try:
+            assert store.get(_digest(1)) is None
+        finally:
+            store.close()
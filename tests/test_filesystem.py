@@ -11,7 +11,7 @@ import uuid
 import pytest
 
 from bbworker.filesystem import LocalHardlinkFilesystem
-from bbworker.filesystem import MaxSizeReached
+from bbworker.metrics import MeterBase
 from bbworker.metrics import create_dummy_meter
 from bbworker.util import set_read_only
 from bbworker.util import unlink_readonly_file
@@ -21,6 +21,47 @@ class FakeIOError(Exception):
     pass
 
 
+class ChunkedBackend(object):
+    """Yield every blob in small blocks, like a ByteStream read."""
+
+    def __init__(self, mock_cas_helper, block_size: int, corrupt=None):
+        self._mock_cas_helper = mock_cas_helper
+        self._block_size = block_size
+        self._corrupt = corrupt
+
+    def fetch_all_block(self, digests):
+        for d, _, data in self._mock_cas_helper.fetch_all_block(digests):
+            if data == self._corrupt:
+                data = data[::-1]
+            for offset in range(0, len(data), self._block_size):
+                end = offset + self._block_size
+                yield d, offset, data[offset:end]
+
+
+class RecordingMeter(MeterBase):
+    def __init__(self):
+        self.records = {}
+        self.counts = {}
+
+    def record(self, name, value, **kargs):
+        self.records.setdefault(name, []).append(value)
+
+    def count(self, name, count=1, **kargs):
+        self.counts[name] = self.counts.get(name, 0) + count
+
+
+def _assert_fetched_uncached(file_list, filesystem_root, target_root):
+    for fnode, data in file_list:
+        p = os.path.join(target_root, fnode.name)
+        with open(p, "rb") as f:
+            assert f.read() == data
+        assert not os.stat(p).st_mode & stat.S_IWUSR
+        digest = fnode.digest
+        assert not os.path.exists(
+            os.path.join(filesystem_root, f"{digest.hash}_{digest.size_bytes}")
+        )
+
+
 class TestLocalHardlinkFilesystem(object):
     def test_verify_file(self, mock_cas_helper):
         with (
@@ -331,17 +372,23 @@ class TestLocalHardlinkFilesystem(object):
                 test_file_list.append(
                     (mock_cas_helper.append_file(name, data), data)
                 )
-            meter = create_dummy_meter()
+            meter = RecordingMeter()
             filesystem = LocalHardlinkFilesystem(
                 filesystem_root, meter, max_cache_size_bytes=30
             )
             filesystem.init()
-            with pytest.raises(MaxSizeReached):
-                filesystem.fetch_to(
-                    mock_cas_helper,
-                    [i[0] for i in test_file_list],
-                    target_root,
-                )
+            # downloaded into the target directory only.
+            filesystem.fetch_to(
+                mock_cas_helper,
+                [i[0] for i in test_file_list],
+                target_root,
+            )
+            _assert_fetched_uncached(
+                test_file_list, filesystem_root, target_root
+            )
+            assert meter.counts["file_cache_saturated"] == 1
+            assert meter.counts["fetch_uncached_file"] == 1
+            assert filesystem.current_size_bytes == 0
 
     def test_multiple_files_larger_than_max_cache_size(self, mock_cas_helper):
         with (
@@ -364,12 +411,14 @@ class TestLocalHardlinkFilesystem(object):
                 max_cache_size_bytes=249,
             )
             filesystem.init()
-            with pytest.raises(MaxSizeReached):
-                filesystem.fetch_to(
-                    mock_cas_helper,
-                    [i[0] for i in test_file_list],
-                    target_root,
-                )
+            filesystem.fetch_to(
+                mock_cas_helper,
+                [i[0] for i in test_file_list],
+                target_root,
+            )
+            _assert_fetched_uncached(
+                test_file_list, filesystem_root, target_root
+            )
 
     def test_multiple_files_with_same_content(self, mock_cas_helper):
         with (
@@ -656,12 +705,15 @@ class TestLocalHardlinkFilesystem(object):
             time.sleep(0.1)
 
             try:
-                with pytest.raises(MaxSizeReached):
-                    filesystem.fetch_to(
-                        mock_cas_helper,
-                        [i[0] for i in test_file_list[3:5]],
-                        target_root,
-                    )
+                # no room left by the pending files.
+                filesystem.fetch_to(
+                    mock_cas_helper,
+                    [i[0] for i in test_file_list[3:5]],
+                    target_root,
+                )
+                _assert_fetched_uncached(
+                    test_file_list[3:5], filesystem_root, target_root
+                )
             finally:
                 other_thread.join()
 
@@ -845,4 +897,343 @@ class TestLocalHardlinkFilesystem(object):
                 with open(path_in_cache, "rb") as f:
                     assert f.read() == data
 
+    def test_pipelined_download_in_blocks(self, mock_cas_helper):
+        with (
+            tempfile.TemporaryDirectory() as filesystem_root,
+            tempfile.TemporaryDirectory() as target_root,
+        ):
+            test_file_list = []
+            for name, data in [
+                ("file_1", b"x" * 1000),
+                ("file_2", b"y" * 10),
+                ("file_3", bytes(range(256)) * 7),
+            ]:
+                test_file_list.append(
+                    (mock_cas_helper.append_file(name, data), data)
+                )
+            meter = RecordingMeter()
+            filesystem = LocalHardlinkFilesystem(
+                filesystem_root,
+                meter,
+                hash_concurrency=1,
+                download_queue_size=2,
+            )
+            filesystem.init()
+            filesystem.fetch_to(
+                ChunkedBackend(mock_cas_helper, 7),
+                [i[0] for i in test_file_list],
+                target_root,
+            )
+            for fnode, data in test_file_list:
+                with open(os.path.join(target_root, fnode.name), "rb") as f:
+                    assert f.read() == data
+            for name in [
+                "download_receive_seconds",
+                "download_queue_wait_seconds",
+                "download_write_hash_seconds",
+            ]:
+                assert meter.records[name]
+
+    def test_pipelined_download_corrupted(self, mock_cas_helper):
+        with (
+            tempfile.TemporaryDirectory() as filesystem_root,
+            tempfile.TemporaryDirectory() as target_root,
+        ):
+            corrupted_data = b"abcdefghijklmn" * 10
+            test_file_list = []
+            for name, data in [
+                ("file_1", b"x" * 1000),
+                ("file_2", corrupted_data),
+                ("file_3", b"z" * 100),
+            ]:
+                test_file_list.append(
+                    (mock_cas_helper.append_file(name, data), data)
+                )
+            meter = create_dummy_meter()
+            filesystem = LocalHardlinkFilesystem(
+                filesystem_root, meter, download_queue_size=1
+            )
+            filesystem.init()
+            with pytest.raises(Exception):
+                filesystem.fetch_to(
+                    ChunkedBackend(mock_cas_helper, 3, corrupt=corrupted_data),
+                    [i[0] for i in test_file_list],
+                    target_root,
+                )
+            # no partial or temp file left.
+            assert not [
+                n for n in os.listdir(filesystem_root) if n.endswith(".tmp")
+            ]
+            assert filesystem.current_size_bytes == 0
+            filesystem.fetch_to(
+                mock_cas_helper, [i[0] for i in test_file_list], target_root
+            )
+            for fnode, data in test_file_list:
+                with open(os.path.join(target_root, fnode.name), "rb") as f:
+                    assert f.read() == data
+
+    def test_pipelined_download_concurrent_batches(self, mock_cas_helper):
+        class BarrierBackend(ChunkedBackend):
+            """Every batch waits for the other one after a few blocks."""
+
+            def __init__(self, *args):
+                super().__init__(*args)
+                self.barrier = threading.Barrier(2, timeout=10)
+
+            def fetch_all_block(self, digests):
+                blocks = super().fetch_all_block(digests)
+                for i, block in enumerate(blocks):
+                    if i == 4:
+                        self.barrier.wait()
+                    yield block
+
+        with (
+            tempfile.TemporaryDirectory() as filesystem_root,
+            tempfile.TemporaryDirectory() as target_root,
+        ):
+            test_file_list = []
+            for name, data in [("file_1", b"x" * 100), ("file_2", b"y" * 100)]:
+                test_file_list.append(
+                    (mock_cas_helper.append_file(name, data), data)
+                )
+            filesystem = LocalHardlinkFilesystem(
+                filesystem_root,
+                create_dummy_meter(),
+                download_batch_size_bytes=1,
+                hash_concurrency=1,
+                download_queue_size=1,
+            )
+            filesystem.init()
+            # the two batches are received at the same time although a
+            # single thread writes them.
+            filesystem.fetch_to(
+                BarrierBackend(mock_cas_helper, 10),
+                [i[0] for i in test_file_list],
+                target_root,
+            )
+            for fnode, data in test_file_list:
+                with open(os.path.join(target_root, fnode.name), "rb") as f:
+                    assert f.read() == data
+
     # TODO: disk IO error.
+
+
+class TestVerifyLevel:
+    def _restart(self, root, meter, level, **kwargs):
+        filesystem = LocalHardlinkFilesystem(
+            os.path.join(root, "files"),
+            meter,
+            verify_level=level,
+            fingerprint_path=os.path.join(root, "fingerprints"),
+            **kwargs,
+        )
+        filesystem.init()
+        return filesystem
+
+    def _fetch(self, root, mock_cas_helper):
+        """Cache two files and return the path of the first one."""
+        file_nodes = [
+            mock_cas_helper.append_file("file_1", b"a" * 10),
+            mock_cas_helper.append_file("file_2", b"b" * 20),
+        ]
+        filesystem = self._restart(root, create_dummy_meter(), "full")
+        target_root = os.path.join(root, "target")
+        os.makedirs(target_root)
+        filesystem.fetch_to(mock_cas_helper, file_nodes, target_root)
+        filesystem.close()
+        digest = file_nodes[0].digest
+        return os.path.join(
+            root, "files", f"{digest.hash}_{digest.size_bytes}"
+        )
+
+    @staticmethod
+    def _overwrite(path, keep_mtime):
+        file_stat = os.stat(path)
+        os.chmod(path, file_stat.st_mode | stat.S_IWUSR)
+        with open(path, "wb") as f:
+            f.write(b"c" * 10)
+        os.chmod(path, file_stat.st_mode)
+        if keep_mtime:
+            os.utime(path, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns))
+
+    @pytest.mark.parametrize(
+        "level,keep_mtime,detected",
+        [
+            ("none", False, False),
+            ("metadata", True, False),
+            ("metadata", False, True),
+            ("sampled", True, True),
+            ("full", True, True),
+        ],
+    )
+    def test_detect_changed_file(
+        self, mock_cas_helper, level, keep_mtime, detected
+    ):
+        with tempfile.TemporaryDirectory() as root:
+            path = self._fetch(root, mock_cas_helper)
+            self._overwrite(path, keep_mtime)
+            filesystem = self._restart(
+                root, create_dummy_meter(), level, verify_sample_ratio=1.0
+            )
+            assert os.path.exists(path) is not detected
+            assert len(filesystem._cached_files) == (1 if detected else 2)
+
+    def test_metadata_hashes_unknown_files(self, mock_cas_helper):
+        with tempfile.TemporaryDirectory() as root:
+            path = self._fetch(root, mock_cas_helper)
+            os.unlink(os.path.join(root, "fingerprints"))
+            self._overwrite(path, keep_mtime=True)
+            self._restart(root, create_dummy_meter(), "metadata")
+            assert not os.path.exists(path)
+
+    def test_scrub(self, mock_cas_helper):
+        with tempfile.TemporaryDirectory() as root:
+            path = self._fetch(root, mock_cas_helper)
+            filesystem = self._restart(root, create_dummy_meter(), "none")
+            self._overwrite(path, keep_mtime=True)
+            # one file per round.
+            filesystem._scrub(1)
+            filesystem._scrub(1)
+            assert not os.path.exists(path)
+            assert filesystem.current_size_bytes == 20
+            assert len(filesystem._cached_files) == 1
+
+    @pytest.mark.only_in_full_test
+    def test_benchmark(self, mock_cas_helper):
+        file_count = 2000
+        file_size = 64 * 1024
+        with tempfile.TemporaryDirectory() as root:
+            filesystem = self._restart(root, create_dummy_meter(), "full")
+            file_nodes = [
+                mock_cas_helper.append_file(f"file_{i}", os.urandom(file_size))
+                for i in range(file_count)
+            ]
+            target_root = os.path.join(root, "target")
+            os.makedirs(target_root)
+            filesystem.fetch_to(mock_cas_helper, file_nodes, target_root)
+            filesystem.close()
+            for level in ["none", "metadata", "sampled", "full"]:
+                start_at = time.time()
+                self._restart(root, create_dummy_meter(), level).close()
+                print(
+                    f"{level}: {time.time() - start_at:.3f}s for"
+                    f" {file_count * file_size // (1024 * 1024)} MiB"
+                )
+
+
+class TestFetchTree:
+    def test_fetch_trees_at_once(self, mock_cas_helper):
+        with (
+            tempfile.TemporaryDirectory() as filesystem_root,
+            tempfile.TemporaryDirectory() as target_root,
+        ):
+            data = {
+                "file": b"top",
+                "a": {"file": b"shared", "b": {"file": b"deep"}},
+                "c": {"file": b"shared", "other": b"other"},
+            }
+            first = mock_cas_helper.get_directory_data_by_digest(
+                mock_cas_helper.append_directory(data)
+            )
+            second = mock_cas_helper.get_directory_data_by_digest(
+                mock_cas_helper.append_directory({"x": {"file": b"top"}})
+            )
+            filesystem = LocalHardlinkFilesystem(
+                filesystem_root, create_dummy_meter()
+            )
+            filesystem.init()
+            mock_cas_helper.clear_call_history()
+            linked = []
+            futures = filesystem.fetch_tree(
+                mock_cas_helper,
+                [
+                    (first, os.path.join(target_root, "first")),
+                    (second, os.path.join(target_root, "second")),
+                ],
+                on_directory=linked.append,
+            )
+            for f in futures:
+                f.result(timeout=10)
+            # planned once, distinct files in one batch.
+            assert [len(list(c)) for c in mock_cas_helper.call_history] == [4]
+            with open(os.path.join(target_root, "first/a/b/file"), "rb") as f:
+                assert f.read() == b"deep"
+            with open(os.path.join(target_root, "second/x/file"), "rb") as f:
+                assert f.read() == b"top"
+            assert sorted(
+                os.path.relpath(p, target_root) for p in linked
+            ) == sorted(
+                [
+                    "first",
+                    os.path.join("first", "a"),
+                    os.path.join("first", "a", "b"),
+                    os.path.join("first", "c"),
+                    "second",
+                    os.path.join("second", "x"),
+                ]
+            )
+
+    def test_failed_download(self, mock_cas_helper):
+        with (
+            tempfile.TemporaryDirectory() as filesystem_root,
+            tempfile.TemporaryDirectory() as target_root,
+        ):
+            mock_cas_helper.set_data_exception(b"broken", FakeIOError())
+            good = mock_cas_helper.get_directory_data_by_digest(
+                mock_cas_helper.append_directory({"file": b"good"})
+            )
+            broken = mock_cas_helper.get_directory_data_by_digest(
+                mock_cas_helper.append_directory({"d": {"file": b"broken"}})
+            )
+            filesystem = LocalHardlinkFilesystem(
+                filesystem_root,
+                create_dummy_meter(),
+                # downloaded apart.
+                download_batch_size_bytes=1,
+            )
+            filesystem.init()
+            good_future, broken_future = filesystem.fetch_tree(
+                mock_cas_helper,
+                [
+                    (good, os.path.join(target_root, "good")),
+                    (broken, os.path.join(target_root, "broken")),
+                ],
+            )
+            good_future.result(timeout=10)
+            with pytest.raises(FakeIOError):
+                broken_future.result(timeout=10)
+
+    def test_saturated(self, mock_cas_helper):
+        with (
+            tempfile.TemporaryDirectory() as filesystem_root,
+            tempfile.TemporaryDirectory() as target_root,
+        ):
+            data = {
+                "small": b"s",
+                "d": {"large": b"x" * 20, "copy": b"x" * 20},
+            }
+            tree = mock_cas_helper.get_directory_data_by_digest(
+                mock_cas_helper.append_directory(data)
+            )
+            meter = RecordingMeter()
+            filesystem = LocalHardlinkFilesystem(
+                filesystem_root, meter, max_cache_size_bytes=10
+            )
+            filesystem.init()
+            (future,) = filesystem.fetch_tree(
+                mock_cas_helper, [(tree, target_root)]
+            )
+            future.result(timeout=10)
+            # the whole tree is downloaded into place, once per content.
+            assert meter.counts["file_cache_saturated"] == 1
+            assert meter.counts["fetch_uncached_file"] == 2
+            assert filesystem.current_size_bytes == 0
+            for path, content in [
+                ("small", b"s"),
+                ("d/large", b"x" * 20),
+                ("d/copy", b"x" * 20),
+            ]:
+                p = os.path.join(target_root, path)
+                with open(p, "rb") as f:
+                    assert f.read() == content
+                assert not os.stat(p).st_mode & stat.S_IWUSR
@@ -0,0 +1,113 @@
+import os
+import os.path
+import tempfile
+import time
+
+import pytest
+
+from bbworker.cacheinfo import FileCacheInfo
+from bbworker.linker import LINKED
+from bbworker.linker import MISMATCH
+from bbworker.linker import NOT_FOUND
+from bbworker.linker import LinkEngine
+from bbworker.linker import LinkJob
+from bbworker.lock import VariableLock
+from bbworker.util import link_file
+from bbworker.util import set_read_only
+from bbworker.util import unlink_readonly_file
+
+
+def _create_source(source_dir: str, name: str, data: bytes):
+    p = os.path.join(source_dir, name)
+    with open(p, "wb") as f:
+        f.write(data)
+    set_read_only(p)
+    return LinkJob(name, name, FileCacheInfo(os.stat(p)))
+
+
+def _legacy_link(source_dir, jobs, target_dir, file_lock):
+    """How files were linked before LinkEngine, for the benchmark."""
+    for job in jobs:
+        path_in_cache = os.path.join(source_dir, job.source_name)
+        with file_lock.lock(path_in_cache):
+            if os.path.exists(path_in_cache):
+                if job.expected.match(os.stat(path_in_cache)):
+                    target_path = os.path.join(target_dir, job.target_name)
+                    if os.path.exists(target_path):
+                        unlink_readonly_file(target_path)
+                    link_file(path_in_cache, target_path)
+
+
+class TestLinkEngine(object):
+    @pytest.mark.parametrize("copy_file", [False, True])
+    def test_link(self, copy_file):
+        with (
+            tempfile.TemporaryDirectory() as source_dir,
+            tempfile.TemporaryDirectory() as target_dir,
+        ):
+            jobs = [
+                _create_source(source_dir, f"file_{i}", b"x" * i)
+                for i in range(10)
+            ]
+            # existing targets are replaced.
+            with open(os.path.join(target_dir, "file_3"), "wb") as f:
+                f.write(b"old")
+            engine = LinkEngine(source_dir, concurrency=3, chunk_size=3)
+            results = engine.link(jobs, target_dir, copy_file=copy_file)
+            assert [r for r, _ in results] == [LINKED] * 10
+            for i in range(10):
+                with open(os.path.join(target_dir, f"file_{i}"), "rb") as f:
+                    assert f.read() == b"x" * i
+
+    def test_not_found_and_mismatch(self):
+        with (
+            tempfile.TemporaryDirectory() as source_dir,
+            tempfile.TemporaryDirectory() as target_dir,
+        ):
+            job = _create_source(source_dir, "file", b"data")
+            other = _create_source(source_dir, "other", b"other data")
+            jobs = [
+                job,
+                LinkJob("missing", "missing", job.expected),
+                LinkJob("file", "unknown", None),
+                LinkJob("other", "changed", job.expected),
+            ]
+            engine = LinkEngine(source_dir, concurrency=1)
+            results = engine.link(jobs, target_dir)
+            assert [r for r, _ in results] == [
+                LINKED,
+                NOT_FOUND,
+                MISMATCH,
+                MISMATCH,
+            ]
+            assert results[3][1].st_size == other.expected.st_size
+            assert sorted(os.listdir(target_dir)) == ["file"]
+
+    @pytest.mark.only_in_full_test
+    def test_benchmark(self):
+        file_count = 50000
+        with tempfile.TemporaryDirectory() as root:
+            source_dir = os.path.join(root, "cache")
+            os.makedirs(source_dir)
+            jobs = [
+                _create_source(source_dir, f"file_{i}", str(i).encode())
+                for i in range(file_count)
+            ]
+            timing = {}
+            for name in ["legacy", "engine"]:
+                # link twice so replacing existing targets is measured too.
+                for round_ in range(2):
+                    target_dir = os.path.join(root, name)
+                    os.makedirs(target_dir, exist_ok=True)
+                    start_at = time.time()
+                    if name == "legacy":
+                        _legacy_link(
+                            source_dir, jobs, target_dir, VariableLock()
+                        )
+                    else:
+                        results = LinkEngine(source_dir).link(jobs, target_dir)
+                        assert all(r == LINKED for r, _ in results)
+                    timing[(name, round_)] = time.time() - start_at
+                    assert len(os.listdir(target_dir)) == file_count
+            for (name, round_), seconds in sorted(timing.items()):
+                print(f"{name} round {round_}: {seconds:.3f}s")
@@ -0,0 +1,216 @@
+import glob
+import os
+import os.path
+import tempfile
+import threading
+import time
+
+from build.bazel.remote.execution.v2.remote_execution_pb2 import Command
+from build.bazel.remote.execution.v2.remote_execution_pb2 import (
+    RequestMetadata,
+)
+from remoteworker.remoteworker_pb2 import DesiredState
+
+from bbworker.directorybuilder import FileData
+from bbworker.directorybuilder import SharedTopLevelCachedDirectoryBuilder
+from bbworker.filesystem import LocalHardlinkFilesystem
+from bbworker.metrics import MeterBase
+from bbworker.prefetch import InputHistory
+from bbworker.prefetch import Prefetcher
+from bbworker.prefetch import action_key
+
+
+class RecordingMeter(MeterBase):
+    def __init__(self):
+        self.counts = {}
+
+    def count(self, name, count=1, **kargs):
+        self.counts[name] = self.counts.get(name, 0) + count
+
+
+def _wait_until(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline, "timeout"
+        time.sleep(0.01)
+
+
+def test_action_key():
+    command = Command(arguments=["/usr/bin/clang", "-c", "a.c"])
+    command.platform.properties.add(name="OSFamily", value="linux")
+    executing = DesiredState.Executing()
+    assert action_key(executing, command) == "command:OSFamily=linux:clang"
+    executing.auxiliary_metadata.add().Pack(
+        RequestMetadata(action_mnemonic="CppCompile")
+    )
+    assert action_key(executing, command) == "mnemonic:CppCompile"
+
+
+class TestInputHistory(object):
+    def test_predict(self, mock_cas_helper):
+        toolchain = FileData(mock_cas_helper.append_digest_data(b"cc"), True)
+        source = FileData(mock_cas_helper.append_digest_data(b"a.c"), False)
+        history = InputHistory(decay=0.5)
+        for _ in range(5):
+            history.record("compile", {toolchain.name_in_cache: toolchain})
+        history.record(
+            "compile",
+            {toolchain.name_in_cache: toolchain, source.name_in_cache: source},
+        )
+        predicted = history.predict(0.6)
+        assert [name for _, name, _ in predicted] == [toolchain.name_in_cache]
+        assert history.predict(0.6)[0][2] is toolchain
+
+    def test_key_share(self, mock_cas_helper):
+        cc = FileData(mock_cas_helper.append_digest_data(b"cc"), True)
+        java = FileData(mock_cas_helper.append_digest_data(b"java"), True)
+        history = InputHistory(decay=0.5)
+        for _ in range(5):
+            history.record("compile", {cc.name_in_cache: cc})
+        history.record("javac", {java.name_in_cache: java})
+        predicted = history.predict(0.0)
+        assert [name for _, name, _ in predicted] == [
+            cc.name_in_cache,
+            java.name_in_cache,
+        ]
+
+    def test_old_inputs_fade_out(self, mock_cas_helper):
+        old = FileData(mock_cas_helper.append_digest_data(b"old"), True)
+        new = FileData(mock_cas_helper.append_digest_data(b"new"), True)
+        history = InputHistory(decay=0.5)
+        history.record("compile", {old.name_in_cache: old})
+        for _ in range(10):
+            history.record("compile", {new.name_in_cache: new})
+        assert [name for _, name, _ in history.predict(0.0)] == [
+            new.name_in_cache
+        ]
+
+
+class TestPrefetcher(object):
+    def test_prefetch_while_idle(self, mock_cas_helper):
+        with (
+            tempfile.TemporaryDirectory() as filesystem_root,
+            tempfile.TemporaryDirectory() as cache_root,
+            tempfile.TemporaryDirectory() as local_root,
+        ):
+            meter = RecordingMeter()
+            filesystem = LocalHardlinkFilesystem(filesystem_root, meter)
+            filesystem.init()
+            builder = SharedTopLevelCachedDirectoryBuilder(
+                cache_root, mock_cas_helper, filesystem, meter
+            )
+            builder.init()
+            prefetcher = Prefetcher(
+                mock_cas_helper,
+                filesystem,
+                builder,
+                meter,
+                1,
+                history=InputHistory(decay=0.5),
+            )
+            prefetcher.start()
+            try:
+                input_root_data = {
+                    "cc": b"a" * 100,
+                    "external": {"toolchain": {"ld": b"b" * 20}},
+                    "src": {"a.c": b"c" * 5},
+                }
+                input_root_digest = mock_cas_helper.append_directory(
+                    input_root_data
+                )
+                input_root = mock_cas_helper.get_directory_by_digest(
+                    input_root_digest
+                )
+                # slot is busy, nothing is prefetched.
+                prefetcher.slot_busy()
+                prefetcher.record("compile", input_root_digest, input_root)
+                _wait_until(lambda: prefetcher._records.empty())
+                assert builder.current_size_bytes == 0
+                prefetcher.slot_idle()
+                _wait_until(lambda: meter.counts.get("prefetch_issued") == 3)
+                _wait_until(
+                    lambda: filesystem.current_size_bytes == 125
+                    and len(glob.glob(os.path.join(cache_root, "*"))) == 2
+                )
+                mock_cas_helper.clear_call_history()
+                builder.build(input_root_digest, input_root, local_root)
+                assert mock_cas_helper.call_history == []
+                with open(os.path.join(local_root, "cc"), "rb") as f:
+                    assert f.read() == b"a" * 100
+                prefetcher.record("compile", input_root_digest, input_root)
+                _wait_until(lambda: meter.counts.get("prefetch_hit") == 3)
+            finally:
+                prefetcher.stop()
+                prefetcher.join()
+
+
+def test_concurrent_prefetch_within_free_space(mock_cas_helper):
+    with tempfile.TemporaryDirectory() as filesystem_root:
+        file_nodes = [
+            mock_cas_helper.append_file(f"file_{i}", bytes([i]) * 100)
+            for i in range(8)
+        ]
+        meter = RecordingMeter()
+        filesystem = LocalHardlinkFilesystem(
+            filesystem_root, meter, max_cache_size_bytes=350
+        )
+        filesystem.init()
+        barrier = threading.Barrier(len(file_nodes))
+        futures = []
+
+        def _prefetch(fn):
+            barrier.wait()
+            futures.extend(filesystem.prefetch(mock_cas_helper, [fn]).values())
+
+        threads = [
+            threading.Thread(target=_prefetch, args=(fn,)) for fn in file_nodes
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for future in futures:
+            future.result()
+        assert len(futures) == 3
+        assert filesystem.current_size_bytes == 300
+        assert len(os.listdir(filesystem_root)) == 3
+        assert meter.counts["prefetch_skipped_file"] == 5
+        filesystem.close()
+
+
+def test_prefetch_dir_keeps_full_file_cache(mock_cas_helper):
+    with (
+        tempfile.TemporaryDirectory() as filesystem_root,
+        tempfile.TemporaryDirectory() as cache_root,
+    ):
+        file_nodes = [
+            mock_cas_helper.append_file(f"file_{i}", bytes([i]) * 100)
+            for i in range(3)
+        ]
+        meter = RecordingMeter()
+        filesystem = LocalHardlinkFilesystem(
+            filesystem_root, meter, max_cache_size_bytes=300
+        )
+        filesystem.init()
+        for future in filesystem.prefetch(
+            mock_cas_helper, file_nodes
+        ).values():
+            future.result()
+        cached = sorted(os.listdir(filesystem_root))
+        builder = SharedTopLevelCachedDirectoryBuilder(
+            cache_root, mock_cas_helper, filesystem, meter
+        )
+        builder.init()
+        dir_digest = mock_cas_helper.append_directory({"new": b"n" * 100})
+        dir_data = mock_cas_helper.get_directory_data_by_digest(dir_digest)
+        for future in builder.prefetch([dir_data]).values():
+            future.result()
+        assert sorted(os.listdir(filesystem_root)) == cached
+        assert filesystem.current_size_bytes == 300
+        assert meter.counts["prefetch_skipped_file"] == 1
+        with open(
+            os.path.join(cache_root, dir_data.name_in_cache, "new"), "rb"
+        ) as f:
+            assert f.read() == b"n" * 100
+        builder.close()
+        filesystem.close()
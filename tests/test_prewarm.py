@@ -0,0 +1,160 @@
+import io
+import os
+import os.path
+import tempfile
+
+import pytest
+from build.bazel.remote.execution.v2.remote_execution_pb2 import Digest
+
+from bbworker.directorybuilder import SharedTopLevelCachedDirectoryBuilder
+from bbworker.filesystem import LocalHardlinkFilesystem
+from bbworker.metrics import MeterBase
+from bbworker.metrics import create_dummy_meter
+from bbworker.prewarm import DIRECTORY
+from bbworker.prewarm import FILE
+from bbworker.prewarm import ROOT
+from bbworker.prewarm import ManifestEntry
+from bbworker.prewarm import ManifestError
+from bbworker.prewarm import export_manifest
+from bbworker.prewarm import prewarm
+from bbworker.prewarm import read_manifest
+from bbworker.prewarm import write_manifest
+
+
+class RecordingMeter(MeterBase):
+    def __init__(self):
+        self.counts = {}
+
+    def count(self, name, count=1, **kargs):
+        self.counts[name] = self.counts.get(name, 0) + count
+
+
+def _create_caches(
+    root: str, mock_cas_helper, meter=None, max_cache_size_bytes=0
+):
+    if meter is None:
+        meter = create_dummy_meter()
+    filesystem = LocalHardlinkFilesystem(
+        os.path.join(root, "files"),
+        meter,
+        max_cache_size_bytes=max_cache_size_bytes,
+    )
+    filesystem.init()
+    builder = SharedTopLevelCachedDirectoryBuilder(
+        os.path.join(root, "dirs"),
+        mock_cas_helper,
+        filesystem,
+        meter,
+        max_cache_size_bytes=max_cache_size_bytes,
+    )
+    builder.init()
+    return filesystem, builder
+
+
+def test_manifest_round_trip():
+    entries = [
+        ManifestEntry(FILE, Digest(hash="a", size_bytes=1), True),
+        ManifestEntry(FILE, Digest(hash="b", size_bytes=2)),
+        ManifestEntry(DIRECTORY, Digest(hash="c", size_bytes=3)),
+        ManifestEntry(ROOT, Digest(hash="d", size_bytes=4)),
+    ]
+    f = io.StringIO()
+    write_manifest(f, entries)
+    lines = ["# comment", ""] + f.getvalue().splitlines()
+    assert read_manifest(lines) == entries
+
+
+@pytest.mark.parametrize(
+    "line",
+    ["file a", "file a b", "other a 1", "directory a 1 x", "file a 1 y"],
+)
+def test_invalid_manifest(line):
+    with pytest.raises(ManifestError):
+        read_manifest([line])
+
+
+def test_prewarm_and_export(mock_cas_helper):
+    tool = mock_cas_helper.append_file("tool", b"tool")
+    mock_cas_helper.set_data_executable(b"tool", True)
+    root_digest = mock_cas_helper.append_directory(
+        {
+            "toolchain": {"bin": {"cc": b"cc"}, "lib": b"lib"},
+            "a.c": b"a.c",
+        }
+    )
+    sub_digest = mock_cas_helper.append_directory({"sdk": b"sdk"})
+    entries = [
+        ManifestEntry(FILE, tool.digest, True),
+        ManifestEntry(ROOT, root_digest),
+        ManifestEntry(DIRECTORY, sub_digest),
+    ]
+    with (
+        tempfile.TemporaryDirectory() as cold_root,
+        tempfile.TemporaryDirectory() as warm_root,
+        tempfile.TemporaryDirectory() as target,
+    ):
+        filesystem, builder = _create_caches(warm_root, mock_cas_helper)
+        try:
+            result = prewarm(mock_cas_helper, filesystem, builder, entries)
+            assert result.fetched == 4
+            assert result.failed == 0
+            # everything is cached, building needs no download.
+            mock_cas_helper.clear_call_history()
+            builder.build(
+                root_digest,
+                mock_cas_helper.get_directory_by_digest(root_digest),
+                target,
+            )
+            for digests in mock_cas_helper.call_history:
+                assert not list(digests)
+            with open(os.path.join(target, "toolchain/bin/cc"), "rb") as f:
+                assert f.read() == b"cc"
+        finally:
+            filesystem.close()
+
+        exported = export_manifest(
+            os.path.join(warm_root, "files"), os.path.join(warm_root, "dirs")
+        )
+        assert ManifestEntry(FILE, tool.digest, True) in exported
+        assert ManifestEntry(DIRECTORY, sub_digest) in exported
+        assert len([e for e in exported if e.kind == DIRECTORY]) == 2
+
+        # a new worker warmed with the export has the same caches.
+        filesystem, builder = _create_caches(cold_root, mock_cas_helper)
+        try:
+            result = prewarm(mock_cas_helper, filesystem, builder, exported)
+            assert result.failed == 0
+        finally:
+            filesystem.close()
+        for name in ["files", "dirs"]:
+            assert sorted(os.listdir(os.path.join(cold_root, name))) == sorted(
+                os.listdir(os.path.join(warm_root, name))
+            )
+
+
+def test_prewarm_skips_chunks_without_room(mock_cas_helper):
+    files = [
+        mock_cas_helper.append_file(f"file_{i}", bytes([i]) * 10)
+        for i in range(3)
+    ]
+    sub_digest = mock_cas_helper.append_directory({"sdk": b"s" * 30})
+    entries = [ManifestEntry(FILE, fn.digest) for fn in files]
+    entries.append(ManifestEntry(DIRECTORY, sub_digest))
+    with tempfile.TemporaryDirectory() as root:
+        meter = RecordingMeter()
+        filesystem, builder = _create_caches(
+            root, mock_cas_helper, meter, max_cache_size_bytes=25
+        )
+        try:
+            result = prewarm(
+                mock_cas_helper,
+                filesystem,
+                builder,
+                entries,
+                chunk_size_bytes=10,
+            )
+            assert result.fetched == 2
+            assert meter.counts["prefetch_skipped_file"] == 1
+            assert meter.counts["prefetch_skipped_dir"] == 1
+        finally:
+            filesystem.close()
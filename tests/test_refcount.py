@@ -0,0 +1,112 @@
+import time
+
+import pytest
+
+from bbworker.refcount import RefcountTable
+from bbworker.refcount import summarize
+
+
+def test_summarize():
+    summary = summarize([("a", 10), ("b", 20), ("a", 10)])
+    assert sorted(summary) == [("a", 2, 10), ("b", 1, 20)]
+
+
+def test_acquire_and_release():
+    table = RefcountTable()
+    first = summarize([("a", 10), ("b", 20), ("a", 10)])
+    second = summarize([("b", 20), ("c", 30)])
+    reservation = table.reserve()
+    assert reservation.acquire(first) == 30
+    # b is referenced by first already.
+    assert reservation.acquire(second) == 30
+    reservation.commit()
+    assert (table.count("a"), table.count("b"), table.count("c")) == (2, 2, 1)
+    reservation = table.reserve()
+    # b is still referenced by second.
+    assert reservation.release(first) == 10
+    assert reservation.release(second) == 50
+    reservation.commit()
+    assert len(table) == 0
+
+
+def test_rollback():
+    table = RefcountTable()
+    summary = summarize([("a", 10)])
+    reservation = table.reserve()
+    reservation.acquire(summary)
+    reservation.commit()
+    reservation = table.reserve()
+    assert reservation.release(summary) == 10
+    # tentatively released, so it's new again.
+    assert reservation.acquire(summary) == 10
+    assert reservation.acquire(summarize([("b", 20)])) == 20
+    reservation.rollback()
+    assert table.count("a") == 1
+    assert table.count("b") == 0
+    reservation = table.reserve()
+    assert reservation.acquire(summary) == 0
+
+
+def _copying_required_size(tree, file_count):
+    # how the builder counted before reservations: a copy of the counts at
+    # every directory.
+    new_file_count = dict(file_count)
+    result = 0
+    for name, size_bytes in tree["files"]:
+        if name not in new_file_count:
+            new_file_count[name] = 1
+            result += size_bytes
+        else:
+            new_file_count[name] += 1
+    for subtree in tree["dirs"]:
+        subdir_result, new_file_count = _copying_required_size(
+            subtree, new_file_count
+        )
+        result += subdir_result
+    return result, new_file_count
+
+
+def _iter_tree_files(tree):
+    yield from tree["files"]
+    for subtree in tree["dirs"]:
+        yield from _iter_tree_files(subtree)
+
+
+@pytest.mark.only_in_full_test
+def test_admission_benchmark():
+    cached_files = 1000 * 1000
+    table = RefcountTable()
+    reservation = table.reserve()
+    reservation.acquire(
+        summarize((f"cached_{i}", 1) for i in range(cached_files))
+    )
+    reservation.commit()
+    file_count = {f"cached_{i}": 1 for i in range(cached_files)}
+    # 10 subdirectories of 10 files each, half of them cached already.
+    tree = {
+        "files": [],
+        "dirs": [
+            {
+                "files": [
+                    (f"cached_{i * 10 + j}" if j % 2 else f"new_{i}_{j}", 1)
+                    for j in range(10)
+                ],
+                "dirs": [],
+            }
+            for i in range(10)
+        ],
+    }
+    start_at = time.perf_counter()
+    copied_size, _ = _copying_required_size(tree, file_count)
+    copying_seconds = time.perf_counter() - start_at
+    start_at = time.perf_counter()
+    reservation = table.reserve()
+    reserved_size = reservation.acquire(summarize(_iter_tree_files(tree)))
+    reservation.commit()
+    reserving_seconds = time.perf_counter() - start_at
+    assert copied_size == reserved_size == 50
+    print(
+        f"admit 11 directories with {cached_files} cached files: "
+        f"copying {copying_seconds * 1000:.1f}ms, "
+        f"reservation {reserving_seconds * 1000:.3f}ms"
+    )
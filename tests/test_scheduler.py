@@ -0,0 +1,118 @@
+import threading
+import time
+
+import pytest
+
+from bbworker.metrics import MeterBase
+from bbworker.metrics import create_dummy_meter
+from bbworker.scheduler import FairShareScheduler
+
+
+class RecordingMeter(MeterBase):
+    def __init__(self):
+        self.records = []
+
+    def record(self, name, value, **kargs):
+        self.records.append((name, value, kargs))
+
+
+def _run_blocked(scheduler, submit_all):
+    """Block the only worker, queue tasks, then release it and return the
+    order tasks were executed in.
+    """
+    started = threading.Event()
+    release = threading.Event()
+    order = []
+
+    def _block():
+        started.set()
+        release.wait()
+
+    scheduler.submit("blocker", 1, _block)
+    started.wait()
+    futures = submit_all(lambda name: order.append(name))
+    release.set()
+    for f in futures:
+        f.result()
+    return order
+
+
+class TestFairShareScheduler:
+    def test_result_and_exception(self):
+        scheduler = FairShareScheduler(create_dummy_meter(), 2)
+        try:
+            assert scheduler.submit("a", 1, lambda x: x * 2, 21).result() == 42
+
+            def _raise():
+                raise ValueError("expected")
+
+            with pytest.raises(ValueError):
+                scheduler.submit("a", 1, _raise).result()
+        finally:
+            scheduler.shutdown()
+
+    def test_small_caller_not_starved(self):
+        scheduler = FairShareScheduler(create_dummy_meter(), 1, age_boost=0)
+
+        def _submit_all(run):
+            futures = []
+            for i in range(20):
+                futures.append(scheduler.submit("big", 100, run, f"big_{i}"))
+            futures.append(scheduler.submit("small", 100, run, "small_0"))
+            return futures
+
+        try:
+            order = _run_blocked(scheduler, _submit_all)
+        finally:
+            scheduler.shutdown()
+        assert order.index("small_0") <= 1
+
+    def test_weight(self):
+        scheduler = FairShareScheduler(create_dummy_meter(), 1, age_boost=0)
+        scheduler.set_weight("heavy", 3)
+
+        def _submit_all(run):
+            futures = []
+            for i in range(8):
+                futures.append(scheduler.submit("light", 10, run, "light"))
+                futures.append(scheduler.submit("heavy", 10, run, "heavy"))
+            return futures
+
+        try:
+            order = _run_blocked(scheduler, _submit_all)
+        finally:
+            scheduler.shutdown()
+        assert order[:8].count("heavy") == 6
+
+    def test_age_boost(self):
+        scheduler = FairShareScheduler(create_dummy_meter(), 1, age_boost=1e12)
+        scheduler.set_weight("low", 0.001)
+
+        def _submit_all(run):
+            futures = [scheduler.submit("low", 100, run, "low")]
+            time.sleep(0.01)
+            for i in range(5):
+                futures.append(scheduler.submit("high", 100, run, "high"))
+            return futures
+
+        try:
+            order = _run_blocked(scheduler, _submit_all)
+        finally:
+            scheduler.shutdown()
+        # waited longest, so boosted over the heavier caller.
+        assert order[0] == "low"
+
+    def test_wait_histogram_per_caller(self):
+        meter = RecordingMeter()
+        scheduler = FairShareScheduler(meter, 2)
+        try:
+            scheduler.submit("0", 1, lambda: None).result()
+            scheduler.submit("1", 1, lambda: None).result()
+        finally:
+            scheduler.shutdown()
+        callers = [
+            kargs["attributes"]["caller"]
+            for name, _, kargs in meter.records
+            if name == "download_schedule_wait_seconds"
+        ]
+        assert sorted(callers) == ["0", "1"]
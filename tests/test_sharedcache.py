@@ -0,0 +1,201 @@
+import os
+import os.path
+import tempfile
+
+from bbworker.filesystem import LocalHardlinkFilesystem
+from bbworker.lock import InterProcessLock
+from bbworker.metrics import create_dummy_meter
+from bbworker.sharedcache import SharedFileIndex
+
+
+def _cache_name(fnode):
+    return f"{fnode.digest.hash}_{fnode.digest.size_bytes}"
+
+
+class TestInterProcessLock(object):
+    def test_non_blocking_conflict(self):
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, "lock")
+            lock_a = InterProcessLock(path)
+            lock_b = InterProcessLock(path)
+            assert lock_a.acquire(blocking=False)
+            assert not lock_b.acquire(blocking=False)
+            lock_a.release()
+            assert lock_b.acquire(blocking=False)
+            lock_b.release()
+
+
+class TestSharedFileIndex(object):
+    def test_open_alone(self):
+        with tempfile.TemporaryDirectory() as root:
+            index_a = SharedFileIndex(root)
+            index_b = SharedFileIndex(root)
+            with index_a.init_lock():
+                assert index_a.open()
+            with index_b.init_lock():
+                assert not index_b.open()
+            index_a.close()
+            index_b.close()
+            # all users exited.
+            index_c = SharedFileIndex(root)
+            with index_c.init_lock():
+                assert index_c.open()
+            index_c.close()
+
+    def test_reserve(self):
+        with tempfile.TemporaryDirectory() as root:
+            index = SharedFileIndex(root)
+            with index.init_lock():
+                index.open()
+            try:
+                assert index.reserve(10, 15, set()) == []
+                assert index.reserve(10, 15, set()) is None
+                index.release(10)
+                assert index.total_bytes() == 0
+            finally:
+                index.close()
+
+    def test_reclaim_reservation_of_dead_process(self):
+        with tempfile.TemporaryDirectory() as root:
+            index_a = SharedFileIndex(root)
+            index_b = SharedFileIndex(root)
+            with index_a.init_lock():
+                index_a.open()
+            with index_b.init_lock():
+                index_b.open()
+            try:
+                assert index_a.reserve(10, 20, set()) == []
+                assert index_b.reserve(5, 20, set()) == []
+                assert index_a.reserve(10, 20, set()) is None
+                # b crashes while downloading.
+                index_b._alive_lock.release()
+                assert index_a.reserve(10, 20, set()) == []
+                assert index_a.total_bytes() == 20
+                index_a.release(20)
+                assert index_a.total_bytes() == 0
+            finally:
+                index_a.close()
+                index_b._alive_lock = None
+                index_b.close()
+
+    def test_open_reclaims_reservation_of_dead_process(self):
+        with tempfile.TemporaryDirectory() as root:
+            index_a = SharedFileIndex(root)
+            index_b = SharedFileIndex(root)
+            with index_a.init_lock():
+                index_a.open()
+            with index_b.init_lock():
+                index_b.open()
+            index_b.reserve(5, 15, set())
+            index_b._alive_lock.release()
+            index_b._alive_lock = None
+            index_b.close()
+            index_c = SharedFileIndex(root)
+            try:
+                with index_c.init_lock():
+                    assert not index_c.open()
+                assert index_c.total_bytes() == 0
+            finally:
+                index_a.close()
+                index_c.close()
+
+
+class TestSharedFilesystem(object):
+    def test_adopt_files_of_other_process(self, mock_cas_helper):
+        with (
+            tempfile.TemporaryDirectory() as cache_root,
+            tempfile.TemporaryDirectory() as target_a,
+            tempfile.TemporaryDirectory() as target_b,
+        ):
+            meter = create_dummy_meter()
+            fnodes = [
+                mock_cas_helper.append_file("a", b"shared_a"),
+                mock_cas_helper.append_file("b", b"shared_bb"),
+            ]
+            fs_a = LocalHardlinkFilesystem(cache_root, meter, shared=True)
+            fs_b = LocalHardlinkFilesystem(cache_root, meter, shared=True)
+            fs_a.init()
+            fs_b.init()
+            try:
+                fs_a.fetch_to(mock_cas_helper, fnodes, target_a)
+                assert len(mock_cas_helper.call_history) == 1
+                mock_cas_helper.clear_call_history()
+                fs_b.fetch_to(mock_cas_helper, fnodes, target_b)
+                assert len(mock_cas_helper.call_history) == 0
+                with open(os.path.join(target_b, "a"), "rb") as f:
+                    assert f.read() == b"shared_a"
+                assert fs_a.current_size_bytes == 17
+                assert fs_b.current_size_bytes == 17
+            finally:
+                fs_a.close()
+                fs_b.close()
+
+    def test_coordinated_eviction(self, mock_cas_helper):
+        with (
+            tempfile.TemporaryDirectory() as cache_root,
+            tempfile.TemporaryDirectory() as target_a,
+            tempfile.TemporaryDirectory() as target_b,
+        ):
+            meter = create_dummy_meter()
+            fnode_a = mock_cas_helper.append_file("a", b"0123456789")
+            fnode_b = mock_cas_helper.append_file("b", b"abcdefghij")
+            fs_a = LocalHardlinkFilesystem(
+                cache_root, meter, max_cache_size_bytes=15, shared=True
+            )
+            fs_b = LocalHardlinkFilesystem(
+                cache_root, meter, max_cache_size_bytes=15, shared=True
+            )
+            fs_a.init()
+            fs_b.init()
+            try:
+                fs_a.fetch_to(mock_cas_helper, [fnode_a], target_a)
+                # evicts the file downloaded by fs_a.
+                fs_b.fetch_to(mock_cas_helper, [fnode_b], target_b)
+                assert not os.path.exists(
+                    os.path.join(cache_root, _cache_name(fnode_a))
+                )
+                assert fs_a.current_size_bytes == 10
+                mock_cas_helper.clear_call_history()
+                # fs_a notices the eviction and downloads again.
+                os.unlink(os.path.join(target_a, "a"))
+                fs_a.fetch_to(mock_cas_helper, [fnode_a], target_a)
+                assert len(mock_cas_helper.call_history) == 1
+                with open(os.path.join(target_a, "a"), "rb") as f:
+                    assert f.read() == b"0123456789"
+                # both processes respect the same max size.
+                fs_b.fetch_to(mock_cas_helper, [fnode_a, fnode_b], target_b)
+                assert fs_a.current_size_bytes <= 15
+                assert len(os.listdir(target_b)) == 2
+                big = mock_cas_helper.append_file("big", b"x" * 16)
+                # too large for the cache, only in the target directory.
+                fs_b.fetch_to(mock_cas_helper, [big], target_b)
+                with open(os.path.join(target_b, "big"), "rb") as f:
+                    assert f.read() == b"x" * 16
+                assert not os.path.exists(
+                    os.path.join(cache_root, _cache_name(big))
+                )
+            finally:
+                fs_a.close()
+                fs_b.close()
+
+    def test_restart_reuses_index(self, mock_cas_helper):
+        with (
+            tempfile.TemporaryDirectory() as cache_root,
+            tempfile.TemporaryDirectory() as target_root,
+        ):
+            meter = create_dummy_meter()
+            fnode = mock_cas_helper.append_file("a", b"restart")
+            fs_a = LocalHardlinkFilesystem(cache_root, meter, shared=True)
+            fs_a.init()
+            fs_a.fetch_to(mock_cas_helper, [fnode], target_root)
+            fs_b = LocalHardlinkFilesystem(cache_root, meter, shared=True)
+            fs_b.init()
+            fs_a.close()
+            fs_b.close()
+            # the last process exited, so the files are verified again.
+            fs_c = LocalHardlinkFilesystem(cache_root, meter, shared=True)
+            fs_c.init()
+            try:
+                assert fs_c.current_size_bytes == 7
+            finally:
+                fs_c.close()
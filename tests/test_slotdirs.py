@@ -0,0 +1,138 @@
+import os
+import os.path
+import tempfile
+
+from bbworker.directorybuilder import SharedTopLevelCachedDirectoryBuilder
+from bbworker.filesystem import LocalHardlinkFilesystem
+from bbworker.metrics import MeterBase
+from bbworker.slotdirs import SlotDirectories
+from bbworker.slotdirs import ToplevelHistory
+from bbworker.util import is_dir_link
+
+
+class RecordingMeter(MeterBase):
+    def __init__(self):
+        self.counts = {}
+
+    def count(self, name, count=1, **kargs):
+        self.counts[name] = self.counts.get(name, 0) + count
+
+
+def test_toplevel_history(mock_cas_helper):
+    def _dir(data):
+        return mock_cas_helper.get_directory_data_by_digest(
+            mock_cas_helper.append_directory(data)
+        )
+
+    old = _dir({"file": b"old"})
+    new = _dir({"file": b"new"})
+    tool = _dir({"file": b"tool"})
+    history = ToplevelHistory(decay=0.9)
+    for _ in range(3):
+        history.record({"external": old, "tool": tool})
+    history.record({"external": new, "tool": tool})
+    # the most likely one at every name.
+    assert history.common(0.05) == {"external": old, "tool": tool}
+    for _ in range(2):
+        history.record({"external": new, "tool": tool})
+    assert history.common(0.05) == {"external": new, "tool": tool}
+    assert history.common(0.4) == {"tool": tool}
+
+
+def test_double_buffer(mock_cas_helper):
+    with (
+        tempfile.TemporaryDirectory() as filesystem_root,
+        tempfile.TemporaryDirectory() as build_root,
+        tempfile.TemporaryDirectory() as cache_root,
+    ):
+        inputs = []
+        for i in range(3):
+            digest = mock_cas_helper.append_directory(
+                {
+                    "tool": {"cc": b"cc"},
+                    "src": {"a.c": f"{i}".encode()},
+                    "bazel-out": {},
+                }
+            )
+            inputs.append(
+                (digest, mock_cas_helper.get_directory_by_digest(digest))
+            )
+        meter = RecordingMeter()
+        filesystem = LocalHardlinkFilesystem(filesystem_root, meter)
+        filesystem.init()
+        builder = SharedTopLevelCachedDirectoryBuilder(
+            cache_root, mock_cas_helper, filesystem, meter
+        )
+        builder.init()
+        slot = os.path.join(build_root, "0")
+        slot_directories = SlotDirectories(
+            builder,
+            slot,
+            meter,
+            history=ToplevelHistory(decay=0.5),
+            # used by every action, not by one of the last two.
+            min_probability=0.75,
+        )
+        try:
+            paths = []
+            for digest, input_root in inputs:
+                path = slot_directories.acquire()
+                paths.append(path)
+                builder.build(digest, input_root, path, caller="0")
+                with open(os.path.join(path, "bazel-out", "out"), "w"):
+                    pass
+                slot_directories.release(digest, input_root)
+            assert paths == [slot, slot + ".b", slot]
+            slot_directories.prepare()
+            prepared = slot_directories.acquire()
+            assert prepared == slot + ".b"
+            # the output of the previous action is gone, the link used by
+            # every action is kept.
+            assert os.listdir(prepared) == ["tool"]
+            tool = os.path.join(prepared, "tool")
+            assert is_dir_link(tool)
+            inode = os.lstat(tool).st_ino
+            digest, input_root = inputs[0]
+            builder.build(digest, input_root, prepared, caller="0")
+            assert os.lstat(tool).st_ino == inode
+            assert sorted(os.listdir(prepared)) == ["bazel-out", "src", "tool"]
+            with open(os.path.join(prepared, "src", "a.c"), "rb") as f:
+                assert f.read() == b"0"
+            assert meter.counts["prepare_kept_dir"] >= 1
+        finally:
+            slot_directories.close()
+            builder.close()
+
+
+def test_prepare_links_cached(mock_cas_helper):
+    with (
+        tempfile.TemporaryDirectory() as filesystem_root,
+        tempfile.TemporaryDirectory() as build_root,
+        tempfile.TemporaryDirectory() as cache_root,
+    ):
+        data = {"tool": {"cc": b"cc"}, "src": {"a.c": b"a"}, "bazel-out": {}}
+        digest = mock_cas_helper.append_directory(data)
+        input_root = mock_cas_helper.get_directory_by_digest(digest)
+        meter = RecordingMeter()
+        filesystem = LocalHardlinkFilesystem(filesystem_root, meter)
+        filesystem.init()
+        builder = SharedTopLevelCachedDirectoryBuilder(
+            cache_root, mock_cas_helper, filesystem, meter
+        )
+        builder.init()
+        builder.build(digest, input_root, os.path.join(build_root, "a"))
+        dirs = builder.toplevel_cached(digest, input_root)
+        # never cached because actions write there.
+        assert sorted(dirs) == ["src", "tool"]
+        other = os.path.join(build_root, "b")
+        builder.prepare(other, dirs)
+        assert meter.counts["prepare_linked_dir"] == 2
+        assert sorted(os.listdir(other)) == ["src", "tool"]
+        inodes = {n: os.lstat(os.path.join(other, n)).st_ino for n in dirs}
+        mock_cas_helper.clear_call_history()
+        builder.build(digest, input_root, other)
+        assert mock_cas_helper.call_history == []
+        assert sorted(os.listdir(other)) == ["bazel-out", "src", "tool"]
+        for name, inode in inodes.items():
+            assert os.lstat(os.path.join(other, name)).st_ino == inode
+        builder.close()
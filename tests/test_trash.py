@@ -0,0 +1,81 @@
+import os
+import os.path
+import stat
+import tempfile
+import time
+
+from bbworker.trash import Trash
+from bbworker.trash import remove_tree
+
+
+def _make_tree(root: str) -> str:
+    tree = os.path.join(root, "tree")
+    os.makedirs(os.path.join(tree, "sub"))
+    with open(os.path.join(tree, "sub", "file"), "wb") as f:
+        f.write(b"a" * 10)
+    os.chmod(os.path.join(tree, "sub", "file"), stat.S_IRUSR)
+    os.chmod(os.path.join(tree, "sub"), stat.S_IRUSR | stat.S_IXUSR)
+    os.chmod(tree, stat.S_IRUSR | stat.S_IXUSR)
+    return tree
+
+
+def test_remove_tree_keeps_link_targets():
+    with tempfile.TemporaryDirectory() as root:
+        tree = _make_tree(root)
+        target = os.path.join(root, "target")
+        os.makedirs(target)
+        os.chmod(tree, stat.S_IRWXU)
+        os.symlink(target, os.path.join(tree, "link"))
+        remove_tree(tree)
+        assert os.listdir(root) == ["target"]
+
+
+def test_move_and_reclaim():
+    with tempfile.TemporaryDirectory() as root:
+        trash_root = os.path.join(root, "trash")
+        trash = Trash(trash_root)
+        # not started, nothing is removed in background.
+        os.makedirs(trash_root)
+        trash.move(_make_tree(root), 10)
+        trash.move(_make_tree(root), 20)
+        assert not os.path.exists(os.path.join(root, "tree"))
+        assert trash.size_bytes == 30
+        assert len(os.listdir(trash_root)) == 2
+        trash.reclaim(5)
+        assert trash.size_bytes == 20
+        trash.reclaim(100)
+        assert trash.size_bytes == 0
+        assert os.listdir(trash_root) == []
+
+
+def test_remove_in_background():
+    with tempfile.TemporaryDirectory() as root:
+        trash_root = os.path.join(root, "trash")
+        os.makedirs(trash_root)
+        # left by a previous process.
+        os.rename(_make_tree(root), os.path.join(trash_root, "left"))
+        trash = Trash(trash_root, io_nice=None)
+        trash.start()
+        trash.move(_make_tree(root), 10)
+        trash.reclaim(10)
+        trash.stop()
+        assert not trash.is_alive()
+        # started again, e.g. by the next init of the builder.
+        trash.start()
+        trash.move(_make_tree(root), 10)
+        # removed by the new thread.
+        deadline = time.time() + 10
+        while trash.size_bytes and time.time() < deadline:
+            time.sleep(0.01)
+        trash.stop()
+        assert trash.size_bytes == 0
+        assert os.listdir(trash_root) == []
+
+
+def test_remove_at_once_without_trash_root():
+    with tempfile.TemporaryDirectory() as root:
+        trash = Trash(os.path.join(root, "missing"))
+        tree = _make_tree(root)
+        trash.move(tree, 10)
+        assert not os.path.exists(tree)
+        assert trash.size_bytes == 0
@@ -0,0 +1,48 @@
+import os.path
+import tempfile
+import threading
+
+import pytest
+
+from bbworker.verify import Scrubber
+from bbworker.verify import load_fingerprints
+from bbworker.verify import parse_verify_level
+from bbworker.verify import save_fingerprints
+
+
+def test_parse_verify_level():
+    assert parse_verify_level("sampled") == "sampled"
+    with pytest.raises(ValueError):
+        parse_verify_level("fast")
+
+
+def test_fingerprints():
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, "fingerprints")
+        assert load_fingerprints(path) == {}
+        save_fingerprints(path, {"a": [1, 2, 3, 4]})
+        assert load_fingerprints(path) == {"a": [1, 2, 3, 4]}
+        with open(path, "w") as f:
+            f.write("{")
+        assert load_fingerprints(path) == {}
+
+
+def test_scrubber():
+    budgets = []
+    called = threading.Event()
+
+    def scrub(budget_bytes):
+        budgets.append(budget_bytes)
+        called.set()
+
+    scrubber = Scrubber("test_scrubber", scrub, 0.01, 1024)
+    scrubber.start()
+    assert called.wait(10)
+    scrubber.stop()
+    assert not scrubber.is_alive()
+    assert budgets[0] == 1024
+    called.clear()
+    scrubber.start()
+    assert called.wait(10)
+    scrubber.stop()
+    assert not scrubber.is_alive()
@@ -0,0 +1,213 @@
+import os
+import os.path
+import stat
+import struct
+import tempfile
+import time
+
+import pytest
+
+from bbworker.cacheinfo import FileCacheInfo
+from bbworker.filesystem import LocalHardlinkFilesystem
+from bbworker.metrics import MeterBase
+from bbworker.metrics import create_dummy_meter
+from bbworker.util import set_read_only
+from bbworker.watcher import IN_ATTRIB
+from bbworker.watcher import IN_MODIFY
+from bbworker.watcher import IN_Q_OVERFLOW
+from bbworker.watcher import CacheWatcher
+
+
+pytestmark = pytest.mark.skipif(
+    not CacheWatcher.available(), reason="inotify is not available"
+)
+
+
+class RecordingMeter(MeterBase):
+    def __init__(self):
+        self.counts = {}
+
+    def count(self, name, count=1, **kargs):
+        self.counts[name] = self.counts.get(name, 0) + count
+
+
+def _wait_until(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline, "timeout"
+        time.sleep(0.01)
+
+
+def _create_cached_file(cache_root: str, name: str, data: bytes):
+    p = os.path.join(cache_root, name)
+    with open(p, "wb") as f:
+        f.write(data)
+    set_read_only(p)
+    return FileCacheInfo(os.stat(p))
+
+
+def _tamper(path: str):
+    os.chmod(path, stat.S_IRUSR | stat.S_IWUSR)
+    with open(path, "ab") as f:
+        f.write(b"tampered")
+    set_read_only(path)
+
+
+class TestCacheWatcher(object):
+    def test_modified_through_hardlink(self):
+        with (
+            tempfile.TemporaryDirectory() as cache_root,
+            tempfile.TemporaryDirectory() as build_root,
+        ):
+            watcher = CacheWatcher(cache_root, create_dummy_meter())
+            watcher.start()
+            try:
+                info = _create_cached_file(cache_root, "a", b"data")
+                watcher.mark_clean("a", info, watcher.sequence())
+                assert watcher.is_clean("a")
+                # our own links only change st_nlink.
+                target = os.path.join(build_root, "a")
+                os.link(os.path.join(cache_root, "a"), target)
+                time.sleep(0.1)
+                assert watcher.is_clean("a")
+                _tamper(target)
+                _wait_until(lambda: not watcher.is_clean("a"))
+            finally:
+                watcher.stop()
+
+    def test_mode_changed(self):
+        with tempfile.TemporaryDirectory() as cache_root:
+            watcher = CacheWatcher(cache_root, create_dummy_meter())
+            watcher.start()
+            try:
+                info = _create_cached_file(cache_root, "a", b"data")
+                watcher.mark_clean("a", info, watcher.sequence())
+                os.chmod(os.path.join(cache_root, "a"), stat.S_IRWXU)
+                _wait_until(lambda: not watcher.is_clean("a"))
+            finally:
+                watcher.stop()
+
+    @pytest.mark.only_in_full_test
+    def test_link_more_than_queued_events(self):
+        with open("/proc/sys/fs/inotify/max_queued_events") as f:
+            max_queued_events = int(f.read())
+        with open("/proc/sys/fs/inotify/max_user_watches") as f:
+            max_user_watches = int(f.read())
+        count = max_queued_events + 1000
+        if count > max_user_watches // 2:
+            pytest.skip("not enough inotify watches")
+        with (
+            tempfile.TemporaryDirectory() as cache_root,
+            tempfile.TemporaryDirectory() as build_root,
+        ):
+            meter = RecordingMeter()
+            watcher = CacheWatcher(cache_root, meter)
+            watcher.start()
+            try:
+                names = [str(i) for i in range(count)]
+                for name in names:
+                    info = _create_cached_file(cache_root, name, b"data")
+                    watcher.mark_clean(name, info, watcher.sequence())
+                start_at = time.time()
+                for name in names:
+                    os.link(
+                        os.path.join(cache_root, name),
+                        os.path.join(build_root, name),
+                    )
+                link_seconds = time.time() - start_at
+                time.sleep(0.5)
+                print(f"linked {count} watched files in {link_seconds:.2f}s")
+                assert "cache_watcher_overflow" not in meter.counts
+                assert all(watcher.is_clean(name) for name in names)
+            finally:
+                watcher.stop()
+
+    def test_changed_after_check(self):
+        with tempfile.TemporaryDirectory() as cache_root:
+            watcher = CacheWatcher(cache_root, create_dummy_meter())
+            watcher.start()
+            try:
+                info = _create_cached_file(cache_root, "a", b"data")
+                since = watcher.sequence()
+                # modified after checked but before watched.
+                _tamper(os.path.join(cache_root, "a"))
+                watcher.mark_clean("a", info, since)
+                assert not watcher.is_clean("a")
+            finally:
+                watcher.stop()
+
+    def test_attrib_events_coalesced(self):
+        with tempfile.TemporaryDirectory() as cache_root:
+            watcher = CacheWatcher(cache_root, create_dummy_meter())
+            watcher.start()
+            try:
+                for name in ["a", "b"]:
+                    info = _create_cached_file(cache_root, name, b"data")
+                    watcher.mark_clean(name, info, watcher.sequence())
+                wd_a = watcher._name_to_wd["a"]
+                wd_b = watcher._name_to_wd["b"]
+                to_check = watcher._handle_events(
+                    struct.pack("iIII", wd_a, IN_ATTRIB, 0, 0) * 3
+                    + struct.pack("iIII", wd_b, IN_ATTRIB, 0, 0)
+                )
+                assert to_check == {"a", "b"}
+                # a later read in the same batch.
+                watcher._handle_events(
+                    struct.pack("iIII", wd_b, IN_MODIFY, 0, 0), to_check
+                )
+                assert to_check == {"a"}
+                assert watcher.is_clean("a")
+                assert not watcher.is_clean("b")
+            finally:
+                watcher.stop()
+
+    def test_overflow(self):
+        with tempfile.TemporaryDirectory() as cache_root:
+            watcher = CacheWatcher(cache_root, create_dummy_meter())
+            watcher.start()
+            try:
+                info = _create_cached_file(cache_root, "a", b"data")
+                since = watcher.sequence()
+                watcher.mark_clean("a", info, since)
+                watcher._handle_events(
+                    struct.pack("iIII", -1, IN_Q_OVERFLOW, 0, 0)
+                )
+                assert not watcher.is_clean("a")
+                # checked before the overflow.
+                watcher.mark_clean("a", info, since)
+                assert not watcher.is_clean("a")
+                watcher.mark_clean("a", info, watcher.sequence())
+                assert watcher.is_clean("a")
+            finally:
+                watcher.stop()
+
+
+class TestWatchedFilesystem(object):
+    def test_tampered_file_downloaded_again(self, mock_cas_helper):
+        with (
+            tempfile.TemporaryDirectory() as filesystem_root,
+            tempfile.TemporaryDirectory() as target_a,
+            tempfile.TemporaryDirectory() as target_b,
+        ):
+            fnode = mock_cas_helper.append_file("a", b"data")
+            filesystem = LocalHardlinkFilesystem(
+                filesystem_root, create_dummy_meter(), watch=True
+            )
+            filesystem.init()
+            try:
+                filesystem.fetch_to(mock_cas_helper, [fnode], target_a)
+                name_in_cache = (
+                    f"{fnode.digest.hash}_{fnode.digest.size_bytes}"
+                )
+                assert filesystem._watcher.is_clean(name_in_cache)
+                _tamper(os.path.join(target_a, "a"))
+                _wait_until(
+                    lambda: not filesystem._watcher.is_clean(name_in_cache)
+                )
+                mock_cas_helper.clear_call_history()
+                filesystem.fetch_to(mock_cas_helper, [fnode], target_b)
+                assert len(mock_cas_helper.call_history) == 1
+                with open(os.path.join(target_b, "a"), "rb") as f:
+                    assert f.read() == b"data"
+            finally:
+                filesystem.close()